@@ -0,0 +1,47 @@
+"""
+鉴权开销压测：对比每次请求都做 RSA 签名校验与缓存已校验 token 的单次 verify_token 耗时
+
+    python benchmarks/bench_auth.py --requests 5000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_dir)
+os.environ.setdefault('MESSAGE_PUSH_CONFIG', os.path.join(root_dir, 'tests', 'config.yml'))
+
+from message_push.authorize import AzureAuthorization  # noqa: E402
+from tests.mocks import MockJWKSServer  # noqa: E402
+
+
+async def measure(authz: AzureAuthorization, token: str, requests: int) -> float:
+    # 预先获取公钥，只统计校验开销
+    await authz.verify_token(token)
+    start = time.perf_counter()
+    for _ in range(requests):
+        await authz.verify_token(token)
+    return (time.perf_counter() - start) / requests
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=5000)
+    args = parser.parse_args()
+
+    with MockJWKSServer() as server:
+        token = server.issue_token('clientid')
+        before = asyncio.run(measure(AzureAuthorization('appid', 'clientid', server.jwks_url, token_cache_size=0),
+                                     token, args.requests))
+        after = asyncio.run(measure(AzureAuthorization('appid', 'clientid', server.jwks_url),
+                                    token, args.requests))
+
+    print(f"requests: {args.requests}")
+    print(f"signature check per request: {before * 1e6:9.1f} us")
+    print(f"verified-token cache:        {after * 1e6:9.1f} us ({before / after:.0f}x)")
+
+
+if __name__ == '__main__':
+    main()
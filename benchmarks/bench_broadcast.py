@@ -0,0 +1,93 @@
+"""
+大批量群发压测：对比 /messages 接口（一个 JSON 请求体）与 /broadcasts 接口（NDJSON 分块上传）发送给大量接收人时，
+web 进程处理请求的峰值内存及耗时
+
+    python benchmarks/bench_broadcast.py --recipients 50000,200000
+
+请求通过 ASGI 直接调用应用，任务写入临时目录中的 sqlite 队列，不发送
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import httpx
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_dir)
+os.environ.setdefault('MESSAGE_PUSH_CONFIG', os.path.join(root_dir, 'tests', 'config.yml'))
+
+from message_push import main as web  # noqa: E402
+from message_push.authorize import has_access  # noqa: E402
+from message_push.dispatch.queue import SQLiteQueue  # noqa: E402
+
+
+def phones(count: int):
+    return (f'150{i:08d}' for i in range(count))
+
+
+async def post_messages(client: httpx.AsyncClient, count: int):
+    body = json.dumps({"template_name": "notice", "to_users": list(phones(count)), "message": {"name": "x"}})
+    resp = await client.post('/api/v1/services/sms/messages', content=body,
+                             headers={"Content-Type": "application/json"})
+    resp.raise_for_status()
+
+
+async def post_broadcast(client: httpx.AsyncClient, count: int):
+    async def body():
+        batch = []
+        for phone in phones(count):
+            batch.append(f'"{phone}"\n')
+            if len(batch) == 1000:
+                yield ''.join(batch).encode()
+                batch = []
+        if batch:
+            yield ''.join(batch).encode()
+
+    params = json.dumps({"template_name": "notice", "message": {"name": "x"}})
+    resp = await client.post('/api/v1/services/sms/broadcasts', params={"params": params}, content=body(),
+                             headers={"Content-Type": "application/x-ndjson"})
+    resp.raise_for_status()
+
+
+def measure(post, count: int):
+    """
+    :return: (峰值内存 MB, 耗时 s)，包括客户端生成请求体的内存
+    """
+    async def run():
+        transport = httpx.ASGITransport(app=web.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+            await post(client, count)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    asyncio.run(run())
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1024 / 1024, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--recipients', default='50000,200000', help='接收人数，逗号分隔')
+    args = parser.parse_args()
+
+    web.app.dependency_overrides[has_access] = lambda: True
+    web.get_deduplicator = lambda: None
+    web.get_delivery_log = lambda: None
+    for count in [int(n) for n in args.recipients.split(',')]:
+        for name, post in [('messages', post_messages), ('broadcast', post_broadcast)]:
+            with tempfile.TemporaryDirectory() as tmp:
+                queue = SQLiteQueue(os.path.join(tmp, 'dispatch.db'), max_depth=10000000)
+                web.get_queue = lambda: queue
+                peak, elapsed = measure(post, count)
+            print(f"recipients: {count:8d}  {name:<10} peak memory: {peak:7.1f}MB  time: {elapsed:6.2f}s")
+
+
+if __name__ == '__main__':
+    main()
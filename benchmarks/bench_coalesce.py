@@ -0,0 +1,68 @@
+"""
+告警合并压测：告警风暴中每个接收人在一个合并窗口内收到同一模板的多条短信，对比合并前后服务商的调用次数、
+合并的耗时（包括合并的消息写入 sqlite HeldStore）及进程内合并状态占用的内存
+
+    python benchmarks/bench_coalesce.py --users 10000 --alerts 20 --windows 3
+
+每个窗口内每个接收人收到 alerts 条告警，窗口结束时生成摘要消息；--max-keys 限制内存时超出的接收人不合并
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_dir)
+os.environ.setdefault('MESSAGE_PUSH_CONFIG', os.path.join(root_dir, 'tests', 'config.yml'))
+
+from message_push.dispatch.coalesce import Coalescer, SQLiteHeldStore  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--alerts', type=int, default=20, help='每个窗口内每个接收人收到的告警数')
+    parser.add_argument('--windows', type=int, default=3)
+    parser.add_argument('--batch', type=int, default=100, help='每条告警的接收人数')
+    parser.add_argument('--max-keys', type=int, default=100000)
+    args = parser.parse_args()
+
+    users = [f'150{i:08d}' for i in range(args.users)]
+    batches = [users[i:i + args.batch] for i in range(0, len(users), args.batch)]
+    tmp_dir = tempfile.TemporaryDirectory()
+    coalescer = Coalescer(window=3600, max_keys=args.max_keys, count_field={'sms': 'content'},
+                          held=SQLiteHeldStore(os.path.join(tmp_dir.name, 'dispatch.db')))
+    messages = immediate = digests = 0
+    elapsed = 0
+    tracemalloc.start()
+    now = time.monotonic()
+    for window in range(args.windows):
+        start = time.perf_counter()
+        for alert in range(args.alerts):
+            for batch in batches:
+                payload = {"template_name": "alarm", "to_users": batch,
+                           "message": {"device": "d1", "content": f"alert {window}-{alert}"}}
+                send, _ = coalescer.split('sms', payload)
+                messages += len(batch)
+                immediate += len(send)
+        for digest in coalescer.expire(now + 3600 * (window + 1)):
+            digests += len(digest.payload['to_users'])
+            # 摘要消息入队后删除合并的消息（不计入发送队列）
+            coalescer.held.delete(digest.held)
+        elapsed += time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    tmp_dir.cleanup()
+
+    sent = immediate + digests
+    print(f"users: {args.users}, alerts per window: {args.alerts}, windows: {args.windows}, max keys: {args.max_keys}")
+    print(f"messages: {messages}  sends (per recipient): {sent} (immediate {immediate}, digest {digests})  "
+          f"saved: {messages - sent} ({(messages - sent) / messages:.1%})")
+    print(f"coalesce: {elapsed / messages * 1e6:.2f}us per recipient  peak memory: {peak / 1024 / 1024:.1f}MB "
+          f"({peak / min(args.users, args.max_keys):.0f}B per key)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+相同内容单独发送给多个接收人：对比每封邮件重新生成并序列化 MIME（send_many）
+与只序列化一次、替换 To 邮件头并使用 PIPELINING（send_each）的 CPU 时间、耗时及内存分配
+
+    python benchmarks/bench_email_fanout.py --recipients 1000 --size 20000
+
+使用本地 aiosmtpd 服务代替 Office365，不发送任何外部邮件；CPU 时间只统计发送线程
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from collections import deque
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_dir)
+os.environ.setdefault('MESSAGE_PUSH_CONFIG', os.path.join(root_dir, 'tests', 'config.yml'))
+
+from message_push.mail.mailbox import MailBox, EmailTemplate  # noqa: E402
+from tests.mocks import SMTPSink  # noqa: E402
+
+
+def per_message(mailbox: MailBox, content: str, recipients):
+    mailbox.send_many(EmailTemplate('benchmark', 'sender@example.com', [to_addr], content=content)
+                      for to_addr in recipients)
+
+
+def encoded_once(mailbox: MailBox, content: str, recipients):
+    mailbox.send_each(EmailTemplate('benchmark', 'sender@example.com', [], content=content), recipients)
+
+
+def measure(func, mailbox: MailBox, content: str, recipients):
+    # 预先建立会话，不计入连接及认证
+    func(mailbox, content, recipients[:1])
+    cpu, start = time.thread_time(), time.perf_counter()
+    func(mailbox, content, recipients)
+    elapsed, cpu = time.perf_counter() - start, time.thread_time() - cpu
+    tracemalloc.start()
+    func(mailbox, content, recipients)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return cpu, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--recipients', type=int, default=1000)
+    parser.add_argument('--size', type=int, default=20000, help='html 内容的字节数')
+    args = parser.parse_args()
+
+    content = ('<p>hello world</p>' * (args.size // 18 + 1))[:args.size]
+    recipients = [f'user{i}@example.com' for i in range(args.recipients)]
+    print(f"recipients: {args.recipients}, html size: {args.size}")
+    with SMTPSink() as sink:
+        # 不保留收到的邮件，内存分配只反映发送端
+        sink.messages, sink.message_times = deque(maxlen=1), deque(maxlen=1)
+        mailbox = MailBox('sender@example.com', 'password', smtp_server=sink.host, smtp_port=sink.port,
+                          pool_size=1, use_tls=False)
+        results = [(name, measure(func, mailbox, content, recipients))
+                   for name, func in [('send_many', per_message), ('send_each', encoded_once)]]
+        mailbox.close()
+    base_cpu = results[0][1][0]
+    for name, (cpu, elapsed, peak) in results:
+        print(f"{name:<10} cpu: {cpu * 1000:8.1f}ms ({base_cpu / cpu:4.1f}x)  "
+              f"elapsed: {elapsed * 1000:8.1f}ms  peak alloc: {peak / 1024:8.1f}KiB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+限流压测：微信模板消息异步群发，对比不限流与按 --rate 限流时 mock 微信服务每个时间窗口收到的请求数
+
+    python benchmarks/bench_ratelimit.py --users 1000 --rate 100 --workers 2
+
+--workers 大于 1 时模拟多个 worker（每个一个 WXBox）通过 redis 共享同一个令牌桶，
+默认使用 fakeredis，--redis-url 可以指定真实的 redis
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_dir)
+os.environ.setdefault('MESSAGE_PUSH_CONFIG', os.path.join(root_dir, 'tests', 'config.yml'))
+
+from message_push.ratelimit import LocalBucketStore, RateLimiter, RedisBucketStore  # noqa: E402
+from message_push.wechat.wxbox import WXBox, WXTemplate  # noqa: E402
+from tests.mocks import MockWechatServer, StaticAzureAuthorization, DictOpenIDCache  # noqa: E402
+
+
+def bucket_store(workers: int, redis_url: str):
+    if workers == 1:
+        return LocalBucketStore()
+    if redis_url:
+        import redis
+        return RedisBucketStore(redis.StrictRedis.from_url(redis_url), prefix='message_push:bench')
+    import fakeredis
+    return RedisBucketStore(fakeredis.FakeStrictRedis())
+
+
+def run(server, users: int, workers: int, concurrency: int, limiter_factory):
+    """
+    :return: 每个请求到达 mock 服务的时间（相对开始时间）
+    """
+    server.requests.clear()
+    server.request_times.clear()
+    boxes = []
+    for w in range(workers):
+        mapping = {f'union{w}-{i}': f'open{w}-{i}' for i in range(users // workers)}
+        wx_box = WXBox(azure_authz=StaticAzureAuthorization(), wx_openid_cache=DictOpenIDCache(mapping),
+                       rate_limiter=limiter_factory())
+        wx_box.wx_token_url = server.token_url
+        wx_box.wx_api_url = server.api_url
+        wx_box.http2 = False
+        wx_box.concurrency = concurrency
+        boxes.append((wx_box, list(mapping)))
+
+    async def send_all():
+        await asyncio.gather(*[wx_box.async_send(to_users, 'template', WXTemplate(message={"k": {"value": "v"}}))
+                               for wx_box, to_users in boxes])
+        for wx_box, _ in boxes:
+            await wx_box.aclose()
+
+    start = time.monotonic()
+    asyncio.run(send_all())
+    return [t - start for (method, path, query, body), t in zip(server.requests, server.request_times)
+            if path.endswith('/send')]
+
+
+def report(name: str, times, window: float):
+    duration = max(times)
+    counts = [0] * (int(duration / window) + 1)
+    for t in times:
+        counts[int(t / window)] += 1
+    # 最后一个窗口不完整，不参与统计
+    full = counts[:-1] or counts
+    rates = [c / window for c in full]
+    print(f"{name:<28} sent: {len(times):6d}  duration: {duration:6.2f}s  avg: {len(times) / duration:8.1f}/s  "
+          f"per {window}s window: max {max(rates):8.1f}/s  min {min(rates):8.1f}/s  "
+          f"stdev {statistics.pstdev(rates):7.1f}/s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--rate', type=float, default=100, help='限流速度(条/秒)')
+    parser.add_argument('--burst', type=float, default=0, help='桶容量，默认等于 rate 的 1/10')
+    parser.add_argument('--workers', type=int, default=1, help='共享令牌桶的 worker 数')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--window', type=float, default=0.5, help='统计窗口(秒)')
+    parser.add_argument('--latency', type=float, default=0.005, help='mock 微信服务延迟(秒)')
+    parser.add_argument('--redis-url', default='', help='多个 worker 共享令牌桶使用的 redis')
+    args = parser.parse_args()
+
+    store = bucket_store(args.workers, args.redis_url)
+    burst = args.burst or max(args.rate / 10, 1)
+    with MockWechatServer(latency=args.latency) as server:
+        unlimited = run(server, args.users, args.workers, args.concurrency, lambda: RateLimiter('wechat'))
+        limited = run(server, args.users, args.workers, args.concurrency,
+                      lambda: RateLimiter('wechat', rate=args.rate, burst=burst, max_wait=60, store=store))
+
+    print(f"users: {args.users}, workers: {args.workers}, concurrency: {args.concurrency}, "
+          f"rate: {args.rate}/s, burst: {burst:g}, store: {type(store).__name__}")
+    report('unlimited', unlimited, args.window)
+    report(f'token bucket ({args.rate:g}/s)', limited, args.window)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+定时发送压测：大量消息在同一时间到期时，对比立即全部入队与 worker 按 release_rate 分批移入时，服务商每秒收到的请求数
+
+    python benchmarks/bench_schedule.py --messages 2000 --release-rate 500 --backend sqlite
+
+发送函数只记录调用时间，--latency 模拟服务商的响应时间；--backend redis 使用 fakeredis
+"""
+import argparse
+import asyncio
+import collections
+import os
+import sys
+import tempfile
+import time
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_dir)
+os.environ.setdefault('MESSAGE_PUSH_CONFIG', os.path.join(root_dir, 'tests', 'config.yml'))
+
+from message_push.dispatch.queue import RedisStreamQueue, SQLiteQueue  # noqa: E402
+from message_push.dispatch.worker import Worker  # noqa: E402
+
+
+def new_queue(backend: str, path: str):
+    if backend == 'sqlite':
+        return SQLiteQueue(path, max_depth=10000000)
+    import fakeredis
+    return RedisStreamQueue(fakeredis.FakeStrictRedis(), max_depth=10000000)
+
+
+def run(queue, messages: int, release_rate: float, concurrency: int, latency: float, lead: float):
+    """
+    :param release_rate: 0 表示所有消息直接入队（相当于外部定时任务在同一时间调用推送接口）
+    :param lead: 定时任务的发送时间在多少秒之后，需要大于写入所有定时任务的耗时
+    :return: (每秒调用次数的峰值, 每秒调用次数的中位数, 总耗时)
+    """
+    due_at = time.time() + lead
+    for i in range(messages):
+        if release_rate:
+            queue.enqueue('sms', {'n': i}, due_at=due_at)
+    if time.time() >= due_at:
+        raise RuntimeError('scheduling took longer than --lead, increase it')
+    calls = []
+
+    async def handler(payload):
+        calls.append(time.time())
+        await asyncio.sleep(latency)
+
+    async def main():
+        if not release_rate:
+            await asyncio.sleep(max(due_at - time.time(), 0))
+            for i in range(messages):
+                queue.enqueue('sms', {'n': i})
+        worker = Worker(queue, 'sms', handler, concurrency=concurrency, release_rate=release_rate,
+                        release_batch=max(int(release_rate / 10), 1))
+        task = asyncio.ensure_future(worker.run(block=0.05))
+        while len(calls) < messages:
+            await asyncio.sleep(0.05)
+        worker.stop()
+        await task
+
+    asyncio.run(main())
+    per_second = sorted(collections.Counter(int((t - due_at) * 10) for t in calls).values())
+    return per_second[-1] * 10, per_second[len(per_second) // 2] * 10, calls[-1] - due_at
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--release-rate', type=float, default=500)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.01)
+    parser.add_argument('--backend', choices=['sqlite', 'redis'], default='sqlite')
+    parser.add_argument('--lead', type=float, default=5, help='定时任务的发送时间在多少秒之后')
+    args = parser.parse_args()
+
+    print(f"messages: {args.messages}, concurrency: {args.concurrency}, backend: {args.backend}")
+    for name, rate in [('burst', 0), ('released', args.release_rate)]:
+        with tempfile.TemporaryDirectory() as tmp:
+            peak, median, elapsed = run(new_queue(args.backend, os.path.join(tmp, 'dispatch.db')), args.messages,
+                                        rate, args.concurrency, args.latency, args.lead)
+        print(f"{name:<9} peak: {peak:8.0f}/s  median: {median:8.0f}/s  total: {elapsed:6.2f}s")
+
+
+if __name__ == '__main__':
+    main()
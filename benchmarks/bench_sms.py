@@ -0,0 +1,70 @@
+"""
+短信发送压测：对比线程池中每次新建 httpx.Client 的 SMSBox 与复用连接、分批并发的 AsyncSMSBox
+
+    python benchmarks/bench_sms.py --sends 200 --phones 250 --latency 0.02
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_dir)
+os.environ.setdefault('MESSAGE_PUSH_CONFIG', os.path.join(root_dir, 'tests', 'config.yml'))
+
+from message_push.sms.smsbox import AsyncSMSBox, SMSBox, SMSTemplate  # noqa: E402
+from tests.mocks import MockSMSGateway  # noqa: E402
+
+
+def run_sync(gateway, messages, concurrency, batch_size):
+    sms_box = SMSBox(gateway.account, gateway.auth_key, gateway.api_url)
+
+    def send(sms):
+        # 同步版本不分批，超过平台限制的手机号需要调用方自己拆分
+        for i in range(0, len(sms.to_users), batch_size):
+            sms_box.send('notice', SMSTemplate(sms.to_users[i:i + batch_size], sms.content))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(send, messages))
+    return time.perf_counter() - start
+
+
+def run_async(gateway, messages, concurrency, batch_size):
+    sms_box = AsyncSMSBox(gateway.account, gateway.auth_key, gateway.api_url,
+                          batch_size=batch_size, concurrency=concurrency)
+
+    async def send_all():
+        await asyncio.gather(*[sms_box.send('notice', sms) for sms in messages])
+        await sms_box.aclose()
+
+    start = time.perf_counter()
+    asyncio.run(send_all())
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sends', type=int, default=200, help='调用 send 的次数')
+    parser.add_argument('--phones', type=int, default=250, help='每次 send 的手机号数量')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.02, help='mock 短信平台延迟(秒)')
+    args = parser.parse_args()
+
+    messages = [SMSTemplate([f'150{i:08d}' for i in range(args.phones)], {'name': 'x'}) for _ in range(args.sends)]
+    total = args.sends * args.phones
+    with MockSMSGateway(max_batch=args.batch_size, latency=args.latency) as gateway:
+        before = run_sync(gateway, messages, args.concurrency, args.batch_size)
+        after = run_async(gateway, messages, args.concurrency, args.batch_size)
+
+    print(f"sends: {args.sends}, phones per send: {args.phones}, batch size: {args.batch_size}, "
+          f"concurrency: {args.concurrency}")
+    print(f"SMSBox (client per request): {total / before:10.1f} sms/s")
+    print(f"AsyncSMSBox (pooled client): {total / after:10.1f} sms/s ({before / after:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
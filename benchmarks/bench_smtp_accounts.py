@@ -0,0 +1,58 @@
+"""
+多发件账号压测：每个账号限流（per_key）时，发送速率随账号数的变化
+
+    python benchmarks/bench_smtp_accounts.py --accounts 1,2,4,8 --rate 50 --duration 2
+
+使用本地 aiosmtpd 服务代替 Office365，不发送任何外部邮件
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_dir)
+os.environ.setdefault('MESSAGE_PUSH_CONFIG', os.path.join(root_dir, 'tests', 'config.yml'))
+
+from message_push.mail.mailbox import MailBox, EmailTemplate  # noqa: E402
+from message_push.ratelimit import RateLimiter  # noqa: E402
+from tests.mocks import SMTPSink  # noqa: E402
+
+
+def run(sink: SMTPSink, accounts: int, rate: float, duration: float, threads: int, strategy: str) -> float:
+    limiter = RateLimiter('email', max_wait=60, per_key=RateLimiter('email', rate=rate, burst=1, max_wait=60))
+    mailbox = MailBox('sender@example.com', 'password', smtp_server=sink.host, smtp_port=sink.port,
+                      pool_size=threads, use_tls=False, rate_limiter=limiter, strategy=strategy,
+                      accounts=[{'address': f'sender{i}@example.com', 'password': 'password'}
+                                for i in range(accounts)])
+    mail = EmailTemplate('benchmark', 'sender@example.com', ['to@example.com'], content='<p>hello</p>' * 50)
+    messages = int(rate * accounts * duration)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads * accounts) as executor:
+        list(executor.map(lambda _: mailbox.send(mail), range(messages)))
+    elapsed = time.perf_counter() - start
+    mailbox.close()
+    return messages / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--accounts', default='1,2,4,8', help='账号数量，逗号分隔')
+    parser.add_argument('--rate', type=float, default=50, help='每个账号每秒的邮件数')
+    parser.add_argument('--duration', type=float, default=2, help='每轮的预计发送时间(秒)')
+    parser.add_argument('--threads', type=int, default=2, help='每个账号的发送线程数')
+    parser.add_argument('--strategy', choices=['round_robin', 'least_loaded'], default='round_robin')
+    args = parser.parse_args()
+
+    print(f"per account rate: {args.rate}/s, strategy: {args.strategy}")
+    with SMTPSink() as sink:
+        base = None
+        for accounts in [int(n) for n in args.accounts.split(',')]:
+            throughput = run(sink, accounts, args.rate, args.duration, args.threads, args.strategy)
+            base = base or throughput / accounts
+            print(f"accounts: {accounts:3d}  {throughput:8.1f} msg/s ({throughput / base:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
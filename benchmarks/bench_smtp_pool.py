@@ -0,0 +1,60 @@
+"""
+smtp 连接池压测：对比每封邮件新建连接与连接池复用会话的发送速率
+
+    python benchmarks/bench_smtp_pool.py --messages 500 --threads 4
+
+使用本地 aiosmtpd 服务代替 Office365，不发送任何外部邮件
+"""
+import argparse
+import os
+import smtplib
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_dir)
+os.environ.setdefault('MESSAGE_PUSH_CONFIG', os.path.join(root_dir, 'tests', 'config.yml'))
+
+from message_push.mail.mailbox import MailBox, EmailTemplate  # noqa: E402
+from tests.mocks import SMTPSink  # noqa: E402
+
+
+def send_without_pool(mailbox: MailBox, mail: EmailTemplate):
+    """
+    连接池之前的发送方式：每封邮件独立完成 connect/ehlo/login/quit
+    """
+    with smtplib.SMTP(mailbox.smtp_server, mailbox.smtp_port) as server:
+        server.ehlo()
+        server.login(mailbox.username, mailbox.password)
+        server.sendmail(mailbox.username, mail.dest, msg=mail.new_mail().as_string())
+
+
+def run(send, mailbox, mail, messages, threads):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(lambda _: send(mailbox, mail), range(messages)))
+    return messages / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    with SMTPSink() as sink:
+        mailbox = MailBox('sender@example.com', 'password', smtp_server=sink.host, smtp_port=sink.port,
+                          pool_size=args.threads, use_tls=False)
+        mail = EmailTemplate('benchmark', 'sender@example.com', ['to@example.com'], content='<p>hello</p>' * 50)
+        before = run(send_without_pool, mailbox, mail, args.messages, args.threads)
+        after = run(MailBox.send, mailbox, mail, args.messages, args.threads)
+        mailbox.close()
+
+    print(f"messages: {args.messages}, threads: {args.threads}")
+    print(f"connection per message: {before:8.1f} msg/s")
+    print(f"pooled sessions:        {after:8.1f} msg/s ({after / before:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
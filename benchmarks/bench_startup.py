@@ -0,0 +1,109 @@
+"""
+启动耗时压测：统计 python -X importtime 导入 message_push.main 的耗时（及耗时最多的依赖），
+以及启动 uvicorn 到 /healthz、/readyz 第一次返回 200 的时间
+
+    python benchmarks/bench_startup.py --runs 5
+"""
+import argparse
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+env = dict(os.environ)
+env.setdefault('MESSAGE_PUSH_CONFIG', os.path.join(root_dir, 'tests', 'config.yml'))
+
+IMPORT_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def import_time():
+    """
+    :return: (message_push.main 累计导入耗时(秒), {顶层依赖: 累计耗时(秒)})
+    """
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import message_push.main'],
+                            cwd=root_dir, env=env, stderr=subprocess.PIPE, universal_newlines=True,
+                            check=True).stderr
+    total, packages, children = 0.0, {}, {}
+    for line in stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if not match:
+            continue
+        cumulative, indent, name = int(match.group(2)) / 1e6, len(match.group(3)), match.group(4)
+        # 子模块先于父模块输出，顶层模块缩进为 1，其直接依赖缩进为 3
+        if indent == 3:
+            children[name] = cumulative
+        elif indent == 1:
+            if name == 'message_push.main':
+                total, packages = cumulative, children
+            children = {}
+    return total, packages
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for(client: httpx.Client, url: str, deadline: float) -> float:
+    while time.perf_counter() < deadline:
+        try:
+            if client.get(url).status_code == 200:
+                return time.perf_counter()
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.005)
+    return float('nan')
+
+
+def first_request(timeout: float):
+    """
+    :return: (启动到 /healthz 返回 200 的秒数, 启动到 /readyz 返回 200 的秒数)
+    """
+    port = free_port()
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'message_push.main:app',
+                                '--port', str(port), '--log-level', 'warning'],
+                               cwd=root_dir, env=env)
+    try:
+        with httpx.Client(base_url=f'http://127.0.0.1:{port}', timeout=1) as client:
+            healthy = wait_for(client, '/healthz', start + timeout)
+            ready = wait_for(client, '/readyz', start + timeout)
+    finally:
+        process.terminate()
+        process.wait()
+    return healthy - start, ready - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=8, help='输出导入耗时最多的依赖数量')
+    parser.add_argument('--timeout', type=float, default=30, help='等待 /readyz 的最长时间(秒)')
+    args = parser.parse_args()
+
+    totals, packages = [], {}
+    for _ in range(args.runs):
+        total, imported = import_time()
+        totals.append(total)
+        for name, seconds in imported.items():
+            packages.setdefault(name, []).append(seconds)
+    print(f"import message_push.main: median {statistics.median(totals) * 1000:8.1f} ms")
+    slowest = sorted(packages.items(), key=lambda item: statistics.median(item[1]), reverse=True)
+    for name, seconds in slowest[:args.top]:
+        print(f"  {name:32} {statistics.median(seconds) * 1000:8.1f} ms")
+
+    results = [first_request(args.timeout) for _ in range(args.runs)]
+    print(f"time to /healthz 200:     median {statistics.median(r[0] for r in results) * 1000:8.1f} ms")
+    # /readyz 需要获取 jwks 公钥等，无法访问外部服务时超时（nan）
+    print(f"time to /readyz 200:      median {statistics.median(r[1] for r in results) * 1000:8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+发送状态跟踪压测：对比每条消息直接写入存储与写入缓冲区后批量写入时，请求路径上的耗时
+
+    python benchmarks/bench_tracking.py --messages 20000 --backend sqlite
+
+--backend redis 默认使用 fakeredis，--redis-url 可以指定真实的 redis
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_dir)
+os.environ.setdefault('MESSAGE_PUSH_CONFIG', os.path.join(root_dir, 'tests', 'config.yml'))
+
+from message_push.dispatch.tracking import (DeliveryEvent, DeliveryLog, RedisDeliveryLogStore,  # noqa: E402
+                                            SQLiteDeliveryLogStore)
+
+
+def new_store(backend: str, redis_url: str, path: str):
+    if backend == 'sqlite':
+        return SQLiteDeliveryLogStore(path)
+    if redis_url:
+        import redis
+        return RedisDeliveryLogStore(redis.StrictRedis.from_url(redis_url), prefix='message_push:bench')
+    import fakeredis
+    return RedisDeliveryLogStore(fakeredis.FakeStrictRedis())
+
+
+def direct(store, messages: int, recipients):
+    """
+    每条消息写入一次存储
+    """
+    start = time.perf_counter()
+    for i in range(messages):
+        store.append([DeliveryEvent(f'direct{i}', 'sms', 'queued', recipients)])
+    return time.perf_counter() - start, 0
+
+
+def batched(store, messages: int, recipients, batch_size: int):
+    """
+    :return: (请求路径上的耗时, close 时写入剩余事件的耗时)
+    """
+    log = DeliveryLog(store, batch_size=batch_size)
+    start = time.perf_counter()
+    for i in range(messages):
+        log.record(f'batched{i}', 'sms', 'queued', recipients)
+    elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    log.close()
+    return elapsed, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--recipients', type=int, default=1, help='每条消息的接收人数')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--backend', choices=['sqlite', 'redis'], default='sqlite')
+    parser.add_argument('--redis-url', default='')
+    args = parser.parse_args()
+
+    recipients = [f'150{i:08d}' for i in range(args.recipients)]
+    with tempfile.TemporaryDirectory() as tmp:
+        store = new_store(args.backend, args.redis_url, os.path.join(tmp, 'dispatch.db'))
+        print(f"messages: {args.messages}, recipients: {args.recipients}, backend: {args.backend}")
+        for name, (elapsed, drain) in [('direct', direct(store, args.messages, recipients)),
+                                       ('batched', batched(store, args.messages, recipients, args.batch_size))]:
+            print(f"{name:<8} per message: {elapsed / args.messages * 1e6:8.1f}us  "
+                  f"throughput: {args.messages / (elapsed + drain):10.0f}/s")
+
+
+if __name__ == '__main__':
+    main()
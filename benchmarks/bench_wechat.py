@@ -0,0 +1,90 @@
+"""
+微信模板消息群发压测：对比每个用户一个线程（WXBox.send）与共享 AsyncClient 的异步发送（WXBox.async_send）
+
+    python benchmarks/bench_wechat.py --sizes 100,1000,10000 --latency 0.02
+
+mock 微信服务运行在当前进程，每个场景在独立子进程中执行，统计吞吐量及子进程峰值内存(RSS)
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_dir)
+os.environ.setdefault('MESSAGE_PUSH_CONFIG', os.path.join(root_dir, 'tests', 'config.yml'))
+
+MESSAGE = {
+    "keyword1": {"value": "公司名称"},
+    "keyword2": {"value": "设备名称"},
+    "keyword3": {"value": "2020-02-02"},
+    "keyword4": {"value": "故障啦", "color": "#ff0000"},
+    "remark": {"value": "remark"},
+}
+
+
+def run_child(mode: str, users: int, url: str, concurrency: int):
+    from message_push.wechat.wxbox import WXBox, WXTemplate
+    from tests.mocks import StaticAzureAuthorization, DictOpenIDCache
+
+    mapping = {f'union{i}': f'open{i}' for i in range(users)}
+    wx_box = WXBox(azure_authz=StaticAzureAuthorization(), wx_openid_cache=DictOpenIDCache(mapping))
+    wx_box.wx_token_url = url + '/token'
+    wx_box.wx_api_url = url + '/cgi-bin/message/template/send'
+    wx_box.concurrency = concurrency
+    msg = WXTemplate(message=MESSAGE)
+
+    start = time.perf_counter()
+    if mode == 'threads':
+        wx_box.send(list(mapping), 'template', msg)
+    else:
+        async def send():
+            await wx_box.async_send(list(mapping), 'template', msg)
+            await wx_box.aclose()
+        asyncio.run(send())
+    elapsed = time.perf_counter() - start
+    print(json.dumps({
+        'mode': mode,
+        'users': users,
+        'seconds': elapsed,
+        'messages_per_second': users / elapsed,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='100,1000,10000')
+    parser.add_argument('--modes', default='threads,async')
+    parser.add_argument('--latency', type=float, default=0.02, help='mock 微信接口延迟(秒)')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--child', nargs=3, metavar=('MODE', 'USERS', 'URL'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        mode, users, url = args.child
+        run_child(mode, int(users), url, args.concurrency)
+        return
+
+    from tests.mocks import MockWechatServer
+
+    with MockWechatServer(latency=args.latency) as server:
+        print(f"{'mode':8} {'users':>7} {'seconds':>9} {'msg/s':>9} {'peak rss(MB)':>13}")
+        for users in [int(size) for size in args.sizes.split(',')]:
+            for mode in args.modes.split(','):
+                output = subprocess.run(
+                    [sys.executable, __file__, '--concurrency', str(args.concurrency),
+                     '--child', mode, str(users), server.url],
+                    check=True, stdout=subprocess.PIPE, universal_newlines=True,
+                ).stdout
+                result = json.loads(output.strip().splitlines()[-1])
+                print(f"{mode:8} {users:7d} {result['seconds']:9.2f} {result['messages_per_second']:9.1f} "
+                      f"{result['peak_rss_mb']:13.1f}")
+
+
+if __name__ == '__main__':
+    main()
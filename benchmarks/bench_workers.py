@@ -0,0 +1,129 @@
+"""
+多进程部署压测：python -m message_push.server 使用不同的 worker 进程数时，推送接口每秒处理的请求数
+
+    python benchmarks/bench_workers.py --workers 1,2,4 --requests 3000 --connections 64
+
+每个请求使用不同的 token（每次都做 RSA 签名校验），公钥由本地 MockJWKSServer 提供；
+任务写入临时目录中的 sqlite 队列，不启动发送 worker；压测客户端在独立进程中运行，与 web 进程争用 CPU，
+worker 数超过空闲核数后不再增加
+"""
+import argparse
+import asyncio
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import yaml
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_dir)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def write_config(workdir: str) -> str:
+    with open(os.path.join(root_dir, 'tests', 'config.yml'), encoding='utf8') as f:
+        conf = yaml.safe_load(f)
+    conf['dispatch'].update(backend='sqlite', sqlite_path=os.path.join(workdir, 'dispatch.db'), max_depth=10000000)
+    conf['tracking'] = {'enable': False}
+    conf['dedup'] = {'enable': False}
+    path = os.path.join(workdir, 'config.yml')
+    with open(path, 'w', encoding='utf8') as f:
+        yaml.safe_dump(conf, f, allow_unicode=True)
+    return path
+
+
+def run_web(args):
+    """
+    web 进程：公钥地址指向 MockJWKSServer
+    """
+    from message_push import main, server
+
+    main.authz.jwks_url = args.jwks_url
+    server.serve(main.app, '127.0.0.1', args.port, workers=int(args.workers), log_level='warning')
+
+
+async def drive(url: str, warmup_tokens: list, tokens: list, connections: int) -> float:
+    """
+    :return: 每秒完成的请求数
+    """
+    limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+    slots = asyncio.Semaphore(connections)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        async def post(index: int, token: str):
+            async with slots:
+                resp = await client.post('/api/v1/services/sms/messages', headers={'Authorization': f'Bearer {token}'},
+                                         json={"template_name": "notice", "to_users": ["15000000000"],
+                                               "message": {"index": index}})
+                resp.raise_for_status()
+
+        # 预热：每个连接先完成一次请求，公钥已获取
+        await asyncio.gather(*[post(-i - 1, token) for i, token in enumerate(warmup_tokens)])
+        start = time.perf_counter()
+        await asyncio.gather(*[post(i, token) for i, token in enumerate(tokens)])
+        return len(tokens) / (time.perf_counter() - start)
+
+
+def wait_ready(url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url + '/healthz').status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    raise TimeoutError('web server did not start')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', default='1,2,4', help='worker 进程数，逗号分隔')
+    parser.add_argument('--requests', type=int, default=3000)
+    parser.add_argument('--connections', type=int, default=64)
+    parser.add_argument('--role', choices=['web'], help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--jwks-url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.role == 'web':
+        return run_web(args)
+
+    os.environ.setdefault('MESSAGE_PUSH_CONFIG', os.path.join(root_dir, 'tests', 'config.yml'))
+    from message_push.authorize import clientid
+    from tests.mocks import MockJWKSServer
+
+    print(f"requests: {args.requests}, connections: {args.connections}, cpus: {os.cpu_count()}")
+    with MockJWKSServer() as jwks_server:
+        tokens = [jwks_server.issue_token(clientid)
+                  for _ in range(args.requests + args.connections)]
+        base = None
+        for workers in [int(n) for n in args.workers.split(',')]:
+            with tempfile.TemporaryDirectory() as workdir:
+                port = free_port()
+                env = dict(os.environ, MESSAGE_PUSH_CONFIG=write_config(workdir))
+                web = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--role', 'web', '--port', str(port),
+                                        '--workers', str(workers), '--jwks-url', jwks_server.jwks_url],
+                                       cwd=workdir, env=env)
+                try:
+                    url = f'http://127.0.0.1:{port}'
+                    wait_ready(url)
+                    rps = asyncio.run(drive(url, tokens[:args.connections], tokens[args.connections:],
+                                            args.connections))
+                finally:
+                    web.send_signal(signal.SIGTERM)
+                    web.wait()
+            base = base or rps
+            print(f"workers: {workers:3d}  {rps:8.1f} req/s ({rps / base:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
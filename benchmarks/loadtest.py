@@ -0,0 +1,453 @@
+"""
+端到端压测：在本地启动 mock 服务（smtp、短信平台、微信接口）、web 进程（uvicorn）及渠道的 worker 进程，
+按 --rate 向推送接口发送请求，统计每个渠道的请求延迟、投递延迟（发出请求到 mock 服务收到最后一个接收人的消息）
+的 p50/p95/p99，每秒投递的消息数，以及 web/worker 进程的 CPU 和内存(RSS)；结果保存为 JSON，
+--baseline 指定之前的结果时对比各项指标，超过 --tolerance 的退化返回非 0
+
+    pip install aiosmtpd
+    python benchmarks/loadtest.py --channels email,sms,wechat --rate 50 --duration 10 --output loadtest.json
+    python benchmarks/loadtest.py --rate 50 --duration 10 --baseline loadtest.json
+
+每个渠道使用独立的工作目录、web 进程和 worker 进程，配置由 tests/config.yml 生成（sqlite 队列及投递日志）；
+不访问 Azure：跳过接口鉴权，邮件模板从本地目录加载（LocalBlobContainer），
+微信 token 使用 StaticAzureAuthorization，openid 保存在 fakeredis 中
+CPU 及 RSS 读取 /proc，仅支持 Linux
+"""
+import argparse
+import asyncio
+import datetime
+import functools
+import json
+import math
+import os
+import platform
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import httpx
+import yaml
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_dir)
+
+CHANNELS = ['email', 'sms', 'wechat']
+PATHS = {channel: f"/api/v1/services/{channel}/messages" for channel in CHANNELS}
+TEMPLATE = '<p>hello {{ name }}</p>'
+# 对比时检查的指标：(路径, 越大越好)
+COMPARED = [
+    ('request_latency.p95', False),
+    ('request_latency.p99', False),
+    ('delivery_latency.p95', False),
+    ('delivery_latency.p99', False),
+    ('messages_per_second', True),
+    ('web.cpu_percent', False),
+    ('worker.cpu_percent', False),
+    ('web.rss_peak_mb', False),
+    ('worker.rss_peak_mb', False),
+]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def recipients_of(channel: str, index: int, recipients: int):
+    """
+    第 index 个请求的接收人，接收人中包含请求序号，用于计算投递延迟
+    """
+    if channel == 'email':
+        return [f"u{index}-{i}@example.com" for i in range(recipients)]
+    if channel == 'sms':
+        return [f"1{index:06d}{i:04d}" for i in range(recipients)]
+    return [f"u{index}-{i}" for i in range(recipients)]
+
+
+def request_index(channel: str, recipient: str) -> int:
+    if channel == 'sms':
+        return int(recipient[1:7])
+    # 邮件地址 u{index}-{i}@...，微信 openid o{index}-{i}
+    return int(recipient[1:].split('-')[0])
+
+
+def request_body(channel: str, index: int, recipients: int) -> dict:
+    to_users = recipients_of(channel, index, recipients)
+    if channel == 'email':
+        return {"subject": "loadtest", "template_name": "notice", "to_users": to_users, "message": {"name": index}}
+    if channel == 'sms':
+        return {"template_name": "notice", "to_users": to_users, "message": {"name": str(index)}}
+    return {"template_id": "loadtest", "to_users": to_users, "message": {"keyword1": {"value": str(index)}}}
+
+
+def percentiles(values) -> dict:
+    """
+    :param values: 秒
+    :return: 毫秒
+    """
+    values = sorted(values)
+    if not values:
+        return {}
+
+    def rank(p):
+        return values[min(len(values) - 1, max(int(math.ceil(p / 100 * len(values))) - 1, 0))] * 1000
+    return {"p50": rank(50), "p95": rank(95), "p99": rank(99), "mean": statistics.mean(values) * 1000,
+            "max": values[-1] * 1000}
+
+
+def process_stats(pid: int):
+    """
+    :return: (累计 CPU 时间(秒), 当前 RSS(MB), 峰值 RSS(MB))，读取失败时返回 None
+    """
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            # 第 2 列进程名可能包含空格，从 ')' 之后开始按列分割，utime/stime 为第 14、15 列
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{pid}/status') as f:
+            status = dict(line.split(':', 1) for line in f if ':' in line)
+    except OSError:
+        return None
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    return cpu, int(status['VmRSS'].split()[0]) / 1024, int(status['VmHWM'].split()[0]) / 1024
+
+
+def write_config(workdir: str, mocks: dict, args) -> str:
+    with open(os.path.join(root_dir, 'tests', 'config.yml'), encoding='utf8') as f:
+        conf = yaml.safe_load(f)
+    if 'smtp' in mocks:
+        conf['email'].update(smtp_server=mocks['smtp'][0], smtp_port=mocks['smtp'][1])
+    conf['email']['template_warmup'] = False
+    conf['sms']['api_server'] = mocks['sms']
+    conf['wechat'].update(wx_token_center_url=mocks['wechat'] + '/token', http2=False,
+                          api_url=mocks['wechat'] + '/cgi-bin/message/template/send')
+    conf['dispatch'].update(backend='sqlite', sqlite_path=os.path.join(workdir, 'dispatch.db'),
+                            max_depth=1000000, concurrency=args.concurrency)
+    conf['tracking'] = {'enable': args.tracking, 'backend': 'sqlite'}
+    os.makedirs(os.path.join(workdir, 'templates'))
+    with open(os.path.join(workdir, 'templates', 'notice.html'), 'w', encoding='utf8') as f:
+        f.write(TEMPLATE)
+    path = os.path.join(workdir, 'config.yml')
+    with open(path, 'w', encoding='utf8') as f:
+        yaml.safe_dump(conf, f, allow_unicode=True)
+    return path
+
+
+def local_loader(workdir: str):
+    from message_push.mail.template import TemplateAzure
+    from tests.mocks import LocalBlobContainer
+
+    loader = TemplateAzure(container=LocalBlobContainer(os.path.join(workdir, 'templates')))
+    return functools.lru_cache(maxsize=None)(lambda: loader)
+
+
+def run_web(args):
+    """
+    web 进程：跳过鉴权及 jwks 预热，邮件模板从工作目录加载
+    """
+    import uvicorn
+    from message_push import main
+    from message_push.authorize import has_access
+
+    async def warmup():
+        pass
+
+    main.get_html_loader = local_loader(args.workdir)
+    main.app.dependency_overrides[has_access] = lambda: True
+    main.authz.start_background_refresh = lambda: None
+    main.warmup = warmup
+    uvicorn.run(main.app, host='127.0.0.1', port=args.port, log_level='warning')
+
+
+def run_worker(args):
+    """
+    worker 进程：发送服务指向 mock 服务，准备好后创建 worker.ready 文件
+    """
+    from message_push.dispatch import handlers
+    from message_push.dispatch.worker import serve
+
+    mocks = json.loads(args.mocks)
+    loop = asyncio.get_event_loop()
+    if args.channel == 'email':
+        from message_push.mail.mailbox import MailBox
+
+        mailbox = MailBox('sender@example.com', 'password', smtp_server=mocks['smtp'][0], smtp_port=mocks['smtp'][1],
+                          use_tls=False)
+        handlers.get_email_sender = functools.lru_cache(maxsize=None)(lambda: mailbox)
+        handlers.get_html_loader = local_loader(args.workdir)
+    elif args.channel == 'wechat':
+        import fakeredis
+        from message_push.caches import AsyncWxOpenIDCache
+        from message_push.wechat.wxbox import WXBox
+        from tests.mocks import DictOpenIDCache, StaticAzureAuthorization
+
+        client = fakeredis.aioredis.FakeRedis()
+        users = [f"{index}-{i}" for index in range(args.requests) for i in range(args.recipients)]
+        for i in range(0, len(users), 10000):
+            loop.run_until_complete(client.mset({f"u{user}": f"o{user}" for user in users[i:i + 10000]}))
+        wx_box = WXBox(azure_authz=StaticAzureAuthorization(), wx_openid_cache=DictOpenIDCache({}),
+                       async_openid_cache=AsyncWxOpenIDCache(client=client))
+        handlers.get_wx_sender = functools.lru_cache(maxsize=None)(lambda: wx_box)
+    open(os.path.join(args.workdir, 'worker.ready'), 'w').close()
+    loop.run_until_complete(serve(args.channel, args.concurrency))
+
+
+def deliveries(channel: str, mocks) -> list:
+    """
+    :return: mock 服务成功接收的 (接收人, 时间)
+    """
+    if channel == 'email':
+        sink = mocks['smtp']
+        return [(rcpt, t) for (_, rcpts, _), t in zip(list(sink.messages), list(sink.message_times)) for rcpt in rcpts]
+    if channel == 'sms':
+        return [(phone, t) for (_, path, _, body), status, _, t in list(mocks['sms'].responses)
+                if path == '/sms' and status == 200 for phone in body['phoneNumber']]
+    return [(body['touser'], t) for (_, path, _, body), status, content, t in list(mocks['wechat'].responses)
+            if path.endswith('/send') and content.get('errcode') == 0]
+
+
+async def drive(url: str, channel: str, args):
+    """
+    按 args.rate 发出请求（开环，不等待前一个请求完成）
+    :return: (每个请求的发出时间, 每个请求的延迟, 响应状态计数)
+    """
+    sent_at, latencies, statuses = [None] * args.requests, [], Counter()
+    limits = httpx.Limits(max_connections=args.connections, max_keepalive_connections=args.connections)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        async def post(index):
+            body = request_body(channel, index, args.recipients)
+            start = time.monotonic()
+            sent_at[index] = start
+            try:
+                resp = await client.post(PATHS[channel], json=body)
+                statuses[str(resp.status_code)] += 1
+            except httpx.HTTPError as e:
+                statuses[type(e).__name__] += 1
+                return
+            latencies.append(time.monotonic() - start)
+
+        start, tasks = time.monotonic(), []
+        for index in range(args.requests):
+            delay = start + index / args.rate - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(post(index)))
+        await asyncio.gather(*tasks)
+    return sent_at, latencies, statuses
+
+
+def spawn(role: str, workdir: str, config_path: str, *extra) -> subprocess.Popen:
+    env = dict(os.environ, MESSAGE_PUSH_CONFIG=config_path)
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), '--role', role, '--workdir', workdir] +
+                            [str(arg) for arg in extra], cwd=workdir, env=env)
+
+
+def wait_ready(port: int, workdir: str, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f'http://127.0.0.1:{port}/healthz').status_code == 200 and \
+                    os.path.exists(os.path.join(workdir, 'worker.ready')):
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    raise TimeoutError('web or worker did not start')
+
+
+def stop(process: subprocess.Popen):
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def usage(before, after, wall: float) -> dict:
+    if before is None or after is None:
+        return {}
+    return {"cpu_seconds": after[0] - before[0], "cpu_percent": (after[0] - before[0]) / wall * 100,
+            "rss_mb": after[1], "rss_peak_mb": after[2]}
+
+
+def run_channel(channel: str, mocks, mock_urls: dict, args) -> dict:
+    with tempfile.TemporaryDirectory() as workdir:
+        config_path = write_config(workdir, mock_urls, args)
+        port = free_port()
+        web = spawn('web', workdir, config_path, '--port', port)
+        worker = spawn('worker', workdir, config_path, '--channel', channel, '--mocks', json.dumps(mock_urls),
+                       '--requests', args.requests, '--recipients', args.recipients,
+                       '--concurrency', args.concurrency)
+        try:
+            wait_ready(port, workdir)
+            delivered_before = len(deliveries(channel, mocks))
+            before = {name: process_stats(p.pid) for name, p in (('web', web), ('worker', worker))}
+            started = time.monotonic()
+            sent_at, latencies, statuses = asyncio.run(drive(f'http://127.0.0.1:{port}', channel, args))
+            expected = statuses['200'] * args.recipients
+            # 等待全部投递，或超过 idle_timeout 秒没有新的投递（部分接收人重试后仍失败）
+            count, progress_at = 0, time.monotonic()
+            while time.monotonic() - progress_at < args.idle_timeout:
+                current = len(deliveries(channel, mocks)) - delivered_before
+                if current >= expected:
+                    break
+                if current > count:
+                    count, progress_at = current, time.monotonic()
+                time.sleep(0.05)
+            delivered = deliveries(channel, mocks)[delivered_before:]
+            finished = max([t for _, t in delivered], default=time.monotonic())
+            wall = max(finished - started, 1e-9)
+            after = {name: process_stats(p.pid) for name, p in (('web', web), ('worker', worker))}
+        finally:
+            stop(web)
+            stop(worker)
+    done = {}
+    for recipient, t in delivered:
+        index = request_index(channel, recipient)
+        done[index] = max(done.get(index, 0), t)
+    return {
+        "requests": args.requests,
+        "responses": dict(statuses),
+        "recipients": expected,
+        "delivered": len({recipient for recipient, _ in delivered}),
+        "duration": wall,
+        "request_latency": percentiles(latencies),
+        "delivery_latency": percentiles([t - sent_at[index] for index, t in done.items()]),
+        "messages_per_second": len(delivered) / wall,
+        "web": usage(before['web'], after['web'], wall),
+        "worker": usage(before['worker'], after['worker'], wall),
+    }
+
+
+def lookup(result: dict, path: str):
+    for key in path.split('.'):
+        result = (result or {}).get(key)
+    return result
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    :return: 退化的指标
+    """
+    regressions = []
+    print(f"\ncompared with {baseline.get('created_at')} ({baseline.get('commit')}), tolerance {tolerance:.0%}")
+    for channel, current in results['channels'].items():
+        previous = baseline.get('channels', {}).get(channel)
+        if not previous:
+            continue
+        for path, higher_is_better in COMPARED:
+            old, new = lookup(previous, path), lookup(current, path)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = change < -tolerance if higher_is_better else change > tolerance
+            if worse:
+                regressions.append(f"{channel}.{path}")
+            print(f"{channel:<8} {path:<24} {old:12.1f} -> {new:12.1f}  {change:+7.1%}{'  REGRESSION' if worse else ''}")
+    return regressions
+
+
+def report(channel: str, result: dict):
+    req, dlv = result['request_latency'], result['delivery_latency']
+    print(f"{channel:<8} requests: {result['requests']:6d} {result['responses']}  "
+          f"delivered: {result['delivered']}/{result['recipients']}  {result['messages_per_second']:8.1f} msg/s")
+    for name, stats in (('request', req), ('delivery', dlv)):
+        if stats:
+            print(f"         {name:<8} latency p50 {stats['p50']:8.1f}ms  p95 {stats['p95']:8.1f}ms  "
+                  f"p99 {stats['p99']:8.1f}ms  max {stats['max']:8.1f}ms")
+    for name in ('web', 'worker'):
+        if result[name]:
+            print(f"         {name:<8} cpu {result[name]['cpu_percent']:6.1f}%  "
+                  f"rss {result[name]['rss_mb']:6.1f}MB (peak {result[name]['rss_peak_mb']:.1f}MB)")
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=root_dir, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--channels', default=','.join(CHANNELS))
+    parser.add_argument('--rate', type=float, default=50, help='每秒请求数')
+    parser.add_argument('--duration', type=float, default=10, help='发送请求的秒数')
+    parser.add_argument('--recipients', type=int, default=10, help='每个请求的接收人数')
+    parser.add_argument('--connections', type=int, default=100, help='压测客户端的最大连接数')
+    parser.add_argument('--concurrency', type=int, default=10, help='worker 同时处理的任务数')
+    parser.add_argument('--latency', type=float, default=0.02, help='mock 服务延迟(秒)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='mock 服务随机返回临时错误的比例')
+    parser.add_argument('--no-tracking', dest='tracking', action='store_false', help='关闭发送状态跟踪')
+    parser.add_argument('--idle-timeout', type=float, default=10, help='超过该秒数没有新的投递时结束等待')
+    parser.add_argument('--output', default='', help='结果保存的 JSON 文件')
+    parser.add_argument('--baseline', default='', help='对比的历史结果 JSON 文件')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='超过该比例的退化视为回归')
+    # 以下参数由压测进程传给 web/worker 子进程
+    parser.add_argument('--role', choices=['web', 'worker'], help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--channel', help=argparse.SUPPRESS)
+    parser.add_argument('--mocks', help=argparse.SUPPRESS)
+    parser.add_argument('--requests', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.role == 'web':
+        return run_web(args)
+    if args.role == 'worker':
+        return run_worker(args)
+
+    from tests.mocks import MockSMSGateway, MockWechatServer, SMTPSink
+
+    args.requests = max(int(args.rate * args.duration), 1)
+    channels = [channel for channel in args.channels.split(',') if channel]
+    mocks = {
+        'sms': MockSMSGateway(latency=args.latency, error_rate=args.error_rate).start(),
+        'wechat': MockWechatServer(latency=args.latency, error_rate=args.error_rate).start(),
+    }
+    try:
+        mocks['smtp'] = SMTPSink(error_rate=args.error_rate).start()
+    except ImportError:
+        print('aiosmtpd is not installed, skip email')
+        channels = [channel for channel in channels if channel != 'email']
+    mock_urls = {'sms': mocks['sms'].api_url, 'wechat': mocks['wechat'].url}
+    if 'smtp' in mocks:
+        mock_urls['smtp'] = [mocks['smtp'].host, mocks['smtp'].port]
+
+    results = {
+        "created_at": datetime.datetime.now().isoformat(timespec='seconds'),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "args": {key: value for key, value in vars(args).items()
+                 if key not in ('role', 'workdir', 'port', 'channel', 'mocks', 'output', 'baseline')},
+        "channels": {},
+    }
+    try:
+        for channel in channels:
+            results['channels'][channel] = run_channel(channel, mocks, mock_urls, args)
+            report(channel, results['channels'][channel])
+    finally:
+        for mock in mocks.values():
+            mock.stop()
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as f:
+            json.dump(results, f, indent=2)
+        print(f"results saved to {args.output}")
+    if args.baseline:
+        with open(args.baseline, encoding='utf8') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,17 @@
 from fastapi.security.http import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi import FastAPI, Response, status, Header, Depends, HTTPException
+import asyncio
 import datetime
+import hashlib
 import httpx
 import json
+import time
+from typing import Optional
 from jose import jwt
 from jose import exceptions as JoseExceptions
-from logconfig import loggers
+from message_push.logconfig import loggers
+from message_push.caches import LocalCache, MISSING, SharedValue, shared_value
+from message_push.metrics import stage
 
 auth = HTTPBearer()
 
@@ -14,22 +20,37 @@ appid = "41ebb163-adc1-4068-9087-eb79c718b633"
 clientid = "09e38b75-8747-450f-a40e-9612ead4228c"
 
 
-def has_access(token_property: HTTPAuthorizationCredentials = Depends(auth)):
+async def has_access(token_property: HTTPAuthorizationCredentials = Depends(auth)):
     """
     用了解析token是否正确，auth已经保证了Authorization为 bearer token形式
     :param token_property:     scheme/credentials:
     :return: always True
     """
-    authz.verify_token(token=token_property.credentials)
+    with stage('api', 'auth'):
+        await authz.verify_token(token=token_property.credentials)
     return True
 
 
 class AzureAuthorization:
     """
     校验 Azure B2C token，使用client credential 流，仅校验APP权限
+    公钥(jwks)异步获取，并发请求共享同一次刷新；后台任务在过期前主动刷新
+    校验通过的 token 缓存到 exp 过期，重复请求不再做签名校验
+    多进程部署时公钥通过 shared 共享，一个进程获取后其余进程不再访问 jwks_url
     """
 
-    def __init__(self, appid: str, clientid: str, jwks_url_config: str = jwks_url):
+    def __init__(self, appid: str, clientid: str, jwks_url_config: str = jwks_url,
+                 refresh_margin: float = 300, unknown_kid_interval: float = 60, token_cache_size: int = 10000,
+                 shared: Optional[SharedValue] = None):
+        """
+        :param appid: Azure 应用id
+        :param clientid: token 的 audience
+        :param jwks_url_config: 公钥地址
+        :param refresh_margin: 后台任务在公钥过期前多少秒刷新
+        :param unknown_kid_interval: 遇到未知 kid 时重新获取公钥的最小间隔(秒)
+        :param token_cache_size: 缓存的已校验 token 数量，0 表示不缓存
+        :param shared: 多个进程共享的公钥，为空时每个进程各自获取
+        """
         self.clientid = clientid
         self.jwks_url = jwks_url_config
         self.appid = appid
@@ -38,47 +59,138 @@ class AzureAuthorization:
         # jwks 3600s 更新一次
         self._jwks_cache_seconds = 3600
         self._jwks = {}
+        self.refresh_margin = refresh_margin
+        self.unknown_kid_interval = unknown_kid_interval
+        self._last_unknown_kid_refresh = 0
+        # 进行中的刷新任务，并发请求共享
+        self._refreshing = None
+        self._background_task = None
+        # sha256(token) -> payload
+        self.token_cache = LocalCache(maxsize=token_cache_size, name='auth_token')
+        self.shared = shared
+
+    def _jwks_expired(self) -> bool:
+        now = datetime.datetime.now()
+        return not (0 < (now - self._jwks_last_updated).total_seconds() < self._jwks_cache_seconds)
 
-    def _refresh_jwks_cache(self):
+    def _jwks_age(self) -> float:
+        return (datetime.datetime.now() - self._jwks_last_updated).total_seconds()
+
+    async def _fetch_jwks(self, force: bool = False):
         """
-        刷新Azure B2c token公钥
+        获取Azure B2c token公钥，优先使用其他进程已获取的公钥
+        :param force: 不使用共享的公钥（如遇到未知 kid）
         :return:
         """
-        response = httpx.get(
-            url=self.jwks_url,
-            params={
-                "appid": self.appid,
-            },
-        )
+        if self.shared is not None and not force:
+            shared = await self.shared.aget()
+            if shared and time.time() - shared['updated_at'] < self._jwks_cache_seconds - self.refresh_margin:
+                self._store_jwks(shared['keys'], datetime.datetime.fromtimestamp(shared['updated_at']))
+                return
+        async with httpx.AsyncClient() as client:
+            response = await client.get(
+                url=self.jwks_url,
+                params={
+                    "appid": self.appid,
+                },
+            )
         loggers.info('Response HTTP Status Code: {status_code}'.format(
             status_code=response.status_code))
-        # print('Response HTTP Response Body: {content}'.format(
-        #     content=response.content))
         jwks = json.loads(response.content.decode('utf8'))
-        for key in jwks['keys']:
+        # 每次获取到公钥后，刷新时间
+        self._store_jwks(jwks['keys'], datetime.datetime.now())
+        if self.shared is not None:
+            await self.shared.aset({"keys": jwks['keys'], "updated_at": time.time()}, ttl=self._jwks_cache_seconds)
+
+    def _store_jwks(self, keys: list, updated_at: datetime.datetime):
+        for key in keys:
             self._jwks[key['kid']] = key
-        # 每次获取到公钥后，刷新时间，24小时候过期
-        self._jwks_last_updated = datetime.datetime.now()
+        self._jwks_last_updated = updated_at
+
+    async def _refresh_jwks_cache(self, force: bool = False):
+        """
+        刷新Azure B2c token公钥，同一时间只有一个刷新请求，其余调用等待同一个结果
+        :param force: 不使用共享的公钥
+        :return:
+        """
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.ensure_future(self._fetch_jwks(force))
+        await asyncio.shield(self._refreshing)
 
-    def verify_token(self, token=None):
+    async def _get_public_key(self, kid: str):
+        """
+        根据 kid 获取公钥，公钥过期时刷新；未知 kid 按 unknown_kid_interval 限制刷新频率
+        :param kid: key id
+        :return: jwk or None
+        """
+        if self._jwks_expired():
+            loggers.info(f"jwks config is out of date (last updated at {self._jwks_last_updated})")
+            try:
+                await self._refresh_jwks_cache()
+            except (httpx.HTTPError, ValueError, KeyError) as e:
+                # 刷新失败时继续使用旧的公钥
+                if not self._jwks:
+                    raise
+                loggers.error(f'refresh jwks error, use the cached keys: {e!r}')
+        public_key = self._jwks.get(kid, None)
+        if not public_key:
+            now = time.monotonic()
+            if now - self._last_unknown_kid_refresh >= self.unknown_kid_interval:
+                self._last_unknown_kid_refresh = now
+                loggers.info(f'unknown kid {kid}, refresh jwks')
+                try:
+                    await self._refresh_jwks_cache(force=True)
+                except (httpx.HTTPError, ValueError, KeyError) as e:
+                    loggers.error(f'refresh jwks error: {e!r}')
+                public_key = self._jwks.get(kid, None)
+        return public_key
+
+    def start_background_refresh(self):
+        """
+        启动后台任务，立即获取公钥，之后在过期前 refresh_margin 秒刷新
+        """
+        if self._background_task is None:
+            self._background_task = asyncio.ensure_future(self._background_refresh())
+
+    async def stop_background_refresh(self):
+        if self._background_task is not None:
+            self._background_task.cancel()
+            try:
+                await self._background_task
+            except asyncio.CancelledError:
+                pass
+            self._background_task = None
+
+    async def _background_refresh(self):
+        while True:
+            try:
+                await self._refresh_jwks_cache()
+                # 使用其他进程获取的公钥时，按该公钥的获取时间计算下一次刷新
+                delay = max(self._jwks_cache_seconds - self.refresh_margin - self._jwks_age(), 1)
+            except Exception as e:
+                loggers.error(f'refresh jwks in background error: {e!r}')
+                delay = 30
+            await asyncio.sleep(delay)
+
+    async def verify_token(self, token=None):
         """
         校验token，仅校验app权限
         :param token: Azure AD b2c token
-        :return:
+        :return: token payload
         """
+        cache_key = hashlib.sha256(token.encode('utf8')).hexdigest() if token else None
+        if cache_key:
+            payload = self.token_cache.get(cache_key)
+            if payload is not MISSING:
+                return payload
         try:
             # 获取 type， alg， kid
             unverified_header = jwt.get_unverified_header(token)
             kid = unverified_header['kid']
             alg = unverified_header['alg']
-            loggers.info(unverified_header)
-            now = datetime.datetime.now()
-
-            if not (0 < (now - self._jwks_last_updated).total_seconds() < self._jwks_cache_seconds):
-                loggers.info(f"jwks config is out of date (last updated at {self._jwks_last_updated})")
-                self._refresh_jwks_cache()
+            loggers.debug(unverified_header)
 
-            public_key = self._jwks.get(kid, None)
+            public_key = await self._get_public_key(kid)
             if not public_key:
                 loggers.error('could not found the kid')
                 raise HTTPException(
@@ -87,8 +199,12 @@ class AzureAuthorization:
                 )
             payload = jwt.decode(token, key=public_key, algorithms=alg, audience=self.clientid)
             # 成功后解析token
-            loggers.info(f"client info: {payload}")
-            # process payload
+            loggers.debug(f"client info: {payload}")
+            # 缓存到 token 过期
+            expires_in = payload.get('exp', 0) - time.time()
+            if expires_in > 0:
+                self.token_cache.set(cache_key, payload, ttl=expires_in)
+            return payload
         except JoseExceptions.ExpiredSignatureError:
             loggers.error('Authorization token expired')
             raise HTTPException(
@@ -109,9 +225,9 @@ class AzureAuthorization:
             )
 
 
-authz = AzureAuthorization(appid=appid, clientid=clientid)
+authz = AzureAuthorization(appid=appid, clientid=clientid, shared=shared_value('jwks'))
 
 if __name__ == '__main__':
     auths = AzureAuthorization(appid=appid, clientid=clientid)
     # auths._refresh_jwks_cache()
-    auths.verify_token()
+    asyncio.run(auths.verify_token())
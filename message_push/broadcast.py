@@ -0,0 +1,112 @@
+"""
+大批量群发：请求体为接收人列表（NDJSON 或 CSV），边接收边解析，每 batch_size 个接收人入队一个发送任务，
+内存占用与接收人数无关；发送队列已满时暂停读取请求体，等待 worker 处理
+"""
+import codecs
+import csv
+import json
+from typing import AsyncIterator, List
+from message_push.utils import config
+
+
+class BroadcastConfig:
+    _broadcast: dict = config.get('broadcast') or {}
+    # 每个发送任务的接收人数
+    batch_size: int = _broadcast.get('batch_size', 1000)
+    # 发送队列已满时最多等待的秒数，超过后返回 429
+    max_wait: float = _broadcast.get('max_wait', 30)
+    # 一行的最大字符数，超过时返回 400
+    max_line_length: int = _broadcast.get('max_line_length', 4096)
+
+
+NDJSON_TYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl', 'application/json-lines')
+CSV_TYPES = ('text/csv', 'application/csv')
+# CSV 第一行为这些列名之一时作为表头，取该列
+CSV_COLUMNS = ('user', 'to_user', 'to_users', 'recipient')
+
+
+class BroadcastError(Exception):
+    """
+    请求体格式错误
+    """
+
+
+async def iter_lines(chunks: AsyncIterator[bytes], max_line_length: int = BroadcastConfig.max_line_length
+                     ) -> AsyncIterator[str]:
+    """
+    按行读取请求体，只保存当前未结束的一行
+    :param chunks: 请求体（request.stream()）
+    :raise BroadcastError: 一行超过 max_line_length
+    """
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    pending = ''
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        lines = pending.split('\n')
+        pending = lines.pop()
+        for line in lines + [pending]:
+            if len(line) > max_line_length:
+                raise BroadcastError(f"line longer than {max_line_length} characters")
+        for line in lines:
+            yield line.rstrip('\r')
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending.rstrip('\r')
+
+
+def parse_ndjson(line: str) -> str:
+    """
+    每行为接收人字符串，或包含 user 的对象
+    """
+    value = json.loads(line)
+    if isinstance(value, dict):
+        value = value.get('user')
+    if not isinstance(value, str):
+        raise ValueError("recipient must be a string or an object with a user field")
+    return value
+
+
+async def iter_recipients(chunks: AsyncIterator[bytes], content_type: str) -> AsyncIterator[str]:
+    """
+    :param content_type: 请求的 Content-Type，NDJSON_TYPES 或 CSV_TYPES
+    :raise BroadcastError: 不支持的格式，或某一行无法解析（包括行号）
+    """
+    media_type = content_type.split(';')[0].strip().lower()
+    if media_type not in NDJSON_TYPES + CSV_TYPES:
+        raise BroadcastError(f"unsupported content type {media_type!r}, use application/x-ndjson or text/csv")
+    column = 0
+    number = 0
+    async for line in iter_lines(chunks):
+        number += 1
+        if not line.strip():
+            continue
+        try:
+            if media_type in NDJSON_TYPES:
+                recipient = parse_ndjson(line)
+            else:
+                row = next(csv.reader([line]))
+                if number == 1 and any(cell.strip().lower() in CSV_COLUMNS for cell in row):
+                    column = next(i for i, cell in enumerate(row) if cell.strip().lower() in CSV_COLUMNS)
+                    continue
+                recipient = row[column] if column < len(row) else ''
+        except (ValueError, csv.Error) as e:
+            raise BroadcastError(f"line {number}: {e}") from e
+        recipient = recipient.strip()
+        if not recipient:
+            raise BroadcastError(f"line {number}: empty recipient")
+        yield recipient
+
+
+async def batched(recipients: AsyncIterator[str], batch_size: int = BroadcastConfig.batch_size
+                  ) -> AsyncIterator[List[str]]:
+    """
+    每 batch_size 个接收人为一批
+    """
+    batch = []
+    async for recipient in recipients:
+        batch.append(recipient)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
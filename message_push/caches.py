@@ -1,37 +1,453 @@
+import asyncio
+import json
 import redis
-from utils import config
+from redis import asyncio as aioredis
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+from message_push.logconfig import loggers
+from message_push.metrics import LOCAL_CACHE, LOCAL_CACHE_SIZE
+from message_push.utils import config
 
 
 class CacheConfig:
     server: str = config['redis']['server']
     port: int = config['redis']['port']
     password: str = config['redis']['password']
+    # 批量读取时每次 MGET 的 key 数量
+    chunk_size: int = config['redis'].get('chunk_size', 500)
+    # 每个 db 共享一个连接池：最大连接数，连接用完时最多等待的秒数
+    max_connections: int = config['redis'].get('max_connections', 50)
+    pool_timeout: float = config['redis'].get('pool_timeout', 5)
+    socket_timeout: float = config['redis'].get('socket_timeout', 5)
+    # 进程内缓存
+    local_cache: dict = config['redis'].get('local_cache') or {}
+    local_maxsize: int = local_cache.get('maxsize', 10000)
+    local_ttl: float = local_cache.get('ttl', 300)
+    local_negative_ttl: float = local_cache.get('negative_ttl', 30)
+    local_invalidate_channel: str = local_cache.get('invalidate_channel', '')
+    # 多个进程共享的值（jwks 公钥、微信 access_token），关闭时每个进程各自获取
+    shared: dict = config['redis'].get('shared') or {}
+    shared_enable: bool = shared.get('enable', False)
+    shared_db: int = shared.get('db', 2)
+    shared_prefix: str = shared.get('prefix', 'message_push:shared')
+
+
+# 本地缓存未命中标记
+MISSING = object()
+
+
+class LocalCache:
+    """
+    进程内 LRU 缓存，每个 key 有独立的过期时间，线程安全
+    """
+    def __init__(self, maxsize: int = 10000, ttl: float = 300, name: Optional[str] = None):
+        """
+        :param maxsize: 最大 key 数量，超出后淘汰最久未使用的 key
+        :param ttl: 默认过期时间(秒)
+        :param name: 指标中的缓存名称，为空时只在 stats() 中计数，不导出 Prometheus 指标
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key -> (value, expires_at)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._metrics = None
+        if name:
+            self._metrics = {result: LOCAL_CACHE.labels(name, result) for result in ('hit', 'miss', 'eviction')}
+            LOCAL_CACHE_SIZE.labels(name).set_function(lambda: len(self._data))
+
+    def get(self, key, default=MISSING):
+        """
+        :return: 缓存的值，不存在或已过期时返回 default
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                if item[1] > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    if self._metrics:
+                        self._metrics['hit'].inc()
+                    return item[0]
+                del self._data[key]
+            self.misses += 1
+            if self._metrics:
+                self._metrics['miss'].inc()
+            return default
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+                if self._metrics:
+                    self._metrics['eviction'].inc()
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+def _pool_kwargs(db: int, ssl: bool, module=redis) -> dict:
+    """
+    连接池参数
+    :param module: redis 或 redis.asyncio，ssl 决定使用其中的 SSLConnection 还是 Connection
+    """
+    return dict(
+        connection_class=module.SSLConnection if ssl else module.Connection,
+        host=CacheConfig.server,
+        password=CacheConfig.password,
+        port=CacheConfig.port,
+        db=db,
+        max_connections=CacheConfig.max_connections,
+        timeout=CacheConfig.pool_timeout,
+        socket_timeout=CacheConfig.socket_timeout,
+    )
+
+
+@lru_cache(maxsize=None)
+def get_connection_pool(db: int, ssl: bool = True) -> redis.BlockingConnectionPool:
+    """
+    进程内共享的同步连接池，同一个 db 的所有 redis 客户端复用连接，连接数不超过 max_connections
+    """
+    return redis.BlockingConnectionPool(**_pool_kwargs(db, ssl))
+
+
+# (db, ssl) -> redis.asyncio 连接池
+_async_pools: Dict[Tuple[int, bool], aioredis.BlockingConnectionPool] = {}
+
+
+def get_async_connection_pool(db: int, ssl: bool = True) -> aioredis.BlockingConnectionPool:
+    """
+    进程内共享的异步连接池，连接（及 SSL 会话）保持到 close_async_connection_pools
+    连接绑定创建时的事件循环，只能在同一个事件循环中使用
+    """
+    pool = _async_pools.get((db, ssl))
+    if pool is None:
+        pool = aioredis.BlockingConnectionPool(**_pool_kwargs(db, ssl, aioredis))
+        _async_pools[(db, ssl)] = pool
+    return pool
+
+
+async def close_async_connection_pools():
+    """
+    关闭所有异步连接池，在应用/worker 退出时调用
+    """
+    pools = list(_async_pools.values())
+    _async_pools.clear()
+    await asyncio.gather(*[pool.disconnect() for pool in pools])
 
 
 class RedisCache:
     """
-    redis 缓存
+    redis 缓存，同一个 db 的实例共享连接池
     """
     def __init__(self, db: int = 1, ssl: bool = True):
-        self.redis = redis.StrictRedis(
-            host=CacheConfig.server,
-            password=CacheConfig.password,
-            port=CacheConfig.port,
-            db=db,
-            ssl=ssl
-        )
+        self.redis = redis.StrictRedis(connection_pool=get_connection_pool(db, ssl))
 
     def read(self, key: str):
         return self.redis.get(key)
 
+    def read_many(self, keys: List[str], chunk_size: int = None) -> Dict[str, bytes]:
+        """
+        批量读取，每 chunk_size 个 key 使用一次 MGET，N 个 key 只需 ceil(N/chunk_size) 次往返
+        :param keys: key 列表，重复的 key 只读取一次
+        :param chunk_size: 每次 MGET 的 key 数量，默认 CacheConfig.chunk_size
+        :return: {key: value}，不存在的 key 不在结果中
+        """
+        chunk_size = chunk_size or CacheConfig.chunk_size
+        keys = list(dict.fromkeys(keys))
+        result = {}
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i + chunk_size]
+            for key, value in zip(chunk, self.redis.mget(chunk)):
+                if value is not None:
+                    result[key] = value
+        return result
+
+
+class _LocalCacheLayer:
+    """
+    LocalCachedRedis 与 AsyncLocalCachedRedis 共用的本地缓存逻辑，子类只负责读取 redis
+    """
+    local_cache: LocalCache
+    negative_ttl: float
+
+    def _init_local_cache(self, local_cache: Optional[LocalCache], negative_ttl: float):
+        self.local_cache = local_cache or LocalCache(maxsize=CacheConfig.local_maxsize, ttl=CacheConfig.local_ttl)
+        self.negative_ttl = negative_ttl
+
+    def _read_local(self, keys: List[str]) -> Tuple[Dict[str, bytes], List[str]]:
+        """
+        :return: (本地缓存中存在的值, 需要从 redis 读取的 key)，缓存为不存在的 key 两者都不包括
+        """
+        result = {}
+        remote_keys = []
+        for key in dict.fromkeys(keys):
+            value = self.local_cache.get(key)
+            if value is MISSING:
+                remote_keys.append(key)
+            elif value is not None:
+                result[key] = value
+        return result, remote_keys
+
+    def _store_many(self, remote_keys: List[str], found: Dict[str, bytes]):
+        for key in remote_keys:
+            self._store(key, found.get(key))
+
+    def _store(self, key: str, value):
+        if value is None:
+            self.local_cache.set(key, None, ttl=self.negative_ttl)
+        else:
+            self.local_cache.set(key, value)
+
+    def invalidate(self, key: str):
+        self.local_cache.delete(key)
+
+
+class LocalCachedRedis(_LocalCacheLayer, RedisCache):
+    """
+    在 redis 前增加一层进程内 LRU 缓存，redis 中不存在的 key 也会缓存（较短的 negative_ttl），
+    可选订阅 redis pub/sub 或 keyspace 通知使本地缓存失效
+    """
+    def __init__(self, db: int = 1, ssl: bool = True, local_cache: LocalCache = None,
+                 negative_ttl: float = CacheConfig.local_negative_ttl):
+        super(LocalCachedRedis, self).__init__(db=db, ssl=ssl)
+        self._init_local_cache(local_cache, negative_ttl)
+        self._invalidation_thread = None
+
+    def read(self, key: str):
+        value = self.local_cache.get(key)
+        if value is not MISSING:
+            return value
+        value = super(LocalCachedRedis, self).read(key)
+        self._store(key, value)
+        return value
+
+    def read_many(self, keys: List[str], chunk_size: int = None) -> Dict[str, bytes]:
+        result, remote_keys = self._read_local(keys)
+        if remote_keys:
+            found = super(LocalCachedRedis, self).read_many(remote_keys, chunk_size=chunk_size)
+            self._store_many(remote_keys, found)
+            result.update(found)
+        return result
+
+    def listen_invalidation(self, channel: str):
+        """
+        订阅失效通知，收到后删除对应的本地缓存
+        channel 为 keyspace 通知模式（如 "__keyspace@1__:*"，需 redis 开启 notify-keyspace-events）时，
+        失效的 key 取自频道名；否则消息内容即为需要失效的 key
+        :param channel: 频道名或 keyspace 通知模式
+        """
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        if channel.startswith('__keyspace@'):
+            pubsub.psubscribe(**{channel: self._on_keyspace_event})
+        else:
+            pubsub.subscribe(**{channel: self._on_invalidate_message})
+        self._invalidation_thread = pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def stop_invalidation(self):
+        if self._invalidation_thread is not None:
+            self._invalidation_thread.stop()
+            self._invalidation_thread = None
+
+    def _on_invalidate_message(self, message: dict):
+        self.invalidate(message['data'].decode('utf8'))
+
+    def _on_keyspace_event(self, message: dict):
+        # __keyspace@1__:<key>
+        self.invalidate(message['channel'].decode('utf8').split(':', 1)[1])
+
+
+class AsyncRedisCache:
+    """
+    redis.asyncio 缓存，接口与 RedisCache 相同，在事件循环中读取 redis 不阻塞
+    """
+    def __init__(self, db: int = 1, ssl: bool = True, client: Optional[aioredis.Redis] = None):
+        """
+        :param db: redis db
+        :param ssl: 是否使用 SSL
+        :param client: redis.asyncio 客户端，默认使用共享的异步连接池，第一次读取时创建
+        """
+        self.db = db
+        self.ssl = ssl
+        self._redis = client
+
+    @property
+    def redis(self) -> aioredis.Redis:
+        if self._redis is None:
+            self._redis = aioredis.Redis(connection_pool=get_async_connection_pool(self.db, self.ssl))
+        return self._redis
+
+    @redis.setter
+    def redis(self, client: aioredis.Redis):
+        self._redis = client
+
+    async def read(self, key: str):
+        return await self.redis.get(key)
+
+    async def read_many(self, keys: List[str], chunk_size: int = None) -> Dict[str, bytes]:
+        """
+        批量读取，每 chunk_size 个 key 一条 MGET，所有 MGET 通过 pipeline 在一次往返中发送
+        :param keys: key 列表，重复的 key 只读取一次
+        :param chunk_size: 每次 MGET 的 key 数量，默认 CacheConfig.chunk_size
+        :return: {key: value}，不存在的 key 不在结果中
+        """
+        chunk_size = chunk_size or CacheConfig.chunk_size
+        keys = list(dict.fromkeys(keys))
+        if not keys:
+            return {}
+        chunks = [keys[i:i + chunk_size] for i in range(0, len(keys), chunk_size)]
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for chunk in chunks:
+                pipe.mget(chunk)
+            values = await pipe.execute()
+        result = {}
+        for chunk, chunk_values in zip(chunks, values):
+            for key, value in zip(chunk, chunk_values):
+                if value is not None:
+                    result[key] = value
+        return result
+
+
+class AsyncLocalCachedRedis(_LocalCacheLayer, AsyncRedisCache):
+    """
+    在 AsyncRedisCache 前增加一层进程内 LRU 缓存，与 LocalCachedRedis 相同；
+    local_cache 可以与同步的 LocalCachedRedis 共用，由其订阅失效通知
+    """
+    def __init__(self, db: int = 1, ssl: bool = True, client: Optional[aioredis.Redis] = None,
+                 local_cache: LocalCache = None, negative_ttl: float = CacheConfig.local_negative_ttl):
+        super(AsyncLocalCachedRedis, self).__init__(db=db, ssl=ssl, client=client)
+        self._init_local_cache(local_cache, negative_ttl)
+
+    async def read(self, key: str):
+        value = self.local_cache.get(key)
+        if value is not MISSING:
+            return value
+        value = await super(AsyncLocalCachedRedis, self).read(key)
+        self._store(key, value)
+        return value
+
+    async def read_many(self, keys: List[str], chunk_size: int = None) -> Dict[str, bytes]:
+        result, remote_keys = self._read_local(keys)
+        if remote_keys:
+            found = await super(AsyncLocalCachedRedis, self).read_many(remote_keys, chunk_size=chunk_size)
+            self._store_many(remote_keys, found)
+            result.update(found)
+        return result
+
+
+class SharedValue:
+    """
+    多个进程共享的值（如 jwks 公钥、微信 access_token），以 json 保存在 redis 中并设置过期时间，
+    一个进程获取后其余进程直接读取；redis 出错时返回 None，调用方退化为各自获取
+    """
+    def __init__(self, key: str, db: int = CacheConfig.shared_db, ssl: bool = True,
+                 client: Optional[redis.StrictRedis] = None, async_client: Optional[aioredis.Redis] = None):
+        """
+        :param key: redis key
+        :param db: redis db
+        :param ssl: 是否使用 SSL
+        :param client: 同步客户端，默认使用共享的连接池
+        :param async_client: 异步客户端，默认使用共享的异步连接池
+        """
+        self.key = key
+        self.db = db
+        self.ssl = ssl
+        self._redis = client
+        self._async_cache = AsyncRedisCache(db=db, ssl=ssl, client=async_client)
+
+    @property
+    def redis(self) -> redis.StrictRedis:
+        if self._redis is None:
+            self._redis = RedisCache(db=self.db, ssl=self.ssl).redis
+        return self._redis
+
+    def get(self) -> Optional[dict]:
+        try:
+            return self._loads(self.redis.get(self.key))
+        except (redis.RedisError, OSError) as e:
+            loggers.error(f"read shared {self.key} error: {e!r}")
+            return None
+
+    def set(self, value: dict, ttl: float):
+        try:
+            self.redis.set(self.key, json.dumps(value), px=max(int(ttl * 1000), 1))
+        except (redis.RedisError, OSError) as e:
+            loggers.error(f"write shared {self.key} error: {e!r}")
+
+    async def aget(self) -> Optional[dict]:
+        try:
+            return self._loads(await self._async_cache.redis.get(self.key))
+        except (redis.RedisError, OSError) as e:
+            loggers.error(f"read shared {self.key} error: {e!r}")
+            return None
+
+    async def aset(self, value: dict, ttl: float):
+        try:
+            await self._async_cache.redis.set(self.key, json.dumps(value), px=max(int(ttl * 1000), 1))
+        except (redis.RedisError, OSError) as e:
+            loggers.error(f"write shared {self.key} error: {e!r}")
+
+    @staticmethod
+    def _loads(value) -> Optional[dict]:
+        if value is None:
+            return None
+        try:
+            return json.loads(value)
+        except ValueError:
+            return None
+
+
+def shared_value(name: str) -> Optional[SharedValue]:
+    """
+    :param name: 共享值的名称，如 jwks、wx_token
+    :return: CacheConfig.shared_enable 为 False 时返回 None
+    """
+    if not CacheConfig.shared_enable:
+        return None
+    return SharedValue(f"{CacheConfig.shared_prefix}:{name}")
+
 
 # 通过微信 unionid获取对应公众号的openid
-class WxOpenIDCache(RedisCache):
+class WxOpenIDCache(LocalCachedRedis):
     """
     从redis中获取对应公众号的openid
     """
-    def __init__(self, db: int = 1, ssl: bool = True):
-        super(WxOpenIDCache, self).__init__(db=db, ssl=ssl)
+    def __init__(self, db: int = 1, ssl: bool = True, local_cache: LocalCache = None):
+        super(WxOpenIDCache, self).__init__(db=db, ssl=ssl, local_cache=local_cache)
+        if CacheConfig.local_invalidate_channel:
+            self.listen_invalidation(CacheConfig.local_invalidate_channel)
+
+
+class AsyncWxOpenIDCache(AsyncLocalCachedRedis):
+    """
+    从redis中异步获取对应公众号的openid
+    """
 
 
 if __name__ == '__main__':
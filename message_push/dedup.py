@@ -0,0 +1,197 @@
+"""
+推送请求去重：上游超时重试时相同的请求只入队一次
+去重 key 取自请求头 Idempotency-Key，没有时可选使用请求内容的哈希；
+key 在去重窗口内只能被 claim 一次（redis SET NX EX，redis 不可用时退化为进程内缓存），
+入队后记录消息id，重复的请求返回第一次请求的消息id
+"""
+import hashlib
+import json
+import threading
+from functools import lru_cache
+from typing import Optional
+import redis
+from message_push.caches import AsyncRedisCache, LocalCache, MISSING
+from message_push.logconfig import loggers
+from message_push.metrics import DEDUPLICATED
+from message_push.server import ServerConfig
+from message_push.utils import config
+
+
+class DedupConfig:
+    _dedup: dict = config.get('dedup') or {}
+    enable: bool = _dedup.get('enable', True)
+    # memory: 进程内；redis: 多个 web 进程共享（使用 redis 配置）；
+    # 默认只有一个 web 进程（server.workers 为 1）时使用 memory，否则使用 redis
+    backend: str = _dedup.get('backend', 'memory' if ServerConfig.workers == 1 else 'redis')
+    redis_db: int = _dedup.get('redis_db', 2)
+    # Idempotency-Key 的去重窗口(秒)
+    ttl: float = _dedup.get('ttl', 86400)
+    # 没有 Idempotency-Key 时是否按请求内容去重，及其去重窗口(秒)
+    content_hash: bool = _dedup.get('content_hash', True)
+    content_ttl: float = _dedup.get('content_ttl', 300)
+    # 进程内缓存的最大 key 数量
+    maxsize: int = _dedup.get('maxsize', 100000)
+
+
+class MemoryDedupStore:
+    """
+    进程内去重，key 过期或超过 maxsize 后被淘汰
+    """
+    def __init__(self, maxsize: int = DedupConfig.maxsize):
+        self._keys = LocalCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+
+    async def add(self, key: str, ttl: float) -> bool:
+        """
+        :return: key 不存在时写入并返回 True，已存在返回 False
+        """
+        with self._lock:
+            if self._keys.get(key) is not MISSING:
+                return False
+            self._keys.set(key, '', ttl=ttl)
+            return True
+
+    async def set(self, key: str, value: str, ttl: float):
+        """
+        key 存在时修改其值，不存在时不写入
+        """
+        with self._lock:
+            if self._keys.get(key) is not MISSING:
+                self._keys.set(key, value, ttl=ttl)
+
+    async def get(self, key: str) -> Optional[str]:
+        value = self._keys.get(key)
+        return None if value is MISSING else value
+
+    async def delete(self, key: str):
+        self._keys.delete(key)
+
+
+class RedisDedupStore:
+    """
+    redis 去重（SET NX EX），redis 出错时使用 fallback
+    """
+    def __init__(self, cache: AsyncRedisCache, prefix: str = 'message_push:dedup',
+                 fallback: Optional[MemoryDedupStore] = None):
+        """
+        :param cache: 异步 redis 缓存，使用其连接
+        :param prefix: key 前缀
+        :param fallback: redis 不可用时的进程内去重
+        """
+        self.cache = cache
+        self.prefix = prefix
+        self.fallback = fallback or MemoryDedupStore()
+
+    async def add(self, key: str, ttl: float) -> bool:
+        try:
+            return bool(await self.cache.redis.set(f"{self.prefix}:{key}", '', nx=True, px=int(ttl * 1000)))
+        except (redis.RedisError, OSError) as e:
+            loggers.error(f"dedup with redis error, fallback to memory: {e!r}")
+            return await self.fallback.add(key, ttl)
+
+    async def set(self, key: str, value: str, ttl: float):
+        try:
+            await self.cache.redis.set(f"{self.prefix}:{key}", value, xx=True, px=int(ttl * 1000))
+        except (redis.RedisError, OSError) as e:
+            loggers.error(f"dedup with redis error, fallback to memory: {e!r}")
+        await self.fallback.set(key, value, ttl)
+
+    async def get(self, key: str) -> Optional[str]:
+        try:
+            value = await self.cache.redis.get(f"{self.prefix}:{key}")
+        except (redis.RedisError, OSError) as e:
+            loggers.error(f"dedup with redis error, fallback to memory: {e!r}")
+            return await self.fallback.get(key)
+        return value.decode('utf8') if isinstance(value, bytes) else value
+
+    async def delete(self, key: str):
+        try:
+            await self.cache.redis.delete(f"{self.prefix}:{key}")
+        except (redis.RedisError, OSError) as e:
+            loggers.error(f"dedup with redis error, fallback to memory: {e!r}")
+        await self.fallback.delete(key)
+
+
+class Deduplicator:
+    """
+    推送请求去重
+    """
+    def __init__(self, store, ttl: float = DedupConfig.ttl, content_hash: bool = DedupConfig.content_hash,
+                 content_ttl: float = DedupConfig.content_ttl):
+        """
+        :param store: MemoryDedupStore 或 RedisDedupStore
+        :param ttl: Idempotency-Key 的去重窗口(秒)
+        :param content_hash: 没有 Idempotency-Key 时是否按请求内容去重
+        :param content_ttl: 按内容去重的窗口(秒)
+        """
+        self.store = store
+        self.ttl = ttl
+        self.content_hash = content_hash
+        self.content_ttl = content_ttl
+
+    def key(self, channel: str, payload: dict, idempotency_key: Optional[str] = None) -> Optional[str]:
+        """
+        去重 key，不需要去重时返回 None
+        :param channel: 渠道
+        :param payload: 入队的内容（包括优先级）
+        :param idempotency_key: 请求头 Idempotency-Key
+        """
+        if idempotency_key:
+            return f"{channel}:key:{hashlib.sha256(idempotency_key.encode('utf8')).hexdigest()}"
+        if self.content_hash:
+            content = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=str)
+            return f"{channel}:hash:{hashlib.sha256(content.encode('utf8')).hexdigest()}"
+        return None
+
+    async def claim(self, channel: str, key: Optional[str]) -> bool:
+        """
+        :return: 第一次出现返回 True，去重窗口内重复的请求返回 False
+        """
+        if key is None:
+            return True
+        if await self.store.add(key, self._ttl(key)):
+            return True
+        DEDUPLICATED.labels(channel).inc()
+        loggers.info(f"drop duplicate {channel} request: {key}")
+        return False
+
+    async def record(self, key: Optional[str], message_id: str):
+        """
+        请求入队后记录消息id
+        """
+        if key is not None:
+            await self.store.set(key, message_id, self._ttl(key))
+
+    async def message_id(self, key: Optional[str]) -> Optional[str]:
+        """
+        重复的请求对应的第一次请求的消息id，第一次请求还未入队时为 None
+        """
+        if key is None:
+            return None
+        return await self.store.get(key) or None
+
+    def _ttl(self, key: str) -> float:
+        return self.ttl if ':key:' in key else self.content_ttl
+
+    async def release(self, key: Optional[str]):
+        """
+        请求没有入队（如队列已满）时释放 key，允许上游重试
+        """
+        if key is not None:
+            await self.store.delete(key)
+
+
+@lru_cache(maxsize=None)
+def get_deduplicator() -> Optional[Deduplicator]:
+    """
+    进程内共享的去重，DedupConfig.enable 为 False 时返回 None
+    """
+    if not DedupConfig.enable:
+        return None
+    if DedupConfig.backend == 'redis':
+        return Deduplicator(RedisDedupStore(AsyncRedisCache(db=DedupConfig.redis_db)))
+    if DedupConfig.backend == 'memory':
+        if ServerConfig.workers != 1:
+            loggers.warning("dedup with memory backend is per process, duplicates across web workers are not dropped")
+        return Deduplicator(MemoryDedupStore())
+    raise ValueError(f"unknown dedup backend: {DedupConfig.backend}")
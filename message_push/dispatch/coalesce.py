@@ -0,0 +1,512 @@
+"""
+告警合并：同一个接收人在 window 秒内收到同一个模板的多条消息时，只有第一条立即发送，
+其余消息只记录条数和最后一条的内容，窗口结束时合并为一条摘要消息（digest）写入发送队列，由 worker 正常发送、重试；
+之后的窗口同样处理，持续的告警风暴中每个接收人每个模板每个窗口最多收到两条消息
+窗口保存在 worker 进程内，最多 max_keys 个（接收人，模板），超过后新的接收人不合并，直接发送；
+合并的消息在任务 ack 之前写入 HeldStore（与发送队列使用相同的后端），摘要消息入队后删除，worker 异常退出时不丢失
+"""
+import asyncio
+import collections
+import functools
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+import redis
+from message_push.caches import get_connection_pool
+from message_push.dispatch.deadletter import DeadLetterStore, get_dead_letter_store
+from message_push.dispatch.queue import DispatchConfig, PRIORITIES, QueueFull, SendQueue, get_queue, _decode
+from message_push.dispatch.tracking import DeliveryLog, get_delivery_log, QUEUED, FAILED
+from message_push.logconfig import loggers
+from message_push.metrics import COALESCED, COALESCE_SAVED, DEAD_LETTERS
+from message_push.models import PriorityEnum
+from message_push.utils import config
+
+
+class CoalesceConfig:
+    _coalesce: dict = config.get('coalesce') or {}
+    enable: bool = _coalesce.get('enable', False)
+    # 合并的渠道
+    channels: List[str] = _coalesce.get('channels', ['sms', 'wechat'])
+    # 合并窗口(秒)
+    window: float = _coalesce.get('window', 60)
+    # 进程内最多记录的（接收人，模板）数量
+    max_keys: int = _coalesce.get('max_keys', 100000)
+    # 各渠道的摘要消息中写入合并条数的模板变量及格式，为空时摘要消息为窗口内最后一条消息
+    count_field: Dict[str, str] = _coalesce.get('count_field') or {}
+    count_format: str = _coalesce.get('count_format', '{value}（共{count}条）')
+
+
+# 各渠道 payload 中的模板字段
+TEMPLATE_FIELDS = {'sms': 'template_name', 'wechat': 'template_id'}
+
+
+class _Window:
+    __slots__ = ('id', 'deadline', 'count')
+
+    def __init__(self, deadline: float):
+        # HeldStore 中的记录id，每个窗口不同，摘要消息入队后删除的记录不包括之后的窗口中合并的消息
+        self.id = uuid.uuid4().hex
+        self.deadline = deadline
+        # 窗口内未发送的消息数，消息内容保存在 HeldStore 中
+        self.count = 0
+
+
+class Held:
+    """
+    一个窗口中合并的消息：条数、最后一条的 payload（不包括 to_users）及其中最高的优先级
+    """
+    __slots__ = ('id', 'channel', 'user', 'count', 'payload', 'priority', 'deadline')
+
+    def __init__(self, id: str, channel: str, user: str, count: int, payload: dict, priority: str, deadline: float):
+        """
+        :param id: 窗口id
+        :param deadline: 窗口结束的 unix 时间戳
+        """
+        self.id = id
+        self.channel = channel
+        self.user = user
+        self.count = count
+        self.payload = payload
+        self.priority = priority
+        self.deadline = deadline
+
+
+def _higher(a: str, b: str) -> str:
+    return a if PRIORITIES.index(a) <= PRIORITIES.index(b) else b
+
+
+class HeldStore:
+    """
+    合并的消息，每个窗口一条记录，摘要消息入队（或写入死信）后删除；
+    worker 异常退出时记录保留，窗口结束 window 秒后仍未删除的记录由其它 worker 取出发送
+    """
+    def hold(self, held: List[Held]):
+        """
+        记录的条数加上 held 的条数，payload 替换为 held 的 payload，优先级取较高的；记录不存在时写入
+        """
+        raise NotImplementedError
+
+    def load(self, ids: Iterable[str]) -> List[Held]:
+        """
+        按 ids 的顺序返回存在的记录
+        """
+        raise NotImplementedError
+
+    def claim_expired(self, before: float, until: float, limit: int = 1000) -> List[Held]:
+        """
+        取出窗口在 before 之前结束的记录，并将其结束时间改为 until，多个 worker 同时调用时每条记录只取出一次
+        """
+        raise NotImplementedError
+
+    def delete(self, ids: Iterable[str]):
+        raise NotImplementedError
+
+
+class RedisHeldStore(HeldStore):
+    """
+    每条记录一个 hash，窗口结束时间保存在一个 sorted set 中；
+    优先级写入 priority:<优先级> 字段，读取时取最高的，不需要先读再写
+    """
+    def __init__(self, client: redis.StrictRedis, prefix: str = 'message_push:coalesce'):
+        self.redis = client
+        self.prefix = prefix
+
+    def _key(self, id: str) -> str:
+        return f"{self.prefix}:held:{id}"
+
+    @property
+    def _deadlines(self) -> str:
+        return f"{self.prefix}:deadlines"
+
+    def hold(self, held: List[Held]):
+        pipe = self.redis.pipeline()
+        for item in held:
+            key = self._key(item.id)
+            pipe.hincrby(key, 'count', item.count)
+            pipe.hset(key, mapping={'channel': item.channel, 'user': item.user, 'payload': json.dumps(item.payload),
+                                    f'priority:{item.priority}': 1})
+            pipe.zadd(self._deadlines, {item.id: item.deadline}, nx=True)
+        pipe.execute()
+
+    def load(self, ids: Iterable[str]) -> List[Held]:
+        ids = list(ids)
+        if not ids:
+            return []
+        pipe = self.redis.pipeline(transaction=False)
+        for id in ids:
+            pipe.hgetall(self._key(id))
+            pipe.zscore(self._deadlines, id)
+        replies = pipe.execute()
+        held = []
+        for id, fields, deadline in zip(ids, replies[::2], replies[1::2]):
+            if not fields:
+                continue
+            fields = {_decode(k): _decode(v) for k, v in fields.items()}
+            priority = next(priority for priority in PRIORITIES if f'priority:{priority}' in fields)
+            held.append(Held(id=id, channel=fields['channel'], user=fields['user'], count=int(fields['count']),
+                             payload=json.loads(fields['payload']), priority=priority, deadline=deadline or 0))
+        return held
+
+    def claim_expired(self, before: float, until: float, limit: int = 1000) -> List[Held]:
+        claimed = []
+
+        def transaction(pipe):
+            # 其它 worker 同时取出时 redis 放弃事务，重新读取
+            ids = [_decode(id) for id in pipe.zrangebyscore(self._deadlines, '-inf', before, start=0, num=limit)]
+            pipe.multi()
+            claimed[:] = ids
+            if ids:
+                pipe.zadd(self._deadlines, {id: until for id in ids}, xx=True)
+
+        self.redis.transaction(transaction, self._deadlines)
+        return self.load(claimed)
+
+    def delete(self, ids: Iterable[str]):
+        ids = list(ids)
+        if not ids:
+            return
+        pipe = self.redis.pipeline()
+        pipe.delete(*[self._key(id) for id in ids])
+        pipe.zrem(self._deadlines, *ids)
+        pipe.execute()
+
+
+class SQLiteHeldStore(HeldStore):
+    """
+    sqlite 存储，与 SQLiteQueue 使用同一个数据库文件
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._execute('''
+            CREATE TABLE IF NOT EXISTS coalesce_held (
+                id TEXT PRIMARY KEY,
+                channel TEXT NOT NULL,
+                user TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                payload TEXT NOT NULL,
+                priority INTEGER NOT NULL,
+                deadline REAL NOT NULL
+            )''')
+        self._execute('CREATE INDEX IF NOT EXISTS coalesce_held_deadline ON coalesce_held (deadline)')
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def _execute(self, sql: str, params=()):
+        return self._conn.execute(sql, params)
+
+    def hold(self, held: List[Held]):
+        conn = self._conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany('INSERT INTO coalesce_held (id, channel, user, count, payload, priority, deadline) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET '
+                             'count = count + excluded.count, payload = excluded.payload, '
+                             'priority = MIN(priority, excluded.priority)',
+                             [(item.id, item.channel, item.user, item.count, json.dumps(item.payload),
+                               PRIORITIES.index(item.priority), item.deadline) for item in held])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _select(self, where: str, params) -> List[Held]:
+        rows = self._execute('SELECT id, channel, user, count, payload, priority, deadline FROM coalesce_held '
+                             f'WHERE {where}', params).fetchall()
+        return [Held(id=id, channel=channel, user=user, count=count, payload=json.loads(payload),
+                     priority=PRIORITIES[priority], deadline=deadline)
+                for id, channel, user, count, payload, priority, deadline in rows]
+
+    def load(self, ids: Iterable[str]) -> List[Held]:
+        ids = list(ids)
+        found = {}
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            for item in self._select(f"id IN ({', '.join('?' * len(chunk))})", chunk):
+                found[item.id] = item
+        return [found[id] for id in ids if id in found]
+
+    def claim_expired(self, before: float, until: float, limit: int = 1000) -> List[Held]:
+        conn = self._conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            held = self._select('deadline <= ? ORDER BY deadline LIMIT ?', (before, limit))
+            conn.executemany('UPDATE coalesce_held SET deadline = ? WHERE id = ?', [(until, item.id) for item in held])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return held
+
+    def delete(self, ids: Iterable[str]):
+        self._conn.executemany('DELETE FROM coalesce_held WHERE id = ?', [(id,) for id in ids])
+
+
+class Digest:
+    """
+    摘要消息，优先级为合并的消息中最高的；held 为入队后删除的 HeldStore 记录
+    """
+    __slots__ = ('channel', 'payload', 'priority', 'held')
+
+    def __init__(self, channel: str, payload: dict, priority: str):
+        self.channel = channel
+        self.payload = payload
+        self.priority = priority
+        self.held: List[str] = []
+
+
+class Coalescer:
+    """
+    按（渠道，模板，接收人）合并消息，窗口按开始时间先后保存在 OrderedDict 中，即按结束时间排序
+    """
+    def __init__(self, window: float = CoalesceConfig.window, max_keys: int = CoalesceConfig.max_keys,
+                 channels: List[str] = CoalesceConfig.channels, count_field: Optional[Dict[str, str]] = None,
+                 count_format: str = CoalesceConfig.count_format, queue: Optional[SendQueue] = None,
+                 delivery_log: Optional[DeliveryLog] = None, dead_letters: Optional[DeadLetterStore] = None,
+                 held: Optional[HeldStore] = None):
+        """
+        :param window: 合并窗口(秒)
+        :param max_keys: 最多记录的（渠道，模板，接收人）数量
+        :param channels: 合并的渠道
+        :param count_field: 渠道 -> 摘要消息中写入合并条数的模板变量
+        :param count_format: 合并条数的格式，value 为该变量原来的值，count 为合并的消息数
+        :param queue: 摘要消息写入的发送队列，默认 get_queue()
+        :param delivery_log: 记录摘要消息的投递日志，默认 get_delivery_log()
+        :param dead_letters: 发送队列已满时写入摘要消息的死信存储，默认 get_dead_letter_store()
+        :param held: 保存合并的消息，默认 get_held_store()
+        """
+        self.window = window
+        self.max_keys = max_keys
+        self.channels = channels
+        self.count_field = CoalesceConfig.count_field if count_field is None else count_field
+        self.count_format = count_format
+        self._queue = queue
+        self._delivery_log = delivery_log
+        self._dead_letters = dead_letters
+        self._held = held
+        self._windows: 'collections.OrderedDict[Tuple[str, str, str], _Window]' = collections.OrderedDict()
+        # split 在线程池中执行，与 expire、release 互斥
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Future] = None
+
+    @property
+    def queue(self) -> SendQueue:
+        return self._queue or get_queue()
+
+    @property
+    def delivery_log(self) -> Optional[DeliveryLog]:
+        return self._delivery_log or get_delivery_log()
+
+    @property
+    def dead_letters(self) -> DeadLetterStore:
+        return self._dead_letters or get_dead_letter_store()
+
+    @property
+    def held(self) -> HeldStore:
+        return self._held or get_held_store()
+
+    def split(self, channel: str, payload: dict,
+              priority: str = PriorityEnum.Normal.value) -> Tuple[List[str], List[str]]:
+        """
+        合并的消息返回之前写入 HeldStore
+        :param payload: 任务的 payload，摘要消息（payload 中有 digest）不再合并
+        :param priority: 任务的优先级
+        :return: (立即发送的接收人, 合并到摘要消息中的接收人)
+        """
+        if channel not in self.channels or payload.get('digest'):
+            return list(payload['to_users']), []
+        template = payload[TEMPLATE_FIELDS[channel]]
+        content = {k: v for k, v in payload.items() if k != 'to_users'}
+        send, held = [], []
+        with self._lock:
+            now = time.monotonic()
+            wall = time.time()
+            for user in payload['to_users']:
+                key = (channel, template, user)
+                window = self._windows.get(key)
+                if window is not None and window.deadline <= now and not window.count:
+                    # 已结束但还没有被 expire 清除的窗口
+                    del self._windows[key]
+                    window = None
+                if window is None:
+                    if len(self._windows) < self.max_keys:
+                        self._windows[key] = _Window(now + self.window)
+                    send.append(user)
+                else:
+                    window.count += 1
+                    held.append(Held(id=window.id, channel=channel, user=user, count=1, payload=content,
+                                     priority=priority, deadline=wall + window.deadline - now))
+            if held:
+                # 在锁内写入，expire 取出的窗口不会再有新的消息
+                self.held.hold(held)
+        if held:
+            COALESCED.labels(channel).inc(len(held))
+        return send, [item.user for item in held]
+
+    def release(self, channel: str, payload: dict, users: List[str]):
+        """
+        立即发送失败的接收人结束窗口，worker 重新发送时不合并；窗口内已有合并的消息时保留
+        """
+        template = payload.get(TEMPLATE_FIELDS.get(channel))
+        with self._lock:
+            for user in users:
+                window = self._windows.get((channel, template, user))
+                if window is not None and not window.count:
+                    del self._windows[(channel, template, user)]
+
+    def expire(self, now: Optional[float] = None, everything: bool = False) -> List[Digest]:
+        """
+        结束到期的窗口，有合并消息的窗口生成摘要消息并开始新的窗口；
+        同时取出其它 worker 异常退出后遗留的合并消息（窗口结束超过 window 秒）
+        :param everything: 结束所有窗口（进程退出时）
+        :return: 摘要消息，相同内容的接收人合并为一条；enqueue 之后才从 HeldStore 中删除
+        """
+        now = time.monotonic() if now is None else now
+        ids = []
+        with self._lock:
+            reopened = []
+            while self._windows:
+                key, window = next(iter(self._windows.items()))
+                if window.deadline > now and not everything:
+                    break
+                del self._windows[key]
+                if not window.count:
+                    continue
+                ids.append(window.id)
+                # 发送摘要消息后开始新的窗口
+                reopened.append(key)
+            if not everything:
+                for key in reopened:
+                    self._windows[key] = _Window(now + self.window)
+        held = self.held.load(ids)
+        if not everything:
+            wall = time.time()
+            loaded = set(ids)
+            held.extend(item for item in self.held.claim_expired(wall - self.window, wall + self.window)
+                        if item.id not in loaded)
+        digests: Dict[Tuple[str, str, int], Digest] = {}
+        for item in held:
+            payload = self._digest(item.channel, item.payload, item.count)
+            group = (item.channel, repr(sorted(payload.items())), item.count)
+            digest = digests.setdefault(group, Digest(item.channel, dict(payload, to_users=[]), item.priority))
+            digest.payload['to_users'].append(item.user)
+            digest.priority = _higher(digest.priority, item.priority)
+            digest.held.append(item.id)
+            COALESCE_SAVED.labels(item.channel).inc(item.count - 1)
+        return list(digests.values())
+
+    def _digest(self, channel: str, payload: dict, count: int) -> dict:
+        payload = dict(payload, digest=count)
+        field = self.count_field.get(channel)
+        if not field:
+            return payload
+        message = dict(payload['message'])
+        value = message.get(field)
+        if isinstance(value, dict):
+            # 微信模板变量为 {"value": ..., "color": ...}
+            message[field] = dict(value, value=self.count_format.format(value=value.get('value', ''), count=count))
+        else:
+            message[field] = self.count_format.format(value='' if value is None else value, count=count)
+        payload['message'] = message
+        return payload
+
+    def enqueue(self, digests: List[Digest]):
+        """
+        摘要消息写入发送队列后删除合并的消息；队列已满时写入死信，并在投递日志中记录这些接收人发送失败（消息id 即死信的 job_id）
+        """
+        delivery_log = self.delivery_log
+        for digest in digests:
+            channel, payload = digest.channel, digest.payload
+            detail = f"digest of {payload['digest']} messages"
+            try:
+                message_id = self.queue.enqueue(channel, payload, digest.priority)
+            except QueueFull as e:
+                message_id = uuid.uuid4().hex
+                self.dead_letters.add(channel, payload, repr(e), 0, job_id=message_id)
+                self.held.delete(digest.held)
+                DEAD_LETTERS.labels(channel).inc()
+                if delivery_log is not None:
+                    delivery_log.record(message_id, channel, FAILED, payload['to_users'], f"{detail}: {e!r}")
+                loggers.error(f"{channel} digest {message_id} of {payload['digest']} messages for "
+                              f"{len(payload['to_users'])} users is dead-lettered: {e}")
+                continue
+            self.held.delete(digest.held)
+            if delivery_log is not None:
+                delivery_log.record(message_id, channel, QUEUED, payload['to_users'], detail)
+            loggers.info(f"coalesced {payload['digest']} {channel} messages for {len(payload['to_users'])} users "
+                         f"into digest {message_id}")
+
+    async def run(self):
+        """
+        每个窗口结束时写入摘要消息，直到 stop
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            wait = self.window
+            if self._windows:
+                wait = max(next(iter(self._windows.values())).deadline - time.monotonic(), 0.01)
+            await asyncio.sleep(min(wait, self.window))
+            try:
+                digests = await loop.run_in_executor(None, self.expire)
+                if digests:
+                    await loop.run_in_executor(None, self.enqueue, digests)
+            except Exception as e:
+                loggers.error(f"enqueue digest messages error: {e!r}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        """
+        停止定时任务，未到期的窗口中合并的消息立即写入发送队列
+        """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        loop = asyncio.get_event_loop()
+        digests = await loop.run_in_executor(None, functools.partial(self.expire, everything=True))
+        if digests:
+            await loop.run_in_executor(None, self.enqueue, digests)
+
+
+def create_held_store(backend: Optional[str] = None) -> HeldStore:
+    """
+    根据配置创建合并消息的存储，与发送队列使用相同的后端
+    :param backend: redis 或 sqlite，默认 DispatchConfig.backend
+    """
+    backend = backend or DispatchConfig.backend
+    if backend == 'sqlite':
+        return SQLiteHeldStore(DispatchConfig.sqlite_path)
+    if backend == 'redis':
+        client = redis.StrictRedis(connection_pool=get_connection_pool(DispatchConfig.redis_db))
+        return RedisHeldStore(client)
+    raise ValueError(f"unknown dispatch backend: {backend}")
+
+
+@lru_cache(maxsize=None)
+def get_held_store() -> HeldStore:
+    """
+    进程内共享的合并消息存储
+    """
+    return create_held_store()
+
+
+@lru_cache(maxsize=None)
+def get_coalescer() -> Optional[Coalescer]:
+    """
+    worker 进程内共享的告警合并，CoalesceConfig.enable 为 False 时返回 None
+    """
+    if not CoalesceConfig.enable:
+        return None
+    return Coalescer()
@@ -0,0 +1,183 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from functools import lru_cache
+from typing import List, Optional
+import redis
+from message_push.caches import get_connection_pool
+from message_push.dispatch.queue import DispatchConfig, _decode
+
+
+class DeadLetter:
+    """
+    放弃发送的任务
+    """
+    def __init__(self, id: str, channel: str, payload: dict, error: str, attempts: int, job_id: str = None,
+                 created_at: float = None):
+        """
+        :param id: 死信id
+        :param channel: 渠道（email/sms/wechat）
+        :param payload: 发送内容（部分失败时只包含失败的接收人）
+        :param error: 最后一次的错误信息
+        :param attempts: 已尝试次数
+        :param job_id: 原任务id
+        :param created_at: 写入时间戳
+        """
+        self.id = id
+        self.channel = channel
+        self.payload = payload
+        self.error = error
+        self.attempts = attempts
+        self.job_id = job_id
+        self.created_at = created_at or time.time()
+
+    def dict(self) -> dict:
+        return dict(id=self.id, channel=self.channel, payload=self.payload, error=self.error,
+                    attempts=self.attempts, job_id=self.job_id, created_at=self.created_at)
+
+
+class DeadLetterStore:
+    """
+    死信存储，每个渠道最多保留 max_size 条，超过后删除最早的
+    """
+    def __init__(self, max_size: int = DispatchConfig.dead_letter_max_size):
+        self.max_size = max_size
+
+    def add(self, channel: str, payload: dict, error: str, attempts: int, job_id: str = None) -> str:
+        """
+        写入死信
+        :return: 死信id
+        """
+        letter = DeadLetter(id=uuid.uuid4().hex, channel=channel, payload=payload, error=error,
+                            attempts=attempts, job_id=job_id)
+        self._add(letter)
+        return letter.id
+
+    def list(self, channel: str, limit: int = 100) -> List[DeadLetter]:
+        """
+        最新的 limit 条死信
+        """
+        raise NotImplementedError
+
+    def count(self, channel: str) -> int:
+        raise NotImplementedError
+
+    def delete(self, channel: str, id: str):
+        raise NotImplementedError
+
+    def _add(self, letter: DeadLetter):
+        raise NotImplementedError
+
+
+class RedisDeadLetterStore(DeadLetterStore):
+    """
+    每个渠道一个 redis stream，XADD MAXLEN 限制长度
+    """
+    def __init__(self, client: redis.StrictRedis, prefix: str = 'message_push:deadletter', **kwargs):
+        super(RedisDeadLetterStore, self).__init__(**kwargs)
+        self.redis = client
+        self.prefix = prefix
+
+    def _stream(self, channel: str) -> str:
+        return f"{self.prefix}:{channel}"
+
+    @staticmethod
+    def _letter(fields: dict) -> dict:
+        fields = {_decode(k): _decode(v) for k, v in fields.items()}
+        return json.loads(fields['letter'])
+
+    def _add(self, letter: DeadLetter):
+        self.redis.xadd(self._stream(letter.channel), {'letter': json.dumps(letter.dict())},
+                        maxlen=self.max_size, approximate=True)
+
+    def list(self, channel: str, limit: int = 100) -> List[DeadLetter]:
+        entries = self.redis.xrevrange(self._stream(channel), count=limit)
+        return [DeadLetter(**self._letter(fields)) for _, fields in entries]
+
+    def count(self, channel: str) -> int:
+        return self.redis.xlen(self._stream(channel))
+
+    def delete(self, channel: str, id: str):
+        stream = self._stream(channel)
+        for entry_id, fields in self.redis.xrange(stream):
+            if self._letter(fields)['id'] == id:
+                self.redis.xdel(stream, entry_id)
+                return
+
+
+class SQLiteDeadLetterStore(DeadLetterStore):
+    """
+    sqlite 死信存储，与 SQLiteQueue 使用同一个数据库文件
+    """
+    def __init__(self, path: str, **kwargs):
+        super(SQLiteDeadLetterStore, self).__init__(**kwargs)
+        self.path = path
+        self._local = threading.local()
+        self._execute('''
+            CREATE TABLE IF NOT EXISTS dead_letters (
+                id TEXT PRIMARY KEY,
+                channel TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                error TEXT NOT NULL,
+                attempts INTEGER NOT NULL,
+                job_id TEXT,
+                created_at REAL NOT NULL
+            )''')
+        self._execute('CREATE INDEX IF NOT EXISTS dead_letters_channel ON dead_letters (channel, created_at)')
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def _execute(self, sql: str, params=()):
+        return self._conn.execute(sql, params)
+
+    def _add(self, letter: DeadLetter):
+        self._execute('INSERT INTO dead_letters (id, channel, payload, error, attempts, job_id, created_at) '
+                      'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                      (letter.id, letter.channel, json.dumps(letter.payload), letter.error, letter.attempts,
+                       letter.job_id, letter.created_at))
+        self._execute('DELETE FROM dead_letters WHERE channel = ? AND rowid NOT IN '
+                      '(SELECT rowid FROM dead_letters WHERE channel = ? ORDER BY created_at DESC LIMIT ?)',
+                      (letter.channel, letter.channel, self.max_size))
+
+    def list(self, channel: str, limit: int = 100) -> List[DeadLetter]:
+        rows = self._execute('SELECT id, payload, error, attempts, job_id, created_at FROM dead_letters '
+                             'WHERE channel = ? ORDER BY created_at DESC LIMIT ?', (channel, limit)).fetchall()
+        return [DeadLetter(id=id, channel=channel, payload=json.loads(payload), error=error, attempts=attempts,
+                           job_id=job_id, created_at=created_at)
+                for id, payload, error, attempts, job_id, created_at in rows]
+
+    def count(self, channel: str) -> int:
+        return self._execute('SELECT COUNT(*) FROM dead_letters WHERE channel = ?', (channel,)).fetchone()[0]
+
+    def delete(self, channel: str, id: str):
+        self._execute('DELETE FROM dead_letters WHERE channel = ? AND id = ?', (channel, id))
+
+
+def create_dead_letter_store(backend: Optional[str] = None) -> DeadLetterStore:
+    """
+    根据配置创建死信存储，与发送队列使用相同的后端
+    :param backend: redis 或 sqlite，默认 DispatchConfig.backend
+    """
+    backend = backend or DispatchConfig.backend
+    if backend == 'sqlite':
+        return SQLiteDeadLetterStore(DispatchConfig.sqlite_path)
+    if backend == 'redis':
+        client = redis.StrictRedis(connection_pool=get_connection_pool(DispatchConfig.redis_db))
+        return RedisDeadLetterStore(client)
+    raise ValueError(f"unknown dispatch backend: {backend}")
+
+
+@lru_cache(maxsize=None)
+def get_dead_letter_store() -> DeadLetterStore:
+    """
+    进程内共享的死信存储
+    """
+    return create_dead_letter_store()
@@ -0,0 +1,166 @@
+import asyncio
+from typing import List, Optional, Tuple
+from message_push.mail.mailbox import get_email_sender, EmailTemplate, get_html_loader, MailConfig
+from message_push.sms.smsbox import get_async_sms_sender, SMSTemplate
+from message_push.wechat.wxbox import get_wx_sender, WXTemplate
+from message_push.caches import close_async_connection_pools
+from message_push.dispatch.coalesce import get_coalescer
+from message_push.dispatch.worker import current_job
+from message_push.metrics import stage
+from message_push.models import PriorityEnum
+from message_push.ratelimit import RateLimited
+from message_push.resilience import DeliveryError
+
+
+def _send_email(payload: dict) -> Optional[dict]:
+    """
+    :return: separate 及批量邮件时返回每个接收人的发送结果
+    """
+    if payload.get('batch'):
+        return _raise_for_failed('email', _send_email_batch(payload))
+    html_file = payload['template_name'] + ".html"
+    content = get_html_loader().render(html_file, **payload['message'])
+    new_email = EmailTemplate(payload['subject'], MailConfig.sender, payload['to_users'], payload['cc_users'], content)
+    email_sender = get_email_sender()
+    if payload.get('separate'):
+        return _raise_for_failed('email', email_sender.send_each(new_email, payload['to_users']))
+    try:
+        email_sender.send(new_email)
+    except DeliveryError:
+        raise
+    except Exception as e:
+        raise DeliveryError(repr(e), retryable=email_sender.retrier.policy.is_retryable(e)) from e
+
+
+def _send_email_batch(payload: dict) -> dict:
+    """
+    批量邮件：模板只编译一次，逐封渲染并通过同一个smtp会话发送，只发送包含 to_users 中接收人的邮件
+    :return: 合并后的结果，格式与 MailBox.send_each 相同，一封邮件失败时其接收人及抄送人都失败
+    """
+    template = get_html_loader().get_template(payload['template_name'] + ".html")
+    pending = set(payload['to_users'])
+    items = [item for item in payload['items'] if pending.intersection(item['to_users'] + (item['cc_users'] or []))]
+    email_sender = get_email_sender()
+    errors: List[Optional[Exception]] = [None] * len(items)
+    # 实际发送的邮件对应的 items 下标
+    sent = []
+
+    def render():
+        for i, item in enumerate(items):
+            try:
+                with stage('email', 'render'):
+                    content = template.render(**item['message'])
+            except Exception as e:
+                errors[i] = DeliveryError(f"render template error: {e}", retryable=False)
+                continue
+            sent.append(i)
+            yield EmailTemplate(payload['subject'], MailConfig.sender, item['to_users'], item['cc_users'], content)
+
+    for i, error in zip(sent, email_sender.send_many(render())):
+        errors[i] = error
+    summary = {"succeeded": [], "failed": [], "retryable": False, "retry_after": 0, "errors": {}}
+    for item, error in zip(items, errors):
+        users = [user for user in item['to_users'] + (item['cc_users'] or []) if user in pending]
+        summary["failed" if error else "succeeded"].extend(users)
+        if error:
+            summary["errors"].setdefault(repr(error), []).extend(users)
+        if error and email_sender.retrier.policy.is_retryable(error):
+            summary["retryable"] = True
+    failed = [error for error in errors if error]
+    if failed and all(isinstance(error, RateLimited) for error in failed):
+        summary["retry_after"] = max(error.retry_after for error in failed)
+    return summary
+
+
+async def send_email(payload: dict) -> Optional[dict]:
+    return await asyncio.get_event_loop().run_in_executor(None, _send_email, payload)
+
+
+async def send_sms(payload: dict) -> dict:
+    to_users, coalesced = await _coalesce('sms', payload)
+    result = await get_async_sms_sender().send(payload['template_name'], SMSTemplate(to_users, payload['message'])) \
+        if to_users else _empty_result()
+    return _raise_for_failed('sms', _coalesced('sms', payload, result, coalesced))
+
+
+async def send_wechat(payload: dict) -> dict:
+    to_users, coalesced = await _coalesce('wechat', payload)
+    new_wx_messages = WXTemplate(message=payload['message'], miniprogram=payload['miniprogram'])
+    result = await get_wx_sender().async_send(to_users, payload['template_id'], new_wx_messages) \
+        if to_users else _empty_result()
+    return _raise_for_failed('wechat', _coalesced('wechat', payload, result, coalesced))
+
+
+async def _coalesce(channel: str, payload: dict) -> Tuple[List[str], List[str]]:
+    """
+    合并的消息在线程池中写入 HeldStore，摘要消息的优先级为合并的任务中最高的
+    :return: (立即发送的接收人, 合并到摘要消息中的接收人)，没有开启告警合并时全部立即发送
+    """
+    coalescer = get_coalescer()
+    if coalescer is None:
+        return payload['to_users'], []
+    job = current_job.get()
+    priority = job.priority if job is not None else PriorityEnum.Normal.value
+    return await asyncio.get_event_loop().run_in_executor(None, coalescer.split, channel, payload, priority)
+
+
+def _coalesced(channel: str, payload: dict, result: dict, coalesced: List[str]) -> dict:
+    """
+    发送结果中加入合并的接收人（worker 记录为 coalesced）；发送失败的接收人结束合并窗口，重新发送时不会被合并
+    """
+    if coalesced:
+        result['coalesced'] = coalesced
+    if result['failed'] and get_coalescer() is not None:
+        get_coalescer().release(channel, payload, result['failed'])
+    return result
+
+
+def _empty_result() -> dict:
+    return {"succeeded": [], "failed": [], "retryable": False, "retry_after": 0, "errors": {}}
+
+
+def _raise_for_failed(channel: str, result: dict) -> dict:
+    """
+    部分接收人发送失败时抛出 DeliveryError，worker 只对失败的接收人重新入队
+    :return: 全部成功时返回发送结果，worker 据此记录每个接收人的状态
+    """
+    if result['failed']:
+        raise DeliveryError(f"send {channel} message to {len(result['failed'])} users error",
+                            recipients=result['failed'], retryable=result['retryable'],
+                            retry_after=result.get('retry_after', 0), result=result)
+    return result
+
+
+async def start_senders(channel: str):
+    if channel == 'email' and MailConfig.template_warmup:
+        await asyncio.get_event_loop().run_in_executor(None, get_html_loader().warmup)
+    if channel == 'wechat':
+        # 创建时会连接 redis，放到线程池中执行
+        wx_sender = await asyncio.get_event_loop().run_in_executor(None, get_wx_sender)
+        wx_sender.token_manager.start_background_refresh()
+    if get_coalescer() is not None and channel in get_coalescer().channels:
+        get_coalescer().start()
+
+
+async def close_senders():
+    # 合并窗口中的消息写入发送队列，下次启动后发送
+    if get_coalescer() is not None:
+        await get_coalescer().stop()
+    # 只关闭已经创建的发送服务
+    if get_email_sender.cache_info().currsize:
+        get_email_sender().close()
+    if get_async_sms_sender.cache_info().currsize:
+        await get_async_sms_sender().aclose()
+    if get_wx_sender.cache_info().currsize:
+        await get_wx_sender().token_manager.stop_background_refresh()
+        await get_wx_sender().aclose()
+    # 关闭 openid 缓存等使用的 redis 异步连接池
+    await close_async_connection_pools()
+
+
+# 渠道 -> 发送函数，payload 格式与 main.py 中入队的内容一致
+HANDLERS = {
+    'email': send_email,
+    'sms': send_sms,
+    'wechat': send_wechat,
+}
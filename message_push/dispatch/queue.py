@@ -0,0 +1,439 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from functools import lru_cache
+from typing import List, Optional
+import redis
+from message_push.caches import get_connection_pool
+from message_push.models import PriorityEnum
+from message_push.utils import config
+
+
+class DispatchConfig:
+    _dispatch: dict = config.get('dispatch') or {}
+    # redis: 使用 redis stream；sqlite: 使用本地 sqlite 文件（单机部署或测试）
+    backend: str = _dispatch.get('backend', 'redis')
+    redis_db: int = _dispatch.get('redis_db', 2)
+    sqlite_path: str = _dispatch.get('sqlite_path', 'dispatch.db')
+    max_depth: int = _dispatch.get('max_depth', 10000)
+    visibility_timeout: float = _dispatch.get('visibility_timeout', 300)
+    max_attempts: int = _dispatch.get('max_attempts', 3)
+    concurrency: int = _dispatch.get('concurrency', 10)
+    # worker 暴露 Prometheus 指标的端口，0 表示不启动
+    metrics_port: int = _dispatch.get('metrics_port', 0)
+    # 每个渠道最多保留的死信数量
+    dead_letter_max_size: int = _dispatch.get('dead_letter_max_size', 100000)
+    # 定时发送（send_at/delay）：每个渠道最多等待中的定时任务数、最长延迟秒数
+    max_scheduled: int = _dispatch.get('max_scheduled', 1000000)
+    max_delay: float = _dispatch.get('max_delay', 30 * 86400)
+    # 每个 worker 进程每秒最多将多少个到期的定时任务移入发送队列，每次移入 release_batch 个
+    release_rate: float = _dispatch.get('release_rate', 100)
+    release_batch: int = _dispatch.get('release_batch', 10)
+
+
+# 优先级从高到低，worker 总是先处理高优先级队列
+PRIORITIES = [PriorityEnum.High.value, PriorityEnum.Normal.value, PriorityEnum.Low.value]
+
+
+class QueueFull(Exception):
+    """
+    队列长度达到 max_depth
+    """
+
+
+class Job:
+    """
+    队列中的一条发送任务
+    """
+    def __init__(self, id: str, channel: str, priority: str, payload: dict, attempts: int = 0, receipt=None):
+        """
+        :param id: 任务id
+        :param channel: 渠道（email/sms/wechat）
+        :param priority: 优先级，PriorityEnum 的值
+        :param payload: 发送内容
+        :param attempts: 已经失败的次数
+        :param receipt: 确认任务时使用的后端句柄
+        """
+        self.id = id
+        self.channel = channel
+        self.priority = priority
+        self.payload = payload
+        self.attempts = attempts
+        self.receipt = receipt
+
+    def __repr__(self):
+        return f"Job(id={self.id!r}, channel={self.channel!r}, priority={self.priority!r}, attempts={self.attempts})"
+
+
+class SendQueue:
+    """
+    持久化的发送队列，按渠道和优先级分队列，至少投递一次：
+    fetch 取出的任务在 visibility_timeout 内未 ack，会重新投递给其它 worker；
+    定时任务按到期时间排序保存，到期后由 release_due 移入发送队列
+    """
+    def __init__(self, max_depth: int = DispatchConfig.max_depth,
+                 visibility_timeout: float = DispatchConfig.visibility_timeout,
+                 max_scheduled: int = DispatchConfig.max_scheduled):
+        self.max_depth = max_depth
+        self.visibility_timeout = visibility_timeout
+        self.max_scheduled = max_scheduled
+
+    def enqueue(self, channel: str, payload: dict, priority: str = PriorityEnum.Normal.value,
+                due_at: Optional[float] = None) -> str:
+        """
+        添加任务
+        :param due_at: 定时发送的 unix 时间戳，为空或已过去时立即入队
+        :return: 任务id
+        :raise QueueFull: 队列长度达到 max_depth，或定时任务数达到 max_scheduled
+        """
+        job = Job(id=uuid.uuid4().hex, channel=channel, priority=priority, payload=payload)
+        if due_at is not None and due_at > time.time():
+            if self.scheduled(channel) >= self.max_scheduled:
+                raise QueueFull(f"{channel} schedule is full")
+            self._schedule(job, due_at)
+            return job.id
+        if self.depth(channel) >= self.max_depth:
+            raise QueueFull(f"{channel} queue is full")
+        self._put(job)
+        return job.id
+
+    def retry(self, job: Job, count_attempt: bool = True):
+        """
+        处理失败的任务重新入队，attempts 加一，不受 max_depth 限制；重新入队与删除原任务是一个原子操作
+        :param count_attempt: 为 False 时 attempts 不变（如被限流）
+        """
+        self._retry(job, Job(id=job.id, channel=job.channel, priority=job.priority, payload=job.payload,
+                             attempts=job.attempts + 1 if count_attempt else job.attempts))
+
+    def fetch(self, channel: str, count: int, consumer: str, block: float = 1) -> List[Job]:
+        """
+        按优先级取出最多 count 个任务
+        :param consumer: worker 名称
+        :param block: 没有任务时最多等待的秒数
+        """
+        raise NotImplementedError
+
+    def ack(self, job: Job):
+        """
+        确认任务已处理完成，从队列中删除
+        """
+        raise NotImplementedError
+
+    def depth(self, channel: str) -> int:
+        """
+        未确认的任务数（包括已取出但未 ack 的任务）
+        """
+        raise NotImplementedError
+
+    def release_due(self, channel: str, count: int) -> int:
+        """
+        将最多 count 个已到期的定时任务按到期时间顺序移入发送队列，多个 worker 同时调用时每个任务只移入一次
+        :return: 移入的任务数
+        """
+        raise NotImplementedError
+
+    def next_due(self, channel: str) -> Optional[float]:
+        """
+        最早到期的定时任务的时间，没有定时任务时为 None
+        """
+        raise NotImplementedError
+
+    def scheduled(self, channel: str) -> int:
+        """
+        等待中的定时任务数
+        """
+        raise NotImplementedError
+
+    def _put(self, job: Job):
+        raise NotImplementedError
+
+    def _schedule(self, job: Job, due_at: float):
+        raise NotImplementedError
+
+    def _retry(self, job: Job, retried: Job):
+        """
+        :param job: 取出的任务
+        :param retried: 重新入队的任务
+        """
+        raise NotImplementedError
+
+
+class RedisStreamQueue(SendQueue):
+    """
+    基于 redis stream 的队列，每个渠道每个优先级一个 stream，所有 worker 属于同一个消费组；
+    定时任务保存在每个渠道一个的有序集合中，score 为到期时间
+    """
+    group = 'workers'
+
+    def __init__(self, client: redis.StrictRedis, prefix: str = 'message_push:queue', **kwargs):
+        super(RedisStreamQueue, self).__init__(**kwargs)
+        self.redis = client
+        self.prefix = prefix
+        self._groups = set()
+
+    def _stream(self, channel: str, priority: str) -> str:
+        return f"{self.prefix}:{channel}:{priority}"
+
+    def _ensure_group(self, stream: str):
+        if stream in self._groups:
+            return
+        try:
+            self.redis.xgroup_create(stream, self.group, id='0', mkstream=True)
+        except redis.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+        self._groups.add(stream)
+
+    def _schedule_key(self, channel: str) -> str:
+        return f"{self.prefix}:{channel}:scheduled"
+
+    def _put(self, job: Job, client=None):
+        stream = self._stream(job.channel, job.priority)
+        self._ensure_group(stream)
+        (client or self.redis).xadd(stream, {
+            'id': job.id,
+            'payload': json.dumps(job.payload),
+            'attempts': job.attempts,
+        })
+
+    def _schedule(self, job: Job, due_at: float):
+        member = json.dumps({'id': job.id, 'priority': job.priority, 'payload': job.payload,
+                             'attempts': job.attempts})
+        self.redis.zadd(self._schedule_key(job.channel), {member: due_at})
+
+    def release_due(self, channel: str, count: int) -> int:
+        key = self._schedule_key(channel)
+        for priority in PRIORITIES:
+            self._ensure_group(self._stream(channel, priority))
+        released = []
+
+        def transaction(pipe):
+            # 其它 worker 同时移入或有新的定时任务时 redis 放弃事务，重新读取
+            members = pipe.zrangebyscore(key, '-inf', time.time(), start=0, num=count)
+            pipe.multi()
+            released[:] = members
+            if not members:
+                return
+            pipe.zrem(key, *members)
+            for member in members:
+                fields = json.loads(member)
+                self._put(Job(id=fields['id'], channel=channel, priority=fields['priority'],
+                              payload=fields['payload'], attempts=fields['attempts']), pipe)
+
+        self.redis.transaction(transaction, key)
+        return len(released)
+
+    def next_due(self, channel: str) -> Optional[float]:
+        first = self.redis.zrange(self._schedule_key(channel), 0, 0, withscores=True)
+        return first[0][1] if first else None
+
+    def scheduled(self, channel: str) -> int:
+        return self.redis.zcard(self._schedule_key(channel))
+
+    def _to_job(self, channel: str, priority: str, stream: str, entry_id, fields: dict) -> Job:
+        fields = {_decode(k): _decode(v) for k, v in fields.items()}
+        return Job(id=fields['id'], channel=channel, priority=priority, payload=json.loads(fields['payload']),
+                   attempts=int(fields.get('attempts', 0)), receipt=(stream, entry_id))
+
+    def _reclaim(self, channel: str, priority: str, count: int, consumer: str) -> List[Job]:
+        """
+        取回超过 visibility_timeout 仍未 ack 的任务（worker 异常退出）
+        """
+        stream = self._stream(channel, priority)
+        min_idle = int(self.visibility_timeout * 1000)
+        pending = self.redis.xpending_range(stream, self.group, '-', '+', count)
+        expired = [item['message_id'] for item in pending if item['time_since_delivered'] >= min_idle]
+        if not expired:
+            return []
+        claimed = self.redis.xclaim(stream, self.group, consumer, min_idle, expired)
+        return [self._to_job(channel, priority, stream, entry_id, fields)
+                for entry_id, fields in claimed if fields]
+
+    def fetch(self, channel: str, count: int, consumer: str, block: float = 1) -> List[Job]:
+        streams = {}
+        for priority in PRIORITIES:
+            stream = self._stream(channel, priority)
+            self._ensure_group(stream)
+            streams[stream] = priority
+            jobs = self._reclaim(channel, priority, count, consumer)
+            if not jobs:
+                response = self.redis.xreadgroup(self.group, consumer, {stream: '>'}, count=count)
+                jobs = [self._to_job(channel, priority, stream, entry_id, fields)
+                        for _, entries in response for entry_id, fields in entries]
+            if jobs:
+                return jobs
+        if not block:
+            return []
+        # 所有优先级均为空时阻塞等待任意队列的新任务
+        response = self.redis.xreadgroup(self.group, consumer, {stream: '>' for stream in streams},
+                                         count=count, block=int(block * 1000))
+        return [self._to_job(channel, streams[_decode(stream)], _decode(stream), entry_id, fields)
+                for stream, entries in response for entry_id, fields in entries]
+
+    def ack(self, job: Job):
+        stream, entry_id = job.receipt
+        pipe = self.redis.pipeline()
+        pipe.xack(stream, self.group, entry_id)
+        pipe.xdel(stream, entry_id)
+        pipe.execute()
+
+    def _retry(self, job: Job, retried: Job):
+        # XADD 与 XACK/XDEL 在同一个 MULTI 中执行
+        stream, entry_id = job.receipt
+        pipe = self.redis.pipeline()
+        self._put(retried, pipe)
+        pipe.xack(stream, self.group, entry_id)
+        pipe.xdel(stream, entry_id)
+        pipe.execute()
+
+    def depth(self, channel: str) -> int:
+        pipe = self.redis.pipeline(transaction=False)
+        for priority in PRIORITIES:
+            pipe.xlen(self._stream(channel, priority))
+        return sum(pipe.execute())
+
+
+class SQLiteQueue(SendQueue):
+    """
+    基于 sqlite 的队列，用于单机部署和测试，多个进程可以共享同一个数据库文件
+    """
+    def __init__(self, path: str, **kwargs):
+        super(SQLiteQueue, self).__init__(**kwargs)
+        self.path = path
+        self._local = threading.local()
+        self._execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT NOT NULL,
+                channel TEXT NOT NULL,
+                priority INTEGER NOT NULL,
+                payload TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                leased_until REAL NOT NULL DEFAULT 0,
+                consumer TEXT
+            )''')
+        self._execute('CREATE INDEX IF NOT EXISTS jobs_fetch ON jobs (channel, priority, created_at)')
+        self._execute('''
+            CREATE TABLE IF NOT EXISTS scheduled_jobs (
+                id TEXT NOT NULL,
+                channel TEXT NOT NULL,
+                priority INTEGER NOT NULL,
+                payload TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                due_at REAL NOT NULL
+            )''')
+        self._execute('CREATE INDEX IF NOT EXISTS scheduled_jobs_due ON scheduled_jobs (channel, due_at)')
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def _execute(self, sql: str, params=()):
+        return self._conn.execute(sql, params)
+
+    def _put(self, job: Job):
+        self._execute('INSERT INTO jobs (id, channel, priority, payload, attempts, created_at) '
+                      'VALUES (?, ?, ?, ?, ?, ?)',
+                      (job.id, job.channel, PRIORITIES.index(job.priority), json.dumps(job.payload),
+                       job.attempts, time.time()))
+
+    def _schedule(self, job: Job, due_at: float):
+        self._execute('INSERT INTO scheduled_jobs (id, channel, priority, payload, attempts, due_at) '
+                      'VALUES (?, ?, ?, ?, ?, ?)',
+                      (job.id, job.channel, PRIORITIES.index(job.priority), json.dumps(job.payload),
+                       job.attempts, due_at))
+
+    def release_due(self, channel: str, count: int) -> int:
+        now = time.time()
+        conn = self._conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute('SELECT rowid, id, priority, payload, attempts FROM scheduled_jobs '
+                                'WHERE channel = ? AND due_at <= ? ORDER BY due_at LIMIT ?',
+                                (channel, now, count)).fetchall()
+            conn.executemany('INSERT INTO jobs (id, channel, priority, payload, attempts, created_at) '
+                             'VALUES (?, ?, ?, ?, ?, ?)',
+                             [(job_id, channel, priority, payload, attempts, now)
+                              for _, job_id, priority, payload, attempts in rows])
+            conn.executemany('DELETE FROM scheduled_jobs WHERE rowid = ?', [(row[0],) for row in rows])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return len(rows)
+
+    def next_due(self, channel: str) -> Optional[float]:
+        return self._execute('SELECT MIN(due_at) FROM scheduled_jobs WHERE channel = ?', (channel,)).fetchone()[0]
+
+    def scheduled(self, channel: str) -> int:
+        return self._execute('SELECT COUNT(*) FROM scheduled_jobs WHERE channel = ?', (channel,)).fetchone()[0]
+
+    def fetch(self, channel: str, count: int, consumer: str, block: float = 1) -> List[Job]:
+        deadline = time.monotonic() + block
+        while True:
+            jobs = self._lease(channel, count, consumer)
+            if jobs or time.monotonic() >= deadline:
+                return jobs
+            time.sleep(min(0.1, block))
+
+    def _lease(self, channel: str, count: int, consumer: str) -> List[Job]:
+        now = time.time()
+        conn = self._conn
+        # BEGIN IMMEDIATE 保证多个 worker 进程不会取到同一个任务
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute('SELECT rowid, id, priority, payload, attempts FROM jobs '
+                                'WHERE channel = ? AND leased_until <= ? '
+                                'ORDER BY priority, created_at LIMIT ?', (channel, now, count)).fetchall()
+            conn.executemany('UPDATE jobs SET leased_until = ?, consumer = ? WHERE rowid = ?',
+                             [(now + self.visibility_timeout, consumer, row[0]) for row in rows])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return [Job(id=job_id, channel=channel, priority=PRIORITIES[priority], payload=json.loads(payload),
+                    attempts=attempts, receipt=rowid)
+                for rowid, job_id, priority, payload, attempts in rows]
+
+    def ack(self, job: Job):
+        self._execute('DELETE FROM jobs WHERE rowid = ?', (job.receipt,))
+
+    def _retry(self, job: Job, retried: Job):
+        # 一条 UPDATE 完成重新入队：排到同优先级的最后并解除租约
+        self._execute('UPDATE jobs SET payload = ?, attempts = ?, created_at = ?, leased_until = 0, consumer = NULL '
+                      'WHERE rowid = ?', (json.dumps(retried.payload), retried.attempts, time.time(), job.receipt))
+
+    def depth(self, channel: str) -> int:
+        return self._execute('SELECT COUNT(*) FROM jobs WHERE channel = ?', (channel,)).fetchone()[0]
+
+
+def _decode(value):
+    return value.decode('utf8') if isinstance(value, bytes) else value
+
+
+def create_queue(backend: Optional[str] = None) -> SendQueue:
+    """
+    根据配置创建队列
+    :param backend: redis 或 sqlite，默认 DispatchConfig.backend
+    """
+    backend = backend or DispatchConfig.backend
+    if backend == 'sqlite':
+        return SQLiteQueue(DispatchConfig.sqlite_path)
+    if backend == 'redis':
+        client = redis.StrictRedis(connection_pool=get_connection_pool(DispatchConfig.redis_db))
+        return RedisStreamQueue(client)
+    raise ValueError(f"unknown dispatch backend: {backend}")
+
+
+@lru_cache(maxsize=None)
+def get_queue() -> SendQueue:
+    """
+    进程内共享的发送队列
+    """
+    return create_queue()
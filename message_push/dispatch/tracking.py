@@ -0,0 +1,410 @@
+"""
+发送状态跟踪：每个入队的推送请求（消息id 即队列任务id）的状态变化写入只追加的投递日志
+状态：queued（入队）、scheduled（定时发送，等待发送时间）、sending（worker 开始发送）、delivered（服务商已接收）、
+failed（失败，detail 为服务商的错误）、throttled（被限流，稍后重新发送）、coalesced（合并到摘要消息中，与 delivered 一样为结束状态）
+记录事件只是追加到进程内的缓冲区，由后台线程每 flush_interval 秒或每 batch_size 条批量写入 sqlite 或 redis stream
+"""
+import collections
+import json
+import os
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+from typing import Iterable, List, Optional, Tuple
+import redis
+from message_push.caches import get_connection_pool
+from message_push.dispatch.queue import DispatchConfig, _decode
+from message_push.logconfig import loggers
+from message_push.utils import config
+
+QUEUED = 'queued'
+SCHEDULED = 'scheduled'
+SENDING = 'sending'
+DELIVERED = 'delivered'
+FAILED = 'failed'
+THROTTLED = 'throttled'
+COALESCED = 'coalesced'
+# 消息的第一个事件，写入按时间排序的索引
+CREATED = (QUEUED, SCHEDULED)
+
+
+class TrackingConfig:
+    _tracking: dict = config.get('tracking') or {}
+    enable: bool = _tracking.get('enable', True)
+    # 默认与发送队列使用相同的后端
+    backend: str = _tracking.get('backend', DispatchConfig.backend)
+    redis_db: int = _tracking.get('redis_db', DispatchConfig.redis_db)
+    sqlite_path: str = _tracking.get('sqlite_path', DispatchConfig.sqlite_path)
+    batch_size: int = _tracking.get('batch_size', 500)
+    flush_interval: float = _tracking.get('flush_interval', 0.2)
+    # 缓冲区最多保存的事件数，存储不可用时丢弃最早的事件
+    max_buffer: int = _tracking.get('max_buffer', 100000)
+    # 事件保留的秒数
+    retention: float = _tracking.get('retention', 7 * 86400)
+
+
+class DeliveryEvent:
+    """
+    一条状态变化
+    """
+    __slots__ = ('message_id', 'channel', 'status', 'recipients', 'detail', 'ts')
+
+    def __init__(self, message_id: str, channel: str, status: str, recipients: List[str] = (),
+                 detail: Optional[str] = None, ts: float = None):
+        """
+        :param message_id: 消息id
+        :param channel: 渠道（email/sms/wechat）
+        :param status: 状态
+        :param recipients: 状态变化的接收人
+        :param detail: 服务商的响应或错误信息
+        :param ts: 时间戳
+        """
+        self.message_id = message_id
+        self.channel = channel
+        self.status = status
+        self.recipients = list(recipients)
+        self.detail = detail
+        self.ts = ts or time.time()
+
+    def dict(self) -> dict:
+        return dict(message_id=self.message_id, channel=self.channel, status=self.status,
+                    recipients=self.recipients, detail=self.detail, ts=self.ts)
+
+
+class DeliveryLogStore:
+    """
+    投递日志的存储，只追加
+    """
+    def append(self, events: List[DeliveryEvent]):
+        raise NotImplementedError
+
+    def events(self, message_id: str) -> List[DeliveryEvent]:
+        """
+        一条消息的所有事件，按时间排序
+        """
+        raise NotImplementedError
+
+    def messages(self, start: float, end: float, limit: int, cursor: Optional[str] = None,
+                 channel: Optional[str] = None) -> Tuple[List[DeliveryEvent], Optional[str]]:
+        """
+        [start, end) 内入队的消息（queued 或 scheduled 事件），按入队时间排序
+        :param cursor: 上一页返回的游标
+        :return: (queued 或 scheduled 事件, 下一页的游标)，没有下一页时游标为 None
+        """
+        raise NotImplementedError
+
+    def purge(self, before: float):
+        """
+        删除 before 之前的事件
+        """
+
+
+class SQLiteDeliveryLogStore(DeliveryLogStore):
+    """
+    sqlite 投递日志，与 SQLiteQueue 使用同一个数据库文件，每批事件在一个事务中写入
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._execute('''
+            CREATE TABLE IF NOT EXISTS delivery_log (
+                message_id TEXT NOT NULL,
+                channel TEXT NOT NULL,
+                status TEXT NOT NULL,
+                recipients TEXT NOT NULL,
+                detail TEXT,
+                ts REAL NOT NULL
+            )''')
+        self._execute('CREATE INDEX IF NOT EXISTS delivery_log_message ON delivery_log (message_id)')
+        self._execute('CREATE INDEX IF NOT EXISTS delivery_log_status ON delivery_log (status, ts)')
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def _execute(self, sql: str, params=()):
+        return self._conn.execute(sql, params)
+
+    def append(self, events: List[DeliveryEvent]):
+        with self._conn:
+            self._conn.execute('BEGIN')
+            self._conn.executemany(
+                'INSERT INTO delivery_log (message_id, channel, status, recipients, detail, ts) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [(e.message_id, e.channel, e.status, json.dumps(e.recipients), e.detail, e.ts) for e in events])
+
+    @staticmethod
+    def _event(row) -> DeliveryEvent:
+        message_id, channel, status, recipients, detail, ts = row
+        return DeliveryEvent(message_id, channel, status, json.loads(recipients), detail, ts)
+
+    def events(self, message_id: str) -> List[DeliveryEvent]:
+        rows = self._execute('SELECT message_id, channel, status, recipients, detail, ts FROM delivery_log '
+                             'WHERE message_id = ? ORDER BY ts, rowid', (message_id,)).fetchall()
+        return [self._event(row) for row in rows]
+
+    def messages(self, start: float, end: float, limit: int, cursor: Optional[str] = None,
+                 channel: Optional[str] = None) -> Tuple[List[DeliveryEvent], Optional[str]]:
+        # 游标为上一页最后一条的 ts:rowid
+        after_ts, after_rowid = (float(cursor.split(':')[0]), int(cursor.split(':')[1])) if cursor else (start, 0)
+        sql = ('SELECT rowid, message_id, channel, status, recipients, detail, ts FROM delivery_log '
+               'WHERE status IN (?, ?) AND ts >= ? AND ts < ? AND (ts > ? OR (ts = ? AND rowid > ?))')
+        params = [*CREATED, start, end, after_ts, after_ts, after_rowid]
+        if channel:
+            sql += ' AND channel = ?'
+            params.append(channel)
+        rows = self._execute(sql + ' ORDER BY ts, rowid LIMIT ?', params + [limit + 1]).fetchall()
+        next_cursor = f"{rows[limit - 1][-1]!r}:{rows[limit - 1][0]}" if len(rows) > limit else None
+        return [self._event(row[1:]) for row in rows[:limit]], next_cursor
+
+    def purge(self, before: float):
+        self._execute('DELETE FROM delivery_log WHERE ts < ?', (before,))
+
+
+class RedisDeliveryLogStore(DeliveryLogStore):
+    """
+    redis stream 投递日志：每条消息一个 stream（过期时间为 retention），
+    queued、scheduled 事件同时写入一个按时间排序的索引 stream 用于分页查询；每批事件通过一个 pipeline 写入
+    """
+    def __init__(self, client: redis.StrictRedis, prefix: str = 'message_push:tracking',
+                 retention: float = TrackingConfig.retention, max_index: int = 1000000):
+        """
+        :param client: redis 连接
+        :param prefix: key 前缀
+        :param retention: 每条消息的事件保留的秒数
+        :param max_index: 索引 stream 的最大长度
+        """
+        self.redis = client
+        self.prefix = prefix
+        self.retention = retention
+        self.max_index = max_index
+
+    @property
+    def _index(self) -> str:
+        return f"{self.prefix}:index"
+
+    def _stream(self, message_id: str) -> str:
+        return f"{self.prefix}:message:{message_id}"
+
+    @staticmethod
+    def _event(fields: dict) -> DeliveryEvent:
+        fields = {_decode(k): _decode(v) for k, v in fields.items()}
+        return DeliveryEvent(**json.loads(fields['event']))
+
+    def append(self, events: List[DeliveryEvent]):
+        pipe = self.redis.pipeline(transaction=False)
+        for event in events:
+            fields = {'event': json.dumps(event.dict())}
+            stream = self._stream(event.message_id)
+            pipe.xadd(stream, fields)
+            pipe.expire(stream, int(self.retention))
+            if event.status in CREATED:
+                pipe.xadd(self._index, fields, maxlen=self.max_index, approximate=True)
+        pipe.execute()
+
+    def events(self, message_id: str) -> List[DeliveryEvent]:
+        # web 与 worker 的事件分别批量写入，写入顺序不一定是发生顺序
+        events = [self._event(fields) for _, fields in self.redis.xrange(self._stream(message_id))]
+        return sorted(events, key=lambda e: e.ts)
+
+    def messages(self, start: float, end: float, limit: int, cursor: Optional[str] = None,
+                 channel: Optional[str] = None) -> Tuple[List[DeliveryEvent], Optional[str]]:
+        # 索引的 entry id 为写入时间，比入队时间最多晚一个 flush_interval，按 ts 再过滤一次
+        low = f"({cursor}" if cursor else int(start * 1000)
+        high = int(end * 1000) + int(TrackingConfig.flush_interval * 1000) + 1000
+        found = []
+        while len(found) <= limit:
+            entries = self.redis.xrange(self._index, min=low, max=high, count=limit + 1)
+            for entry_id, fields in entries:
+                event = self._event(fields)
+                if start <= event.ts < end and (not channel or event.channel == channel):
+                    found.append((_decode(entry_id), event))
+            if len(entries) <= limit:
+                break
+            low = f"({_decode(entries[-1][0])}"
+        if len(found) > limit:
+            return [event for _, event in found[:limit]], found[limit - 1][0]
+        return [event for _, event in found], None
+
+
+class DeliveryLog:
+    """
+    批量写入的投递日志：record 追加到缓冲区，后台线程批量写入存储
+    """
+    def __init__(self, store: DeliveryLogStore, batch_size: int = TrackingConfig.batch_size,
+                 flush_interval: float = TrackingConfig.flush_interval, max_buffer: int = TrackingConfig.max_buffer,
+                 retention: float = TrackingConfig.retention):
+        """
+        :param store: 存储
+        :param batch_size: 缓冲区达到该数量时立即写入，也是每次写入的最大数量
+        :param flush_interval: 最长的写入间隔(秒)
+        :param max_buffer: 缓冲区最多保存的事件数，超过后丢弃最早的事件
+        :param retention: 事件保留的秒数，每小时清理一次
+        """
+        self.store = store
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retention = retention
+        self._buffer = collections.deque(maxlen=max_buffer)
+        self._wakeup = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        self._purged_at = 0
+        self._pid = os.getpid()
+
+    def record(self, message_id: str, channel: str, status: str, recipients: Iterable[str] = (),
+               detail: Optional[str] = None):
+        """
+        记录状态变化，不访问存储
+        :param message_id: 消息id
+        :param channel: 渠道
+        :param status: queued/scheduled/sending/delivered/failed/throttled/coalesced
+        :param recipients: 状态变化的接收人
+        :param detail: 服务商的响应或错误信息
+        """
+        if self._pid != os.getpid():
+            self._after_fork()
+        self._buffer.append(DeliveryEvent(message_id, channel, status, recipients, detail))
+        if self._thread is None:
+            self._start()
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    def _after_fork(self):
+        """
+        fork 之后后台线程只存在于父进程中，子进程重新启动；继承的缓冲区由父进程写入，子进程丢弃
+        """
+        self._pid = os.getpid()
+        self._buffer.clear()
+        self._wakeup = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread = None
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._stopping = False
+                self._thread = threading.Thread(target=self._run, name='delivery_log_flush', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """
+        把缓冲区中的事件写入存储，写入失败时丢弃这些事件
+        """
+        with self._flush_lock:
+            while self._buffer:
+                events = []
+                while self._buffer and len(events) < self.batch_size:
+                    events.append(self._buffer.popleft())
+                try:
+                    self.store.append(events)
+                except Exception as e:
+                    loggers.error(f"write {len(events)} delivery events error: {e!r}")
+            now = time.time()
+            if now - self._purged_at > 3600:
+                self._purged_at = now
+                try:
+                    self.store.purge(now - self.retention)
+                except Exception as e:
+                    loggers.error(f"purge delivery events error: {e!r}")
+
+    def close(self):
+        """
+        停止后台线程并写入剩余的事件
+        """
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stopping = True
+            self._wakeup.set()
+            thread.join()
+        self.flush()
+
+    def get(self, message_id: str) -> Optional[dict]:
+        """
+        消息的当前状态，消息不存在时返回 None
+        """
+        self.flush()
+        events = self.store.events(message_id)
+        return summarize(events) if events else None
+
+    def list(self, start: float, end: float, limit: int = 100, cursor: Optional[str] = None,
+             channel: Optional[str] = None) -> dict:
+        """
+        按入队时间分页列出消息
+        :return: {"messages": [...], "next_cursor": 下一页的游标}
+        """
+        self.flush()
+        events, next_cursor = self.store.messages(start, end, limit, cursor, channel)
+        return {
+            "messages": [{"id": e.message_id, "channel": e.channel, "created_at": e.ts,
+                          "recipients": len(e.recipients)} for e in events],
+            "next_cursor": next_cursor,
+        }
+
+
+def summarize(events: List[DeliveryEvent]) -> dict:
+    """
+    由事件得到消息的状态：每个接收人取最后一次状态变化，
+    全部 delivered 为 delivered，全部 failed 为 failed，都已结束但有成功有失败为 partial，否则为进行中的状态
+    """
+    recipients = {}
+    for event in events:
+        for recipient in event.recipients:
+            recipients[recipient] = {"status": event.status, "detail": event.detail, "updated_at": event.ts}
+    statuses = {DELIVERED if state["status"] == COALESCED else state["status"] for state in recipients.values()}
+    if not statuses:
+        status = events[-1].status
+    elif statuses == {DELIVERED} or statuses == {FAILED}:
+        status = statuses.pop()
+    elif statuses == {DELIVERED, FAILED}:
+        status = 'partial'
+    else:
+        status = next(s for s in (SENDING, THROTTLED, QUEUED, SCHEDULED, FAILED) if s in statuses)
+    return {
+        "id": events[0].message_id,
+        "channel": events[0].channel,
+        "status": status,
+        "created_at": events[0].ts,
+        "updated_at": events[-1].ts,
+        "recipients": recipients,
+        "events": [{"status": e.status, "recipients": len(e.recipients), "detail": e.detail, "ts": e.ts}
+                   for e in events],
+    }
+
+
+def create_delivery_log_store(backend: Optional[str] = None) -> DeliveryLogStore:
+    """
+    根据配置创建投递日志的存储
+    :param backend: redis 或 sqlite，默认 TrackingConfig.backend
+    """
+    backend = backend or TrackingConfig.backend
+    if backend == 'sqlite':
+        return SQLiteDeliveryLogStore(TrackingConfig.sqlite_path)
+    if backend == 'redis':
+        client = redis.StrictRedis(connection_pool=get_connection_pool(TrackingConfig.redis_db))
+        return RedisDeliveryLogStore(client)
+    raise ValueError(f"unknown tracking backend: {backend}")
+
+
+@lru_cache(maxsize=None)
+def get_delivery_log() -> Optional[DeliveryLog]:
+    """
+    进程内共享的投递日志，TrackingConfig.enable 为 False 时返回 None
+    """
+    if not TrackingConfig.enable:
+        return None
+    return DeliveryLog(create_delivery_log_store())
@@ -0,0 +1,229 @@
+import argparse
+import asyncio
+import functools
+import os
+import signal
+import socket
+import time
+from contextvars import ContextVar
+from typing import Awaitable, Callable, List, Optional
+from prometheus_client import start_http_server
+from message_push.logconfig import loggers
+from message_push.dispatch.queue import DispatchConfig, Job, SendQueue, get_queue
+from message_push.dispatch.deadletter import DeadLetterStore, get_dead_letter_store
+from message_push.dispatch.tracking import DeliveryLog, get_delivery_log, SENDING, DELIVERED, FAILED, THROTTLED, \
+    COALESCED
+from message_push.metrics import IN_FLIGHT, JOBS, RETRIED, DEAD_LETTERS, RELEASED
+from message_push.resilience import DeliveryError
+
+# 正在处理的任务，handler 只接收 payload，需要任务的其它属性（如优先级）时读取
+current_job: ContextVar[Optional[Job]] = ContextVar('current_job', default=None)
+
+
+class Worker:
+    """
+    从队列中取出指定渠道的任务并发送，处理成功后 ack；
+    失败的任务重新入队（DeliveryError 指定了失败的接收人时只发送给这些接收人），
+    不可重试的错误或超过 max_attempts 后写入死信；被限流的任务等待后重新入队，不计入尝试次数；
+    每个接收人的状态变化写入投递日志；
+    同时将到期的定时任务分批移入发送队列，同一时间到期的大量任务按 release_rate 匀速发送
+    """
+    def __init__(self, queue: SendQueue, channel: str, handler: Callable[[dict], Awaitable],
+                 concurrency: int = DispatchConfig.concurrency, max_attempts: int = DispatchConfig.max_attempts,
+                 name: str = None, dead_letters: Optional[DeadLetterStore] = None, throttle_delay: float = 5,
+                 delivery_log: Optional[DeliveryLog] = None, release_rate: float = DispatchConfig.release_rate,
+                 release_batch: int = DispatchConfig.release_batch):
+        """
+        :param queue: 发送队列
+        :param channel: 渠道（email/sms/wechat）
+        :param handler: 发送函数，参数为任务的 payload，可以返回发送结果（succeeded/errors）
+        :param concurrency: 同时处理的任务数
+        :param max_attempts: 最多尝试次数
+        :param name: worker 名称，默认 主机名-进程号
+        :param dead_letters: 死信存储，为空时直接丢弃
+        :param throttle_delay: 被限流的任务重新入队前最多等待的秒数
+        :param delivery_log: 投递日志，为空时不记录状态
+        :param release_rate: 每秒最多移入发送队列的定时任务数，0 表示不处理定时任务
+        :param release_batch: 每次移入的定时任务数
+        """
+        self.queue = queue
+        self.dead_letters = dead_letters
+        self.delivery_log = delivery_log
+        self.channel = channel
+        self.handler = handler
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.throttle_delay = throttle_delay
+        self.release_rate = release_rate
+        self.release_batch = release_batch
+        self.name = name or f"{socket.gethostname()}-{os.getpid()}"
+        self._stopping = False
+        self._in_flight = set()
+
+    def stop(self):
+        """
+        停止取新任务，已取出的任务处理完后 run 返回
+        """
+        self._stopping = True
+
+    async def run(self, block: float = 1):
+        loggers.info(f"worker {self.name} start consuming {self.channel} queue")
+        loop = asyncio.get_event_loop()
+        releaser = asyncio.ensure_future(self._release_scheduled(block)) if self.release_rate > 0 else None
+        while not self._stopping:
+            free = self.concurrency - len(self._in_flight)
+            if free <= 0:
+                await asyncio.wait(self._in_flight, return_when=asyncio.FIRST_COMPLETED)
+                continue
+            jobs = await loop.run_in_executor(None, self.queue.fetch, self.channel, free, self.name, block)
+            for job in jobs:
+                task = asyncio.ensure_future(self._process(job))
+                self._in_flight.add(task)
+                task.add_done_callback(self._in_flight.discard)
+        if releaser is not None:
+            releaser.cancel()
+        if self._in_flight:
+            await asyncio.wait(self._in_flight)
+        loggers.info(f"worker {self.name} stopped")
+
+    async def _release_scheduled(self, poll_interval: float):
+        """
+        每 release_batch / release_rate 秒最多移入 release_batch 个到期的定时任务，发送队列已满时暂停；
+        没有到期的任务时等到最早的到期时间，最多等待 poll_interval 秒以发现新的定时任务
+        """
+        loop = asyncio.get_event_loop()
+        interval = self.release_batch / self.release_rate
+        while not self._stopping:
+            wait = poll_interval
+            try:
+                count = min(self.release_batch,
+                            self.queue.max_depth - await loop.run_in_executor(None, self.queue.depth, self.channel))
+                released = await loop.run_in_executor(None, self.queue.release_due, self.channel, count) \
+                    if count > 0 else 0
+                if released:
+                    RELEASED.labels(self.channel).inc(released)
+                    wait = interval
+                elif count > 0:
+                    due_at = await loop.run_in_executor(None, self.queue.next_due, self.channel)
+                    if due_at is not None:
+                        wait = min(max(due_at - time.time(), interval), poll_interval)
+            except Exception as e:
+                loggers.error(f"release scheduled {self.channel} jobs error: {e!r}")
+            await asyncio.sleep(wait)
+
+    async def _process(self, job: Job):
+        loop = asyncio.get_event_loop()
+        in_flight = IN_FLIGHT.labels(self.channel)
+        in_flight.inc()
+        recipients = _recipients(job.payload)
+        self._track(job, SENDING, recipients)
+        # 每个任务在单独的 asyncio task 中处理，不影响其它任务
+        current_job.set(job)
+        try:
+            result = await self.handler(job.payload)
+        except Exception as e:
+            if isinstance(e, DeliveryError) and e.recipients:
+                job.payload = dict(job.payload, to_users=e.recipients)
+            throttled = getattr(e, 'retry_after', 0) > 0
+            self._track_result(job, recipients, getattr(e, 'result', None), e, THROTTLED if throttled else FAILED)
+            if throttled:
+                JOBS.labels(self.channel, 'throttled').inc()
+                loggers.info(f"{job} is rate limited, requeue it: {e}")
+                await asyncio.sleep(min(e.retry_after, self.throttle_delay))
+                await loop.run_in_executor(None, functools.partial(self.queue.retry, job, count_attempt=False))
+            elif not getattr(e, 'retryable', True) or job.attempts + 1 >= self.max_attempts:
+                JOBS.labels(self.channel, 'dropped').inc()
+                loggers.error(f"{job} failed after {job.attempts + 1} attempts, drop it: {e!r}")
+                await loop.run_in_executor(None, self._dead_letter, job, e)
+                await loop.run_in_executor(None, self.queue.ack, job)
+            else:
+                JOBS.labels(self.channel, 'retried').inc()
+                RETRIED.labels(self.channel).inc()
+                loggers.error(f"{job} failed, retry later: {e!r}")
+                await loop.run_in_executor(None, self.queue.retry, job)
+            return
+        finally:
+            in_flight.dec()
+        self._track_result(job, recipients, result)
+        JOBS.labels(self.channel, 'acked').inc()
+        await loop.run_in_executor(None, self.queue.ack, job)
+
+    def _track(self, job: Job, status: str, recipients: List[str], detail: Optional[str] = None):
+        if self.delivery_log is not None:
+            self.delivery_log.record(job.id, job.channel, status, recipients, detail)
+
+    def _track_result(self, job: Job, recipients: List[str], result: Optional[dict], error: Exception = None,
+                      status: str = FAILED):
+        """
+        记录每个接收人的发送结果：result 中 succeeded 的接收人为 delivered，coalesced 的接收人为 coalesced
+        （合并到摘要消息中），errors 中的接收人为失败；没有 result 时，error 指定的接收人（为空时为全部接收人）失败，其余为 delivered
+        :param status: 需要重新发送的接收人的状态（failed 或 throttled），不会重新发送的一律为 failed
+        """
+        if self.delivery_log is None:
+            return
+        retrying = (getattr(error, 'recipients', None) or recipients) if error is not None else []
+        if isinstance(result, dict):
+            succeeded, errors = result.get('succeeded', []), result.get('errors') or {}
+        elif error is None:
+            succeeded, errors = recipients, {}
+        else:
+            failed = set(retrying)
+            succeeded, errors = [r for r in recipients if r not in failed], {repr(error): retrying}
+        if succeeded:
+            self._track(job, DELIVERED, succeeded)
+        if isinstance(result, dict) and result.get('coalesced'):
+            self._track(job, COALESCED, result['coalesced'], 'merged into a digest message')
+        retrying = set(retrying)
+        for detail, users in errors.items():
+            self._track(job, status if users and users[0] in retrying else FAILED, users, detail)
+
+    def _dead_letter(self, job: Job, error: Exception):
+        if self.dead_letters is None:
+            return
+        DEAD_LETTERS.labels(self.channel).inc()
+        self.dead_letters.add(job.channel, job.payload, repr(error), job.attempts + 1, job_id=job.id)
+
+
+def _recipients(payload: dict) -> List[str]:
+    """
+    任务的接收人，邮件包括抄送人
+    """
+    return list(payload.get('to_users') or []) + list(payload.get('cc_users') or [])
+
+
+async def serve(channel: str, concurrency: int, metrics_port: int = 0):
+    # 只在 worker 进程中导入发送器
+    from message_push.dispatch.handlers import HANDLERS, start_senders, close_senders
+
+    if metrics_port:
+        # 发送指标在 worker 进程中产生，单独暴露 http://host:metrics_port/metrics
+        start_http_server(metrics_port)
+
+    delivery_log = get_delivery_log()
+    worker = Worker(get_queue(), channel, HANDLERS[channel], concurrency=concurrency,
+                    dead_letters=get_dead_letter_store(), delivery_log=delivery_log)
+    loop = asyncio.get_event_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, worker.stop)
+    await start_senders(channel)
+    try:
+        await worker.run()
+    finally:
+        await close_senders()
+        if delivery_log is not None:
+            # 写入缓冲区中剩余的状态变化
+            await loop.run_in_executor(None, delivery_log.close)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="message push worker")
+    parser.add_argument('--channel', required=True, choices=['email', 'sms', 'wechat'])
+    parser.add_argument('--concurrency', type=int, default=DispatchConfig.concurrency)
+    parser.add_argument('--metrics-port', type=int, default=DispatchConfig.metrics_port,
+                        help='Prometheus 指标端口，0 表示不启动')
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(serve(args.channel, args.concurrency, args.metrics_port))
+
+
+if __name__ == '__main__':
+    main()
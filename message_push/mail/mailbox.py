@@ -1,17 +1,30 @@
-
+import itertools
+import re
 import smtplib
 import ssl
+import threading
 from email.header import Header
+from email.policy import compat32
+from email.utils import formataddr, parseaddr
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from typing import List
+from functools import lru_cache
+from typing import Callable, Iterable, List, Optional
 from message_push.logconfig import loggers
+from message_push.metrics import SENT, FAILED, RETRIED, stage
+from message_push.ratelimit import RateLimiter, RateLimited
+from message_push.resilience import Retrier, RetryPolicy, CircuitBreaker, CircuitOpenError
 from message_push.utils import config
 
 try:
     from .template import TemplateRender,TemplateAzure
+    from .pool import SMTPConnectionPool
 except ImportError:
     from template import TemplateRender,TemplateAzure
+    from pool import SMTPConnectionPool
+
+# 与 MIMEMultipart 默认的 compat32 相同，换行使用 smtp 要求的 CRLF
+SMTP_POLICY = compat32.clone(linesep='\r\n')
 
 
 class MailConfig:
@@ -20,8 +33,29 @@ class MailConfig:
     smtp_server: str = config['email']['smtp_server']
     smtp_port: int = config['email']['smtp_port']
     template_path: str = config['email']['template_path']
+    # 邮件头中的发件人
+    sender: str = config['email'].get('sender', "digital.service@cn.abb.com")
     blob_conn_str: str = config['email']['blob_conn_str']
     blob_container_name: str = config['email']['blob_container_name']
+    pool_size: int = config['email'].get('pool_size', 4)
+    pool_idle_timeout: float = config['email'].get('pool_idle_timeout', 60)
+    # 模板缓存校验间隔(秒)，以及启动时是否预先加载所有模板
+    template_revalidate_interval: float = config['email'].get('template_revalidate_interval', 60)
+    template_warmup: bool = config['email'].get('template_warmup', False)
+    # 重试策略及熔断，smtp 4xx 为临时错误
+    retry: dict = config['email'].get('retry') or {}
+    circuit_breaker: dict = config['email'].get('circuit_breaker') or {}
+    retry_codes: list = retry.get('retry_codes', [421, 450, 451, 452])
+    # 限流，per_key 为每个发件账号的限制
+    rate_limit: dict = config['email'].get('rate_limit') or {}
+    # 多个发件账号 [{address, password, sender}]，为空时只使用 address/password；
+    # 发送时按 account_strategy（round_robin/least_loaded）选择账号
+    accounts: list = config['email'].get('accounts') or []
+    account_strategy: str = config['email'].get('account_strategy', 'round_robin')
+    # 账号连续 eject_after 次认证失败或被限流（eject_codes）后暂停使用 eject_timeout 秒
+    eject_after: int = config['email'].get('eject_after', 3)
+    eject_timeout: float = config['email'].get('eject_timeout', 300)
+    eject_codes: list = config['email'].get('eject_codes', [432])
 
 
 # 邮件模板
@@ -40,6 +74,7 @@ class EmailTemplate:
         self.dest = dest
         self.cc = cc
         self.content = MIMEText(content, 'html', 'utf8')
+        self._encoded = None
 
     def new_mail(self):
         msg = MIMEMultipart()
@@ -50,45 +85,529 @@ class EmailTemplate:
         msg.attach(self.content)
         return msg
 
+    def encode(self) -> bytes:
+        """
+        不含 To/CC 邮件头、可以直接作为 smtp DATA 发送的邮件（CRLF 换行，行首"."已转义，以单独一行"."结尾），
+        只序列化一次，在前面加上接收人的邮件头即可发送
+        """
+        if self._encoded is None:
+            msg = MIMEMultipart()
+            msg['Subject'] = self.subject
+            msg.attach(self.content)
+            data = re.sub(br'(?m)^\.', b'..', msg.as_bytes(policy=SMTP_POLICY))
+            if not data.endswith(b'\r\n'):
+                data += b'\r\n'
+            self._encoded = data + b'.\r\n'
+        return self._encoded
+
+
+def transaction(server: smtplib.SMTP, from_addr: str, to_addr: str, data: bytes):
+    """
+    发送一封已编码的邮件，服务器支持 PIPELINING 时 MAIL/RCPT/DATA 一次发出
+    :param server: 已完成 ehlo 的smtp会话
+    :param from_addr: 信封发件人
+    :param to_addr: 信封收件人
+    :param data: CRLF 换行、行首"."已转义并以单独一行"."结尾的邮件（EmailTemplate.encode）
+    :raise SMTPSenderRefused, SMTPRecipientsRefused, SMTPDataError: 与 smtplib.SMTP.sendmail 相同
+    :raise SMTPServerDisconnected: 会话已断开
+    """
+    commands = [f"MAIL FROM:{smtplib.quoteaddr(from_addr)}\r\n", f"RCPT TO:{smtplib.quoteaddr(to_addr)}\r\n",
+                "DATA\r\n"]
+    if server.has_extn('pipelining'):
+        server.send(''.join(commands))
+        replies = [server.getreply() for _ in commands]
+    else:
+        replies = []
+        for command in commands:
+            server.send(command)
+            replies.append(server.getreply())
+            if replies[-1][0] not in (250, 251):
+                break
+    (mail_code, mail_resp), rcpt_reply = replies[0], replies[1] if len(replies) > 1 else None
+    data_code, data_resp = replies[2] if len(replies) > 2 else (503, b'')
+    if data_code == 354 and (mail_code != 250 or rcpt_reply[0] not in (250, 251)):
+        # 不规范的服务器在没有有效收件人时也接受 DATA，发送空邮件结束事务
+        server.send(b'.\r\n')
+        server.getreply()
+    if mail_code != 250:
+        _rset(server)
+        raise smtplib.SMTPSenderRefused(mail_code, mail_resp, from_addr)
+    if rcpt_reply[0] not in (250, 251):
+        _rset(server)
+        raise smtplib.SMTPRecipientsRefused({to_addr: rcpt_reply})
+    if data_code != 354:
+        _rset(server)
+        raise smtplib.SMTPDataError(data_code, data_resp)
+    server.send(data)
+    code, resp = server.getreply()
+    if code != 250:
+        _rset(server)
+        raise smtplib.SMTPDataError(code, resp)
+
+
+def _rset(server: smtplib.SMTP):
+    try:
+        server.rset()
+    except smtplib.SMTPServerDisconnected:
+        pass
+
+
+class SMTPAccount:
+    """
+    发件账号：独立的 smtp 连接池，记录进行中、成功及失败的邮件数；
+    连续认证失败或被服务商限流达到 eject_after 次后暂停使用 eject_timeout 秒，之后放行一封邮件试探
+    """
+    def __init__(self, username: str, password: str, connect: Callable[['SMTPAccount'], smtplib.SMTP],
+                 sender: Optional[str] = None, pool_size: int = 4, pool_idle_timeout: float = 60,
+                 eject_after: int = MailConfig.eject_after, eject_timeout: float = MailConfig.eject_timeout):
+        """
+        :param username: 账号（信封发件人）
+        :param password: 密码
+        :param connect: 参数为账号，创建并完成认证的 smtp 连接
+        :param sender: 邮件头中的发件人，为空时不修改邮件
+        :param pool_size: 该账号保持的已认证smtp会话数量
+        :param pool_idle_timeout: 会话空闲超过该秒数后关闭重建
+        :param eject_after: 连续失败多少次后暂停使用
+        :param eject_timeout: 暂停使用的秒数
+        """
+        self.username = username
+        self.password = password
+        self.sender = sender
+        # EmailTemplate.encode 的邮件前加上的发件人邮件头
+        self.sender_header = f"From: {formataddr(parseaddr(sender), 'utf8')}\r\n".encode('ascii') if sender else b''
+        self.pool = SMTPConnectionPool(lambda: connect(self), size=pool_size, idle_timeout=pool_idle_timeout)
+        self.breaker = CircuitBreaker(f"smtp_account:{username}", failure_threshold=eject_after,
+                                      reset_timeout=eject_timeout)
+        self.in_flight = 0
+        self.sent = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    @property
+    def available(self) -> bool:
+        return self.breaker.state != 'open'
+
+    def checkout(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def cancel(self):
+        """
+        取消 checkout（没有发送），不记录结果
+        """
+        with self._lock:
+            self.in_flight -= 1
+
+    def checkin(self, error: Optional[Exception] = None, ejectable: bool = False):
+        """
+        归还账号并记录结果
+        :param error: 发送失败的错误
+        :param ejectable: 错误是否为账号本身的问题，是则计入暂停使用的失败次数
+        """
+        with self._lock:
+            self.in_flight -= 1
+            if error is None:
+                self.sent += 1
+            else:
+                self.failed += 1
+        if ejectable:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+    def format(self, msg: MIMEMultipart) -> str:
+        if self.sender:
+            del msg['From']
+            msg['From'] = self.sender
+        return msg.as_string()
+
 
 # 邮件服务
 class MailBox:
-    def __init__(self, username, password, smtp_server="smtp.office365.com", smtp_port=587):
+    def __init__(self, username, password, smtp_server="smtp.office365.com", smtp_port=587,
+                 pool_size: int = 4, pool_idle_timeout: float = 60, use_tls: bool = True,
+                 retrier: Optional[Retrier] = None, rate_limiter: Optional[RateLimiter] = None,
+                 accounts: Optional[List[dict]] = None, strategy: str = MailConfig.account_strategy,
+                 eject_after: int = MailConfig.eject_after, eject_timeout: float = MailConfig.eject_timeout,
+                 eject_codes: Iterable[int] = MailConfig.eject_codes):
         """
         配置 smtp 服务
         :param username: 用户名
         :param password: 密码
         :param smtp_server: smtp服务器，默认"smtp.office365.com"
         :param smtp_port: smtp服务器端口号，默认587，使能TLS
+        :param pool_size: 每个账号保持的已认证smtp会话数量
+        :param pool_idle_timeout: 会话空闲超过该秒数后关闭重建
+        :param use_tls: 是否使用 STARTTLS
+        :param retrier: 重试及熔断，默认使用 MailConfig 中的配置
+        :param rate_limiter: 限流，按邮件数计数，per_key 为每个账号的限制，默认使用 MailConfig 中的配置
+        :param accounts: 多个发件账号 [{"address", "password", "sender"}]，为空时只使用 username/password
+        :param strategy: 选择账号的方式，round_robin 轮流使用，least_loaded 优先使用进行中邮件最少的账号
+        :param eject_after: 账号连续认证失败或被限流多少次后暂停使用
+        :param eject_timeout: 账号暂停使用的秒数
+        :param eject_codes: 表示账号被限流的 smtp 响应码
         """
-        self.username = username
-        self.password = password
+        if strategy not in ('round_robin', 'least_loaded'):
+            raise ValueError(f"unknown smtp account strategy: {strategy}")
         self.smtp_server = smtp_server
         self.smtp_port = smtp_port
+        self.use_tls = use_tls
+        self.strategy = strategy
+        self.eject_codes = set(eject_codes)
         self._context = ssl.create_default_context()
+        self.accounts = [SMTPAccount(account['address'], account['password'], self._connect,
+                                     sender=account.get('sender'), pool_size=pool_size,
+                                     pool_idle_timeout=pool_idle_timeout, eject_after=eject_after,
+                                     eject_timeout=eject_timeout)
+                         for account in accounts or [{'address': username, 'password': password}]]
+        self._next = itertools.count()
+        self.username = self.accounts[0].username
+        self.password = self.accounts[0].password
+        self.retrier = retrier or Retrier(
+            'email', RetryPolicy.from_config(MailConfig.retry, MailConfig.retry_codes),
+            CircuitBreaker.from_config(f"smtp:{self.username}", MailConfig.circuit_breaker))
+        self.rate_limiter = rate_limiter or RateLimiter.from_config('email', MailConfig.rate_limit)
+
+    @property
+    def pool(self) -> SMTPConnectionPool:
+        """
+        第一个账号的连接池
+        """
+        return self.accounts[0].pool
+
+    def _connect(self, account: SMTPAccount):
+        """
+        建立smtp连接并完成认证
+        :param account: 发件账号
+        :return: smtplib.SMTP
+        """
+        loggers.info(f"connect to smtp server {self.smtp_server}:{self.smtp_port} as {account.username}")
+        server = smtplib.SMTP(self.smtp_server, self.smtp_port)
+        try:
+            server.ehlo()
+            if self.use_tls:
+                server.starttls(context=self._context)
+                server.ehlo()
+            server.login(account.username, account.password)
+        except Exception:
+            server.close()
+            raise
+        return server
+
+    def _candidates(self, exclude: Iterable[SMTPAccount] = ()) -> List[SMTPAccount]:
+        """
+        按 strategy 排序的可用账号（不包括暂停使用的账号）
+        :param exclude: 不使用的账号
+        """
+        start = next(self._next) % len(self.accounts)
+        accounts = [account for account in self.accounts[start:] + self.accounts[:start]
+                    if account.available and account not in exclude]
+        if self.strategy == 'least_loaded':
+            # 排序是稳定的，进行中邮件数相同的账号仍然轮流使用
+            accounts.sort(key=lambda account: account.in_flight)
+        return accounts
+
+    def _acquire_account(self, exclude: Iterable[SMTPAccount] = (), reserve: bool = True) -> Optional[SMTPAccount]:
+        """
+        选择账号并获取该账号的发送配额，账号被限流时尝试下一个账号；返回的账号需要 checkin
+        暂停使用的账号在获取配额之前跳过，不占用配额；只有选中的账号占用一个令牌
+        :param exclude: 不使用的账号
+        :param reserve: 是否获取发送配额，为 False 时由调用方按邮件获取
+        :return: 账号，所有账号都暂停使用时返回 None
+        :raise RateLimited: 渠道超过发送配额，或所有可用账号都超过发送配额
+        """
+        limited = []
+        for account in self._candidates(exclude):
+            try:
+                # 暂停期满的账号只放行一封试探邮件
+                probing = account.breaker.before_call()
+            except CircuitOpenError:
+                continue
+            # 等待配额期间也计入进行中的邮件，least_loaded 不会把并发的邮件都分配给同一个账号
+            account.checkout()
+            if reserve:
+                try:
+                    self.rate_limiter.acquire(account.username)
+                except RateLimited as e:
+                    account.cancel()
+                    if probing:
+                        account.breaker.release_probe()
+                    if not self._is_account_limited(e):
+                        # 渠道的配额，换账号也不能发送
+                        raise
+                    limited.append(e)
+                    continue
+            return account
+        if limited:
+            raise min(limited, key=lambda e: e.retry_after)
+        return None
+
+    def _is_account_limited(self, error: Exception) -> bool:
+        """
+        是否为账号本身的发送配额（per_key）用完，换一个账号可能成功
+        """
+        return isinstance(error, RateLimited) and error.key != self.rate_limiter.name
+
+    def _is_account_error(self, error: Exception) -> bool:
+        """
+        是否为账号本身的问题（认证失败、发件人被拒绝、被服务商限流），换一个账号可能成功
+        """
+        return isinstance(error, (smtplib.SMTPAuthenticationError, smtplib.SMTPSenderRefused)) or \
+            getattr(error, 'smtp_code', None) in self.eject_codes
 
     # 发送邮件
     def send(self, mail: EmailTemplate):
         """
-        发送邮件
+        发送邮件，临时错误（smtp 4xx、网络错误）按 retrier 的策略重试，每次尝试重新选择账号
         :param mail: 按照邮件格式的内容
         :return:
+        :raise RateLimited: 所有账号都超过发送配额
         """
         loggers.info("prepare to send email")
-        with smtplib.SMTP(self.smtp_server, self.smtp_port) as server:
-            server.ehlo()
-            server.starttls(context=self._context)
-            server.login(self.username, self.password)
-            loggers.info("send email start")
-            if mail.cc:
-                server.sendmail(self.username, (mail.dest+mail.cc), msg=mail.new_mail().as_string())
-            else:
-                server.sendmail(self.username, (mail.dest), msg=mail.new_mail().as_string())
+        to_addrs = mail.dest + mail.cc if mail.cc else mail.dest
+        msg = mail.new_mail()
+        try:
+            self.retrier.call(self._send_once, to_addrs, msg)
+        except Exception:
+            FAILED.labels('email').inc()
+            raise
+        SENT.labels('email').inc()
         loggers.info("send email successfully")
 
-html_loader = TemplateAzure(MailConfig.blob_conn_str,MailConfig.blob_container_name)
-#html_loader = TemplateRender(MailConfig.template_path)
-email_sender = MailBox(MailConfig.address, MailConfig.password)
+    def _send_once(self, to_addrs: List[str], msg: MIMEMultipart):
+        """
+        使用一个账号发送，账号本身的问题立即换下一个账号重发
+        """
+        tried = []
+        while True:
+            account = self._acquire_account(tried)
+            if account is None:
+                if tried:
+                    raise error
+                raise CircuitOpenError("all smtp accounts are ejected")
+            tried.append(account)
+            error = None
+            try:
+                self._sendmail_with(account, to_addrs, msg)
+                return
+            except Exception as e:
+                error = e
+                if not self._is_account_error(e):
+                    raise
+                # 账号被拒绝，邮件没有发送，退还该账号的令牌
+                self.rate_limiter.refund(account.username)
+                loggers.error(f"smtp account {account.username} error, try another account: {e!r}")
+            finally:
+                account.checkin(error, error is not None and self._is_account_error(error))
+
+    @staticmethod
+    def _sendmail_with(account: SMTPAccount, to_addrs: List[str], msg: MIMEMultipart):
+        # 连接池中的会话可能已被服务器断开，断开时重连重发一次
+        for retry in (True, False):
+            try:
+                with stage('email', 'provider_call'), account.pool.connection() as server:
+                    loggers.info(f"send email start with {account.username}")
+                    server.sendmail(account.username, to_addrs, msg=account.format(msg))
+                return
+            except smtplib.SMTPServerDisconnected:
+                if not retry:
+                    raise
+                RETRIED.labels('email').inc()
+                loggers.info("smtp session is disconnected, retry with a new session")
+
+    def send_many(self, mails: Iterable[EmailTemplate]) -> List[Optional[Exception]]:
+        """
+        使用同一个账号的同一个smtp会话依次发送多封邮件，mails 可以是生成器，边生成边发送
+        会话断开时重连并重发当前邮件一次；单封邮件被拒收不影响其余邮件
+        账号本身的问题或账号的配额用完时换下一个账号继续发送，其它临时错误按 retrier 的策略重试
+        :param mails: 邮件
+        :return: 按顺序返回每封邮件的结果，成功为 None，失败为异常
+        """
+        return self._send_over_session(mails, self._sendmail)
+
+    def send_each(self, mail: EmailTemplate, recipients: List[str]) -> dict:
+        """
+        相同的内容给每个接收人单独发送一封（邮件中只有该接收人），使用同一个账号的同一个smtp会话；
+        邮件只序列化一次，每封只替换 To 邮件头，服务器支持 PIPELINING 时每封邮件只需两次往返
+        会话断开时重连并重发当前邮件一次；单个接收人被拒收不影响其余接收人；账号的处理与 send_many 相同
+        :param mail: 邮件，不使用其中的接收人及抄送人
+        :param recipients: 接收人
+        :return: 合并后的结果 {"succeeded": 成功的接收人, "failed": 失败的接收人, "retryable": 失败中是否有临时错误,
+                 "retry_after": 失败都是被限流时，建议的重试时间, "errors": {错误信息: 接收人}}
+        """
+        loggers.info(f"prepare to send email to {len(recipients)} users separately")
+        errors = self._send_over_session(recipients, lambda server, account, to_addr:
+                                         self._send_encoded(server, account, mail, to_addr))
+        summary = {"succeeded": [], "failed": [], "retryable": False, "retry_after": 0, "errors": {}}
+        for to_addr, error in zip(recipients, errors):
+            summary["failed" if error else "succeeded"].append(to_addr)
+            if error:
+                summary["errors"].setdefault(repr(error), []).append(to_addr)
+            if error and self.retrier.policy.is_retryable(error):
+                summary["retryable"] = True
+        failed = [error for error in errors if error]
+        if failed and all(isinstance(error, RateLimited) for error in failed):
+            summary["retry_after"] = max(error.retry_after for error in failed)
+        loggers.info(f"send email to {len(summary['succeeded'])} users successfully, {len(failed)} failed")
+        return summary
+
+    def _send_over_session(self, items: Iterable, send: Callable) -> List[Optional[Exception]]:
+        """
+        按 retrier 的策略发送，每次尝试重新选择账号，已发送的邮件不重发
+        :param items: 邮件或接收人
+        :param send: send(server, account, item)，返回 None 或单封邮件的错误；
+                     账号本身的问题及账号的配额用完时抛出，当前邮件换下一个账号重发
+        """
+        results = []
+        # current: 已取出但还没有结果的邮件，换会话或换账号后重发
+        state = {'items': iter(items), 'current': None, 'resent': False}
+        try:
+            self.retrier.call(self._send_session_once, state, results, send)
+        except Exception as e:
+            return self._fail_all(results, state['current'], state['items'], e)
+        return results
+
+    def _send_session_once(self, state: dict, results: list, send: Callable):
+        """
+        使用一个账号的会话发送剩余的邮件，账号本身的问题立即换下一个账号继续发送
+        """
+        tried = []
+        while True:
+            # 配额由 send 按邮件获取
+            account = self._acquire_account(tried, reserve=False)
+            if account is None:
+                if tried:
+                    raise error
+                raise CircuitOpenError("all smtp accounts are ejected")
+            tried.append(account)
+            error = None
+            try:
+                self._send_with_session(account, state, results, send)
+                return
+            except Exception as e:
+                error = e
+                if not self._is_account_error(e) and not self._is_account_limited(e):
+                    raise
+                loggers.error(f"smtp account {account.username} error, try another account: {e!r}")
+            finally:
+                account.checkin(error, error is not None and self._is_account_error(error))
+
+    @staticmethod
+    def _send_with_session(account: SMTPAccount, state: dict, results: list, send: Callable):
+        # 连接池中的会话可能已被服务器断开，断开时重连并重发当前邮件一次
+        while True:
+            try:
+                with account.pool.connection() as server:
+                    if state['current'] is not None:
+                        results.append(send(server, account, state['current']))
+                        state['current'], state['resent'] = None, False
+                    for item in state['items']:
+                        state['current'] = item
+                        results.append(send(server, account, item))
+                        state['current'], state['resent'] = None, False
+                return
+            except smtplib.SMTPServerDisconnected as e:
+                if state['current'] is None:
+                    raise
+                if state['resent']:
+                    FAILED.labels('email').inc()
+                    loggers.error(f"send email error: {e!r}")
+                    results.append(e)
+                    state['current'], state['resent'] = None, False
+                else:
+                    RETRIED.labels('email').inc()
+                    loggers.info("smtp session is disconnected, retry with a new session")
+                    state['resent'] = True
+
+    @staticmethod
+    def _fail_all(results: list, current, items, error: Exception) -> list:
+        loggers.error(f"send email error: {error!r}")
+        sent = len(results)
+        if current is not None:
+            results.append(error)
+        results.extend(error for _ in items)
+        FAILED.labels('email').inc(len(results) - sent)
+        return results
+
+    def _sendmail(self, server: smtplib.SMTP, account: SMTPAccount, mail: EmailTemplate) -> Optional[Exception]:
+        to_addrs = mail.dest + mail.cc if mail.cc else mail.dest
+        try:
+            self.rate_limiter.acquire(account.username)
+        except RateLimited as e:
+            if self._is_account_limited(e):
+                raise
+            loggers.error(f"send email to {to_addrs} error: {e!r}")
+            return e
+        try:
+            with stage('email', 'provider_call'):
+                server.sendmail(account.username, to_addrs, msg=account.format(mail.new_mail()))
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+            if self._is_account_error(e):
+                # 账号被拒绝，邮件没有发送，退还该账号的令牌后换账号重发
+                self.rate_limiter.refund(account.username)
+                raise
+            FAILED.labels('email').inc()
+            loggers.error(f"send email to {to_addrs} error: {e!r}")
+            return e
+        SENT.labels('email').inc()
+        return None
+
+    def _send_encoded(self, server: smtplib.SMTP, account: SMTPAccount, mail: EmailTemplate,
+                      to_addr: str) -> Optional[Exception]:
+        if '\r' in to_addr or '\n' in to_addr:
+            # 接收人直接写入 To 邮件头及 RCPT 命令，不能包含换行
+            FAILED.labels('email').inc()
+            loggers.error(f"send email to {to_addr!r} error: prohibited newline characters")
+            return ValueError(f"recipient contains prohibited newline characters: {to_addr!r}")
+        try:
+            self.rate_limiter.acquire(account.username)
+        except RateLimited as e:
+            if self._is_account_limited(e):
+                raise
+            loggers.error(f"send email to {to_addr} error: {e!r}")
+            return e
+        data = account.sender_header + b'To: ' + to_addr.encode('utf8') + b'\r\n' + mail.encode()
+        try:
+            with stage('email', 'provider_call'):
+                transaction(server, account.username, to_addr, data)
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+            if self._is_account_error(e):
+                # 账号被拒绝，邮件没有发送，退还该账号的令牌后换账号重发
+                self.rate_limiter.refund(account.username)
+                raise
+            FAILED.labels('email').inc()
+            loggers.error(f"send email to {to_addr} error: {e!r}")
+            return e
+        SENT.labels('email').inc()
+        return None
+
+    def close(self):
+        """
+        关闭所有账号连接池中的smtp会话
+        """
+        for account in self.accounts:
+            account.pool.close()
+
+@lru_cache(maxsize=None)
+def get_html_loader() -> TemplateAzure:
+    """
+    进程内共享的模板加载器，第一次使用时创建
+    """
+    return TemplateAzure(MailConfig.blob_conn_str, MailConfig.blob_container_name,
+                         revalidate_interval=MailConfig.template_revalidate_interval,
+                         index_interval=MailConfig.template_revalidate_interval)
+    # return TemplateRender(MailConfig.template_path)
+
+
+@lru_cache(maxsize=None)
+def get_email_sender() -> MailBox:
+    """
+    进程内共享的邮件发送服务，第一次使用时创建
+    """
+    return MailBox(MailConfig.address, MailConfig.password,
+                   smtp_server=MailConfig.smtp_server, smtp_port=MailConfig.smtp_port,
+                   pool_size=MailConfig.pool_size, pool_idle_timeout=MailConfig.pool_idle_timeout,
+                   accounts=MailConfig.accounts, strategy=MailConfig.account_strategy)
 
 
 if __name__ == "__main__":
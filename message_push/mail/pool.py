@@ -0,0 +1,93 @@
+import smtplib
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable
+from message_push.logconfig import loggers
+
+
+class SMTPConnectionPool:
+    """
+    已认证 smtp 会话连接池
+    连接在多次发送之间复用，取出时对空闲过久的连接做 NOOP 健康检查，
+    超过空闲超时的连接直接关闭重建
+    """
+
+    def __init__(self, factory: Callable[[], smtplib.SMTP], size: int = 4,
+                 idle_timeout: float = 60, health_check_interval: float = 10):
+        """
+        :param factory: 创建并完成 ehlo/starttls/login 的 smtp 连接
+        :param size: 最大连接数
+        :param idle_timeout: 空闲超过该秒数的连接不再复用
+        :param health_check_interval: 空闲超过该秒数的连接复用前先发送 NOOP
+        """
+        self._factory = factory
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        # (connection, last_used)
+        self._idle = deque()
+
+    @contextmanager
+    def connection(self):
+        """
+        取出一个可用连接，使用完归还连接池；使用过程中出现异常则丢弃该连接
+        """
+        self._slots.acquire()
+        try:
+            server = self._checkout()
+            try:
+                yield server
+            except Exception:
+                self._close(server)
+                raise
+            else:
+                with self._lock:
+                    self._idle.append((server, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """
+        关闭所有空闲连接
+        """
+        with self._lock:
+            idle, self._idle = self._idle, deque()
+        for server, _ in idle:
+            self._close(server)
+
+    def _checkout(self) -> smtplib.SMTP:
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                # 后进先出，优先使用最近用过的连接
+                server, last_used = self._idle.pop()
+            idle = time.monotonic() - last_used
+            if idle > self.idle_timeout:
+                self._close(server)
+                continue
+            if idle > self.health_check_interval and not self._is_alive(server):
+                loggers.info("smtp session is dropped by server, reconnecting")
+                self._close(server)
+                continue
+            return server
+        return self._factory()
+
+    @staticmethod
+    def _is_alive(server: smtplib.SMTP) -> bool:
+        try:
+            code, _ = server.noop()
+        except (smtplib.SMTPException, OSError):
+            return False
+        return code == 250
+
+    @staticmethod
+    def _close(server: smtplib.SMTP):
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
@@ -2,10 +2,11 @@ from jinja2 import Environment, select_autoescape
 from jinja2 import BaseLoader, TemplateNotFound,Template
 from os.path import join, exists, getmtime
 from tempfile import NamedTemporaryFile
-from azure.storage.blob import BlobClient
-from azure.storage.blob import ContainerClient
 import os
+import time
 from fastapi import HTTPException
+from message_push.logconfig import loggers
+from message_push.metrics import stage
 
 
 class CustomLoader(BaseLoader):
@@ -49,45 +50,108 @@ class TemplateRender:
 
 class TemplateAzure:
     """
-    从指定位置加载模板，并装载变量
+    从Azure blob加载模板，并装载变量
+    编译后的模板按 blob 名称缓存，超过 revalidate_interval 后使用 ETag 条件请求校验是否有更新；
+    blob 列表同样缓存，不再每次判断模板是否存在时遍历容器
     """
-    def __init__(self,conn_str,container_name):
-        # Get container client by connection string
-        self.container = ContainerClient.from_connection_string(
-            conn_str=conn_str,
-            container_name=container_name)
-
-    def is_teplate_exist(self,filename):
-        # try:
+    def __init__(self, conn_str=None, container_name=None, container=None,
+                 revalidate_interval: float = 60, index_interval: float = 60, miss_interval: float = 5):
+        """
+        :param conn_str: blob 连接字符串
+        :param container_name: 容器名称
+        :param container: ContainerClient，传入时忽略 conn_str/container_name
+        :param revalidate_interval: 缓存的模板超过该秒数后，使用时校验 ETag
+        :param index_interval: blob 列表缓存时间(秒)
+        :param miss_interval: 模板不在 blob 列表中时，距上次刷新超过该秒数则重新获取列表
+        """
+        if container is None:
+            # azure sdk 导入较慢（数百毫秒），在第一次创建 TemplateAzure 时才导入
+            from azure.storage.blob import ContainerClient
+            # Get container client by connection string
+            container = ContainerClient.from_connection_string(
+                conn_str=conn_str,
+                container_name=container_name)
+        self.container = container
+        self.revalidate_interval = revalidate_interval
+        self.index_interval = index_interval
+        self.miss_interval = miss_interval
+        self._index = set()
+        self._index_updated = None
+        # blob 名称 -> (jinja2.Template, etag, 上次校验时间)
+        self._templates = {}
+
+    def _refresh_index(self):
         # 遍历容器下的blob (获取blob列表)
-        template_list = []
-        blob_list = self.container.list_blobs()
-        for blob in blob_list:
-            template_list.append(blob.name)
-        if filename in template_list:
-            print("Template is existed on azure.")
+        self._index = {blob.name for blob in self.container.list_blobs()}
+        self._index_updated = time.monotonic()
+
+    def is_teplate_exist(self, filename):
+        age = time.monotonic() - self._index_updated if self._index_updated is not None else None
+        if age is None or age > self.index_interval or (filename not in self._index and age > self.miss_interval):
+            self._refresh_index()
+        if filename in self._index:
             return True
-        else:
-            print("Template is not existed on azure.")
-            #raise TemplateNotFound(self.filename)
-            raise HTTPException(
-                status_code=404,
-                detail="Template is not existed on azure."
-            )
+        loggers.error(f"Template {filename} is not existed on azure.")
+        #raise TemplateNotFound(self.filename)
+        raise HTTPException(
+            status_code=404,
+            detail="Template is not existed on azure."
+        )
+
+    def get_template(self, filename) -> Template:
+        """
+        获取编译后的模板，缓存超过 revalidate_interval 时通过 ETag 校验，blob 未修改则继续使用缓存
+        :param filename: blob 名称
+        :return: jinja2.Template
+        """
+        now = time.monotonic()
+        cached = self._templates.get(filename)
+        if cached and now - cached[2] < self.revalidate_interval:
+            return cached[0]
+        from azure.core import MatchConditions
+        from azure.core.exceptions import ResourceNotModifiedError
+
+        blob_client = self.container.get_blob_client(filename)
+        try:
+            with stage('email', 'template_fetch'):
+                if cached:
+                    downloader = blob_client.download_blob(etag=cached[1],
+                                                           match_condition=MatchConditions.IfModified)
+                else:
+                    downloader = blob_client.download_blob()
+                source = downloader.content_as_text()
+        except ResourceNotModifiedError:
+            self._templates[filename] = (cached[0], cached[1], now)
+            return cached[0]
+        template = Template(source)
+        self._templates[filename] = (template, downloader.properties.etag, now)
+        return template
+
+    def warmup(self):
+        """
+        预先加载容器中所有 html 模板
+        """
+        self._refresh_index()
+        for filename in self._index:
+            if filename.endswith('.html'):
+                self.get_template(filename)
+        loggers.info(f"{len(self._templates)} templates are loaded")
+
+    def render(self, template_name, **content):
+        """
+        :param template_name: 模板名字（html文件名字）
+        :param content: 模板内变量{{var}}
+        :return: 加载变量后的html 文本文件
+        """
+        template = self.get_template(template_name)
+        with stage('email', 'render'):
+            return template.render(**content)
 
     def get_template_content(self, filename,**content):
         try:
-            # 获取"index.html" blob的client
-            blob_client = self.container.get_blob_client(filename)
-            # 读取blob内容为文本并打印
-            text_strings = blob_client.download_blob().content_as_text()
-            print(text_strings)
-            template_azure = Template(text_strings)
-            return template_azure.render(**content)
-            template_save_local(filename, text_strings)
-            return "success"
+            return self.render(filename, **content)
         except Exception as e:
-            message = "Find template in azure blob error"
+            loggers.error(f"Find template {filename} in azure blob error: {e!r}")
             return "error"
 
 
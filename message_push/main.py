@@ -1,17 +1,151 @@
-from typing import List, Optional
-from fastapi import FastAPI, Response, status, Header, Depends, BackgroundTasks
-from message_push.models import EmailModel, SMSModel, WechatModel
+import asyncio
+import json
+import time
+from typing import Optional
+from fastapi import FastAPI, Request, Response, status, Header, Depends, Query
+from message_push.models import EmailModel, EmailBatchModel, SMSModel, WechatModel
 import uvicorn
 from fastapi.security.oauth2 import get_authorization_scheme_param
 from fastapi.exceptions import HTTPException
-from starlette.status import HTTP_401_UNAUTHORIZED, HTTP_403_FORBIDDEN
-from message_push.authorize import has_access
-from mail.mailbox import email_sender, EmailTemplate,html_loader
-from sms.smsbox import sms_sender, SMSTemplate
-from wechat.wxbox import wx_sender, WXTemplate
+from starlette.concurrency import run_in_threadpool
+from starlette.status import HTTP_400_BAD_REQUEST, HTTP_401_UNAUTHORIZED, HTTP_403_FORBIDDEN, HTTP_404_NOT_FOUND, \
+    HTTP_422_UNPROCESSABLE_ENTITY, HTTP_429_TOO_MANY_REQUESTS, HTTP_503_SERVICE_UNAVAILABLE
+from message_push.authorize import has_access, authz
+from message_push.mail.mailbox import get_email_sender, get_html_loader, MailConfig
+from message_push.models import PriorityEnum
+from message_push.dispatch.queue import get_queue, QueueFull, DispatchConfig
+from message_push.dispatch.tracking import get_delivery_log, QUEUED, SCHEDULED
+from message_push.caches import close_async_connection_pools
+from message_push.dedup import get_deduplicator
+from message_push.broadcast import BroadcastConfig, BroadcastError, batched, iter_recipients
+from message_push.logconfig import loggers
+from message_push.metrics import CHANNELS, QUEUE_DEPTH, SCHEDULED as SCHEDULED_JOBS, CONTENT_TYPE_LATEST, \
+    render_latest, stage
 
 
 app = FastAPI()
+# 启动后在后台进行的预热任务，完成前 /readyz 返回 503
+warmup_task: Optional[asyncio.Future] = None
+
+
+async def warmup():
+    """
+    并行预热：获取 jwks 公钥、加载邮件模板、创建发送队列，失败不影响服务启动，第一次请求时会重试
+    """
+    tasks = [authz._refresh_jwks_cache(), run_in_threadpool(get_queue)]
+    if MailConfig.template_warmup:
+        tasks.append(run_in_threadpool(get_html_loader().warmup))
+    for result in await asyncio.gather(*tasks, return_exceptions=True):
+        if isinstance(result, Exception):
+            loggers.error(f"warmup error: {result!r}")
+
+
+@app.on_event("startup")
+async def start_background_tasks():
+    # 不等待预热完成，服务立即开始监听端口
+    global warmup_task
+    authz.start_background_refresh()
+    warmup_task = asyncio.ensure_future(warmup())
+
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    if warmup_task is not None and not warmup_task.done():
+        warmup_task.cancel()
+    await authz.stop_background_refresh()
+    if get_email_sender.cache_info().currsize:
+        get_email_sender().close()
+    if get_delivery_log.cache_info().currsize and get_delivery_log() is not None:
+        await run_in_threadpool(get_delivery_log().close)
+    await close_async_connection_pools()
+
+
+def due_time(params) -> Optional[float]:
+    """
+    请求中 send_at 或 delay 对应的发送时间（unix 时间戳），都为空时立即发送
+    """
+    if params.send_at is not None and params.delay is not None:
+        raise HTTPException(status_code=HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail="send_at and delay cannot be used together")
+    if params.send_at is not None:
+        # 不带时区时 timestamp() 按服务器本地时间计算
+        due_at = params.send_at.timestamp()
+    elif params.delay is not None:
+        if params.delay < 0:
+            raise HTTPException(status_code=HTTP_422_UNPROCESSABLE_ENTITY, detail="delay must not be negative")
+        due_at = time.time() + params.delay
+    else:
+        return None
+    if due_at - time.time() > DispatchConfig.max_delay:
+        raise HTTPException(status_code=HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f"send time must be within {DispatchConfig.max_delay} seconds")
+    return due_at
+
+
+async def claim(channel: str, payload: dict, params, idempotency_key: Optional[str]):
+    """
+    请求去重，在模板检查之后、入队之前进行；请求内容包括优先级及定时发送的参数
+    :return: (是否为第一次请求, 去重 key)，去重 key 用于请求失败时释放
+    """
+    deduplicator = get_deduplicator()
+    if deduplicator is None:
+        return True, None
+    content = dict(payload, priority=params.priority.value)
+    if params.send_at is not None or params.delay is not None:
+        content.update(send_at=params.send_at and params.send_at.isoformat(), delay=params.delay)
+    key = deduplicator.key(channel, content, idempotency_key)
+    return await deduplicator.claim(channel, key), key
+
+
+async def release(key: Optional[str]):
+    if key is not None:
+        await get_deduplicator().release(key)
+
+
+async def duplicate(response: Response, key: Optional[str]) -> str:
+    """
+    重复的请求通过响应头 X-Message-Id 返回第一次请求的消息id（第一次请求还在入队时没有该响应头）
+    """
+    message_id = await get_deduplicator().message_id(key)
+    if message_id:
+        response.headers['X-Message-Id'] = message_id
+    return "duplicate"
+
+
+async def enqueue(channel: str, payload: dict, priority: PriorityEnum, response: Response,
+                  dedup_key: Optional[str] = None, due_at: Optional[float] = None) -> str:
+    """
+    发送任务入队，由 worker 进程发送（python -m message_push.dispatch.worker --channel xxx）；
+    任务id 即消息id，通过响应头 X-Message-Id 返回，用于查询发送状态
+    :param response: 设置 X-Message-Id 的响应
+    :param dedup_key: 入队失败时释放、入队后记录消息id的去重 key
+    :param due_at: 定时发送的时间，到期后由 worker 移入发送队列
+    :return: 任务id
+    """
+    scheduled = due_at is not None and due_at > time.time()
+    try:
+        with stage(channel, 'enqueue'):
+            message_id = await run_in_threadpool(get_queue().enqueue, channel, payload, priority.value, due_at)
+    except Exception as e:
+        await release(dedup_key)
+        if isinstance(e, QueueFull):
+            raise HTTPException(
+                status_code=HTTP_429_TOO_MANY_REQUESTS,
+                detail=f"{str(e)}, please retry later"
+            )
+        raise
+    delivery_log = get_delivery_log()
+    if delivery_log is not None:
+        recipients = payload['to_users'] + (payload.get('cc_users') or [])
+        if scheduled:
+            delivery_log.record(message_id, channel, SCHEDULED, recipients,
+                                f"send at {time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(due_at))}")
+        else:
+            delivery_log.record(message_id, channel, QUEUED, recipients)
+    if dedup_key is not None:
+        await get_deduplicator().record(dedup_key, message_id)
+    response.headers['X-Message-Id'] = message_id
+    return message_id
 
 
 @app.get("/")
@@ -19,50 +153,267 @@ def read_root():
     return {"hello": "FastAPI"}
 
 
+@app.get("/healthz")
+def healthz():
+    """
+    存活检查，不访问任何外部服务
+    """
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+def readyz(response: Response):
+    """
+    就绪检查，启动预热完成后返回 200
+    """
+    if warmup_task is None or not warmup_task.done():
+        response.status_code = HTTP_503_SERVICE_UNAVAILABLE
+        return {"status": "warming up"}
+    return {"status": "ok"}
+
+
+def update_queue_depth():
+    queue = get_queue()
+    for channel in CHANNELS:
+        QUEUE_DEPTH.labels(channel).set(queue.depth(channel))
+        SCHEDULED_JOBS.labels(channel).set(queue.scheduled(channel))
+
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Prometheus 指标，worker 进程的发送指标通过 worker 的 --metrics-port 获取
+    """
+    try:
+        await run_in_threadpool(update_queue_depth)
+    except Exception as e:
+        loggers.error(f"get queue depth error: {e!r}")
+    return Response(render_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+def sms_payload(params_dict: dict) -> dict:
+    """
+    短信任务的 payload
+    """
+    return {
+        "template_name": params_dict['template_name'],
+        "to_users": params_dict['to_users'],
+        "message": params_dict['message'],
+    }
+
+
+def email_payload(params_dict: dict) -> dict:
+    """
+    邮件任务的 payload，模板在 worker 中渲染
+    """
+    payload = {
+        "subject": params_dict['subject'],
+        "template_name": params_dict['template_name'],
+        "to_users": params_dict['to_users'],
+        "cc_users": params_dict['cc_users'],
+        "message": params_dict['message'],
+    }
+    if params_dict['separate']:
+        # 每个接收人单独一封邮件，抄送人也作为接收人，部分失败时 worker 只重发失败的接收人
+        payload.update(to_users=payload['to_users'] + (payload['cc_users'] or []), cc_users=None, separate=True)
+    return payload
+
+
+def wechat_payload(params_dict: dict) -> dict:
+    """
+    微信任务的 payload
+    """
+    return {
+        "template_id": params_dict['template_id'],
+        "to_users": params_dict['to_users'],
+        "message": params_dict['message'],
+        "miniprogram": params_dict['miniprogram'],
+    }
+
+
 @app.post("/api/v1/services/sms/messages", dependencies=[Depends(has_access)])
-async def push_sms_message(params: SMSModel, response: Response, background_tasks: BackgroundTasks):
-    params_dict = params.dict()
-    template_name = params_dict['template_name']
-    to_users = params_dict['to_users']
-    template_params = params_dict['message']
-    new_sms = SMSTemplate(to_users, template_params)
-    background_tasks.add_task(sms_sender.send, template_name, new_sms)
+async def push_sms_message(params: SMSModel, response: Response, idempotency_key: Optional[str] = Header(None)):
+    """
+    Idempotency-Key 或相同的请求内容在去重窗口内重复时返回 duplicate 及第一次请求的 X-Message-Id，不再入队
+    """
+    payload = sms_payload(params.dict())
+    due_at = due_time(params)
+    first, dedup_key = await claim("sms", payload, params, idempotency_key)
+    if not first:
+        return await duplicate(response, dedup_key)
+    await enqueue("sms", payload, params.priority, response, dedup_key, due_at)
     return "success"
 
 
 @app.post("/api/v1/services/email/messages", dependencies=[Depends(has_access)])
-async def push_email_message(params: EmailModel, response: Response, background_tasks: BackgroundTasks):
-    params_dict = params.dict()
-    template_name = params_dict['template_name']
-    subject = params_dict['subject']
-    to_users = params_dict['to_users']
-    cc_users = params_dict['cc_users']
-    #priority = params_dict['priority']
-    template_params = params_dict['message']
-    html_file = template_name + ".html"
-    if not html_loader.is_teplate_exist(html_file):
-        return "error"
-    else:
-        content = html_loader.get_template_content(html_file, **template_params)
-        #content = html_loader.render(html_file, **template_params)
-        sender = "digital.service@cn.abb.com"
-        new_email = EmailTemplate(subject, sender, to_users, cc_users, content)
-        background_tasks.add_task(email_sender.send, new_email)
+async def push_email_message(params: EmailModel, response: Response, idempotency_key: Optional[str] = Header(None)):
+    """
+    Idempotency-Key 或相同的请求内容在去重窗口内重复时返回 duplicate 及第一次请求的 X-Message-Id，不再入队
+    """
+    payload = email_payload(params.dict())
+    due_at = due_time(params)
+    # 模板不存在时抛出 404，在去重之前检查，上传模板后重新请求不会被当作重复请求
+    await run_in_threadpool(get_html_loader().is_teplate_exist, params.template_name + ".html")
+    first, dedup_key = await claim("email", payload, params, idempotency_key)
+    if not first:
+        return await duplicate(response, dedup_key)
+    # 模板在 worker 中渲染
+    await enqueue("email", payload, params.priority, response, dedup_key, due_at)
+    return "success"
+
+
+def email_batch_payload(params_dict: dict) -> dict:
+    """
+    批量邮件任务的 payload，to_users 为所有邮件的接收人及抄送人，worker 只发送包含 to_users 中接收人的邮件，
+    部分失败时重新入队的任务只发送失败的邮件
+    """
+    items = [{"to_users": item['to_users'], "cc_users": item['cc_users'], "message": item['message']}
+             for item in params_dict['items']]
+    return {
+        "subject": params_dict['subject'],
+        "template_name": params_dict['template_name'],
+        "items": items,
+        "to_users": list(dict.fromkeys(user for item in items for user in item['to_users'] + (item['cc_users'] or []))),
+        "cc_users": None,
+        "batch": True,
+    }
+
 
+@app.post("/api/v1/services/email/batches", dependencies=[Depends(has_access)])
+async def push_email_batch(params: EmailBatchModel, response: Response, idempotency_key: Optional[str] = Header(None)):
+    """
+    批量邮件入队，由 worker 使用同一个smtp会话逐封渲染发送；
+    Idempotency-Key 或相同的请求内容在去重窗口内重复时返回 duplicate 及第一次请求的 X-Message-Id，不再入队
+    """
+    payload = email_batch_payload(params.dict())
+    due_at = due_time(params)
+    await run_in_threadpool(get_html_loader().is_teplate_exist, params.template_name + ".html")
+    first, dedup_key = await claim("email", payload, params, idempotency_key)
+    if not first:
+        return await duplicate(response, dedup_key)
+    await enqueue("email", payload, params.priority, response, dedup_key, due_at)
     return "success"
 
 
 @app.post("/api/v1/services/wechat/messages", dependencies=[Depends(has_access)])
-async def push_wechat_message(params: WechatModel, response: Response, background_tasks: BackgroundTasks):
-    params_dict = params.dict()
-    template_id = params_dict['template_id']
-    to_users = params_dict['to_users']
-    message = params_dict['message']
-    miniprogram = params_dict['miniprogram']
-    new_wx_messages = WXTemplate(message=message, miniprogram=miniprogram)
-    background_tasks.add_task(wx_sender.send, to_users, template_id, new_wx_messages)
+async def push_wechat_message(params: WechatModel, response: Response,
+                              idempotency_key: Optional[str] = Header(None)):
+    """
+    Idempotency-Key 或相同的请求内容在去重窗口内重复时返回 duplicate 及第一次请求的 X-Message-Id，不再入队
+    """
+    payload = wechat_payload(params.dict())
+    due_at = due_time(params)
+    first, dedup_key = await claim("wechat", payload, params, idempotency_key)
+    if not first:
+        return await duplicate(response, dedup_key)
+    await enqueue("wechat", payload, params.priority, response, dedup_key, due_at)
     return "success"
 
 
+# 渠道 -> (请求参数, 任务 payload)，群发接口使用
+BROADCASTS = {
+    'email': (EmailModel, email_payload),
+    'sms': (SMSModel, sms_payload),
+    'wechat': (WechatModel, wechat_payload),
+}
+
+
+async def enqueue_waiting(channel: str, payload: dict, priority: PriorityEnum, response: Response,
+                          due_at: Optional[float]) -> str:
+    """
+    入队，发送队列已满时等待，最多 BroadcastConfig.max_wait 秒；等待期间不读取请求体
+    """
+    deadline = time.monotonic() + BroadcastConfig.max_wait
+    while True:
+        try:
+            return await enqueue(channel, payload, priority, response, due_at=due_at)
+        except HTTPException as e:
+            if e.status_code != HTTP_429_TOO_MANY_REQUESTS or time.monotonic() >= deadline:
+                raise
+        await asyncio.sleep(0.5)
+
+
+@app.post("/api/v1/services/{channel}/broadcasts", dependencies=[Depends(has_access)])
+async def push_broadcast(channel: str, request: Request, response: Response,
+                         params: str = Query(..., description="JSON 格式的消息参数，与 messages 接口相同，不包括 to_users"),
+                         idempotency_key: Optional[str] = Header(None)):
+    """
+    大批量群发：请求体为接收人列表，Content-Type 为 application/x-ndjson（每行一个 JSON 字符串或 {"user": ...}）
+    或 text/csv（第一列，或表头为 user 的列），可以分块上传；边接收边解析，每 broadcast.batch_size 个接收人入队一个任务，
+    返回接收人数及各任务的消息id；邮件每个接收人单独一封。
+    请求体格式错误（400）或发送队列持续已满（429）时，之前的接收人已经入队，错误中的 recipients、message_ids 为已入队的部分
+    """
+    if channel not in BROADCASTS:
+        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail=f"unknown channel {channel}")
+    model, build_payload = BROADCASTS[channel]
+    try:
+        fields = json.loads(params)
+        if not isinstance(fields, dict):
+            raise ValueError("params must be a JSON object")
+        if channel == 'email':
+            fields.update(cc_users=None, separate=True)
+        message = model(**dict(fields, to_users=[]))
+    except ValueError as e:
+        raise HTTPException(status_code=HTTP_422_UNPROCESSABLE_ENTITY, detail=f"invalid params: {e}")
+    due_at = due_time(message)
+    payload = build_payload(message.dict())
+    if channel == 'email':
+        await run_in_threadpool(get_html_loader().is_teplate_exist, message.template_name + ".html")
+    # 请求内容无法预先计算哈希，只按 Idempotency-Key 去重
+    dedup_key = None
+    if idempotency_key:
+        first, dedup_key = await claim(channel, payload, message, idempotency_key)
+        if not first:
+            return await duplicate(response, dedup_key)
+    recipients, message_ids = 0, []
+    try:
+        recipient_stream = iter_recipients(request.stream(), request.headers.get('content-type', ''))
+        async for batch in batched(recipient_stream, BroadcastConfig.batch_size):
+            message_ids.append(await enqueue_waiting(channel, dict(payload, to_users=batch), message.priority,
+                                                     response, due_at))
+            recipients += len(batch)
+        if not recipients:
+            raise BroadcastError("no recipients")
+    except (BroadcastError, HTTPException) as e:
+        if not message_ids:
+            await release(dedup_key)
+        status_code = e.status_code if isinstance(e, HTTPException) else HTTP_400_BAD_REQUEST
+        error = e.detail if isinstance(e, HTTPException) else str(e)
+        raise HTTPException(status_code=status_code,
+                            detail={"error": error, "recipients": recipients, "message_ids": message_ids})
+    return {"status": "success", "recipients": recipients, "message_ids": message_ids}
+
+
+def get_tracking():
+    delivery_log = get_delivery_log()
+    if delivery_log is None:
+        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="message tracking is disabled")
+    return delivery_log
+
+
+@app.get("/api/v1/messages/{message_id}", dependencies=[Depends(has_access)])
+async def get_message(message_id: str):
+    """
+    消息的发送状态及每个接收人的状态，worker 的状态变化最多延迟 tracking.flush_interval 秒
+    """
+    message = await run_in_threadpool(get_tracking().get, message_id)
+    if message is None:
+        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail=f"message {message_id} not found")
+    return message
+
+
+@app.get("/api/v1/messages", dependencies=[Depends(has_access)])
+async def list_messages(start: Optional[float] = None, end: Optional[float] = None,
+                        limit: int = Query(100, ge=1, le=1000), cursor: Optional[str] = None,
+                        channel: Optional[str] = None):
+    """
+    按入队时间分页列出消息，时间窗口 [start, end) 为 unix 时间戳，默认为最近一小时；
+    返回的 next_cursor 不为空时，用相同的参数加上 cursor 获取下一页
+    """
+    end = end or time.time()
+    start = start if start is not None else end - 3600
+    return await run_in_threadpool(get_tracking().list, start, end, limit, cursor, channel)
+
+
 if __name__ == '__main__':
     uvicorn.run(app, host="0.0.0.0", port=8000)
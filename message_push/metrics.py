@@ -0,0 +1,61 @@
+"""
+发送链路的 Prometheus 指标
+web 进程通过 GET /metrics 暴露，worker 进程通过 --metrics-port 启动独立的 http 服务暴露
+"""
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
+
+CHANNELS = ['email', 'sms', 'wechat']
+
+# 按接收人计数：邮件按封，短信按手机号，微信按 openid
+SENT = Counter('message_push_sent_total', 'Messages accepted by the provider', ['channel'])
+FAILED = Counter('message_push_failed_total', 'Messages rejected by the provider or failed to send', ['channel'])
+RETRIED = Counter('message_push_retried_total', 'Provider calls and queue jobs that were retried', ['channel'])
+JOBS = Counter('message_push_jobs_total', 'Queue jobs processed by workers', ['channel', 'status'])
+
+# stage: auth, template_fetch, render, token_fetch, openid_lookup, provider_call, enqueue
+STAGE_LATENCY = Histogram(
+    'message_push_stage_seconds', 'Latency of each delivery stage', ['channel', 'stage'],
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30),
+)
+
+QUEUE_DEPTH = Gauge('message_push_queue_depth', 'Unacknowledged jobs in the send queue', ['channel'])
+SCHEDULED = Gauge('message_push_scheduled', 'Scheduled jobs waiting for their send time', ['channel'])
+RELEASED = Counter('message_push_released_total', 'Due scheduled jobs moved into the send queue', ['channel'])
+IN_FLIGHT = Gauge('message_push_in_flight', 'Jobs being processed by this worker', ['channel'])
+CIRCUIT_OPEN = Gauge('message_push_circuit_open', 'Whether the provider circuit breaker is open', ['provider'])
+DEAD_LETTERS = Counter('message_push_dead_letters_total', 'Jobs written to the dead-letter store', ['channel'])
+# 告警合并：合并到摘要消息中的消息数、节省的发送次数（合并的消息数减去摘要消息数）
+COALESCED = Counter('message_push_coalesced_total', 'Messages merged into a digest instead of sent', ['channel'])
+COALESCE_SAVED = Counter('message_push_coalesce_saved_total', 'Sends saved by coalescing into digests', ['channel'])
+DEDUPLICATED = Counter('message_push_deduplicated_total', 'Duplicate push requests dropped', ['channel'])
+# 进程内缓存（已校验的 token 等）：result 为 hit、miss、eviction
+LOCAL_CACHE = Counter('message_push_local_cache_total', 'Local cache lookups and evictions', ['cache', 'result'])
+LOCAL_CACHE_SIZE = Gauge('message_push_local_cache_size', 'Keys in the local cache', ['cache'])
+# action: waited（等待后发送）、requeued（超过 max_wait 或当日配额，重新入队）
+THROTTLED = Counter('message_push_throttled_total', 'Sends delayed by the rate limiter', ['channel', 'action'])
+
+
+def stage(channel: str, name: str):
+    """
+    记录一个阶段的耗时，可用作上下文管理器或装饰器
+        with stage('email', 'render'):
+            ...
+    :param channel: 渠道（email/sms/wechat），鉴权为 api
+    :param name: 阶段名称
+    """
+    return STAGE_LATENCY.labels(channel, name).time()
+
+
+def render_latest() -> bytes:
+    """
+    生成 Prometheus 文本格式的指标
+    """
+    return generate_latest()
+
+
+__all__ = [
+    'CHANNELS', 'SENT', 'FAILED', 'RETRIED', 'JOBS', 'STAGE_LATENCY', 'QUEUE_DEPTH', 'SCHEDULED', 'RELEASED',
+    'IN_FLIGHT', 'CIRCUIT_OPEN', 'DEAD_LETTERS', 'THROTTLED', 'DEDUPLICATED',
+    'COALESCED', 'COALESCE_SAVED', 'LOCAL_CACHE', 'LOCAL_CACHE_SIZE',
+    'stage', 'render_latest', 'CONTENT_TYPE_LATEST',
+]
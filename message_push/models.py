@@ -1,3 +1,4 @@
+from datetime import datetime
 from typing import Optional, List, Dict
 from pydantic import BaseModel
 from enum import Enum
@@ -20,14 +21,50 @@ class EmailModel(BaseModel):
     to_users: 接收对象邮箱列表 \n
     cc_users: cc对象邮箱列表 \n
     message: 消息模板 \n
+    separate: 每个接收人（包括cc对象）单独收到一封邮件，邮件中不显示其他接收人 \n
     priority: 优先级（high，none，low）\n
+    send_at: 定时发送的时间（ISO 8601 或 unix 时间戳，不带时区时为服务器本地时间），为空时立即发送 \n
+    delay: 延迟发送的秒数，不能与 send_at 同时指定 \n
     """
     subject: str
     template_name: str
     to_users: List[str]
     cc_users: Optional[List[str]] = None
     message: Dict
-    #priority: Optional[PriorityEnum] = "none"
+    separate: bool = False
+    priority: PriorityEnum = PriorityEnum.Normal
+    send_at: Optional[datetime] = None
+    delay: Optional[float] = None
+
+
+class EmailBatchItem(BaseModel):
+    """
+    批量邮件中的一封邮件 \n
+    to_users: 接收对象邮箱列表 \n
+    cc_users: cc对象邮箱列表 \n
+    message: 该邮件的模板变量 \n
+    """
+    to_users: List[str]
+    cc_users: Optional[List[str]] = None
+    message: Dict
+
+
+class EmailBatchModel(BaseModel):
+    """
+    批量发送邮件消息格式，所有邮件使用同一个模板 \n
+    subject: 邮件主题 \n
+    template_name: 模板名称，需要和html文件名保持一致 \n
+    items: 邮件列表，每封邮件单独渲染模板变量 \n
+    priority: 优先级（high，none，low）\n
+    send_at: 定时发送的时间（ISO 8601 或 unix 时间戳，不带时区时为服务器本地时间），为空时立即发送 \n
+    delay: 延迟发送的秒数，不能与 send_at 同时指定 \n
+    """
+    subject: str
+    template_name: str
+    items: List[EmailBatchItem]
+    priority: PriorityEnum = PriorityEnum.Normal
+    send_at: Optional[datetime] = None
+    delay: Optional[float] = None
 
 
 class SMSModel(BaseModel):
@@ -36,10 +73,16 @@ class SMSModel(BaseModel):
     template_name: 模板名称，需要和平台注册的保持一致 \n
     to_users: 接收对象手机号列表 \n
     message: 消息模板 \n
+    priority: 优先级（high，none，low）\n
+    send_at: 定时发送的时间（ISO 8601 或 unix 时间戳，不带时区时为服务器本地时间），为空时立即发送 \n
+    delay: 延迟发送的秒数，不能与 send_at 同时指定 \n
     """
     template_name: str
     to_users: List[str]
     message: Dict
+    priority: PriorityEnum = PriorityEnum.Normal
+    send_at: Optional[datetime] = None
+    delay: Optional[float] = None
 
 
 class WechatModel(BaseModel):
@@ -49,9 +92,15 @@ class WechatModel(BaseModel):
     to_users: 接收对象邮箱列表 \n
     message: 消息模板 \n
     miniprogram: 关联小程序 \n
+    priority: 优先级（high，none，low）\n
+    send_at: 定时发送的时间（ISO 8601 或 unix 时间戳，不带时区时为服务器本地时间），为空时立即发送 \n
+    delay: 延迟发送的秒数，不能与 send_at 同时指定 \n
     """
     template_id: str
     to_users: List[str]
     message: Dict
     miniprogram: Optional[Dict] = None
+    priority: PriorityEnum = PriorityEnum.Normal
+    send_at: Optional[datetime] = None
+    delay: Optional[float] = None
 
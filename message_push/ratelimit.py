@@ -0,0 +1,258 @@
+"""
+发送限流：令牌桶，按服务商的每秒及每日配额限制各渠道的发送速度
+每个渠道一个 RateLimiter（key 为空），per_key 为每个模板（微信 template_id、短信 templateName）或账号的限制；
+令牌可以预支，等待时间不超过 max_wait 时发送方 sleep 后发送，否则抛出 RateLimited，由 worker 稍后重新入队
+桶的状态保存在进程内（local），或保存在 redis 中由多个 worker 共享（redis）
+"""
+import asyncio
+import json
+import threading
+import time
+from functools import lru_cache
+from typing import Any, Callable, Optional, Tuple
+import redis
+from message_push.caches import RedisCache
+from message_push.metrics import THROTTLED
+from message_push.resilience import DeliveryError
+
+# 桶的状态：(剩余令牌数, 更新时间, 当前配额日, 当日已使用数)
+BucketState = Tuple[float, float, int, int]
+
+
+class RateLimited(DeliveryError):
+    """
+    超过配额，需要等待 retry_after 秒后重新发送
+    """
+    def __init__(self, name: str, retry_after: float):
+        """
+        :param name: 限流器名称
+        :param retry_after: 建议的等待时间(秒)
+        """
+        super(RateLimited, self).__init__(f"{name} rate limit exceeded, retry after {retry_after:.1f}s",
+                                          retryable=True, retry_after=retry_after)
+        # 超过配额的桶：渠道名，或 "渠道名:模板/账号"
+        self.key = name
+
+
+def take(state: Optional[BucketState], now: float, tokens: float, rate: float, burst: float, per_day: int,
+         max_wait: float, utc_offset: float = 8) -> Tuple[Optional[BucketState], float]:
+    """
+    从桶中预支 tokens 个令牌
+    :param state: 桶的状态，None 表示新建的满桶
+    :param now: 当前时间戳
+    :param tokens: 令牌数
+    :param rate: 每秒补充的令牌数，0 表示不限制速度
+    :param burst: 桶容量
+    :param per_day: 每日配额，0 表示不限制
+    :param max_wait: 最多等待的秒数
+    :param utc_offset: 配额日的时区（小时）
+    :return: (新的状态, 需要等待的秒数)；超过配额时新的状态为 None，等待时间为建议的重试时间
+    """
+    local_now = now + utc_offset * 3600
+    day = int(local_now // 86400)
+    level, updated_at, state_day, used = state or (burst, now, day, 0)
+    if state_day != day:
+        used = 0
+    if per_day and used + tokens > per_day:
+        # 当日配额用完，等到下一个配额日
+        return None, 86400 - local_now % 86400
+    if rate:
+        level = min(burst, level + max(now - updated_at, 0) * rate)
+        wait = max(tokens - level, 0) / rate
+        if wait > max_wait:
+            return None, wait
+        level -= tokens
+    else:
+        wait = 0
+    return (level, now, day, used + tokens), wait
+
+
+def give_back(state: Optional[BucketState], now: float, tokens: float, burst: float,
+              utc_offset: float = 8) -> Optional[BucketState]:
+    """
+    退还预支但没有使用的 tokens 个令牌及当日配额，take 的逆操作
+    :return: 新的状态，桶不存在时为 None
+    """
+    if state is None:
+        return None
+    level, updated_at, state_day, used = state
+    day = int((now + utc_offset * 3600) // 86400)
+    return min(burst, level + tokens), updated_at, state_day, max(used - tokens, 0) if state_day == day else used
+
+
+class LocalBucketStore:
+    """
+    进程内的桶状态，线程安全
+    """
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def update(self, key: str, func: Callable[[Optional[BucketState]], Tuple[Optional[BucketState], Any]]):
+        """
+        原子地更新桶的状态
+        :param func: 参数为旧状态，返回 (新状态, 结果)，新状态为 None 时不修改；冲突时可能被调用多次
+        :return: func 的结果
+        """
+        with self._lock:
+            state, result = func(self._buckets.get(key))
+            if state is not None:
+                self._buckets[key] = state
+            return result
+
+
+class RedisBucketStore:
+    """
+    redis 中的桶状态，多个 worker 共享；WATCH/MULTI 乐观锁保证原子更新
+    """
+    def __init__(self, client: redis.StrictRedis, prefix: str = 'message_push:ratelimit', ttl: int = 2 * 86400):
+        """
+        :param client: redis 连接
+        :param prefix: key 前缀
+        :param ttl: 状态的过期时间(秒)，需要覆盖一个配额日
+        """
+        self.redis = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def update(self, key: str, func: Callable[[Optional[BucketState]], Tuple[Optional[BucketState], Any]]):
+        key = f"{self.prefix}:{key}"
+        result = []
+
+        def transaction(pipe):
+            value = pipe.get(key)
+            state, outcome = func(tuple(json.loads(value)) if value else None)
+            pipe.multi()
+            if state is not None:
+                pipe.set(key, json.dumps(state), ex=self.ttl)
+            result[:] = [outcome]
+
+        self.redis.transaction(transaction, key)
+        return result[0]
+
+
+class RateLimiter:
+    """
+    令牌桶限流器
+    """
+    def __init__(self, name: str, rate: float = 0, burst: float = 0, per_day: int = 0, max_wait: float = 5,
+                 utc_offset: float = 8, store=None, per_key: Optional['RateLimiter'] = None):
+        """
+        :param name: 名称，用于 key、日志和指标（一般为渠道名）
+        :param rate: 每秒令牌数，0 表示不限制速度
+        :param burst: 桶容量，即允许的突发数量，默认等于 rate（至少为 1）
+        :param per_day: 每日配额，0 表示不限制
+        :param max_wait: 最多等待的秒数，超过时抛出 RateLimited
+        :param utc_offset: 配额日的时区（小时），微信按北京时间零点重置
+        :param store: 桶状态的存储，LocalBucketStore 或 RedisBucketStore，默认 LocalBucketStore
+        :param per_key: 每个模板或账号的限流器，与渠道的限制同时生效
+        """
+        self.name = name
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.per_day = per_day
+        self.max_wait = max_wait
+        self.utc_offset = utc_offset
+        self.store = store or LocalBucketStore()
+        self.per_key = per_key
+
+    @classmethod
+    def from_config(cls, name: str, conf: Optional[dict]) -> 'RateLimiter':
+        """
+        :param name: 渠道名
+        :param conf: 渠道配置中的 rate_limit 部分
+        """
+        conf = conf or {}
+        store = RedisBucketStore(get_redis_client(conf.get('redis_db', 2))) \
+            if conf.get('backend', 'local') == 'redis' else LocalBucketStore()
+        per_key = conf.get('per_key') or {}
+        options = dict(max_wait=conf.get('max_wait', 5), utc_offset=conf.get('utc_offset', 8), store=store)
+        return cls(name, rate=conf.get('rate', 0), burst=conf.get('burst', 0), per_day=conf.get('per_day', 0),
+                   per_key=cls(name, rate=per_key.get('rate', 0), burst=per_key.get('burst', 0),
+                               per_day=per_key.get('per_day', 0), **options) if per_key else None,
+                   **options)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.rate or self.per_day or (self.per_key and self.per_key.enabled))
+
+    def reserve(self, key: str = '', tokens: float = 1) -> float:
+        """
+        预支令牌
+        :param key: 模板id或账号，为空时只检查渠道的限制
+        :param tokens: 令牌数（如短信手机号数量）
+        :return: 需要等待的秒数
+        :raise RateLimited: 需要等待超过 max_wait 秒或当日配额已用完
+        """
+        wait = self._reserve(self.name, tokens)
+        if self.per_key is not None and key:
+            try:
+                wait = max(wait, self.per_key._reserve(f"{self.name}:{key}", tokens))
+            except RateLimited:
+                # 没有发送，退还渠道的令牌及当日配额
+                self._refund(self.name, tokens)
+                raise
+        return wait
+
+    def refund(self, key: str = '', tokens: float = 1):
+        """
+        退还 reserve/acquire 预支但没有发送的令牌（如选中的账号随后被拒绝）
+        :param key: 与 reserve 时相同
+        """
+        self._refund(self.name, tokens)
+        if self.per_key is not None and key:
+            self.per_key._refund(f"{self.name}:{key}", tokens)
+
+    def _reserve(self, key: str, tokens: float) -> float:
+        if not self.rate and not self.per_day:
+            return 0
+        now = time.time()
+
+        def func(state):
+            state, wait = take(state, now, tokens, self.rate, self.burst, self.per_day, self.max_wait, self.utc_offset)
+            return state, (state is not None, wait)
+
+        granted, wait = self.store.update(key, func)
+        if not granted:
+            THROTTLED.labels(self.name, 'requeued').inc()
+            raise RateLimited(key, wait)
+        return wait
+
+    def _refund(self, key: str, tokens: float):
+        if not self.rate and not self.per_day:
+            return
+        now = time.time()
+        self.store.update(key, lambda state: (give_back(state, now, tokens, self.burst, self.utc_offset), None))
+
+    def acquire(self, key: str = '', tokens: float = 1):
+        """
+        同步获取令牌，需要时 sleep
+        :raise RateLimited: 需要等待超过 max_wait 秒或当日配额已用完
+        """
+        wait = self.reserve(key, tokens)
+        if wait > 0:
+            THROTTLED.labels(self.name, 'waited').inc()
+            time.sleep(wait)
+
+    async def acquire_async(self, key: str = '', tokens: float = 1):
+        """
+        异步获取令牌，需要时 asyncio.sleep；redis 存储时在线程池中访问 redis
+        :raise RateLimited: 需要等待超过 max_wait 秒或当日配额已用完
+        """
+        if not self.enabled:
+            return
+        if isinstance(self.store, LocalBucketStore):
+            wait = self.reserve(key, tokens)
+        else:
+            wait = await asyncio.get_event_loop().run_in_executor(None, self.reserve, key, tokens)
+        if wait > 0:
+            THROTTLED.labels(self.name, 'waited').inc()
+            await asyncio.sleep(wait)
+
+
+@lru_cache(maxsize=None)
+def get_redis_client(db: int) -> redis.StrictRedis:
+    """
+    进程内共享的 redis 连接，使用 RedisCache 的连接配置
+    """
+    return RedisCache(db=db).redis
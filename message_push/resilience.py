@@ -0,0 +1,269 @@
+"""
+发送重试与熔断：各渠道发送服务共用
+RetryPolicy 决定哪些错误需要重试及重试间隔（指数退避 + full jitter），
+CircuitBreaker 在服务商连续失败后熔断，熔断期间不再请求（也不再重试），
+Retrier 组合两者，提供同步 call 和异步 acall
+"""
+import asyncio
+import random
+import smtplib
+import socket
+import threading
+import time
+from typing import Iterable, List, Optional
+import httpx
+from message_push.logconfig import loggers
+from message_push.metrics import CIRCUIT_OPEN, RETRIED
+
+
+class ProviderError(Exception):
+    """
+    服务商返回的错误
+    """
+    def __init__(self, code, message: str = '', retryable: Optional[bool] = None):
+        """
+        :param code: 错误码（http 状态码、微信 errcode 等）
+        :param message: 错误信息
+        :param retryable: 是否重试，None 表示由 RetryPolicy.retry_codes 决定
+        """
+        super(ProviderError, self).__init__(f"{code}: {message}" if message else str(code))
+        self.code = code
+        self.retryable = retryable
+
+
+class CircuitOpenError(Exception):
+    """
+    熔断期间拒绝请求
+    """
+
+
+class DeliveryError(Exception):
+    """
+    发送任务（部分）失败，由 worker 决定重新入队还是写入死信
+    """
+    def __init__(self, message: str, recipients: Optional[List[str]] = None, retryable: bool = True,
+                 retry_after: float = 0, result: Optional[dict] = None):
+        """
+        :param message: 错误信息
+        :param recipients: 失败的接收人，重新入队时只发送给这些接收人；为空表示整个任务
+        :param retryable: 是否值得重新入队
+        :param retry_after: 大于 0 表示被限流，等待后重新入队，不计入尝试次数
+        :param result: 发送服务返回的结果（succeeded/errors），用于记录每个接收人的状态
+        """
+        super(DeliveryError, self).__init__(message)
+        self.recipients = recipients or []
+        self.retryable = retryable
+        self.retry_after = retry_after
+        self.result = result
+
+
+def error_code(error: Exception):
+    """
+    错误码：ProviderError.code 或 smtp 响应码
+    """
+    if isinstance(error, ProviderError):
+        return error.code
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code
+    return None
+
+
+class RetryPolicy:
+    """
+    重试策略
+    """
+    # 网络错误默认重试
+    retry_exceptions = (httpx.TransportError, smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError,
+                        socket.timeout, CircuitOpenError)
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.5, max_delay: float = 10,
+                 retry_codes: Iterable = ()):
+        """
+        :param max_attempts: 最多尝试次数（包括第一次）
+        :param base_delay: 第一次重试的最大等待时间(秒)，之后每次翻倍
+        :param max_delay: 最大等待时间(秒)
+        :param retry_codes: 需要重试的错误码
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_codes = set(retry_codes)
+
+    @classmethod
+    def from_config(cls, conf: Optional[dict], retry_codes: Iterable = ()) -> 'RetryPolicy':
+        """
+        :param conf: 渠道配置中的 retry 部分
+        :param retry_codes: 配置中没有 retry_codes 时的默认值
+        """
+        conf = conf or {}
+        return cls(max_attempts=conf.get('max_attempts', 3), base_delay=conf.get('base_delay', 0.5),
+                   max_delay=conf.get('max_delay', 10), retry_codes=conf.get('retry_codes', retry_codes))
+
+    def is_retryable(self, error: Exception) -> bool:
+        if getattr(error, 'retryable', None) is not None:
+            return error.retryable
+        code = error_code(error)
+        if code is not None:
+            return code in self.retry_codes
+        return isinstance(error, self.retry_exceptions)
+
+    def backoff(self, attempt: int) -> float:
+        """
+        第 attempt 次失败后的等待时间（full jitter），attempt 从 1 开始
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    """
+    熔断器，线程安全
+    closed: 正常请求；连续 failure_threshold 次失败后 open
+    open: 拒绝请求，reset_timeout 秒后 half-open
+    half-open: 只放行一个试探请求，成功则 closed，失败则重新 open
+    """
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30):
+        """
+        :param name: 服务商名称，用于日志和指标
+        :param failure_threshold: 连续失败多少次后熔断
+        :param reset_timeout: 熔断后多少秒尝试恢复
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+        CIRCUIT_OPEN.labels(name).set(0)
+
+    @classmethod
+    def from_config(cls, name: str, conf: Optional[dict]) -> 'CircuitBreaker':
+        """
+        :param conf: 渠道配置中的 circuit_breaker 部分
+        """
+        conf = conf or {}
+        return cls(name, failure_threshold=conf.get('failure_threshold', 5),
+                   reset_timeout=conf.get('reset_timeout', 30))
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return 'half-open'
+            return 'open'
+
+    def before_call(self) -> bool:
+        """
+        请求前调用
+        :return: 是否为 half-open 的试探请求，试探请求的结果不计入熔断时需要 release_probe
+        :raise CircuitOpenError: 熔断中
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            if time.monotonic() - self._opened_at >= self.reset_timeout and not self._probing:
+                self._probing = True
+                return True
+        raise CircuitOpenError(f"{self.name} circuit is open")
+
+    def release_probe(self):
+        """
+        试探请求没有到达服务商（被限流等），不改变状态，放行下一个试探请求
+        """
+        with self._lock:
+            self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                loggers.info(f"{self.name} circuit is closed")
+                CIRCUIT_OPEN.labels(self.name).set(0)
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or (self._opened_at is None and self._failures >= self.failure_threshold):
+                loggers.error(f"{self.name} circuit is open after {self._failures} failures")
+                CIRCUIT_OPEN.labels(self.name).set(1)
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+
+class Retrier:
+    """
+    按 RetryPolicy 重试，并通过 CircuitBreaker 熔断
+    不需要重试的错误（如 4xx）说明服务商可用，不计入熔断的失败次数
+    """
+    def __init__(self, channel: str, policy: RetryPolicy, breaker: CircuitBreaker):
+        """
+        :param channel: 渠道，用于指标
+        :param policy: 重试策略
+        :param breaker: 服务商的熔断器
+        """
+        self.channel = channel
+        self.policy = policy
+        self.breaker = breaker
+
+    def _should_retry(self, error: Exception, attempt: int, probing: bool) -> bool:
+        # 被限流的错误由调用方等待后重新入队，不在这里重试，也不计入熔断
+        if isinstance(error, CircuitOpenError) or getattr(error, 'retry_after', 0) > 0:
+            if probing:
+                self.breaker.release_probe()
+            return False
+        retryable = self.policy.is_retryable(error)
+        if retryable:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        if not retryable or attempt >= self.policy.max_attempts:
+            return False
+        RETRIED.labels(self.channel).inc()
+        loggers.info(f"{self.breaker.name} error, retry {attempt}/{self.policy.max_attempts - 1}: {error!r}")
+        return True
+
+    def call(self, func, *args, **kwargs):
+        """
+        同步调用 func，失败时按策略 sleep 后重试
+        :raise: 最后一次的错误，或 CircuitOpenError
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            probing = self.breaker.before_call()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if not self._should_retry(e, attempt, probing):
+                    raise
+                time.sleep(self.policy.backoff(attempt))
+                continue
+            self.breaker.record_success()
+            return result
+
+    async def acall(self, func, *args, **kwargs):
+        """
+        异步调用协程函数 func，失败时按策略 asyncio.sleep 后重试
+        :raise: 最后一次的错误，或 CircuitOpenError
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            probing = self.breaker.before_call()
+            try:
+                result = await func(*args, **kwargs)
+            except asyncio.CancelledError:
+                if probing:
+                    self.breaker.release_probe()
+                raise
+            except Exception as e:
+                if not self._should_retry(e, attempt, probing):
+                    raise
+                await asyncio.sleep(self.policy.backoff(attempt))
+                continue
+            self.breaker.record_success()
+            return result
@@ -0,0 +1,171 @@
+"""
+多进程部署：父进程监听端口后 fork 出 workers 个 uvicorn 进程，共享同一个监听 socket，由内核分配连接
+
+    python -m message_push.server --workers 4 --port 8000
+
+每个进程的发送服务、队列、redis 连接池等单例在 fork 之后第一次使用时创建，不与其他进程共享；
+jwks 公钥、微信 access_token 通过 redis 共享（redis.shared），openid 缓存本来就在 redis 中。
+父进程收到 SIGTERM/SIGINT 后转发给各 worker：worker 停止接受新连接，处理完进行中的请求并执行 shutdown
+（写入剩余的投递日志、关闭连接池）后退出，超过 graceful_timeout 秒仍未退出的 worker 被强制结束；
+worker 异常退出时父进程重新启动一个
+"""
+import argparse
+import os
+import signal
+import socket
+import sys
+import time
+from typing import Dict
+from message_push.logconfig import loggers
+from message_push.utils import config
+
+
+class ServerConfig:
+    _server: dict = config.get('server') or {}
+    host: str = _server.get('host', '0.0.0.0')
+    port: int = _server.get('port', 8000)
+    # worker 进程数，0 表示 CPU 核数
+    workers: int = _server.get('workers', 0)
+    # 收到 SIGTERM 后等待 worker 处理完进行中请求的最长秒数
+    graceful_timeout: float = _server.get('graceful_timeout', 30)
+    backlog: int = _server.get('backlog', 2048)
+
+
+# fork 之前可能已经创建、需要在子进程中重新创建的单例：(模块, lru_cache 的 getter)
+SINGLETONS = [
+    ('message_push.mail.mailbox', 'get_email_sender'),
+    ('message_push.mail.mailbox', 'get_html_loader'),
+    ('message_push.sms.smsbox', 'get_async_sms_sender'),
+    ('message_push.wechat.wxbox', 'get_wx_sender'),
+    ('message_push.dispatch.queue', 'get_queue'),
+    ('message_push.dispatch.deadletter', 'get_dead_letter_store'),
+    ('message_push.dispatch.tracking', 'get_delivery_log'),
+    ('message_push.dispatch.coalesce', 'get_coalescer'),
+    ('message_push.dedup', 'get_deduplicator'),
+    ('message_push.ratelimit', 'get_redis_client'),
+    ('message_push.caches', 'get_connection_pool'),
+]
+
+
+def reset_after_fork():
+    """
+    清除从父进程继承的单例（已导入的模块中），子进程第一次使用时重新创建；
+    父进程中的后台线程、事件循环及连接不能在子进程中使用
+    """
+    for module_name, getter in SINGLETONS:
+        module = sys.modules.get(module_name)
+        if module is not None:
+            getattr(module, getter).cache_clear()
+    caches = sys.modules.get('message_push.caches')
+    if caches is not None:
+        caches._async_pools.clear()
+
+
+def listen(host: str, port: int, backlog: int = ServerConfig.backlog) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(app, sock: socket.socket, log_level: str = 'info'):
+    """
+    子进程：在共享的 socket 上运行 uvicorn，SIGTERM 时由 uvicorn 处理完进行中的请求后退出
+    """
+    import uvicorn
+
+    reset_after_fork()
+    # 父进程的信号处理不适用于子进程，由 uvicorn 重新注册
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, signal.SIG_DFL)
+    server = uvicorn.Server(uvicorn.Config(app, log_level=log_level))
+    server.run(sockets=[sock])
+
+
+def serve(app, host: str = ServerConfig.host, port: int = ServerConfig.port, workers: int = ServerConfig.workers,
+          graceful_timeout: float = ServerConfig.graceful_timeout, log_level: str = 'info'):
+    """
+    启动 workers 个 worker 进程并监控，收到 SIGTERM/SIGINT 后等待所有 worker 退出
+    :param app: ASGI 应用，fork 之前导入，子进程共享导入后的内存
+    :param host: 监听地址
+    :param port: 监听端口
+    :param workers: worker 进程数，0 表示 CPU 核数
+    :param graceful_timeout: 等待 worker 处理完进行中请求的最长秒数
+    :param log_level: uvicorn 日志级别
+    """
+    workers = workers or os.cpu_count() or 1
+    sock = listen(host, port)
+    # pid -> 启动时间
+    children: Dict[int, float] = {}
+    stopping = []
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(app, sock, log_level)
+            except BaseException as e:
+                loggers.error(f"web worker {os.getpid()} error: {e!r}")
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = time.monotonic()
+        loggers.info(f"web worker {pid} started")
+
+    def stop(signum, frame):
+        if not stopping:
+            loggers.info(f"received signal {signum}, stopping {len(children)} web workers")
+            stopping.append(time.monotonic())
+        for pid in children:
+            _kill(pid, signal.SIGTERM)
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, stop)
+    loggers.info(f"listening on {host}:{port} with {workers} web workers")
+    for _ in range(workers):
+        spawn()
+    while children:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if pid == 0:
+            if stopping and time.monotonic() - stopping[0] > graceful_timeout:
+                loggers.error(f"{len(children)} web workers did not stop in {graceful_timeout}s, kill them")
+                for pid in children:
+                    _kill(pid, signal.SIGKILL)
+                stopping[0] = float('inf')
+            time.sleep(0.1)
+            continue
+        started_at = children.pop(pid, None)
+        if started_at is None or stopping:
+            continue
+        loggers.error(f"web worker {pid} exited with status {status}, restart it")
+        # 启动即退出时避免频繁重启
+        if time.monotonic() - started_at < 1:
+            time.sleep(1)
+        spawn()
+    sock.close()
+    loggers.info("all web workers stopped")
+
+
+def _kill(pid: int, sig: int):
+    try:
+        os.kill(pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="message push web server")
+    parser.add_argument('--host', default=ServerConfig.host)
+    parser.add_argument('--port', type=int, default=ServerConfig.port)
+    parser.add_argument('--workers', type=int, default=ServerConfig.workers, help='worker 进程数，0 表示 CPU 核数')
+    parser.add_argument('--graceful-timeout', type=float, default=ServerConfig.graceful_timeout)
+    args = parser.parse_args()
+    from message_push.main import app
+    serve(app, args.host, args.port, args.workers, args.graceful_timeout)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,13 @@
+import asyncio
 import httpx
 import json
 import re
+from functools import lru_cache
 from typing import List, Dict, Optional
 from message_push.logconfig import loggers
+from message_push.metrics import SENT, FAILED, stage
+from message_push.ratelimit import RateLimiter, RateLimited
+from message_push.resilience import Retrier, RetryPolicy, CircuitBreaker, CircuitOpenError, ProviderError
 from message_push.utils import config
 
 
@@ -11,6 +16,15 @@ class SMSConfig:
     auth_key: str = config['sms']['auth_key']
     api_server: str = config['sms']['api_server']
     api_version: str = config['sms']['api_version']
+    # 每次请求的最大手机号数量，及异步发送时同时进行的请求数
+    batch_size: int = config['sms'].get('batch_size', 100)
+    concurrency: int = config['sms'].get('concurrency', 10)
+    # 重试策略及熔断，默认重试限流及 5xx
+    retry: dict = config['sms'].get('retry') or {}
+    circuit_breaker: dict = config['sms'].get('circuit_breaker') or {}
+    retry_codes: list = retry.get('retry_codes', [429, 500, 502, 503, 504])
+    # 限流，按手机号数计数，per_key 为每个短信模板的限制
+    rate_limit: dict = config['sms'].get('rate_limit') or {}
 
 
 # 短信模板
@@ -36,15 +50,21 @@ class SMSTemplate:
 
 # 短信服务
 class SMSBox:
-    def __init__(self, account: str, auth_key: str, server: str):
+    def __init__(self, account: str, auth_key: str, server: str, retrier: Optional[Retrier] = None,
+                 rate_limiter: Optional[RateLimiter] = None):
         """
         :param server: 短信服务器地址
         :param account: sms账户名
         :param auth_key: authorization信息
+        :param retrier: 重试及熔断，默认使用 SMSConfig 中的配置
+        :param rate_limiter: 限流，默认使用 SMSConfig 中的配置
         """
         self.account = account
         self.auth_key = auth_key
         self.server = server
+        self.retrier = retrier or Retrier('sms', RetryPolicy.from_config(SMSConfig.retry, SMSConfig.retry_codes),
+                                          CircuitBreaker.from_config('sms', SMSConfig.circuit_breaker))
+        self.rate_limiter = rate_limiter or RateLimiter.from_config('sms', SMSConfig.rate_limit)
 
     def get_template_detail(self, template_name: str):
         pass
@@ -55,42 +75,191 @@ class SMSBox:
         :param template_name: 短信模板名称，需要在短信平台添加并审核
         :param sms: 短信内容
         :return:
+        :raise RateLimited: 超过发送配额
         """
         loggers.info("prepare to send sms message")
-        with httpx.Client() as client:
-            resp = client.post(
-                url=self.server,
-                params={
-                    "api-version": SMSConfig.api_version,
-                },
-                headers={
-                    "Account": self.account,
-                    "Authorization": self.auth_key,
-                    "Content-Type": "application/json"
+        self.rate_limiter.acquire(template_name, len(sms.to_users))
+        try:
+            with httpx.Client() as client:
+                resp = self.retrier.call(self._post, client, template_name, sms.content, sms.to_users)
+        except ProviderError as e:
+            FAILED.labels('sms').inc(len(sms.to_users))
+            loggers.error(f"send sms message error, with code: {e}")
+            return
+        except (httpx.HTTPError, CircuitOpenError):
+            FAILED.labels('sms').inc(len(sms.to_users))
+            raise
+        SENT.labels('sms').inc(len(sms.to_users))
+        loggers.info(f"send sms message successfully, with content: {resp.content.decode('utf8')}")
+
+    def _post(self, client: httpx.Client, template_name: str, content: Optional[dict],
+              phone_numbers: List[str]) -> httpx.Response:
+        with stage('sms', 'provider_call'):
+            resp = client.post(**self._request(template_name, content, phone_numbers))
+        _raise_for_status(resp)
+        return resp
+
+    def _request(self, template_name: str, content: Optional[dict], phone_numbers: List[str]) -> dict:
+        """
+        短信平台请求参数
+        """
+        return dict(
+            url=self.server,
+            params={
+                "api-version": SMSConfig.api_version,
+            },
+            headers={
+                "Account": self.account,
+                "Authorization": self.auth_key,
+                "Content-Type": "application/json"
+            },
+            json={
+                "extend": "10",
+                "messageBody": {
+                    "templateParam": content,
+                    "templateName": template_name
                 },
-                json={
-                    "extend": "10",
-                    "messageBody": {
-                        "templateParam": sms.content,
-                        "templateName": template_name
-                    },
-                    "phoneNumber": sms.to_users
-
-                }
+                "phoneNumber": phone_numbers
+
+            }
+        )
+
+
+# 异步短信服务
+class AsyncSMSBox(SMSBox):
+    def __init__(self, account: str, auth_key: str, server: str,
+                 batch_size: int = SMSConfig.batch_size, concurrency: int = SMSConfig.concurrency,
+                 retrier: Optional[Retrier] = None, rate_limiter: Optional[RateLimiter] = None):
+        """
+        复用同一个 httpx.AsyncClient，手机号按 batch_size 分批，最多 concurrency 批同时发送
+        :param server: 短信服务器地址
+        :param account: sms账户名
+        :param auth_key: authorization信息
+        :param batch_size: 每次请求的最大手机号数量
+        :param concurrency: 同时进行的请求数
+        :param retrier: 重试及熔断，默认使用 SMSConfig 中的配置
+        :param rate_limiter: 限流，默认使用 SMSConfig 中的配置
+        """
+        super(AsyncSMSBox, self).__init__(account=account, auth_key=auth_key, server=server, retrier=retrier,
+                                          rate_limiter=rate_limiter)
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self._client = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        """
+        获取共享的 httpx.AsyncClient，第一次使用时创建
+        """
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self.concurrency,
+                                    max_keepalive_connections=self.concurrency),
             )
-            if resp.status_code == 200:
-                loggers.info(f"send sms message successfully, with content: {resp.content.decode('utf8')}")
-            else:
-                loggers.error(f"send sms message error, with code: {resp.status_code}, "
-                              f"content: {resp.content.decode('utf8')}")
-            loggers.info("send sms message successfully")
-
-
-sms_sender = SMSBox(
-    account=SMSConfig.account,
-    auth_key=SMSConfig.auth_key,
-    server=SMSConfig.api_server
-)
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def send(self, template_name: str, sms: SMSTemplate) -> dict:
+        """
+        发送短信，每批按 rate_limiter 限流，按 retrier 的策略重试
+        :param template_name: 短信模板名称，需要在短信平台添加并审核
+        :param sms: 短信内容
+        :return: 合并后的结果 {"batches": 批数, "succeeded": 成功的手机号, "failed": 失败的手机号,
+                 "retryable": 失败的批次中是否有临时错误, "retry_after": 失败的批次都是被限流时，建议的重试时间,
+                 "errors": {错误信息: 手机号}}
+        """
+        loggers.info("prepare to send sms message")
+        batches = [sms.to_users[i:i + self.batch_size] for i in range(0, len(sms.to_users), self.batch_size)]
+        slots = asyncio.Semaphore(self.concurrency)
+        errors = await asyncio.gather(*[self._send_batch(template_name, sms.content, batch, slots)
+                                        for batch in batches])
+        summary = {"batches": len(batches), "succeeded": [], "failed": [], "retryable": False, "errors": {}}
+        for batch, error in zip(batches, errors):
+            summary["failed" if error else "succeeded"].extend(batch)
+            if error:
+                summary["errors"].setdefault(repr(error), []).extend(batch)
+            if error and self.retrier.policy.is_retryable(error):
+                summary["retryable"] = True
+        summary["retry_after"] = _retry_after(errors)
+        if summary["failed"]:
+            loggers.error(f"send sms message to {len(summary['failed'])} users error")
+        else:
+            loggers.info(f"send sms message to {len(summary['succeeded'])} users successfully")
+        return summary
+
+    async def _send_batch(self, template_name: str, content: Optional[dict], phone_numbers: List[str],
+                          slots: asyncio.Semaphore) -> Optional[Exception]:
+        """
+        :return: 成功返回 None，失败返回最后一次的错误
+        """
+        try:
+            await self.rate_limiter.acquire_async(template_name, len(phone_numbers))
+        except RateLimited as e:
+            loggers.error(f"send sms message error: {e!r}")
+            return e
+        try:
+            resp = await self.retrier.acall(self._async_post, template_name, content, phone_numbers, slots)
+        except (ProviderError, httpx.HTTPError, CircuitOpenError) as e:
+            FAILED.labels('sms').inc(len(phone_numbers))
+            loggers.error(f"send sms message error: {e!r}")
+            return e
+        SENT.labels('sms').inc(len(phone_numbers))
+        loggers.info(f"send sms message successfully, with content: {resp.content.decode('utf8')}")
+        return None
+
+    async def _async_post(self, template_name: str, content: Optional[dict], phone_numbers: List[str],
+                          slots: asyncio.Semaphore) -> httpx.Response:
+        # 重试等待期间不占用并发数
+        async with slots:
+            with stage('sms', 'provider_call'):
+                resp = await self._get_client().post(**self._request(template_name, content, phone_numbers))
+        _raise_for_status(resp)
+        return resp
+
+
+def _retry_after(errors: List[Optional[Exception]]) -> float:
+    """
+    所有失败都是被限流时返回最长的等待时间，否则返回 0
+    """
+    errors = [error for error in errors if error]
+    if errors and all(isinstance(error, RateLimited) for error in errors):
+        return max(error.retry_after for error in errors)
+    return 0
+
+
+def _raise_for_status(resp: httpx.Response):
+    """
+    短信平台返回非 200 时抛出 ProviderError，错误码为 http 状态码
+    """
+    if resp.status_code != 200:
+        raise ProviderError(resp.status_code, resp.content.decode('utf8'))
+
+
+@lru_cache(maxsize=None)
+def get_sms_sender() -> SMSBox:
+    """
+    进程内共享的短信发送服务，第一次使用时创建
+    """
+    return SMSBox(
+        account=SMSConfig.account,
+        auth_key=SMSConfig.auth_key,
+        server=SMSConfig.api_server
+    )
+
+
+@lru_cache(maxsize=None)
+def get_async_sms_sender() -> AsyncSMSBox:
+    """
+    进程内共享的异步短信发送服务，第一次使用时创建
+    """
+    return AsyncSMSBox(
+        account=SMSConfig.account,
+        auth_key=SMSConfig.auth_key,
+        server=SMSConfig.api_server
+    )
 
 if __name__ == '__main__':
     data = {
@@ -16,7 +16,8 @@ def get_config(path):
         exit(0)
 
 
-config_path = base_dir + '/config.yml'
+# 可通过环境变量 MESSAGE_PUSH_CONFIG 指定配置文件（测试、压测时使用）
+config_path = os.environ.get('MESSAGE_PUSH_CONFIG', base_dir + '/config.yml')
 # 获取配置
 config = get_config(config_path)
 
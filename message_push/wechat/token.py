@@ -0,0 +1,182 @@
+import asyncio
+import httpx
+import json
+import threading
+import time
+from typing import Optional
+from message_push.caches import SharedValue
+from message_push.logconfig import loggers
+from message_push.metrics import stage
+
+# access_token 失效或过期的错误码
+INVALID_TOKEN_ERRCODES = (40001, 42001)
+
+
+class WXTokenManager:
+    """
+    微信 access_token 管理，token 从中控服务器获取，中控服务器鉴权使用 Azure B2C 客户端流
+    token 缓存到过期前 refresh_margin 秒，并发请求共享同一次刷新；后台任务在过期前主动刷新
+    微信返回 40001/42001 时调用 invalidate，下一次获取会重新请求中控服务器
+    多进程部署时 token 通过 shared 共享，一个进程获取后其余进程不再访问中控服务器
+    """
+
+    def __init__(self, azure_authz, token_url: str, refresh_margin: float = 300, default_expires_in: float = 7200,
+                 shared: Optional[SharedValue] = None):
+        """
+        :param azure_authz: 中控服务器鉴权，提供 get_token 方法
+        :param token_url: 中控服务器地址
+        :param refresh_margin: 在 token 过期前多少秒刷新
+        :param default_expires_in: 中控服务器未返回 expires_in 时，token 的有效期(秒)
+        :param shared: 多个进程共享的 token，为空时每个进程各自获取
+        """
+        self.azure_authz = azure_authz
+        self.token_url = token_url
+        self.refresh_margin = refresh_margin
+        self.default_expires_in = default_expires_in
+        self._token = None
+        self._expires_at = 0
+        # 进行中的刷新任务，并发请求共享
+        self._refreshing = None
+        self._background_task = None
+        self._lock = threading.Lock()
+        self.shared = shared
+        # invalidate 的 token，共享的 token 仍是它时不再使用
+        self._invalid_token = None
+
+    def _valid(self) -> bool:
+        return self._token is not None and time.monotonic() < self._expires_at - self.refresh_margin
+
+    def _authorization(self) -> str:
+        _token = self.azure_authz.get_token()
+        return _token['token_type'] + ' ' + _token['access_token']
+
+    def _store(self, resp: httpx.Response) -> Optional[str]:
+        """
+        解析中控服务器的响应并缓存 token
+        :return: access_token, 失败返回None
+        """
+        if resp.status_code != 200:
+            loggers.error(f"get weixin token error, with code: {resp.status_code}, "
+                          f"content: {resp.content.decode('utf8')}")
+            return None
+        loggers.info(f"get weixin token successfully")
+        content = json.loads(resp.content.decode('utf8'))
+        self._token = content['access_token']
+        self._expires_at = time.monotonic() + float(content.get('expires_in') or self.default_expires_in)
+        return self._token
+
+    def _adopt(self, shared: Optional[dict]) -> Optional[str]:
+        """
+        使用其他进程获取的 token
+        :return: access_token, 共享的 token 不存在、已失效或即将过期时返回None
+        """
+        if not shared or shared['token'] == self._invalid_token:
+            return None
+        expires_in = shared['expires_at'] - time.time()
+        if expires_in <= self.refresh_margin:
+            return None
+        self._token = shared['token']
+        self._expires_at = time.monotonic() + expires_in
+        return self._token
+
+    def _shared_value(self) -> dict:
+        expires_in = self._expires_at - time.monotonic()
+        return {"token": self._token, "expires_at": time.time() + expires_in}
+
+    async def _fetch_token(self) -> Optional[str]:
+        if self.shared is not None:
+            token = self._adopt(await self.shared.aget())
+            if token is not None:
+                return token
+        with stage('wechat', 'token_fetch'):
+            # msal 为同步调用，放到线程池中执行，避免阻塞事件循环
+            authorization = await asyncio.get_event_loop().run_in_executor(None, self._authorization)
+            async with httpx.AsyncClient() as client:
+                resp = await client.get(url=self.token_url, headers={"Authorization": authorization})
+        token = self._store(resp)
+        if token is not None and self.shared is not None:
+            await self.shared.aset(self._shared_value(), ttl=self._expires_at - time.monotonic())
+        return token
+
+    async def refresh(self) -> Optional[str]:
+        """
+        从中控服务器获取 token，同一时间只有一个刷新请求，其余调用等待同一个结果
+        :return: access_token, 失败返回None
+        """
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.ensure_future(self._fetch_token())
+        return await asyncio.shield(self._refreshing)
+
+    async def get_token(self) -> Optional[str]:
+        """
+        获取 token，缓存有效时不访问中控服务器
+        :return: access_token, 失败返回None
+        """
+        if self._valid():
+            return self._token
+        try:
+            return await self.refresh()
+        except (httpx.HTTPError, ValueError, KeyError) as e:
+            loggers.error(f"get weixin token error: {e!r}")
+            return None
+
+    def get_token_sync(self) -> Optional[str]:
+        """
+        同步获取 token，供线程中发送使用
+        :return: access_token, 失败返回None
+        """
+        with self._lock:
+            if self._valid():
+                return self._token
+            if self.shared is not None:
+                token = self._adopt(self.shared.get())
+                if token is not None:
+                    return token
+            try:
+                with stage('wechat', 'token_fetch'), httpx.Client() as client:
+                    resp = client.get(url=self.token_url, headers={"Authorization": self._authorization()})
+                token = self._store(resp)
+                if token is not None and self.shared is not None:
+                    self.shared.set(self._shared_value(), ttl=self._expires_at - time.monotonic())
+                return token
+            except (httpx.HTTPError, ValueError, KeyError) as e:
+                loggers.error(f"get weixin token error: {e!r}")
+                return None
+
+    def invalidate(self, token: Optional[str] = None):
+        """
+        清除缓存的 token
+        :param token: 只有当前缓存的仍是该 token 时才清除，避免并发请求清除已经刷新过的 token
+        """
+        if token is None or token == self._token:
+            loggers.info("weixin token invalidated")
+            self._invalid_token = self._token
+            self._token = None
+            self._expires_at = 0
+
+    def start_background_refresh(self):
+        """
+        启动后台任务，立即获取 token，之后在过期前 refresh_margin 秒刷新
+        """
+        if self._background_task is None:
+            self._background_task = asyncio.ensure_future(self._background_refresh())
+
+    async def stop_background_refresh(self):
+        if self._background_task is not None:
+            self._background_task.cancel()
+            try:
+                await self._background_task
+            except asyncio.CancelledError:
+                pass
+            self._background_task = None
+
+    async def _background_refresh(self):
+        while True:
+            try:
+                if not self._valid():
+                    await self.refresh()
+                delay = self._expires_at - self.refresh_margin - time.monotonic() if self._valid() else 30
+            except Exception as e:
+                loggers.error(f'refresh weixin token in background error: {e!r}')
+                delay = 30
+            await asyncio.sleep(max(delay, 1))
@@ -1,20 +1,38 @@
+import asyncio
 import httpx
 import msal
 import json
-from typing import List, Optional, Mapping, Union
+from functools import lru_cache
+from typing import Dict, List, Optional, Mapping, Union
 import threading
 from message_push.logconfig import loggers
+from message_push.metrics import SENT, FAILED, RETRIED, stage
+from message_push.ratelimit import RateLimiter, RateLimited
+from message_push.resilience import Retrier, RetryPolicy, CircuitBreaker, CircuitOpenError, ProviderError
 
 # try:
 #     from ..caches import WxOpenIDCache
 # except ImportError:
-from message_push.caches import WxOpenIDCache
+from message_push.caches import WxOpenIDCache, AsyncWxOpenIDCache, shared_value
 from message_push.utils import config
+from message_push.wechat.token import WXTokenManager, INVALID_TOKEN_ERRCODES
 
 
 class WechatConfig:
     wx_token_center_url: str = config['wechat']['wx_token_center_url']
     default_color: str = config['wechat']['default_color']
+    api_url: str = config['wechat'].get('api_url', 'https://api.weixin.qq.com/cgi-bin/message/template/send')
+    # 异步发送时同时进行中的请求数上限
+    concurrency: int = config['wechat'].get('concurrency', 50)
+    http2: bool = config['wechat'].get('http2', True)
+    # 在 access_token 过期前多少秒刷新
+    token_refresh_margin: float = config['wechat'].get('token_refresh_margin', 300)
+    # 重试策略及熔断，默认重试系统繁忙(-1)、接口调用超过限制(45009)，及没有 errcode 的 http 5xx
+    retry: dict = config['wechat'].get('retry') or {}
+    circuit_breaker: dict = config['wechat'].get('circuit_breaker') or {}
+    retry_codes: list = retry.get('retry_codes', [-1, 45009, 500, 502, 503, 504])
+    # 限流，per_key 为每个模板的限制
+    rate_limit: dict = config['wechat'].get('rate_limit') or {}
 
 
 class AzureB2CConfig:
@@ -77,14 +95,46 @@ class WXTemplate:
 
 
 class WXBox:
-    def __init__(self):
-        self.azure_authz = AzureClientAuthorization()
-        self.wx_token_url = WechatConfig.wx_token_center_url
-        self.wx_openid_cache = WxOpenIDCache()
+    def __init__(self, azure_authz=None, wx_openid_cache=None, token_manager: Optional[WXTokenManager] = None,
+                 retrier: Optional[Retrier] = None, rate_limiter: Optional[RateLimiter] = None,
+                 async_openid_cache=None):
+        """
+        :param azure_authz: 中控服务器鉴权，默认 AzureClientAuthorization
+        :param wx_openid_cache: unionid 到 openid 的缓存，默认 WxOpenIDCache
+        :param async_openid_cache: async_send 使用的异步缓存，默认与 WxOpenIDCache 共用本地缓存的 AsyncWxOpenIDCache；
+                                   只指定了同步的 wx_openid_cache 时，async_send 在线程池中读取
+        :param token_manager: access_token 管理，默认使用 azure_authz 访问 wx_token_center_url
+        :param retrier: 重试及熔断，默认使用 WechatConfig 中的配置
+        :param rate_limiter: 限流，默认使用 WechatConfig 中的配置
+        """
+        self.azure_authz = azure_authz or AzureClientAuthorization()
+        self.token_manager = token_manager or WXTokenManager(self.azure_authz, WechatConfig.wx_token_center_url,
+                                                             refresh_margin=WechatConfig.token_refresh_margin,
+                                                             shared=shared_value('wx_token'))
+        self.wx_api_url = WechatConfig.api_url
+        self.wx_openid_cache = wx_openid_cache or WxOpenIDCache()
+        if async_openid_cache is None and wx_openid_cache is None:
+            async_openid_cache = AsyncWxOpenIDCache(local_cache=self.wx_openid_cache.local_cache)
+        self.async_openid_cache = async_openid_cache
+        self.concurrency = WechatConfig.concurrency
+        self.http2 = WechatConfig.http2
+        self.retrier = retrier or Retrier(
+            'wechat', RetryPolicy.from_config(WechatConfig.retry, WechatConfig.retry_codes),
+            CircuitBreaker.from_config('wechat', WechatConfig.circuit_breaker))
+        self.rate_limiter = rate_limiter or RateLimiter.from_config('wechat', WechatConfig.rate_limit)
+        self._client = None
+
+    @property
+    def wx_token_url(self) -> str:
+        return self.token_manager.token_url
+
+    @wx_token_url.setter
+    def wx_token_url(self, url: str):
+        self.token_manager.token_url = url
 
     def send(self, to_users: List[str], template_id: str, msg: WXTemplate):
         """
-        发送模板消息
+        发送模板消息，每条消息按 rate_limiter 限流后再启动发送线程
         :param to_users: 微信开放平台unionid list
         :param template_id: 微信模板id
         :param msg: 微信模板消息内容
@@ -94,47 +144,100 @@ class WXBox:
         task = []
         # 同一次消息使用获取一次token
         wx_token = self._get_wx_token()
+        # 将微信unionid批量转化为公众号openid
+        openids = self._get_wx_openids(to_users)
         # 微信接口每次只能发送给一个用户
-        for user in to_users:
-            # 将微信unionid转化为公众号openid
-            openid = self._get_wx_openid(to_user=user)
-            if openid:
-                # bytes to str
-                openid = openid.decode('utf8')
-                task.append(threading.Thread(target=self._send_wx_template_message,
-                                             args=(openid, template_id, msg, wx_token),
-                                             name=f"Thread_send_wx_message"))
-        for t in task:
+        for i, openid in enumerate(openids.values()):
+            try:
+                self.rate_limiter.acquire(template_id)
+            except RateLimited as e:
+                FAILED.labels('wechat').inc(len(openids) - i)
+                loggers.error(f"send wechat message to {len(openids) - i} users error: {e!r}")
+                break
+            t = threading.Thread(target=self._send_wx_template_message,
+                                 args=(openid, template_id, msg, wx_token, self.wx_api_url, self.token_manager),
+                                 name=f"Thread_send_wx_message")
             t.start()
+            task.append(t)
         for t in task:
             t.join()
         loggers.info(f"send wechat message successfully")
 
-    def _get_wx_token(self):
+    async def async_send(self, to_users: List[str], template_id: str, msg: WXTemplate):
         """
-        从中控服务器获取token，中控服务器鉴权使用Azure B2C 客户端流
-        :return: 获取到返回access_token, 失败返回None
+        异步发送模板消息，所有请求复用同一个 httpx.AsyncClient，
+        同时进行中的请求数不超过 concurrency，每条消息按 rate_limiter 限流，按 retrier 的策略重试
+        :param to_users: 微信开放平台unionid list
+        :param template_id: 微信模板id
+        :param msg: 微信模板消息内容
+        :return: {"succeeded": 成功的unionid, "failed": 失败的unionid（不包括找不到openid的用户）,
+                  "retryable": 失败的消息中是否有临时错误, "retry_after": 失败的消息都是被限流时，建议的重试时间,
+                  "errors": {错误信息: unionid}（包括找不到openid的用户）}
         """
-        _token = self.azure_authz.get_token()
-        access_token = _token['token_type'] + ' ' + _token['access_token']
-        with httpx.Client() as client:
-            resp = client.get(
-                url=self.wx_token_url,
-                headers={
-                    "Authorization": access_token,
-                },
+        loggers.info(f"prepare to send weixin message")
+        summary = {"succeeded": [], "failed": [], "retryable": False, "retry_after": 0, "errors": {}}
+        limited = []
+        wx_token = await self.token_manager.get_token()
+        if not wx_token:
+            FAILED.labels('wechat').inc(len(to_users))
+            loggers.error(f'could not get weixin token')
+            summary.update(failed=list(to_users), retryable=True,
+                           errors={"could not get weixin token": list(to_users)})
+            return summary
+        openids = await self._async_get_wx_openids(to_users)
+        if len(openids) < len(to_users):
+            summary["errors"]["openid not found"] = [user for user in to_users if user not in openids]
+        template_data = self._build_template_data(template_id, msg)
+        client = self._get_client()
+        # 固定数量的协程依次从同一个迭代器中取用户，内存占用与接收人数无关
+        users = iter(openids.items())
+
+        async def worker():
+            for unionid, openid in users:
+                error = await self._async_send_wx_template_message(client, openid, template_data)
+                summary["failed" if error else "succeeded"].append(unionid)
+                if error:
+                    summary["errors"].setdefault(repr(error), []).append(unionid)
+                if error and self.retrier.policy.is_retryable(error):
+                    summary["retryable"] = True
+                if isinstance(error, RateLimited):
+                    limited.append(error.retry_after)
+
+        await asyncio.gather(*[worker() for _ in range(min(self.concurrency, len(openids)))])
+        if limited and len(limited) == len(summary["failed"]):
+            summary["retry_after"] = max(limited)
+        if summary["failed"]:
+            loggers.error(f"send wechat message to {len(summary['failed'])} users error")
+        else:
+            loggers.info(f"send wechat message successfully")
+        return summary
 
+    def _get_client(self) -> httpx.AsyncClient:
+        """
+        获取共享的 httpx.AsyncClient，第一次使用时创建
+        """
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                http2=self.http2,
+                limits=httpx.Limits(max_connections=self.concurrency,
+                                    max_keepalive_connections=self.concurrency),
             )
-            if resp.status_code == 200:
-                loggers.info(f"get weixin token successfully")
-                content = json.loads(resp.content.decode('utf8'))
-                return content['access_token']
+        return self._client
 
-            else:
-                loggers.error(f"get weixin token error, with code: {resp.status_code}, "
-                              f"content: {resp.content.decode('utf8')}")
+    async def aclose(self):
+        """
+        关闭共享的 httpx.AsyncClient
+        """
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
 
-        return None
+    def _get_wx_token(self):
+        """
+        获取token，缓存过期时从中控服务器获取
+        :return: 获取到返回access_token, 失败返回None
+        """
+        return self.token_manager.get_token_sync()
 
     def _get_wx_openid(self, to_user: str):
         """
@@ -147,43 +250,154 @@ class WXBox:
             loggers.error(f"could not find the user@{to_user}'s openid")
         return openid
 
+    def _get_wx_openids(self, to_users: List[str]) -> Dict[str, str]:
+        """
+        通过redis批量获取用户openid（MGET 分批读取），忽略找不到openid的用户
+        :param to_users: 用户union id list
+        :return: {unionid: openid}，顺序与 to_users 一致
+        """
+        with stage('wechat', 'openid_lookup'):
+            found = self.wx_openid_cache.read_many(to_users)
+        return self._found_openids(to_users, found)
+
+    async def _async_get_wx_openids(self, to_users: List[str]) -> Dict[str, str]:
+        """
+        通过 async_openid_cache 批量获取用户openid，不阻塞事件循环
+        :param to_users: 用户union id list
+        :return: {unionid: openid}，顺序与 to_users 一致
+        """
+        if self.async_openid_cache is None:
+            # 同步缓存放到线程池中执行
+            return await asyncio.get_event_loop().run_in_executor(None, self._get_wx_openids, to_users)
+        with stage('wechat', 'openid_lookup'):
+            found = await self.async_openid_cache.read_many(to_users)
+        return self._found_openids(to_users, found)
+
     @staticmethod
-    def _send_wx_template_message(to_user: str, template_id: str, msg: WXTemplate, wx_token: None):
+    def _found_openids(to_users: List[str], found: Dict[str, bytes]) -> Dict[str, str]:
+        """
+        按 to_users 的顺序整理读取到的 openid，记录找不到openid的用户
+        """
+        openids = {}
+        for user in to_users:
+            openid = found.get(user)
+            if not openid:
+                FAILED.labels('wechat').inc()
+                loggers.error(f"could not find the user@{user}'s openid")
+                continue
+            # bytes to str
+            openids[user] = openid.decode('utf8')
+        return openids
+
+    @staticmethod
+    def _build_template_data(template_id: str, msg: WXTemplate) -> dict:
+        """
+        生成模板消息请求内容（不含touser），同一次发送的所有用户共用
+        :param template_id: 模板id
+        :param msg: 模板内容
+        :return:
+        """
+        # 默认字体颜色为绿色
+        default_color = WechatConfig.default_color
+        template_data = {
+            "data": {
+            },
+            "template_id": template_id
+        }
+        # 如果模板消息需要关联微信小程序
+        if msg.miniprogram:
+            template_data.update({
+                "miniprogram": msg.miniprogram
+            })
+        # 自定义颜色
+        for keyword in msg.message:
+            if "color" not in msg.message[keyword]:
+                msg.message[keyword]['color'] = default_color
+        template_data.update({
+            "data": msg.message
+        })
+        return template_data
+
+    async def _async_send_wx_template_message(self, client: httpx.AsyncClient, to_user: str,
+                                              template_data: dict) -> Optional[Exception]:
+        """
+        调用微信接口，异步发送模板消息，按模板限流，临时错误按 retrier 的策略重试
+        :param client: 共享的 httpx.AsyncClient
+        :param to_user: openid
+        :param template_data: _build_template_data 生成的模板内容
+        :return: 成功返回 None，失败返回最后一次的错误
+        """
+        data = dict(template_data, touser=to_user)
+        try:
+            await self.rate_limiter.acquire_async(template_data['template_id'])
+        except RateLimited as e:
+            loggers.error(f"send wechat message to {to_user} error: {e!r}")
+            return e
+        try:
+            await self.retrier.acall(self._post_template_message, client, data)
+        except (ProviderError, httpx.HTTPError, CircuitOpenError) as e:
+            FAILED.labels('wechat').inc()
+            loggers.error(f"send wechat message to {to_user} error: {e!r}")
+            return e
+        SENT.labels('wechat').inc()
+        return None
+
+    async def _post_template_message(self, client: httpx.AsyncClient, data: dict) -> httpx.Response:
+        """
+        发送一条模板消息，token 失效(40001/42001)时刷新 token 并重发一次
+        :raise ProviderError: 微信接口返回错误，错误码为 errcode
+        """
+        for retry in (False, True):
+            wx_token = await self.token_manager.get_token()
+            if not wx_token:
+                raise ProviderError(None, 'could not get weixin token', retryable=True)
+            with stage('wechat', 'provider_call'):
+                resp = await client.post(
+                    url=self.wx_api_url,
+                    headers={
+                        "Content-Type": "application/json; charset=utf-8",
+                    },
+                    params={
+                        "access_token": wx_token
+                    },
+                    json=data
+                )
+            loggers.info(f"response from wechat, code: {resp.status_code}, content:{resp.content}, "
+                         f"request data:{data}")
+            errcode = _errcode(resp)
+            if resp.status_code == 200 and errcode == 0:
+                return resp
+            if retry or errcode not in INVALID_TOKEN_ERRCODES:
+                raise ProviderError(errcode if errcode is not None else resp.status_code,
+                                    resp.content.decode('utf8'))
+            RETRIED.labels('wechat').inc()
+            self.token_manager.invalidate(wx_token)
+
+    @staticmethod
+    def _send_wx_template_message(to_user: str, template_id: str, msg: WXTemplate, wx_token: None,
+                                  wx_api_url: str = WechatConfig.api_url,
+                                  token_manager: Optional[WXTokenManager] = None):
         """
         调用微信接口，发送模板消息
         :param to_user: openid
         :param template_id: 模板id
         :param msg: 模板内容
         :param wx_token: token
+        :param wx_api_url: 微信模板消息接口地址
+        :param token_manager: token 失效(40001/42001)时用于刷新 token 并重试一次
         :return:
         """
-        # 默认字体颜色为绿色
-        default_color = WechatConfig.default_color
         if not wx_token:
+            FAILED.labels('wechat').inc()
             loggers.error(f'could not get weixin token')
         else:
-            template_data = {
-                "touser": to_user,
-                "data": {
-                },
-                "template_id": template_id
-            }
-            # 如果模板消息需要关联微信小程序
-            if msg.miniprogram:
-                template_data.update({
-                    "miniprogram": msg.miniprogram
-                })
-            # 自定义颜色
-            for keyword in msg.message:
-                if "color" not in msg.message[keyword]:
-                    msg.message[keyword]['color'] = default_color
+            template_data = WXBox._build_template_data(template_id, msg)
             template_data.update({
-                "data": msg.message
+                "touser": to_user
             })
-            with httpx.Client() as client:
-
+            with stage('wechat', 'provider_call'), httpx.Client() as client:
                 resp = client.post(
-                    url="https://api.weixin.qq.com/cgi-bin/message/template/send",
+                    url=wx_api_url,
                     headers={
                         "Content-Type": "application/json; charset=utf-8",
                     },
@@ -194,6 +408,32 @@ class WXBox:
                 )
                 loggers.info(f"response from wechat, code: {resp.status_code}, content:{resp.content}, "
                              f"request data:{template_data}")
+            if token_manager is not None and _errcode(resp) in INVALID_TOKEN_ERRCODES:
+                RETRIED.labels('wechat').inc()
+                token_manager.invalidate(wx_token)
+                WXBox._send_wx_template_message(to_user, template_id, msg, token_manager.get_token_sync(), wx_api_url)
+            else:
+                _record(resp)
+
+
+def _errcode(resp: httpx.Response) -> Optional[int]:
+    """
+    微信接口返回的 errcode，无法解析时返回 None
+    """
+    try:
+        return json.loads(resp.content.decode('utf8')).get('errcode')
+    except (ValueError, AttributeError):
+        return None
+
+
+def _record(resp: httpx.Response):
+    """
+    按微信接口的返回结果记录发送成功/失败数
+    """
+    if resp.status_code == 200 and _errcode(resp) == 0:
+        SENT.labels('wechat').inc()
+    else:
+        FAILED.labels('wechat').inc()
 
 
 # 通过azure b2c获取 client credential相关信息
@@ -208,14 +448,19 @@ class AzureClientAuthorization:
     authority = AzureB2CConfig.b2c_authority
 
     def __init__(self):
-        self.app = msal.ConfidentialClientApplication(
-            client_id=self.client_id,
-            client_credential=self.client_credential,
-            authority=self.authority
-        )
-        # get new token
-        self._access_token = self.app.acquire_token_for_client(scopes=self.scope)
-        # self._access_token = None
+        # msal 初始化时会访问 authority，延迟到第一次获取 token 时创建
+        self._app = None
+        self._access_token = None
+
+    @property
+    def app(self) -> msal.ConfidentialClientApplication:
+        if self._app is None:
+            self._app = msal.ConfidentialClientApplication(
+                client_id=self.client_id,
+                client_credential=self.client_credential,
+                authority=self.authority
+            )
+        return self._app
 
     def get_token(self):
         """
@@ -233,7 +478,12 @@ class AzureClientAuthorization:
         return self._access_token
 
 
-wx_sender = WXBox()
+@lru_cache(maxsize=None)
+def get_wx_sender() -> WXBox:
+    """
+    进程内共享的微信发送服务，第一次使用时创建（连接 redis、订阅缓存失效通知）
+    """
+    return WXBox()
 
 if __name__ == '__main__':
     import time
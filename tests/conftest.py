@@ -0,0 +1,8 @@
+import os
+import sys
+
+tests_dir = os.path.abspath(os.path.dirname(__file__))
+# 测试使用独立配置，避免依赖 message_push/config.yml
+os.environ.setdefault('MESSAGE_PUSH_CONFIG', os.path.join(tests_dir, 'config.yml'))
+# 部分模块按 message_push 目录为工作目录的方式导入（如 from logconfig import loggers）
+sys.path.append(os.path.join(os.path.dirname(tests_dir), 'message_push'))
@@ -0,0 +1,387 @@
+"""
+本地 mock 服务，供测试和 benchmarks 使用
+"""
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from http import HTTPStatus
+from types import SimpleNamespace
+from urllib.parse import urlsplit, parse_qs
+
+
+class SMTPSink:
+    """
+    本地 smtp 服务，接收并记录邮件，支持 AUTH LOGIN/PLAIN（除 bad_accounts 外任意账号密码均通过）
+    依赖 aiosmtpd
+    messages / message_times: 收到的邮件及到达时间(time.monotonic)
+    error_rate: 按该比例随机返回 421（临时错误）
+    pipelining: 是否在 EHLO 中声明 PIPELINING（aiosmtpd 按顺序处理一次收到的多条命令）
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, error_rate: float = 0.0, pipelining: bool = True):
+        from aiosmtpd.controller import Controller
+        from aiosmtpd.smtp import AuthResult
+
+        sink = self
+        self.messages = []
+        self.message_times = []
+        self.error_rate = error_rate
+        self.pipelining = pipelining
+        self.sessions = 0
+        # 拒收的收件人
+        self.rejected = set()
+        # 故障注入：依次作为 DATA 的响应（如 '421 try again later'），为空时正常接收
+        self.faults = []
+        # 认证失败的账号，及 DATA 时返回 432（账号被限流）的发件人
+        self.bad_accounts = set()
+        self.throttled = set()
+        self._lock = threading.Lock()
+
+        class Handler:
+            async def handle_EHLO(self, server, session, envelope, hostname, responses):
+                with sink._lock:
+                    sink.sessions += 1
+                session.host_name = hostname
+                if sink.pipelining:
+                    responses.insert(-1, '250-PIPELINING')
+                return responses
+
+            async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+                if address in sink.rejected:
+                    return '550 mailbox unavailable'
+                envelope.rcpt_tos.append(address)
+                return '250 OK'
+
+            async def handle_DATA(self, server, session, envelope):
+                with sink._lock:
+                    if sink.faults:
+                        return sink.faults.pop(0)
+                    if envelope.mail_from in sink.throttled:
+                        return '432 4.3.2 sender thread limit exceeded'
+                    if sink.error_rate and random.random() < sink.error_rate:
+                        return '421 try again later'
+                    sink.messages.append((envelope.mail_from, list(envelope.rcpt_tos), envelope.content))
+                    sink.message_times.append(time.monotonic())
+                return '250 OK'
+
+        def authenticator(server, session, envelope, mechanism, auth_data):
+            login = getattr(auth_data, 'login', b'') or b''
+            return AuthResult(success=login.decode('utf8') not in sink.bad_accounts, handled=False)
+
+        self._controller = Controller(Handler(), hostname=host, port=port or self._free_port(host),
+                                      authenticator=authenticator, auth_require_tls=False)
+        self.host = host
+        self.port = self._controller.port
+
+    @staticmethod
+    def _free_port(host: str) -> int:
+        import socket
+        with socket.socket() as s:
+            s.bind((host, 0))
+            return s.getsockname()[1]
+
+    def start(self):
+        self._controller.start()
+        return self
+
+    def stop(self):
+        self._controller.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class MockHTTPServer:
+    """
+    本地 http mock 服务基类（asyncio 实现的 HTTP/1.1 keep-alive 服务，运行在后台线程），
+    子类实现 handle 方法
+    latency: 每个请求的模拟延迟(秒)
+    error_rate: 按该比例随机返回临时错误（由子类决定错误的形式）
+    requests / request_times: 收到的请求及到达时间(time.monotonic)
+    responses: 已返回的响应 (request, status, content, 返回时间)
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0, error_rate: float = 0.0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = []
+        self.request_times = []
+        self.responses = []
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.host}:{self.port}'
+
+    def _random_error(self) -> bool:
+        return bool(self.error_rate) and random.random() < self.error_rate
+
+    def handle(self, method: str, path: str, query: dict, headers: dict, body):
+        raise NotImplementedError
+
+    async def _serve_connection(self, reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                lines = head.decode('latin1').split('\r\n')
+                method, target, _ = lines[0].split(' ', 2)
+                headers = {}
+                for line in lines[1:]:
+                    if line:
+                        name, value = line.split(':', 1)
+                        headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length') or 0)
+                raw = await reader.readexactly(length) if length else b''
+                body = json.loads(raw) if raw else None
+                url = urlsplit(target)
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                request = (method, url.path, query, body)
+                self.requests.append(request)
+                self.request_times.append(time.monotonic())
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                status, content = self.handle(method, url.path, query, headers, body)
+                self.responses.append((request, status, content, time.monotonic()))
+                data = json.dumps(content).encode('utf8')
+                writer.write(f'HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n'
+                             f'Content-Type: application/json\r\n'
+                             f'Content-Length: {len(data)}\r\n\r\n'.encode('latin1') + data)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def start(self):
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._serve_connection, self.host, self.port, backlog=4096))
+            self.port = self._server.sockets[0].getsockname()[1]
+            started.set()
+            self._loop.run_forever()
+            self._server.close()
+            self._loop.run_until_complete(self._server.wait_closed())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class MockWechatServer(MockHTTPServer):
+    """
+    模拟微信模板消息接口及 token 中控服务
+    token 中控: GET /token
+    模板消息: POST /cgi-bin/message/template/send
+    faults: 故障注入，依次作为模板消息接口返回的 errcode；error_rate 的随机错误为 -1（系统繁忙）
+    """
+    access_token = 'mock-access-token'
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.faults = []
+
+    @property
+    def token_url(self) -> str:
+        return self.url + '/token'
+
+    @property
+    def api_url(self) -> str:
+        return self.url + '/cgi-bin/message/template/send'
+
+    def handle(self, method, path, query, headers, body):
+        if path == '/token':
+            return 200, {'access_token': self.access_token, 'expires_in': 7200}
+        if path == '/cgi-bin/message/template/send':
+            if query.get('access_token') != self.access_token:
+                return 200, {'errcode': 40001, 'errmsg': 'invalid credential'}
+            if self.faults:
+                return 200, {'errcode': self.faults.pop(0), 'errmsg': 'injected fault'}
+            if self._random_error():
+                return 200, {'errcode': -1, 'errmsg': 'system busy'}
+            return 200, {'errcode': 0, 'errmsg': 'ok', 'msgid': len(self.requests)}
+        return 404, {'errcode': 404, 'errmsg': 'not found'}
+
+
+class StaticAzureAuthorization:
+    """
+    代替 AzureClientAuthorization，返回固定 token，不访问 Azure
+    """
+
+    def get_token(self):
+        return {'token_type': 'Bearer', 'access_token': 'mock-azure-token'}
+
+
+class DictOpenIDCache:
+    """
+    代替 WxOpenIDCache，unionid 即 openid 的映射保存在内存中
+    """
+
+    def __init__(self, mapping: dict):
+        self.mapping = {k: v.encode('utf8') for k, v in mapping.items()}
+
+    def read(self, key: str):
+        return self.mapping.get(key)
+
+    def read_many(self, keys):
+        return {key: self.mapping[key] for key in keys if key in self.mapping}
+
+
+class MockJWKSServer(MockHTTPServer):
+    """
+    模拟 Azure 公钥(jwks)地址，并可签发对应的 RS256 token
+    依赖 python-jose[cryptography]
+    """
+
+    def __init__(self, kid: str = 'mock-kid', **kwargs):
+        super().__init__(**kwargs)
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        from jose import jwk
+
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.kid = kid
+        self.private_pem = private_key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+        public_pem = private_key.public_key().public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+        public_jwk = {k: v.decode('utf8') if isinstance(v, bytes) else v
+                      for k, v in jwk.construct(public_pem, 'RS256').to_dict().items()}
+        public_jwk.update({'kid': kid, 'use': 'sig'})
+        self.keys = [public_jwk]
+
+    @property
+    def jwks_url(self) -> str:
+        return self.url + '/keys'
+
+    def handle(self, method, path, query, headers, body):
+        if path == '/keys':
+            return 200, {'keys': self.keys}
+        return 404, {}
+
+    def issue_token(self, audience: str, expires_in: int = 3600, kid: str = None) -> str:
+        from jose import jwt
+
+        now = int(time.time())
+        claims = {'aud': audience, 'iat': now, 'nbf': now, 'exp': now + expires_in, 'appid': 'mock-client'}
+        return jwt.encode(claims, self.private_pem.decode('utf8'), algorithm='RS256',
+                          headers={'kid': kid or self.kid})
+
+
+class LocalBlobContainer:
+    """
+    使用本地目录代替 azure ContainerClient（实现 TemplateAzure 用到的接口），
+    ETag 由文件修改时间和大小生成，并记录 list/download 次数
+    """
+
+    class _Blob:
+        def __init__(self, name):
+            self.name = name
+
+    class _Downloader:
+        def __init__(self, text, etag):
+            self._text = text
+            self.properties = SimpleNamespace(etag=etag)
+
+        def content_as_text(self):
+            return self._text
+
+    class _BlobClient:
+        def __init__(self, container, name):
+            self.container = container
+            self.name = name
+
+        def download_blob(self, etag=None, match_condition=None):
+            from azure.core import MatchConditions
+            from azure.core.exceptions import ResourceNotFoundError, ResourceNotModifiedError
+
+            path = os.path.join(self.container.path, self.name)
+            if not os.path.exists(path):
+                raise ResourceNotFoundError(f"{self.name} not found")
+            self.container.downloads += 1
+            current = self.container.etag(self.name)
+            if match_condition == MatchConditions.IfModified and etag == current:
+                raise ResourceNotModifiedError("not modified")
+            self.container.transfers += 1
+            with open(path, encoding='utf8') as f:
+                return LocalBlobContainer._Downloader(f.read(), current)
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lists = 0
+        # 请求次数（包括 304）及实际传输内容的次数
+        self.downloads = 0
+        self.transfers = 0
+
+    def etag(self, name: str) -> str:
+        stat = os.stat(os.path.join(self.path, name))
+        return f'"{stat.st_mtime_ns}-{stat.st_size}"'
+
+    def list_blobs(self):
+        self.lists += 1
+        return [self._Blob(name) for name in sorted(os.listdir(self.path))]
+
+    def get_blob_client(self, name: str):
+        return self._BlobClient(self, name)
+
+
+class MockSMSGateway(MockHTTPServer):
+    """
+    模拟短信平台，POST /sms，每次请求最多 max_batch 个手机号
+    faults: 故障注入，依次作为响应的 http 状态码；error_rate 的随机错误为 503
+    """
+    account = 'account'
+    auth_key = 'SharedAccessSignature sig=xxxxx&se=xxxx&skn=full'
+
+    def __init__(self, max_batch: int = 100, **kwargs):
+        super().__init__(**kwargs)
+        self.max_batch = max_batch
+        self.faults = []
+
+    @property
+    def api_url(self) -> str:
+        return self.url + '/sms'
+
+    @property
+    def phone_numbers(self) -> list:
+        return [phone for _, path, _, body in self.requests if path == '/sms' for phone in body['phoneNumber']]
+
+    def handle(self, method, path, query, headers, body):
+        if path != '/sms':
+            return 404, {}
+        if headers.get('account') != self.account or headers.get('authorization') != self.auth_key:
+            return 401, {'code': 401, 'message': 'unauthorized'}
+        if len(body['phoneNumber']) > self.max_batch:
+            return 400, {'code': 400, 'message': f"at most {self.max_batch} phone numbers"}
+        if self.faults:
+            status = self.faults.pop(0)
+            return status, {'code': status, 'message': 'injected fault'}
+        if self._random_error():
+            return 503, {'code': 503, 'message': 'service unavailable'}
+        return 200, {'code': 0, 'message': 'success', 'count': len(body['phoneNumber'])}
@@ -0,0 +1,133 @@
+import asyncio
+import pytest
+
+pytest.importorskip('jose')
+pytest.importorskip('loguru')
+
+from fastapi import HTTPException
+from message_push.authorize import AzureAuthorization
+from tests.mocks import MockJWKSServer
+
+
+@pytest.fixture()
+def jwks_server():
+    with MockJWKSServer(latency=0.05) as server:
+        yield server
+
+
+def new_authz(server, **kwargs):
+    return AzureAuthorization(appid='appid', clientid='clientid', jwks_url_config=server.jwks_url, **kwargs)
+
+
+def jwks_requests(server):
+    return len([request for request in server.requests if request[1] == '/keys'])
+
+
+def test_concurrent_requests_share_one_refresh(jwks_server):
+    authz = new_authz(jwks_server)
+    token = jwks_server.issue_token('clientid')
+
+    async def verify():
+        await asyncio.gather(*[authz.verify_token(token) for _ in range(20)])
+
+    asyncio.run(verify())
+    assert jwks_requests(jwks_server) == 1
+
+
+def test_unknown_kid_refresh_is_rate_limited(jwks_server):
+    authz = new_authz(jwks_server, unknown_kid_interval=60)
+    unknown = jwks_server.issue_token('clientid', kid='unknown')
+
+    async def verify():
+        await authz.verify_token(jwks_server.issue_token('clientid'))
+        for _ in range(3):
+            with pytest.raises(HTTPException) as e:
+                await authz.verify_token(unknown)
+            assert e.value.status_code == 401
+
+    asyncio.run(verify())
+    # 第一次获取 + 一次未知 kid 刷新
+    assert jwks_requests(jwks_server) == 2
+
+
+def test_background_refresh(jwks_server):
+    authz = new_authz(jwks_server)
+
+    async def run():
+        authz.start_background_refresh()
+        await asyncio.sleep(0.2)
+        assert not authz._jwks_expired()
+        await authz.verify_token(jwks_server.issue_token('clientid'))
+        await authz.stop_background_refresh()
+
+    asyncio.run(run())
+    assert jwks_requests(jwks_server) == 1
+
+
+def test_invalid_audience(jwks_server):
+    authz = new_authz(jwks_server)
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(authz.verify_token(jwks_server.issue_token('other')))
+    assert e.value.detail == "Invalid audience"
+
+
+def test_verified_token_cache(jwks_server):
+    authz = new_authz(jwks_server)
+    token = jwks_server.issue_token('clientid')
+
+    async def verify():
+        first = await authz.verify_token(token)
+        assert await authz.verify_token(token) == first
+        # 过期的 token 不缓存
+        with pytest.raises(HTTPException):
+            await authz.verify_token(jwks_server.issue_token('clientid', expires_in=-10))
+
+    asyncio.run(verify())
+    assert authz.token_cache.stats()['hits'] == 1
+    assert authz.token_cache.stats()['size'] == 1
+
+
+def test_token_cache_metrics(jwks_server):
+    from prometheus_client import REGISTRY
+
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(name, dict(labels, cache='auth_token')) or 0
+
+    before = {result: sample('message_push_local_cache_total', result=result) for result in ('hit', 'miss', 'eviction')}
+    authz = new_authz(jwks_server, token_cache_size=1)
+    tokens = [jwks_server.issue_token('clientid', expires_in=3600 + i) for i in range(2)]
+
+    async def verify():
+        for token in tokens + tokens[1:]:
+            await authz.verify_token(token)
+
+    asyncio.run(verify())
+    # 第二个 token 淘汰第一个，再次请求第二个 token 命中
+    assert {result: sample('message_push_local_cache_total', result=result) - before[result]
+            for result in before} == {'hit': 1, 'miss': 2, 'eviction': 1}
+    assert sample('message_push_local_cache_size') == 1
+
+
+def test_jwks_shared_between_processes(jwks_server):
+    fakeredis = pytest.importorskip('fakeredis')
+    from message_push.caches import SharedValue
+
+    server = fakeredis.FakeServer()
+
+    def shared():
+        return SharedValue('jwks', client=fakeredis.FakeStrictRedis(server=server),
+                           async_client=fakeredis.aioredis.FakeRedis(server=server))
+
+    first, second = new_authz(jwks_server, shared=shared()), new_authz(jwks_server, shared=shared())
+    token = jwks_server.issue_token('clientid')
+
+    async def verify():
+        await first.verify_token(token)
+        await second.verify_token(token)
+        # 未知 kid 不使用共享的公钥
+        with pytest.raises(HTTPException):
+            await second.verify_token(jwks_server.issue_token('clientid', kid='unknown'))
+
+    asyncio.run(verify())
+    assert jwks_requests(jwks_server) == 2
+    assert not second._jwks_expired()
@@ -0,0 +1,143 @@
+import asyncio
+import json
+import pytest
+
+pytest.importorskip('loguru')
+
+from message_push.broadcast import BroadcastConfig, BroadcastError, batched, iter_recipients
+from message_push.dispatch.queue import SQLiteQueue
+
+
+async def chunks(*parts: bytes):
+    for part in parts:
+        yield part
+
+
+def collect(content_type: str, *parts: bytes):
+    async def run():
+        return [r async for r in iter_recipients(chunks(*parts), content_type)]
+    return asyncio.run(run())
+
+
+def test_ndjson_split_across_chunks():
+    body = '"a"\n{"user": "b"}\r\n\n"用户c"\n"d"'.encode('utf8')
+    # 在行中间及多字节字符中间分块
+    parts = [body[i:i + 3] for i in range(0, len(body), 3)]
+    assert collect('application/x-ndjson', *parts) == ['a', 'b', '用户c', 'd']
+
+
+def test_csv_header_and_columns():
+    assert collect('text/csv; charset=utf-8', b'\xef\xbb\xbfname,user\nx,15000000000\n', b'y,"15000000001"\n') == \
+        ['15000000000', '15000000001']
+    assert collect('text/csv', b'15000000000,x\n15000000001\n') == ['15000000000', '15000000001']
+
+
+@pytest.mark.parametrize('content_type, body, error', [
+    ('application/json', b'["a"]', 'unsupported content type'),
+    ('application/x-ndjson', b'"a"\n1\n', 'line 2'),
+    ('application/x-ndjson', b'"a"\n{"user": \n', 'line 2'),
+    ('text/csv', b'a\n,b\n', 'line 2: empty recipient'),
+    ('application/x-ndjson', b'"' + b'a' * (BroadcastConfig.max_line_length + 1), 'line longer than'),
+])
+def test_invalid_body(content_type, body, error):
+    with pytest.raises(BroadcastError, match=error):
+        collect(content_type, body)
+
+
+def test_batched():
+    async def run():
+        return [batch async for batch in batched(iter_recipients(chunks(b'"a"\n"b"\n"c"\n'), 'application/x-ndjson'),
+                                                 2)]
+    assert asyncio.run(run()) == [['a', 'b'], ['c']]
+
+
+@pytest.fixture()
+def client(tmp_path, monkeypatch):
+    pytest.importorskip('httpx')
+    from fastapi.testclient import TestClient
+    from message_push import main
+    from message_push.authorize import has_access
+
+    queue = SQLiteQueue(str(tmp_path / 'dispatch.db'), max_depth=1000)
+    monkeypatch.setattr(main, 'get_queue', lambda: queue)
+    monkeypatch.setattr(main, 'get_delivery_log', lambda: None)
+    monkeypatch.setattr(BroadcastConfig, 'batch_size', 100)
+    monkeypatch.setattr(BroadcastConfig, 'max_wait', 0)
+    main.app.dependency_overrides[has_access] = lambda: True
+    try:
+        yield TestClient(main.app), queue
+    finally:
+        main.app.dependency_overrides.clear()
+
+
+def test_broadcast_streams_batches(client):
+    client, queue = client
+    params = json.dumps({"template_name": "notice", "message": {"name": "x"}, "priority": "high"})
+
+    def body():
+        # 分块上传
+        for i in range(250):
+            yield f'"150{i:08d}"\n'.encode()
+
+    resp = client.post("/api/v1/services/sms/broadcasts", params={"params": params}, content=body(),
+                       headers={"Content-Type": "application/x-ndjson"})
+    assert resp.status_code == 200
+    result = resp.json()
+    assert result['recipients'] == 250
+    jobs = queue.fetch('sms', 10, 'worker', block=0)
+    assert [job.id for job in jobs] == result['message_ids']
+    assert [len(job.payload['to_users']) for job in jobs] == [100, 100, 50]
+    assert jobs[2].payload == {"template_name": "notice", "to_users": [f'150{i:08d}' for i in range(200, 250)],
+                               "message": {"name": "x"}}
+    assert {job.priority for job in jobs} == {'high'}
+
+
+def test_broadcast_errors(client):
+    client, queue = client
+    url = "/api/v1/services/wechat/broadcasts"
+    params = {"params": json.dumps({"template_id": "t", "message": {}})}
+    csv = {"Content-Type": "text/csv"}
+    assert client.post(url, params=params, content=b'', headers=csv).status_code == 400
+    assert client.post(url, params={"params": '{"message": {}}'}, content=b'a\n', headers=csv).status_code == 422
+    assert client.post("/api/v1/services/fax/broadcasts", params=params, content=b'a\n',
+                       headers=csv).status_code == 404
+
+    # 格式错误之前的接收人已经入队
+    body = ''.join(f'u{i}\n' for i in range(150)) + ',\n'
+    resp = client.post(url, params=params, content=body.encode(), headers=csv)
+    assert resp.status_code == 400
+    detail = resp.json()['detail']
+    assert detail['recipients'] == 100 and len(detail['message_ids']) == 1
+    assert 'line 151' in detail['error']
+
+    # 发送队列已满
+    queue.max_depth = queue.depth('wechat') + 1
+    resp = client.post(url, params=params, content=body.encode()[:-2], headers=csv)
+    assert resp.status_code == 429
+    assert resp.json()['detail']['recipients'] == 100
+
+
+def test_broadcast_email_is_separate(client, monkeypatch):
+    client, queue = client
+    from fastapi.exceptions import HTTPException
+    from message_push import main
+
+    class Loader:
+        def is_teplate_exist(self, html_file):
+            if html_file != 'notice.html':
+                raise HTTPException(status_code=404, detail="Template is not existed on azure.")
+            return True
+
+    monkeypatch.setattr(main, 'get_html_loader', lambda: Loader())
+    params = {"subject": "s", "template_name": "notice", "message": {}, "cc_users": ["cc@example.com"]}
+    resp = client.post("/api/v1/services/email/broadcasts", params={"params": json.dumps(params)},
+                       content=b'user\na@example.com\nb@example.com\n', headers={"Content-Type": "text/csv"})
+    assert resp.json()['recipients'] == 2
+    job, = queue.fetch('email', 10, 'worker', block=0)
+    assert job.payload['separate'] is True
+    assert job.payload['to_users'] == ['a@example.com', 'b@example.com']
+    assert job.payload['cc_users'] is None
+    resp = client.post("/api/v1/services/email/broadcasts",
+                       params={"params": json.dumps(dict(params, template_name="missing"))},
+                       content=b'a@example.com\n', headers={"Content-Type": "text/csv"})
+    assert resp.status_code == 404
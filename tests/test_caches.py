@@ -0,0 +1,188 @@
+import asyncio
+import math
+import time
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+
+from message_push.caches import WxOpenIDCache, AsyncWxOpenIDCache, LocalCache, MISSING, RedisCache, \
+    get_connection_pool, get_async_connection_pool, close_async_connection_pools
+
+
+class CountingRedis(fakeredis.FakeStrictRedis):
+    """
+    记录发送到 redis 的命令次数（每条命令一次往返）
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.round_trips = 0
+
+    def execute_command(self, *args, **options):
+        self.round_trips += 1
+        return super().execute_command(*args, **options)
+
+
+@pytest.fixture()
+def openid_cache():
+    cache = WxOpenIDCache(local_cache=LocalCache(maxsize=0))
+    cache.redis = CountingRedis()
+    return cache
+
+
+@pytest.fixture()
+def cached_openid_cache():
+    cache = WxOpenIDCache(local_cache=LocalCache(maxsize=100, ttl=60))
+    cache.redis = CountingRedis()
+    return cache
+
+
+def test_read_many_round_trips(openid_cache):
+    users = [f'union{i}' for i in range(1234)]
+    openid_cache.redis.mset({user: f'open{i}' for i, user in enumerate(users) if i % 10})
+    openid_cache.redis.round_trips = 0
+
+    result = openid_cache.read_many(users + users[:5], chunk_size=100)
+
+    assert openid_cache.redis.round_trips == math.ceil(len(users) / 100)
+    assert len(result) == len(users) - math.ceil(len(users) / 10)
+    assert result['union1'] == b'open1'
+    assert 'union0' not in result
+
+
+def test_read_many_single_reads(openid_cache):
+    users = [f'union{i}' for i in range(50)]
+    for user in users:
+        openid_cache.read(user)
+    assert openid_cache.redis.round_trips == len(users)
+
+
+def test_local_cache_lru_and_ttl():
+    cache = LocalCache(maxsize=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is MISSING
+    cache.set('d', 4, ttl=0)
+    assert cache.get('d') is MISSING
+    assert cache.stats() == {"size": 1, "hits": 1, "misses": 2, "evictions": 2}
+
+
+def test_local_cache_in_front_of_redis(cached_openid_cache):
+    cached_openid_cache.redis.set('union1', 'open1')
+    cached_openid_cache.redis.round_trips = 0
+
+    for _ in range(3):
+        assert cached_openid_cache.read('union1') == b'open1'
+        # 不存在的 openid 同样缓存
+        assert cached_openid_cache.read('union2') is None
+        assert cached_openid_cache.read_many(['union1', 'union2', 'union3']) == {'union1': b'open1'}
+    assert cached_openid_cache.redis.round_trips == 3
+
+
+def test_negative_cache_expires(cached_openid_cache):
+    cached_openid_cache.negative_ttl = 0
+    assert cached_openid_cache.read('union1') is None
+    cached_openid_cache.redis.set('union1', 'open1')
+    assert cached_openid_cache.read('union1') == b'open1'
+
+
+def test_invalidate_by_pubsub(cached_openid_cache):
+    cached_openid_cache.redis.set('union1', 'open1')
+    assert cached_openid_cache.read('union1') == b'open1'
+    cached_openid_cache.listen_invalidation('openid-invalidate')
+    try:
+        cached_openid_cache.redis.set('union1', 'open2')
+        cached_openid_cache.redis.publish('openid-invalidate', 'union1')
+        for _ in range(50):
+            if cached_openid_cache.local_cache.get('union1') is MISSING:
+                break
+            time.sleep(0.1)
+        assert cached_openid_cache.read('union1') == b'open2'
+    finally:
+        cached_openid_cache.stop_invalidation()
+
+
+class CountingAsyncRedis(fakeredis.aioredis.FakeRedis):
+    """
+    记录 redis.asyncio 客户端的往返次数（pipeline 一次执行为一次往返）
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.round_trips = 0
+
+    async def execute_command(self, *args, **options):
+        self.round_trips += 1
+        return await super().execute_command(*args, **options)
+
+    def pipeline(self, *args, **kwargs):
+        self.round_trips += 1
+        return super().pipeline(*args, **kwargs)
+
+
+def test_async_read_many_in_one_round_trip():
+    users = [f'union{i}' for i in range(1234)]
+
+    async def run():
+        client = CountingAsyncRedis()
+        await client.mset({user: f'open{i}' for i, user in enumerate(users) if i % 10})
+        cache = AsyncWxOpenIDCache(client=client, local_cache=LocalCache(maxsize=0))
+        client.round_trips = 0
+        result = await cache.read_many(users + users[:5], chunk_size=100)
+        assert client.round_trips == 1
+        assert await cache.read('union1') == b'open1'
+        await client.aclose()
+        return result
+
+    result = asyncio.run(run())
+    assert len(result) == len(users) - math.ceil(len(users) / 10)
+    assert 'union0' not in result
+
+
+def test_async_cache_shares_local_cache():
+    sync_cache = WxOpenIDCache(local_cache=LocalCache(maxsize=100, ttl=60))
+    sync_cache.redis = CountingRedis()
+    sync_cache.redis.set('union1', 'open1')
+    assert sync_cache.read('union1') == b'open1'
+
+    async def run():
+        client = CountingAsyncRedis()
+        cache = AsyncWxOpenIDCache(client=client, local_cache=sync_cache.local_cache)
+        # 同步缓存读取过的 key 不再访问 redis，不存在的 key 同样缓存
+        assert await cache.read_many(['union1', 'union2']) == {'union1': b'open1'}
+        assert await cache.read('union2') is None
+        await client.aclose()
+        return client.round_trips
+
+    assert asyncio.run(run()) == 1
+
+
+def test_shared_connection_pools():
+    assert RedisCache(db=1).redis.connection_pool is WxOpenIDCache(db=1).redis.connection_pool
+    assert get_connection_pool(1) is not get_connection_pool(2)
+    assert get_connection_pool(1).max_connections == 50
+
+    async def run():
+        pool = get_async_connection_pool(1)
+        assert AsyncWxOpenIDCache(db=1).redis.connection_pool is pool
+        await close_async_connection_pools()
+        assert get_async_connection_pool(1) is not pool
+        await close_async_connection_pools()
+
+    asyncio.run(run())
+
+
+def test_pool_connection_class():
+    import redis
+    from redis import asyncio as aioredis
+    assert get_connection_pool(1).connection_class is redis.SSLConnection
+    assert get_connection_pool(1, ssl=False).connection_class is redis.Connection
+
+    async def run():
+        assert get_async_connection_pool(1).connection_class is aioredis.SSLConnection
+        assert get_async_connection_pool(1, ssl=False).connection_class is aioredis.Connection
+        await close_async_connection_pools()
+
+    asyncio.run(run())
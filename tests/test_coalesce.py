@@ -0,0 +1,185 @@
+import asyncio
+import time
+import pytest
+
+pytest.importorskip('loguru')
+
+from prometheus_client import REGISTRY
+from message_push.dispatch import handlers
+from message_push.dispatch.coalesce import Coalescer, RedisHeldStore, SQLiteHeldStore, Held
+from message_push.dispatch.queue import SQLiteQueue
+from message_push.dispatch.tracking import DeliveryLog, SQLiteDeliveryLogStore
+from message_push.dispatch.worker import Worker
+
+
+def sms(users, index):
+    return {"template_name": "alarm", "to_users": users, "message": {"device": "d1", "index": index}}
+
+
+def new_coalescer(tmp_path, **kwargs):
+    path = str(tmp_path / 'dispatch.db')
+    kwargs.setdefault('queue', SQLiteQueue(path))
+    return Coalescer(held=SQLiteHeldStore(path), **kwargs)
+
+
+def test_split_and_expire(tmp_path):
+    coalescer = new_coalescer(tmp_path, window=10, count_field={})
+    assert coalescer.split('sms', sms(['a', 'b'], 0)) == (['a', 'b'], [])
+    assert coalescer.split('sms', sms(['a'], 1)) == ([], ['a'])
+    assert coalescer.split('sms', sms(['a', 'c'], 2)) == (['c'], ['a'])
+    # 不同模板、不合并的渠道、摘要消息不合并
+    assert coalescer.split('sms', dict(sms(['a'], 3), template_name='other')) == (['a'], [])
+    assert coalescer.split('email', dict(sms(['a'], 4), subject='s')) == (['a'], [])
+    assert coalescer.split('sms', dict(sms(['a'], 5), digest=2)) == (['a'], [])
+
+    assert coalescer.expire(time.monotonic()) == []
+    digests = coalescer.expire(time.monotonic() + 10)
+    assert [(digest.channel, digest.payload, digest.priority) for digest in digests] == \
+        [('sms', {"template_name": "alarm", "to_users": ['a'], "message": {"device": "d1", "index": 2}, "digest": 2},
+          'none')]
+    # 摘要消息入队后删除合并的消息
+    assert len(coalescer.held.load(digests[0].held)) == 1
+    coalescer.enqueue(digests)
+    assert coalescer.held.load(digests[0].held) == []
+    # 发送摘要消息后开始新的窗口，没有合并消息的窗口结束
+    assert coalescer.split('sms', sms(['a', 'b'], 6)) == (['b'], ['a'])
+    assert coalescer.expire(time.monotonic() + 25)[0].payload['to_users'] == ['a']
+    assert coalescer.expire(time.monotonic() + 40) == []
+    assert len(coalescer._windows) == 0
+
+
+def test_digest_count_field_and_grouping(tmp_path):
+    coalescer = new_coalescer(tmp_path, window=10, count_field={'sms': 'index', 'wechat': 'remark'},
+                              count_format='{value}（共{count}条）')
+    wechat = {"template_id": "t", "to_users": ['a', 'b'], "miniprogram": None,
+              "message": {"remark": {"value": "请处理", "color": "#ff0000"}}}
+    for _ in range(3):
+        coalescer.split('wechat', wechat)
+        coalescer.split('sms', sms(['a'], 'x'))
+    digests = dict((digest.channel, digest.payload) for digest in coalescer.expire(everything=True))
+    # 内容相同的接收人合并为一条摘要消息
+    assert digests['wechat']['to_users'] == ['a', 'b']
+    assert digests['wechat']['message'] == {"remark": {"value": "请处理（共2条）", "color": "#ff0000"}}
+    assert digests['sms']['message']['index'] == 'x（共2条）'
+    assert len(coalescer._windows) == 0
+
+
+def test_bounded_keys(tmp_path):
+    coalescer = new_coalescer(tmp_path, window=10, max_keys=2)
+    users = ['a', 'b', 'c']
+    assert coalescer.split('sms', sms(users, 0)) == (users, [])
+    # 超过 max_keys 的接收人不合并
+    assert coalescer.split('sms', sms(users, 1)) == (['c'], ['a', 'b'])
+    assert len(coalescer._windows) == 2
+
+
+def test_worker_sends_digest(tmp_path, monkeypatch):
+    queue = SQLiteQueue(str(tmp_path / 'dispatch.db'))
+    log = DeliveryLog(SQLiteDeliveryLogStore(str(tmp_path / 'dispatch.db')), flush_interval=0.01)
+    coalescer = new_coalescer(tmp_path, window=0.3, queue=queue, delivery_log=log, count_field={'sms': 'index'},
+                              count_format='{count}')
+    sent = []
+
+    class FakeSMSBox:
+        async def send(self, template_name, new_sms):
+            sent.append((list(new_sms.to_users), new_sms.content['index']))
+            if new_sms.to_users == ['fail']:
+                return {"succeeded": [], "failed": ['fail'], "retryable": True, "retry_after": 0,
+                        "errors": {"ProviderError(503)": ['fail']}}
+            return {"succeeded": list(new_sms.to_users), "failed": [], "retryable": False, "retry_after": 0,
+                    "errors": {}}
+
+    monkeypatch.setattr(handlers, 'get_async_sms_sender', lambda: FakeSMSBox())
+    monkeypatch.setattr(handlers, 'get_coalescer', lambda: coalescer)
+    saved = REGISTRY.get_sample_value('message_push_coalesce_saved_total', {'channel': 'sms'}) or 0
+    message_ids = [queue.enqueue('sms', sms(['a'], i)) for i in range(5)]
+    queue.enqueue('sms', sms(['fail'], 0))
+    for message_id in message_ids:
+        log.record(message_id, 'sms', 'queued', ['a'])
+
+    async def run():
+        worker = Worker(queue, 'sms', handlers.send_sms, concurrency=1, max_attempts=2, delivery_log=log)
+        await handlers.start_senders('sms')
+        task = asyncio.ensure_future(worker.run(block=0.05))
+        while len(sent) < 4:
+            await asyncio.sleep(0.05)
+        worker.stop()
+        await task
+        await coalescer.stop()
+
+    asyncio.run(run())
+    # 第一条立即发送，其余 4 条合并为一条摘要消息；发送失败的接收人重新发送时不合并
+    assert sorted(sent, key=str) == sorted([(['a'], 0), (['a'], '4'), (['fail'], 0), (['fail'], 0)], key=str)
+    assert REGISTRY.get_sample_value('message_push_coalesce_saved_total', {'channel': 'sms'}) - saved == 3
+    assert log.get(message_ids[0])['recipients']['a']['status'] == 'delivered'
+    message = log.get(message_ids[4])
+    log.close()
+    assert message['status'] == 'delivered'
+    assert message['recipients']['a']['status'] == 'coalesced'
+
+
+def test_digest_dead_lettered_when_queue_is_full(tmp_path):
+    from message_push.dispatch.deadletter import SQLiteDeadLetterStore
+    queue = SQLiteQueue(str(tmp_path / 'dispatch.db'), max_depth=1)
+    log = DeliveryLog(SQLiteDeliveryLogStore(str(tmp_path / 'dispatch.db')), flush_interval=0.01)
+    dead_letters = SQLiteDeadLetterStore(str(tmp_path / 'dispatch.db'))
+    coalescer = new_coalescer(tmp_path, window=10, queue=queue, delivery_log=log, dead_letters=dead_letters,
+                              count_field={})
+    queue.enqueue('sms', sms(['x'], 0))
+    for i in range(3):
+        coalescer.split('sms', sms(['a', 'b'], i))
+    digests = coalescer.expire(everything=True)
+    letter_held = digests[0].held
+    coalescer.enqueue(digests)
+    # 摘要消息写入死信，合并的接收人记录为发送失败
+    letter, = dead_letters.list('sms')
+    assert letter.payload['to_users'] == ['a', 'b'] and letter.payload['digest'] == 2
+    message = log.get(letter.job_id)
+    log.close()
+    assert message['status'] == 'failed'
+    assert sorted(message['recipients']) == ['a', 'b']
+    assert queue.depth('sms') == 1
+    assert coalescer.held.load(letter_held) == []
+
+
+@pytest.fixture(params=['sqlite', 'redis'])
+def held_store(request, tmp_path):
+    if request.param == 'sqlite':
+        return SQLiteHeldStore(str(tmp_path / 'dispatch.db'))
+    fakeredis = pytest.importorskip('fakeredis')
+    return RedisHeldStore(fakeredis.FakeStrictRedis())
+
+
+def test_held_store(held_store):
+    now = time.time()
+    held_store.hold([Held('w1', 'sms', 'a', 1, {'index': 0}, 'low', now + 10),
+                     Held('w2', 'sms', 'b', 1, {'index': 0}, 'none', now - 100)])
+    held_store.hold([Held('w1', 'sms', 'a', 1, {'index': 1}, 'high', now + 10),
+                     Held('w1', 'sms', 'a', 1, {'index': 2}, 'none', now + 10)])
+    w1, w2 = held_store.load(['w1', 'w2', 'missing'])
+    # 条数累加，payload 为最后一条，优先级为最高的
+    assert (w1.user, w1.count, w1.payload, w1.priority) == ('a', 3, {'index': 2}, 'high')
+    assert (w2.user, w2.count, w2.priority) == ('b', 1, 'none')
+    # 过期的记录只被取出一次
+    assert [item.id for item in held_store.claim_expired(now - 50, now + 60)] == ['w2']
+    assert held_store.claim_expired(now - 50, now + 60) == []
+    held_store.delete(['w1', 'w2'])
+    assert held_store.load(['w1', 'w2']) == []
+
+
+def test_digest_survives_worker_crash(tmp_path):
+    queue = SQLiteQueue(str(tmp_path / 'dispatch.db'))
+    crashed = new_coalescer(tmp_path, window=0.1, queue=queue, count_field={})
+    crashed.split('sms', sms(['a'], 0), 'low')
+    crashed.split('sms', sms(['a'], 1), 'high')
+    crashed.split('sms', sms(['a'], 2), 'none')
+    # worker 异常退出，窗口结束 window 秒后由其它 worker 发送摘要消息，优先级为合并的消息中最高的
+    other = new_coalescer(tmp_path, window=0.1, queue=queue, count_field={})
+    assert other.expire() == []
+    time.sleep(0.25)
+    digest, = other.expire()
+    assert (digest.payload['to_users'], digest.payload['digest'], digest.priority) == (['a'], 2, 'high')
+    other.enqueue([digest])
+    job, = queue.fetch('sms', 10, 'worker', block=0)
+    assert job.priority == 'high' and job.payload['message']['index'] == 2
+    assert other.expire(time.monotonic() + 1) == []
@@ -0,0 +1,176 @@
+import asyncio
+import pytest
+
+pytest.importorskip('loguru')
+
+import redis
+from message_push.dedup import Deduplicator, MemoryDedupStore, RedisDedupStore
+from message_push.caches import AsyncRedisCache
+from message_push.dispatch.queue import SQLiteQueue
+
+
+def test_memory_store_expires():
+    store = MemoryDedupStore()
+
+    async def run():
+        assert await store.add('k', 60)
+        assert not await store.add('k', 60)
+        assert await store.add('expired', 0)
+        assert await store.add('expired', 0)
+        await store.delete('k')
+        assert await store.add('k', 60)
+        assert await store.get('k') == ''
+        await store.set('k', 'message-1', 60)
+        assert await store.get('k') == 'message-1'
+        # 只修改已存在的 key
+        await store.set('missing', 'message-2', 60)
+        assert await store.get('missing') is None
+
+    asyncio.run(run())
+
+
+def test_redis_store_set_nx():
+    fakeredis = pytest.importorskip('fakeredis')
+
+    async def run():
+        client = fakeredis.aioredis.FakeRedis()
+        store = RedisDedupStore(AsyncRedisCache(client=client))
+        assert await store.add('k', 60)
+        assert not await store.add('k', 60)
+        assert 0 < await client.pttl('message_push:dedup:k') <= 60000
+        await store.delete('k')
+        assert await store.add('k', 60)
+        await store.set('k', 'message-1', 60)
+        assert await store.get('k') == 'message-1'
+        assert not await store.add('k', 60)
+        await store.set('missing', 'message-2', 60)
+        assert await store.get('missing') is None
+        await client.aclose()
+
+    asyncio.run(run())
+
+
+class BrokenRedis:
+    async def set(self, *args, **kwargs):
+        raise redis.ConnectionError('redis is down')
+
+    async def delete(self, *args):
+        raise redis.ConnectionError('redis is down')
+
+
+def test_redis_store_falls_back_to_memory():
+    store = RedisDedupStore(AsyncRedisCache(client=BrokenRedis()))
+
+    async def run():
+        assert await store.add('k', 60)
+        assert not await store.add('k', 60)
+
+    asyncio.run(run())
+
+
+def test_dedup_key():
+    deduplicator = Deduplicator(MemoryDedupStore(), content_hash=True)
+    payload = {"to_users": ["a"], "message": {"x": 1, "y": 2}}
+    assert deduplicator.key('sms', payload) == deduplicator.key('sms', {"message": {"y": 2, "x": 1}, "to_users": ["a"]})
+    assert deduplicator.key('sms', payload) != deduplicator.key('wechat', payload)
+    assert deduplicator.key('sms', payload, 'abc') != deduplicator.key('sms', payload)
+    assert deduplicator.key('sms', payload, 'abc') == deduplicator.key('sms', {}, 'abc')
+    assert Deduplicator(MemoryDedupStore(), content_hash=False).key('sms', payload) is None
+
+
+@pytest.fixture()
+def client(tmp_path, monkeypatch):
+    pytest.importorskip('httpx')
+    from fastapi.testclient import TestClient
+    from message_push import main
+    from message_push.authorize import has_access
+
+    queue = SQLiteQueue(str(tmp_path / 'dispatch.db'), max_depth=3)
+    monkeypatch.setattr(main, 'get_queue', lambda: queue)
+    deduplicator = Deduplicator(MemoryDedupStore(), content_hash=True)
+    monkeypatch.setattr(main, 'get_deduplicator', lambda: deduplicator)
+    main.app.dependency_overrides[has_access] = lambda: True
+    try:
+        yield TestClient(main.app), queue
+    finally:
+        main.app.dependency_overrides.clear()
+
+
+SMS = {"template_name": "notice", "to_users": ["15000000000"], "message": {"name": "x"}}
+
+
+def test_duplicate_idempotency_key_dropped(client):
+    client, queue = client
+    url = "/api/v1/services/sms/messages"
+    first = client.post(url, json=SMS, headers={"Idempotency-Key": "req-1"})
+    assert first.json() == "success"
+    resp = client.post(url, json=dict(SMS, message={"name": "y"}), headers={"Idempotency-Key": "req-1"})
+    assert resp.status_code == 200
+    assert resp.json() == "duplicate"
+    # 返回第一次请求的消息id
+    assert resp.headers['X-Message-Id'] == first.headers['X-Message-Id']
+    assert client.post(url, json=SMS, headers={"Idempotency-Key": "req-2"}).json() == "success"
+    assert queue.depth('sms') == 2
+
+
+def test_duplicate_content_dropped(client):
+    client, queue = client
+    url = "/api/v1/services/wechat/messages"
+    body = {"template_id": "t1", "to_users": ["union1"], "message": {"keyword1": {"value": "x"}}}
+    assert client.post(url, json=body).json() == "success"
+    assert client.post(url, json=body).json() == "duplicate"
+    # 优先级不同视为不同的请求
+    assert client.post(url, json=dict(body, priority="high")).json() == "success"
+    assert queue.depth('wechat') == 2
+
+
+def test_key_released_when_queue_is_full(client):
+    client, queue = client
+    url = "/api/v1/services/sms/messages"
+    for i in range(3):
+        queue.enqueue('sms', {'n': i})
+    assert client.post(url, json=SMS, headers={"Idempotency-Key": "req-1"}).status_code == 429
+    job, = queue.fetch('sms', 1, 'worker', block=0)
+    queue.ack(job)
+    # 上游重试时可以正常入队
+    assert client.post(url, json=SMS, headers={"Idempotency-Key": "req-1"}).json() == "success"
+
+
+def test_key_not_claimed_when_template_is_missing(client, monkeypatch):
+    from fastapi.exceptions import HTTPException
+    from message_push import main
+    client, queue = client
+    templates = set()
+
+    class Loader:
+        def is_teplate_exist(self, html_file):
+            if html_file not in templates:
+                raise HTTPException(status_code=404, detail="Template is not existed on azure.")
+            return True
+
+    monkeypatch.setattr(main, 'get_html_loader', lambda: Loader())
+    url = "/api/v1/services/email/messages"
+    body = {"subject": "s", "template_name": "notice", "to_users": ["a@example.com"], "message": {}}
+    assert client.post(url, json=body, headers={"Idempotency-Key": "req-1"}).status_code == 404
+    assert client.post(url, json=body).status_code == 404
+    # 上传模板后重新请求
+    templates.add('notice.html')
+    assert client.post(url, json=body, headers={"Idempotency-Key": "req-1"}).json() == "success"
+    assert client.post(url, json=body).json() == "success"
+    assert queue.depth('email') == 2
+
+
+def test_default_backend_with_multiple_workers():
+    import importlib
+    from message_push import dedup, server
+
+    # 多进程部署时进程内去重无法发现其它进程的重复请求，默认使用 redis
+    try:
+        with pytest.MonkeyPatch.context() as m:
+            m.setitem(dedup.config, 'dedup', {})
+            m.setattr(server.ServerConfig, 'workers', 4)
+            assert importlib.reload(dedup).DedupConfig.backend == 'redis'
+            m.setattr(server.ServerConfig, 'workers', 1)
+            assert importlib.reload(dedup).DedupConfig.backend == 'memory'
+    finally:
+        importlib.reload(dedup)
@@ -0,0 +1,223 @@
+import asyncio
+import time
+import pytest
+
+pytest.importorskip('loguru')
+
+from message_push.dispatch.queue import SQLiteQueue, RedisStreamQueue, QueueFull
+from message_push.dispatch.worker import Worker
+
+
+@pytest.fixture(params=['sqlite', 'redis'])
+def queue(request, tmp_path):
+    if request.param == 'sqlite':
+        return SQLiteQueue(str(tmp_path / 'dispatch.db'), max_depth=5)
+    fakeredis = pytest.importorskip('fakeredis')
+    return RedisStreamQueue(fakeredis.FakeStrictRedis(), max_depth=5)
+
+
+def test_priority_lanes(queue):
+    queue.enqueue('sms', {'n': 1}, 'low')
+    queue.enqueue('sms', {'n': 2}, 'none')
+    queue.enqueue('sms', {'n': 3}, 'high')
+    queue.enqueue('wechat', {'n': 4}, 'high')
+    order = []
+    for _ in range(3):
+        job, = queue.fetch('sms', 1, 'worker', block=0)
+        order.append(job.priority)
+        queue.ack(job)
+    assert order == ['high', 'none', 'low']
+    assert queue.fetch('sms', 1, 'worker', block=0) == []
+    assert queue.depth('sms') == 0
+    assert queue.depth('wechat') == 1
+
+
+def test_queue_full(queue):
+    for i in range(5):
+        queue.enqueue('sms', {'n': i})
+    with pytest.raises(QueueFull):
+        queue.enqueue('sms', {'n': 5})
+    # 取出但未确认的任务仍计入队列长度
+    jobs = queue.fetch('sms', 5, 'worker', block=0)
+    with pytest.raises(QueueFull):
+        queue.enqueue('sms', {'n': 5})
+    for job in jobs:
+        queue.ack(job)
+    queue.enqueue('sms', {'n': 5})
+
+
+def test_retry_is_atomic(queue, monkeypatch):
+    queue.enqueue('sms', {'n': 0}, 'high')
+    queue.enqueue('sms', {'n': 1}, 'high')
+    job, = queue.fetch('sms', 1, 'worker', block=0)
+    job.payload = {'n': 0, 'retried': True}
+
+    def ack(job):
+        raise AssertionError("retry must not ack separately")
+
+    # 重新入队与删除原任务在同一个操作中完成，不会因为中途退出而重复
+    monkeypatch.setattr(queue, 'ack', ack)
+    queue.retry(job)
+    monkeypatch.undo()
+    assert queue.depth('sms') == 2
+    # 重新入队的任务排在同优先级的最后
+    jobs = queue.fetch('sms', 2, 'worker', block=0)
+    assert [(job.payload, job.attempts) for job in jobs] == [({'n': 1}, 0), ({'n': 0, 'retried': True}, 1)]
+
+
+def test_redeliver_unacked_job(queue):
+    queue.visibility_timeout = 0.2
+    job_id = queue.enqueue('email', {'n': 1})
+    job, = queue.fetch('email', 1, 'worker-1', block=0)
+    assert queue.fetch('email', 1, 'worker-2', block=0) == []
+    # worker-1 异常退出，超过 visibility_timeout 后重新投递
+    time.sleep(0.3)
+    redelivered, = queue.fetch('email', 1, 'worker-2', block=0)
+    assert redelivered.id == job_id
+    assert redelivered.payload == {'n': 1}
+    queue.ack(redelivered)
+    assert queue.depth('email') == 0
+
+
+def test_worker_acks_and_retries(queue):
+    for i in range(4):
+        queue.enqueue('sms', {'n': i})
+    sent = []
+    attempts = {}
+
+    async def handler(payload):
+        attempts[payload['n']] = attempts.get(payload['n'], 0) + 1
+        if payload['n'] == 3:
+            raise RuntimeError('provider error')
+        sent.append(payload['n'])
+
+    async def run():
+        worker = Worker(queue, 'sms', handler, concurrency=2, max_attempts=3)
+        task = asyncio.ensure_future(worker.run(block=0.05))
+        while queue.depth('sms'):
+            await asyncio.sleep(0.05)
+        worker.stop()
+        await task
+
+    asyncio.run(run())
+    assert sorted(sent) == [0, 1, 2]
+    assert attempts[3] == 3
+
+
+def test_endpoint_returns_429_when_queue_is_full(tmp_path, monkeypatch):
+    pytest.importorskip('httpx')
+    from fastapi.testclient import TestClient
+    from message_push import main
+    from message_push.authorize import has_access
+
+    full_queue = SQLiteQueue(str(tmp_path / 'dispatch.db'), max_depth=1)
+    monkeypatch.setattr(main, 'get_queue', lambda: full_queue)
+    main.app.dependency_overrides[has_access] = lambda: True
+    try:
+        client = TestClient(main.app)
+        body = {"template_name": "notice", "to_users": ["15000000000"], "message": {"name": "x"},
+                "priority": "high"}
+        assert client.post("/api/v1/services/sms/messages", json=body).status_code == 200
+        assert client.post("/api/v1/services/sms/messages", json=body).status_code == 429
+        job, = full_queue.fetch('sms', 1, 'worker', block=0)
+        assert job.priority == 'high'
+        assert job.payload == {"template_name": "notice", "to_users": ["15000000000"], "message": {"name": "x"}}
+    finally:
+        main.app.dependency_overrides.clear()
+
+
+def test_scheduled_jobs_released_when_due(queue):
+    now = time.time()
+    late = queue.enqueue('sms', {'n': 2}, 'high', due_at=now + 0.4)
+    early = queue.enqueue('sms', {'n': 1}, due_at=now + 0.2)
+    queue.enqueue('sms', {'n': 0}, due_at=now - 1)
+    assert (queue.depth('sms'), queue.scheduled('sms')) == (1, 2)
+    assert queue.next_due('sms') == pytest.approx(now + 0.2)
+    assert queue.release_due('sms', 10) == 0
+
+    time.sleep(0.5)
+    # 每次最多移入 count 个，按到期时间先后
+    assert queue.release_due('sms', 1) == 1
+    assert [job.id for job in queue.fetch('sms', 10, 'worker', block=0) if job.payload['n']] == [early]
+    assert queue.release_due('sms', 10) == 1
+    job, = queue.fetch('sms', 10, 'worker', block=0)
+    assert (job.id, job.priority, job.payload) == (late, 'high', {'n': 2})
+    assert (queue.scheduled('sms'), queue.next_due('sms')) == (0, None)
+
+
+def test_scheduled_jobs_limit(queue):
+    queue.max_scheduled = 1
+    queue.enqueue('sms', {'n': 0}, due_at=time.time() + 60)
+    with pytest.raises(QueueFull):
+        queue.enqueue('sms', {'n': 1}, due_at=time.time() + 60)
+    # 定时任务不计入发送队列长度
+    queue.enqueue('sms', {'n': 2})
+
+
+def test_worker_releases_due_jobs_smoothly(queue, monkeypatch):
+    queue.max_depth = 1000
+    # 所有任务同时到期：入队时还未到期，worker 启动时已经全部到期
+    now = time.time()
+    for i in range(40):
+        queue.enqueue('sms', {'n': i}, due_at=now + 60)
+    assert queue.scheduled('sms') == 40
+    monkeypatch.setattr(time, 'time', lambda: now + 120)
+    sent = []
+    released = []
+    release_due = queue.release_due
+
+    def record_release(channel, count):
+        released.append(release_due(channel, count))
+        return released[-1]
+
+    monkeypatch.setattr(queue, 'release_due', record_release)
+
+    async def handler(payload):
+        sent.append(payload['n'])
+
+    async def run():
+        worker = Worker(queue, 'sms', handler, release_rate=100, release_batch=10)
+        task = asyncio.ensure_future(worker.run(block=0.05))
+        while len(sent) < 40:
+            await asyncio.sleep(0.01)
+        worker.stop()
+        await task
+
+    asyncio.run(run())
+    assert sorted(sent) == list(range(40))
+    # 40 个同时到期的任务每次最多移入 10 个，不会一次全部发送
+    ticks = [count for count in released if count]
+    assert all(count <= 10 for count in ticks)
+    assert sum(ticks) == 40
+    assert len(ticks) > 1
+    assert queue.scheduled('sms') == 0
+
+
+def test_endpoint_schedules_message(tmp_path, monkeypatch):
+    pytest.importorskip('httpx')
+    from fastapi.testclient import TestClient
+    from message_push import main
+    from message_push.authorize import has_access
+
+    queue = SQLiteQueue(str(tmp_path / 'dispatch.db'))
+    monkeypatch.setattr(main, 'get_queue', lambda: queue)
+    monkeypatch.setattr(main, 'get_delivery_log', lambda: None)
+    main.app.dependency_overrides[has_access] = lambda: True
+    try:
+        client = TestClient(main.app)
+        body = {"template_name": "notice", "to_users": ["15000000000"], "message": {"name": "x"}}
+        assert client.post("/api/v1/services/sms/messages", json=dict(body, delay=60)).json() == "success"
+        send_at = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(time.time() + 120))
+        assert client.post("/api/v1/services/sms/messages", json=dict(body, send_at=send_at)).json() == "success"
+        assert (queue.depth('sms'), queue.scheduled('sms')) == (0, 2)
+        assert queue.next_due('sms') == pytest.approx(time.time() + 60, abs=5)
+        assert client.post("/api/v1/services/sms/messages", json=dict(body, delay=-1)).status_code == 422
+        assert client.post("/api/v1/services/sms/messages",
+                           json=dict(body, delay=60, send_at=send_at)).status_code == 422
+        assert client.post("/api/v1/services/sms/messages", json=dict(body, delay=1e9)).status_code == 422
+        # 发送时间已过去时立即入队
+        resp = client.post("/api/v1/services/sms/messages", json=dict(body, send_at=time.time() - 10))
+        assert resp.status_code == 200
+        assert (queue.depth('sms'), queue.scheduled('sms')) == (1, 2)
+    finally:
+        main.app.dependency_overrides.clear()
@@ -0,0 +1,325 @@
+import email
+import email.header
+import pytest
+
+pytest.importorskip('aiosmtpd')
+pytest.importorskip('loguru')
+
+from message_push.mail.mailbox import MailBox, EmailTemplate
+from tests.mocks import SMTPSink
+
+
+@pytest.fixture()
+def smtp_sink():
+    with SMTPSink() as sink:
+        yield sink
+
+
+def new_mailbox(sink, **kwargs):
+    return MailBox('sender@example.com', 'password', smtp_server=sink.host, smtp_port=sink.port,
+                   use_tls=False, **kwargs)
+
+
+def test_send_reuses_smtp_session(smtp_sink):
+    mailbox = new_mailbox(smtp_sink, pool_size=2)
+    for i in range(5):
+        mailbox.send(EmailTemplate(f'subject {i}', 'sender@example.com', ['to@example.com'],
+                                   ['cc@example.com'], '<p>hello</p>'))
+    mailbox.close()
+    assert len(smtp_sink.messages) == 5
+    assert smtp_sink.messages[0][1] == ['to@example.com', 'cc@example.com']
+    assert smtp_sink.sessions == 1
+
+
+def test_send_reconnects_dropped_session(smtp_sink):
+    mailbox = new_mailbox(smtp_sink)
+    mail = EmailTemplate('subject', 'sender@example.com', ['to@example.com'], content='<p>hello</p>')
+    mailbox.send(mail)
+    # 模拟服务器断开空闲连接
+    with mailbox.pool.connection() as server:
+        server.close()
+    mailbox.send(mail)
+    assert len(smtp_sink.messages) == 2
+    assert smtp_sink.sessions == 2
+
+
+def test_idle_timeout_closes_session(smtp_sink):
+    mailbox = new_mailbox(smtp_sink, pool_idle_timeout=0)
+    mail = EmailTemplate('subject', 'sender@example.com', ['to@example.com'], content='<p>hello</p>')
+    mailbox.send(mail)
+    mailbox.send(mail)
+    assert smtp_sink.sessions == 2
+
+
+def test_send_many_over_one_session(smtp_sink):
+    smtp_sink.rejected.add('bad@example.com')
+    mailbox = new_mailbox(smtp_sink)
+    mails = [EmailTemplate('subject', 'sender@example.com', [f'user{i}@example.com'], content=f'<p>{i}</p>')
+             for i in range(5)]
+    mails.insert(2, EmailTemplate('subject', 'sender@example.com', ['bad@example.com'], content='<p>bad</p>'))
+
+    results = mailbox.send_many(iter(mails))
+
+    assert [result is None for result in results] == [True, True, False, True, True, True]
+    assert len(smtp_sink.messages) == 5
+    assert smtp_sink.sessions == 1
+
+
+def test_send_many_reconnects(smtp_sink):
+    mailbox = new_mailbox(smtp_sink)
+    mail = EmailTemplate('subject', 'sender@example.com', ['to@example.com'], content='<p>hello</p>')
+    mailbox.send(mail)
+    with mailbox.pool.connection() as server:
+        server.close()
+    assert mailbox.send_many([mail, mail]) == [None, None]
+    assert len(smtp_sink.messages) == 3
+
+
+def test_send_many_connection_error():
+    mailbox = MailBox('sender@example.com', 'password', smtp_server='127.0.0.1', smtp_port=1, use_tls=False)
+    mail = EmailTemplate('subject', 'sender@example.com', ['to@example.com'], content='<p>hello</p>')
+    results = mailbox.send_many([mail, mail])
+    assert len(results) == 2
+    assert all(isinstance(result, OSError) for result in results)
+
+
+def test_email_batch_endpoint(smtp_sink, tmp_path, monkeypatch):
+    pytest.importorskip('azure.storage.blob')
+    from fastapi.testclient import TestClient
+    from message_push import main
+    from message_push.authorize import has_access
+    from message_push.dispatch import handlers
+    from message_push.dispatch.queue import SQLiteQueue
+    from message_push.mail.template import TemplateAzure
+    from message_push.resilience import DeliveryError
+    from tests.mocks import LocalBlobContainer
+
+    (tmp_path / 'notice.html').write_text('<p>{{ name }}</p>', encoding='utf8')
+    container = LocalBlobContainer(str(tmp_path))
+    html_loader = TemplateAzure(container=container)
+    email_sender = new_mailbox(smtp_sink)
+    queue = SQLiteQueue(str(tmp_path / 'dispatch.db'))
+    for module in (main, handlers):
+        monkeypatch.setattr(module, 'get_html_loader', lambda: html_loader)
+    monkeypatch.setattr(handlers, 'get_email_sender', lambda: email_sender)
+    monkeypatch.setattr(main, 'get_queue', lambda: queue)
+    monkeypatch.setattr(main, 'get_delivery_log', lambda: None)
+    main.app.dependency_overrides[has_access] = lambda: True
+    try:
+        items = [{"to_users": [f"user{i}@example.com"], "message": {"name": f"user{i}"}} for i in range(3)]
+        items.append({"to_users": ["other@example.com"], "cc_users": ["cc@example.com"], "message": {}})
+        response = TestClient(main.app).post("/api/v1/services/email/batches", json={
+            "subject": "newsletter", "template_name": "notice", "items": items, "priority": "high"})
+    finally:
+        main.app.dependency_overrides.clear()
+
+    # 批量邮件入队，由 worker 发送
+    assert response.json() == "success"
+    assert smtp_sink.messages == []
+    job, = queue.fetch('email', 10, 'worker', block=0)
+    assert job.id == response.headers['X-Message-Id'] and job.priority == 'high'
+    assert job.payload['to_users'] == [f"user{i}@example.com" for i in range(3)] + ["other@example.com",
+                                                                                  "cc@example.com"]
+    smtp_sink.rejected.add('user2@example.com')
+    with pytest.raises(DeliveryError) as e:
+        handlers._send_email(job.payload)
+    assert e.value.recipients == ['user2@example.com'] and not e.value.retryable
+    assert len(smtp_sink.messages) == 3
+    body = email.message_from_bytes(smtp_sink.messages[1][2]).get_payload()[0].get_payload(decode=True)
+    assert body == b'<p>user1</p>'
+    assert smtp_sink.messages[2][1] == ['other@example.com', 'cc@example.com']
+    assert container.downloads == 1
+    assert smtp_sink.sessions == 1
+
+    # 重新入队的任务只发送失败的邮件
+    smtp_sink.rejected.clear()
+    result = handlers._send_email(dict(job.payload, to_users=e.value.recipients))
+    email_sender.close()
+    assert result['succeeded'] == ['user2@example.com']
+    assert smtp_sink.messages[3][1] == ['user2@example.com']
+    assert len(smtp_sink.messages) == 4
+
+
+def new_accounts(n):
+    return [{'address': f'sender{i}@example.com', 'password': 'password'} for i in range(n)]
+
+
+def test_accounts_round_robin(smtp_sink):
+    mailbox = new_mailbox(smtp_sink, accounts=new_accounts(3))
+    mail = EmailTemplate('subject', 'sender@example.com', ['to@example.com'], content='<p>hello</p>')
+    for _ in range(6):
+        mailbox.send(mail)
+    mailbox.close()
+    assert [mail_from for mail_from, _, _ in smtp_sink.messages] == \
+        ['sender0@example.com', 'sender1@example.com', 'sender2@example.com'] * 2
+    assert [account.sent for account in mailbox.accounts] == [2, 2, 2]
+    assert all(account.in_flight == 0 for account in mailbox.accounts)
+
+
+def test_accounts_least_loaded(smtp_sink):
+    mailbox = new_mailbox(smtp_sink, accounts=new_accounts(3), strategy='least_loaded')
+    mailbox.accounts[0].checkout()
+    mailbox.accounts[1].checkout()
+    mail = EmailTemplate('subject', 'sender@example.com', ['to@example.com'], content='<p>hello</p>')
+    mailbox.send(mail)
+    mailbox.send(mail)
+    mailbox.close()
+    assert [mail_from for mail_from, _, _ in smtp_sink.messages] == ['sender2@example.com'] * 2
+
+
+def test_account_ejected_after_auth_failures(smtp_sink):
+    smtp_sink.bad_accounts.add('sender0@example.com')
+    mailbox = new_mailbox(smtp_sink, accounts=new_accounts(2), eject_after=2, eject_timeout=60)
+    mail = EmailTemplate('subject', 'sender@example.com', ['to@example.com'], content='<p>hello</p>')
+    for _ in range(6):
+        mailbox.send(mail)
+    mailbox.close()
+    # 认证失败的邮件立即由另一个账号重发，连续失败 2 次后不再使用该账号
+    assert len(smtp_sink.messages) == 6
+    assert {mail_from for mail_from, _, _ in smtp_sink.messages} == {'sender1@example.com'}
+    assert mailbox.accounts[0].failed == 2
+    assert not mailbox.accounts[0].available
+
+
+def test_rejected_account_does_not_use_quota(smtp_sink):
+    from message_push.ratelimit import LocalBucketStore, RateLimiter
+
+    store = LocalBucketStore()
+    limiter = RateLimiter('email', per_day=10, max_wait=0, store=store,
+                          per_key=RateLimiter('email', per_day=10, max_wait=0, store=store))
+    smtp_sink.bad_accounts.add('sender0@example.com')
+    mailbox = new_mailbox(smtp_sink, accounts=new_accounts(2), rate_limiter=limiter, eject_after=1, eject_timeout=60)
+    mail = EmailTemplate('subject', 'sender@example.com', ['to@example.com'], content='<p>hello</p>')
+    for _ in range(3):
+        mailbox.send(mail)
+    mailbox.close()
+    assert len(smtp_sink.messages) == 3
+
+    def used(key):
+        return store.update(key, lambda state: (None, state))[3]
+
+    # 每封邮件只占用一次渠道配额；认证失败的账号退还令牌，暂停使用后不再占用
+    assert used('email') == 3
+    assert used('email:sender0@example.com') == 0
+    assert used('email:sender1@example.com') == 3
+
+
+def test_account_throttled_by_provider(smtp_sink):
+    smtp_sink.throttled.add('sender1@example.com')
+    mailbox = new_mailbox(smtp_sink, accounts=new_accounts(2), eject_after=1)
+    mail = EmailTemplate('subject', 'sender@example.com', ['to@example.com'], content='<p>hello</p>')
+    for _ in range(3):
+        mailbox.send(mail)
+    mailbox.close()
+    assert len(smtp_sink.messages) == 3
+    assert not mailbox.accounts[1].available
+
+
+def test_accounts_rate_limit(smtp_sink):
+    from message_push.ratelimit import RateLimiter, RateLimited
+
+    limiter = RateLimiter('email', max_wait=0, per_key=RateLimiter('email', rate=0.01, burst=2, max_wait=0))
+    mailbox = new_mailbox(smtp_sink, accounts=new_accounts(2), rate_limiter=limiter)
+    mail = EmailTemplate('subject', 'sender@example.com', ['to@example.com'], content='<p>hello</p>')
+    # 每个账号的配额独立，用完一个账号的配额后使用另一个账号
+    for _ in range(4):
+        mailbox.send(mail)
+    with pytest.raises(RateLimited):
+        mailbox.send(mail)
+    mailbox.close()
+    assert [account.sent for account in mailbox.accounts] == [2, 2]
+
+
+def test_send_many_fails_over_accounts(smtp_sink):
+    smtp_sink.bad_accounts.add('sender0@example.com')
+    mailbox = new_mailbox(smtp_sink, accounts=new_accounts(2), eject_after=1, eject_timeout=60)
+    mail = EmailTemplate('subject', 'sender@example.com', ['to@example.com'], content='<p>hello</p>')
+    results = mailbox.send_many([mail] * 3)
+    mailbox.close()
+    # 认证失败时剩余的邮件由另一个账号的会话继续发送
+    assert results == [None] * 3
+    assert [mail_from for mail_from, _, _ in smtp_sink.messages] == ['sender1@example.com'] * 3
+    assert not mailbox.accounts[0].available
+    assert all(account.in_flight == 0 for account in mailbox.accounts)
+
+
+def test_send_each_spreads_over_account_quota(smtp_sink):
+    from message_push.ratelimit import RateLimiter, RateLimited
+
+    limiter = RateLimiter('email', max_wait=0, per_key=RateLimiter('email', rate=0.01, burst=2, max_wait=0))
+    mailbox = new_mailbox(smtp_sink, accounts=new_accounts(2), rate_limiter=limiter)
+    mail = EmailTemplate('subject', 'sender@example.com', [], content='<p>hello</p>')
+    recipients = [f'user{i}@example.com' for i in range(5)]
+    result = mailbox.send_each(mail, recipients)
+    mailbox.close()
+    # 一个账号的配额用完后换另一个账号，所有账号的配额都用完时剩余的接收人被限流
+    assert result['succeeded'] == recipients[:4]
+    assert result['failed'] == recipients[4:]
+    assert result['retry_after'] > 0
+    assert sorted(mail_from for mail_from, _, _ in smtp_sink.messages) == \
+        ['sender0@example.com'] * 2 + ['sender1@example.com'] * 2
+
+
+def test_send_many_circuit_open(smtp_sink):
+    from message_push.resilience import CircuitOpenError
+
+    mailbox = new_mailbox(smtp_sink)
+    for _ in range(mailbox.retrier.breaker.failure_threshold):
+        mailbox.retrier.breaker.record_failure()
+    mail = EmailTemplate('subject', 'sender@example.com', ['to@example.com'], content='<p>hello</p>')
+    results = mailbox.send_many([mail, mail])
+    assert len(results) == 2
+    assert all(isinstance(result, CircuitOpenError) for result in results)
+    assert not smtp_sink.messages
+
+
+@pytest.mark.parametrize('pipelining', [True, False])
+def test_send_each_reuses_encoded_mail(pipelining):
+    with SMTPSink(pipelining=pipelining) as sink:
+        sink.rejected.add('bad@example.com')
+        mailbox = new_mailbox(sink, accounts=[{'address': 'sender@example.com', 'password': 'password',
+                                               'sender': '通知 <noreply@example.com>'}])
+        mail = EmailTemplate('subject', 'sender@example.com', ['ignored@example.com'], content='<p>hello</p>')
+        recipients = [f'user{i}@example.com' for i in range(4)]
+        recipients.insert(2, 'bad@example.com')
+        result = mailbox.send_each(mail, recipients)
+        mailbox.close()
+
+    assert result['failed'] == ['bad@example.com']
+    assert result['succeeded'] == [r for r in recipients if r != 'bad@example.com']
+    assert not result['retryable']
+    assert sink.sessions == 1
+    assert [(mail_from, rcpt_tos) for mail_from, rcpt_tos, _ in sink.messages] == \
+        [('sender@example.com', [r]) for r in result['succeeded']]
+    for to_addr, (_, _, content) in zip(result['succeeded'], sink.messages):
+        msg = email.message_from_bytes(content)
+        assert msg['To'] == to_addr
+        assert msg['CC'] is None
+        assert str(email.header.make_header(email.header.decode_header(msg['From']))) == '通知 <noreply@example.com>'
+        assert msg.get_payload()[0].get_payload(decode=True) == b'<p>hello</p>'
+
+
+def test_send_each_rejects_header_injection(smtp_sink):
+    mailbox = new_mailbox(smtp_sink)
+    mail = EmailTemplate('subject', 'sender@example.com', [], content='<p>hello</p>')
+    bad = ['a@example.com\r\nBcc: victim@example.com', 'b@example.com\nSubject: spoofed']
+    result = mailbox.send_each(mail, bad + ['c@example.com'])
+    mailbox.close()
+    assert result['failed'] == bad
+    assert not result['retryable']
+    assert result['succeeded'] == ['c@example.com']
+    (_, rcpt_tos, content), = smtp_sink.messages
+    assert rcpt_tos == ['c@example.com']
+    msg = email.message_from_bytes(content)
+    assert (msg['To'], msg['Bcc'], msg['Subject']) == ('c@example.com', None, '=?utf8?q?subject?=')
+
+
+def test_send_each_reconnects(smtp_sink):
+    mailbox = new_mailbox(smtp_sink)
+    mail = EmailTemplate('subject', 'sender@example.com', [], content='<p>hello</p>')
+    mailbox.send_each(mail, ['to@example.com'])
+    with mailbox.pool.connection() as server:
+        server.close()
+    assert mailbox.send_each(mail, ['a@example.com', 'b@example.com'])['succeeded'] == \
+        ['a@example.com', 'b@example.com']
+    assert len(smtp_sink.messages) == 3
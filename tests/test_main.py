@@ -0,0 +1,52 @@
+import os
+import subprocess
+import sys
+import time
+import pytest
+
+pytest.importorskip('jose')
+pytest.importorskip('loguru')
+
+from fastapi.testclient import TestClient
+from message_push.authorize import AzureAuthorization
+from tests.mocks import MockJWKSServer
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_import_has_no_side_effects():
+    # 导入 main 时不创建发送服务，不导入 msal / azure sdk
+    code = ("import sys, message_push.main\n"
+            "from message_push.mail.mailbox import get_email_sender, get_html_loader\n"
+            "assert get_email_sender.cache_info().currsize == 0\n"
+            "assert get_html_loader.cache_info().currsize == 0\n"
+            "assert 'msal' not in sys.modules and 'azure.storage.blob' not in sys.modules\n")
+    subprocess.run([sys.executable, '-c', code], cwd=root_dir, check=True)
+
+
+def test_healthz_before_startup(monkeypatch):
+    from message_push import main
+
+    monkeypatch.setattr(main, 'warmup_task', None)
+    client = TestClient(main.app)
+    assert client.get('/healthz').json() == {'status': 'ok'}
+    assert client.get('/readyz').status_code == 503
+
+
+def test_readyz_after_warmup(monkeypatch):
+    from message_push import main
+
+    with MockJWKSServer() as jwks_server:
+        authz = AzureAuthorization(appid='appid', clientid='clientid', jwks_url_config=jwks_server.jwks_url)
+        monkeypatch.setattr(main, 'authz', authz)
+        monkeypatch.setattr(main, 'get_queue', lambda: None)
+        monkeypatch.setattr(main.MailConfig, 'template_warmup', False)
+        monkeypatch.setattr(main, 'warmup_task', None)
+        with TestClient(main.app) as client:
+            assert client.get('/healthz').status_code == 200
+            for _ in range(100):
+                if client.get('/readyz').status_code == 200:
+                    break
+                time.sleep(0.01)
+            assert client.get('/readyz').json() == {'status': 'ok'}
+        assert not authz._jwks_expired()
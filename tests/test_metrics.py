@@ -0,0 +1,72 @@
+import asyncio
+import pytest
+
+pytest.importorskip('loguru')
+pytest.importorskip('prometheus_client')
+
+from prometheus_client import REGISTRY
+from message_push.dispatch.queue import SQLiteQueue
+from message_push.dispatch.worker import Worker
+from message_push.sms.smsbox import SMSBox, SMSTemplate
+from tests.mocks import MockSMSGateway
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_sms_counters_and_latency():
+    with MockSMSGateway(max_batch=2) as gateway:
+        sms_box = SMSBox(gateway.account, gateway.auth_key, gateway.api_url)
+        sent = sample('message_push_sent_total', channel='sms')
+        failed = sample('message_push_failed_total', channel='sms')
+        calls = sample('message_push_stage_seconds_count', channel='sms', stage='provider_call')
+        sms_box.send('notice', SMSTemplate(['15000000000', '15000000001'], {}))
+        # 超过网关每次请求的手机号上限，返回 400
+        sms_box.send('notice', SMSTemplate(['15000000000', '15000000001', '15000000002'], {}))
+    assert sample('message_push_sent_total', channel='sms') - sent == 2
+    assert sample('message_push_failed_total', channel='sms') - failed == 3
+    assert sample('message_push_stage_seconds_count', channel='sms', stage='provider_call') - calls == 2
+
+
+def test_worker_job_counters(tmp_path):
+    queue = SQLiteQueue(str(tmp_path / 'dispatch.db'))
+    queue.enqueue('sms', {'ok': True})
+    queue.enqueue('sms', {'ok': False})
+    acked = sample('message_push_jobs_total', channel='sms', status='acked')
+    retried = sample('message_push_retried_total', channel='sms')
+    dropped = sample('message_push_jobs_total', channel='sms', status='dropped')
+
+    async def handler(payload):
+        assert sample('message_push_in_flight', channel='sms') >= 1
+        if not payload['ok']:
+            raise RuntimeError('provider error')
+
+    async def run():
+        worker = Worker(queue, 'sms', handler, concurrency=2, max_attempts=2)
+        task = asyncio.ensure_future(worker.run(block=0.05))
+        while queue.depth('sms'):
+            await asyncio.sleep(0.05)
+        worker.stop()
+        await task
+
+    asyncio.run(run())
+    assert sample('message_push_jobs_total', channel='sms', status='acked') - acked == 1
+    assert sample('message_push_retried_total', channel='sms') - retried == 1
+    assert sample('message_push_jobs_total', channel='sms', status='dropped') - dropped == 1
+    assert sample('message_push_in_flight', channel='sms') == 0
+
+
+def test_metrics_endpoint(tmp_path, monkeypatch):
+    from fastapi.testclient import TestClient
+    from message_push import main
+
+    queue = SQLiteQueue(str(tmp_path / 'dispatch.db'))
+    queue.enqueue('wechat', {})
+    queue.enqueue('wechat', {})
+    monkeypatch.setattr(main, 'get_queue', lambda: queue)
+    response = TestClient(main.app).get('/metrics')
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/plain')
+    assert 'message_push_queue_depth{channel="wechat"} 2.0' in response.text
+    assert 'message_push_queue_depth{channel="email"} 0.0' in response.text
@@ -0,0 +1,166 @@
+import asyncio
+import time
+import pytest
+
+pytest.importorskip('loguru')
+
+from message_push.ratelimit import LocalBucketStore, RateLimited, RateLimiter, RedisBucketStore, take
+from message_push.dispatch.queue import SQLiteQueue
+from message_push.dispatch.worker import Worker
+from message_push.resilience import DeliveryError
+
+
+@pytest.fixture(params=['local', 'redis'])
+def store(request):
+    if request.param == 'local':
+        return LocalBucketStore()
+    fakeredis = pytest.importorskip('fakeredis')
+    return RedisBucketStore(fakeredis.FakeStrictRedis())
+
+
+def test_take_paces_after_burst():
+    state, wait = take(None, 100.0, 3, rate=10, burst=5, per_day=0, max_wait=1)
+    assert wait == 0
+    # 桶中剩 2 个令牌，再取 4 个需要等待 0.2 秒，令牌可以预支
+    state, wait = take(state, 100.0, 4, rate=10, burst=5, per_day=0, max_wait=1)
+    assert wait == pytest.approx(0.2)
+    state, wait = take(state, 100.0, 1, rate=10, burst=5, per_day=0, max_wait=1)
+    assert wait == pytest.approx(0.3)
+    # 超过 max_wait 时不预支
+    rejected, wait = take(state, 100.0, 20, rate=10, burst=5, per_day=0, max_wait=1)
+    assert rejected is None
+    assert wait == pytest.approx(2.3)
+    _, wait = take(state, 101.0, 1, rate=10, burst=5, per_day=0, max_wait=1)
+    assert wait == 0
+
+
+def test_take_daily_quota():
+    now = 86400 * 10 + 3600.0
+    state, _ = take(None, now, 2, rate=0, burst=1, per_day=3, max_wait=1, utc_offset=0)
+    state, _ = take(state, now, 1, rate=0, burst=1, per_day=3, max_wait=1, utc_offset=0)
+    rejected, wait = take(state, now, 1, rate=0, burst=1, per_day=3, max_wait=1, utc_offset=0)
+    assert rejected is None
+    assert wait == pytest.approx(86400 - 3600)
+    # 第二天重新计数
+    _, wait = take(state, now + 86400, 1, rate=0, burst=1, per_day=3, max_wait=1, utc_offset=0)
+    assert wait == 0
+
+
+def test_limiter_throughput(store):
+    limiter = RateLimiter('sms', rate=200, burst=1, store=store)
+    start = time.monotonic()
+    for _ in range(41):
+        limiter.acquire()
+    assert 0.18 < time.monotonic() - start < 0.5
+
+
+def test_limiter_raises_when_wait_too_long(store):
+    limiter = RateLimiter('sms', rate=10, burst=2, max_wait=0.05, store=store)
+    limiter.acquire(tokens=2)
+    with pytest.raises(RateLimited) as e:
+        limiter.acquire(tokens=5)
+    assert e.value.retry_after == pytest.approx(0.5, abs=0.05)
+    assert e.value.retryable
+    # 被拒绝的请求不占用令牌
+    time.sleep(0.1)
+    assert limiter.reserve() == pytest.approx(0, abs=0.01)
+
+
+def test_limiter_per_key(store):
+    limiter = RateLimiter('wechat', rate=1000, max_wait=0, store=store,
+                          per_key=RateLimiter('wechat', per_day=2, store=store))
+    for template_id in ('t1', 't2'):
+        limiter.acquire(template_id)
+        limiter.acquire(template_id)
+    with pytest.raises(RateLimited):
+        limiter.acquire('t1')
+    # 渠道的限制不受模板配额影响
+    limiter.acquire()
+
+
+def test_per_key_rejection_keeps_channel_quota(store):
+    limiter = RateLimiter('sms', per_day=10, max_wait=0, store=store,
+                          per_key=RateLimiter('sms', rate=1, burst=1, max_wait=0, store=store))
+    limiter.acquire('t1')
+    for _ in range(9):
+        with pytest.raises(RateLimited):
+            limiter.acquire('t1')
+    # 被模板的限制拒绝时退还渠道的当日配额，其它模板不受影响
+    assert store.update('sms', lambda state: (None, state))[3] == 1
+    limiter.acquire('t2')
+    for _ in range(8):
+        limiter.acquire()
+    with pytest.raises(RateLimited):
+        limiter.acquire()
+
+
+def test_refund(store):
+    limiter = RateLimiter('email', rate=10, burst=1, per_day=5, max_wait=0, store=store)
+    limiter.acquire('a')
+    limiter.refund('a')
+    limiter.acquire('a')
+    assert store.update('email', lambda state: (None, state))[3] == 1
+
+
+def test_redis_limiter_shared_across_workers():
+    fakeredis = pytest.importorskip('fakeredis')
+    client = fakeredis.FakeStrictRedis()
+    workers = [RateLimiter('sms', rate=10, burst=3, max_wait=0, store=RedisBucketStore(client)) for _ in range(3)]
+    for limiter in workers:
+        limiter.acquire()
+    with pytest.raises(RateLimited):
+        workers[0].acquire()
+
+
+def test_from_config():
+    limiter = RateLimiter.from_config('email', {'rate': 0.5, 'per_day': 10000, 'max_wait': 3,
+                                                'per_key': {'per_day': 100}})
+    assert (limiter.rate, limiter.burst, limiter.per_day, limiter.max_wait) == (0.5, 1, 10000, 3)
+    assert limiter.per_key.per_day == 100
+    assert limiter.per_key.max_wait == 3
+    assert limiter.per_key.store is limiter.store
+    assert not RateLimiter.from_config('email', None).enabled
+
+
+def test_async_sms_requeues_when_rate_limited():
+    from message_push.sms.smsbox import AsyncSMSBox, SMSTemplate
+    from tests.mocks import MockSMSGateway
+
+    with MockSMSGateway(max_batch=10) as gateway:
+        sms_box = AsyncSMSBox(gateway.account, gateway.auth_key, gateway.api_url, batch_size=10, concurrency=1,
+                              rate_limiter=RateLimiter('sms', rate=10, burst=10, max_wait=0.5))
+        phones = [f'150{i:08d}' for i in range(30)]
+
+        async def send():
+            try:
+                return await sms_box.send('notice', SMSTemplate(phones, {}))
+            finally:
+                await sms_box.aclose()
+        result = asyncio.run(send())
+    # 第一批使用桶中的令牌，第二批需要等待约 1 秒，超过 max_wait
+    assert result['succeeded'] == phones[:10]
+    assert result['failed'] == phones[10:]
+    assert result['retry_after'] > 0.5
+    assert len(gateway.requests) == 1
+
+
+def test_worker_requeues_throttled_job_without_counting_attempts(tmp_path):
+    queue = SQLiteQueue(str(tmp_path / 'dispatch.db'))
+    calls = []
+
+    async def handler(payload):
+        calls.append(payload['to_users'])
+        if len(calls) < 4:
+            raise DeliveryError('rate limited', recipients=['b'], retry_after=0.01)
+
+    async def run():
+        worker = Worker(queue, 'sms', handler, max_attempts=2)
+        task = asyncio.ensure_future(worker.run(block=0.05))
+        while queue.depth('sms'):
+            await asyncio.sleep(0.05)
+        worker.stop()
+        await task
+
+    queue.enqueue('sms', {'to_users': ['a', 'b']})
+    asyncio.run(run())
+    assert calls == [['a', 'b'], ['b'], ['b'], ['b']]
@@ -0,0 +1,311 @@
+import asyncio
+import smtplib
+import time
+import pytest
+
+pytest.importorskip('loguru')
+
+from message_push.resilience import (CircuitBreaker, CircuitOpenError, DeliveryError, ProviderError, Retrier,
+                                     RetryPolicy)
+from message_push.ratelimit import RateLimited
+from message_push.dispatch.deadletter import RedisDeadLetterStore, SQLiteDeadLetterStore
+from message_push.dispatch.queue import SQLiteQueue
+from message_push.dispatch.worker import Worker
+
+
+def new_retrier(max_attempts=3, failure_threshold=5, reset_timeout=30, retry_codes=(503,)):
+    return Retrier('sms', RetryPolicy(max_attempts=max_attempts, base_delay=0.001, max_delay=0.01,
+                                      retry_codes=retry_codes),
+                   CircuitBreaker('test', failure_threshold=failure_threshold, reset_timeout=reset_timeout))
+
+
+def flaky(errors):
+    """
+    依次抛出 errors 中的错误，之后返回调用次数
+    """
+    calls = []
+
+    def func():
+        calls.append(1)
+        if errors:
+            raise errors.pop(0)
+        return len(calls)
+    return func, calls
+
+
+def test_backoff_is_bounded():
+    policy = RetryPolicy(base_delay=1, max_delay=5)
+    for attempt, cap in [(1, 1), (2, 2), (3, 4), (4, 5), (10, 5)]:
+        delays = [policy.backoff(attempt) for _ in range(200)]
+        assert all(0 <= d <= cap for d in delays)
+        assert max(delays) > cap / 2
+
+
+def test_is_retryable():
+    policy = RetryPolicy(retry_codes=(421, 503))
+    assert policy.is_retryable(ProviderError(503))
+    assert not policy.is_retryable(ProviderError(400))
+    assert policy.is_retryable(ProviderError(None, retryable=True))
+    assert policy.is_retryable(smtplib.SMTPDataError(421, b'try later'))
+    assert not policy.is_retryable(smtplib.SMTPDataError(550, b'rejected'))
+    assert policy.is_retryable(ConnectionResetError())
+    assert not policy.is_retryable(ValueError())
+
+
+def test_retrier_retries_transient_errors():
+    retrier = new_retrier()
+    func, calls = flaky([ProviderError(503), ProviderError(503)])
+    assert retrier.call(func) == 3
+    assert retrier.breaker.state == 'closed'
+
+    func, calls = flaky([ProviderError(503)] * 3)
+    with pytest.raises(ProviderError):
+        retrier.call(func)
+    assert len(calls) == 3
+
+
+def test_retrier_does_not_retry_permanent_errors():
+    retrier = new_retrier(failure_threshold=1)
+    func, calls = flaky([ProviderError(400)])
+    with pytest.raises(ProviderError):
+        retrier.call(func)
+    assert len(calls) == 1
+    # 4xx 说明服务商可用，不触发熔断
+    assert retrier.breaker.state == 'closed'
+
+
+def test_circuit_breaker_opens_and_recovers():
+    retrier = new_retrier(max_attempts=10, failure_threshold=3, reset_timeout=0.2)
+    func, calls = flaky([ProviderError(503)] * 10)
+    # 连续 3 次失败后熔断，不再继续重试
+    with pytest.raises(CircuitOpenError):
+        retrier.call(func)
+    assert len(calls) == 3
+    assert retrier.breaker.state == 'open'
+    with pytest.raises(CircuitOpenError):
+        retrier.call(func)
+    assert len(calls) == 3
+
+    # half-open 只放行一个试探请求，失败后重新熔断
+    time.sleep(0.25)
+    assert retrier.breaker.state == 'half-open'
+    retrier.breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        retrier.breaker.before_call()
+    retrier.breaker.record_failure()
+    assert retrier.breaker.state == 'open'
+
+    time.sleep(0.25)
+    func, calls = flaky([])
+    assert retrier.call(func) == 1
+    assert retrier.breaker.state == 'closed'
+
+
+@pytest.mark.parametrize('error', [RateLimited('q', 1.0), CircuitOpenError("all smtp accounts are ejected")])
+def test_half_open_probe_released(error):
+    retrier = new_retrier(max_attempts=1, failure_threshold=1, reset_timeout=0.1)
+    with pytest.raises(ProviderError):
+        retrier.call(flaky([ProviderError(503)])[0])
+    assert retrier.breaker.state == 'open'
+    time.sleep(0.15)
+    # 试探请求没有到达服务商（被限流、没有可用账号），不计入熔断，下一个请求继续试探
+    with pytest.raises(type(error)):
+        retrier.call(flaky([error])[0])
+    assert retrier.breaker.state == 'half-open'
+    assert retrier.call(flaky([])[0]) == 1
+    assert retrier.breaker.state == 'closed'
+
+    with pytest.raises(ProviderError):
+        retrier.call(flaky([ProviderError(503)])[0])
+    time.sleep(0.15)
+
+    async def probe():
+        raise error
+    with pytest.raises(type(error)):
+        asyncio.run(retrier.acall(probe))
+    assert retrier.call(flaky([])[0]) == 1
+    assert retrier.breaker.state == 'closed'
+
+
+def test_mailbox_probe_released_when_rate_limited():
+    from message_push.mail.mailbox import EmailTemplate, MailBox
+
+    class Limiter:
+        name = 'email'
+        limited = False
+
+        def refund(self, key='', tokens=1):
+            pass
+
+        def acquire(self, key='', tokens=1):
+            if self.limited:
+                raise RateLimited('email', 1.0)
+
+    limiter = Limiter()
+    mailbox = MailBox('user@example.com', 'password', retrier=new_retrier(failure_threshold=1, reset_timeout=0.1),
+                      rate_limiter=limiter)
+    sent = []
+    mailbox._sendmail_with = lambda account, to_addrs, msg: sent.append(to_addrs)
+    mail = EmailTemplate('subject', 'sender@example.com', ['to@example.com'], content='<p>hello</p>')
+    mailbox.retrier.breaker.record_failure()
+    time.sleep(0.15)
+    limiter.limited = True
+    with pytest.raises(RateLimited):
+        mailbox.send(mail)
+    limiter.limited = False
+    mailbox.send(mail)
+    assert sent == [['to@example.com']]
+    assert mailbox.retrier.breaker.state == 'closed'
+
+
+def test_async_retrier():
+    retrier = new_retrier()
+    calls = []
+
+    async def func():
+        calls.append(1)
+        if len(calls) < 3:
+            raise ProviderError(503)
+        return 'ok'
+
+    assert asyncio.run(retrier.acall(func)) == 'ok'
+    assert len(calls) == 3
+
+
+def test_sms_gateway_errors_retried():
+    from message_push.sms.smsbox import AsyncSMSBox, SMSTemplate
+    from tests.mocks import MockSMSGateway
+
+    with MockSMSGateway(max_batch=10) as gateway:
+        gateway.faults = [503, 502]
+        sms_box = AsyncSMSBox(gateway.account, gateway.auth_key, gateway.api_url, batch_size=10)
+
+        async def send():
+            try:
+                return await sms_box.send('notice', SMSTemplate(['15000000000'], {}))
+            finally:
+                await sms_box.aclose()
+        result = asyncio.run(send())
+    assert result['succeeded'] == ['15000000000']
+    assert len(gateway.requests) == 3
+
+
+def test_wechat_rate_limit_retried():
+    from message_push.wechat.wxbox import WXTemplate
+    from tests.mocks import MockWechatServer
+    from tests.test_wxbox import new_wxbox
+
+    with MockWechatServer() as server:
+        server.faults = [45009, -1]
+        wx_box = new_wxbox(server, {'union0': 'open0', 'union1': 'open1'})
+        wx_box.concurrency = 1
+
+        async def send():
+            try:
+                return await wx_box.async_send(['union0', 'union1'], 'template',
+                                               WXTemplate(message={"keyword1": {"value": "x"}}))
+            finally:
+                await wx_box.aclose()
+        result = asyncio.run(send())
+    assert sorted(result['succeeded']) == ['union0', 'union1']
+    assert result['failed'] == []
+    sent = [path for method, path, query, body in server.requests if path.endswith('/send')]
+    assert len(sent) == 4
+
+
+def test_smtp_temporary_failure_retried():
+    pytest.importorskip('aiosmtpd')
+    from message_push.mail.mailbox import EmailTemplate
+    from tests.mocks import SMTPSink
+    from tests.test_mailbox import new_mailbox
+
+    mail = EmailTemplate('subject', 'sender@example.com', ['to@example.com'], content='<p>hello</p>')
+    with SMTPSink() as sink:
+        mailbox = new_mailbox(sink)
+        sink.faults = ['421 try again later']
+        mailbox.send(mail)
+        assert len(sink.messages) == 1
+
+        sink.faults = ['554 transaction failed']
+        with pytest.raises(smtplib.SMTPDataError):
+            mailbox.send(mail)
+        assert sink.faults == []
+        mailbox.close()
+    assert len(sink.messages) == 1
+
+
+@pytest.fixture(params=['sqlite', 'redis'])
+def dead_letters(request, tmp_path):
+    if request.param == 'sqlite':
+        return SQLiteDeadLetterStore(str(tmp_path / 'dispatch.db'), max_size=3)
+    fakeredis = pytest.importorskip('fakeredis')
+    return RedisDeadLetterStore(fakeredis.FakeStrictRedis(), max_size=3)
+
+
+def test_dead_letter_store(dead_letters):
+    ids = [dead_letters.add('sms', {'n': i}, 'error', 3, job_id=f'job{i}') for i in range(2)]
+    dead_letters.add('email', {'n': 0}, 'error', 1)
+    letters = dead_letters.list('sms')
+    assert [letter.payload for letter in letters] == [{'n': 1}, {'n': 0}]
+    assert letters[0].job_id == 'job1'
+    assert letters[0].attempts == 3
+    assert dead_letters.count('sms') == 2
+    dead_letters.delete('sms', ids[0])
+    assert [letter.id for letter in dead_letters.list('sms')] == [ids[1]]
+
+
+def test_sqlite_dead_letter_store_trimmed(tmp_path):
+    store = SQLiteDeadLetterStore(str(tmp_path / 'dispatch.db'), max_size=3)
+    for i in range(5):
+        store.add('sms', {'n': i}, 'error', 1)
+    assert store.count('sms') == 3
+    assert [letter.payload['n'] for letter in store.list('sms')] == [4, 3, 2]
+
+
+def run_worker(queue, handler, dead_letters, max_attempts=3):
+    async def run():
+        worker = Worker(queue, 'sms', handler, concurrency=2, max_attempts=max_attempts,
+                        dead_letters=dead_letters)
+        task = asyncio.ensure_future(worker.run(block=0.05))
+        while queue.depth('sms'):
+            await asyncio.sleep(0.05)
+        worker.stop()
+        await task
+    asyncio.run(run())
+
+
+def test_worker_dead_letters_permanent_failure(tmp_path):
+    queue = SQLiteQueue(str(tmp_path / 'dispatch.db'))
+    store = SQLiteDeadLetterStore(str(tmp_path / 'dispatch.db'))
+    calls = []
+
+    async def handler(payload):
+        calls.append(payload)
+        raise DeliveryError('invalid template', retryable=False)
+
+    job_id = queue.enqueue('sms', {'to_users': ['a']})
+    run_worker(queue, handler, store)
+    assert len(calls) == 1
+    letter, = store.list('sms')
+    assert letter.job_id == job_id
+    assert letter.attempts == 1
+    assert 'invalid template' in letter.error
+
+
+def test_worker_retries_only_failed_recipients(tmp_path):
+    queue = SQLiteQueue(str(tmp_path / 'dispatch.db'))
+    store = SQLiteDeadLetterStore(str(tmp_path / 'dispatch.db'))
+    calls = []
+
+    async def handler(payload):
+        calls.append(payload['to_users'])
+        failed = [user for user in payload['to_users'] if user == 'b']
+        if failed:
+            raise DeliveryError('partial failure', recipients=failed)
+
+    queue.enqueue('sms', {'to_users': ['a', 'b', 'c']})
+    run_worker(queue, handler, store)
+    assert calls == [['a', 'b', 'c'], ['b'], ['b']]
+    letter, = store.list('sms')
+    assert letter.payload == {'to_users': ['b']}
+    assert letter.attempts == 3
@@ -0,0 +1,108 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import pytest
+
+pytest.importorskip('loguru')
+httpx = pytest.importorskip('httpx')
+
+from message_push import server
+
+APP = """
+import asyncio, os, sys
+from fastapi import FastAPI
+from message_push import server
+
+app = FastAPI()
+
+
+@app.get('/pid')
+async def pid():
+    return os.getpid()
+
+
+@app.get('/slow')
+async def slow():
+    await asyncio.sleep(1)
+    return 'done'
+
+
+server.serve(app, '127.0.0.1', int(sys.argv[1]), workers=2, graceful_timeout=10, log_level='warning')
+"""
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture()
+def web():
+    port = free_port()
+    process = subprocess.Popen([sys.executable, '-c', APP, str(port)], cwd=os.path.dirname(os.path.dirname(__file__)))
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 20
+    while True:
+        try:
+            httpx.get(url + '/pid')
+            break
+        except httpx.HTTPError:
+            assert time.monotonic() < deadline
+            time.sleep(0.1)
+    try:
+        yield process, url
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+
+def test_sigterm_drains_in_flight_requests(web):
+    process, url = web
+    with httpx.Client() as client:
+        result = []
+        thread = threading.Thread(target=lambda: result.append(client.get(url + '/slow', timeout=10)))
+        thread.start()
+        time.sleep(0.3)
+        process.send_signal(signal.SIGTERM)
+        thread.join()
+    assert result[0].status_code == 200
+    assert process.wait(timeout=10) == 0
+
+
+def test_crashed_worker_restarted(web):
+    process, url = web
+    pid = httpx.get(url + '/pid').json()
+    assert pid != process.pid
+    os.kill(pid, signal.SIGKILL)
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            # 被结束的进程的连接可能失败，由另一个或重新启动的 worker 处理
+            assert httpx.get(url + '/pid').json() != pid
+            break
+        except httpx.HTTPError:
+            assert time.monotonic() < deadline
+            time.sleep(0.1)
+    deadline = time.monotonic() + 5
+    while len(children(process.pid)) < 2 and time.monotonic() < deadline:
+        time.sleep(0.1)
+    assert len(children(process.pid)) == 2
+
+
+def children(pid: int) -> list:
+    with open(f'/proc/{pid}/task/{pid}/children') as f:
+        return f.read().split()
+
+
+def test_reset_after_fork():
+    from message_push.dedup import get_deduplicator
+
+    deduplicator = get_deduplicator()
+    server.reset_after_fork()
+    assert get_deduplicator() is not deduplicator
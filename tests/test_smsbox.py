@@ -0,0 +1,53 @@
+import asyncio
+import pytest
+
+pytest.importorskip('loguru')
+
+from message_push.sms.smsbox import AsyncSMSBox, SMSBox, SMSTemplate
+from tests.mocks import MockSMSGateway
+
+
+@pytest.fixture()
+def sms_gateway():
+    with MockSMSGateway(max_batch=10) as gateway:
+        yield gateway
+
+
+def new_sms_box(gateway, cls=AsyncSMSBox, **kwargs):
+    return cls(account=gateway.account, auth_key=gateway.auth_key, server=gateway.api_url, **kwargs)
+
+
+def send(sms_box, phones, content=None):
+    async def run():
+        try:
+            return await sms_box.send('notice', SMSTemplate(phones, content or {}))
+        finally:
+            await sms_box.aclose()
+    return asyncio.run(run())
+
+
+def test_async_send_in_batches(sms_gateway):
+    sms_box = new_sms_box(sms_gateway, batch_size=10, concurrency=3)
+    phones = [f'150{i:08d}' for i in range(95)]
+    result = send(sms_box, phones, {'name': 'x'})
+    assert result['batches'] == 10
+    assert sorted(result['succeeded']) == phones
+    assert result['failed'] == []
+    assert sorted(sms_gateway.phone_numbers) == phones
+    assert sms_gateway.requests[0][3]['messageBody'] == {'templateParam': {'name': 'x'}, 'templateName': 'notice'}
+
+
+def test_async_send_reports_failed_batches(sms_gateway):
+    # 网关每次最多接受 10 个手机号，第一批 20 个被拒绝，第二批 10 个成功
+    sms_box = new_sms_box(sms_gateway, batch_size=20)
+    phones = [f'150{i:08d}' for i in range(30)]
+    result = send(sms_box, phones)
+    errors = result.pop('errors')
+    assert list(errors.values()) == [phones[:20]]
+    assert '400' in list(errors)[0]
+    assert result == {'batches': 2, 'succeeded': phones[20:], 'failed': phones[:20], 'retryable': False, 'retry_after': 0}
+
+
+def test_sync_send(sms_gateway):
+    new_sms_box(sms_gateway, cls=SMSBox).send('notice', SMSTemplate(['15000000000'], {}))
+    assert sms_gateway.phone_numbers == ['15000000000']
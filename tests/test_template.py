@@ -0,0 +1,60 @@
+import os
+import pytest
+
+pytest.importorskip('azure.storage.blob')
+pytest.importorskip('loguru')
+
+from fastapi import HTTPException
+from message_push.mail.template import TemplateAzure
+from tests.mocks import LocalBlobContainer
+
+
+@pytest.fixture()
+def container(tmp_path):
+    (tmp_path / 'notice.html').write_text('<p>{{ name }}</p>', encoding='utf8')
+    return LocalBlobContainer(str(tmp_path))
+
+
+def test_compiled_template_is_cached(container):
+    loader = TemplateAzure(container=container, revalidate_interval=60)
+    for name in ('a', 'b', 'c'):
+        assert loader.render('notice.html', name=name) == f'<p>{name}</p>'
+    assert container.downloads == 1
+
+
+def test_revalidate_with_etag(container):
+    loader = TemplateAzure(container=container, revalidate_interval=0)
+    template = loader.get_template('notice.html')
+    # 未修改时返回 304，继续使用已编译的模板
+    assert loader.get_template('notice.html') is template
+    assert (container.downloads, container.transfers) == (2, 1)
+
+    path = os.path.join(container.path, 'notice.html')
+    with open(path, 'w', encoding='utf8') as f:
+        f.write('<h1>{{ name }}</h1>')
+    os.utime(path, ns=(0, 1))
+    assert loader.render('notice.html', name='x') == '<h1>x</h1>'
+    assert container.transfers == 2
+
+
+def test_template_index_is_cached(container):
+    loader = TemplateAzure(container=container, index_interval=60, miss_interval=60)
+    for _ in range(3):
+        assert loader.is_teplate_exist('notice.html')
+    with pytest.raises(HTTPException) as e:
+        loader.is_teplate_exist('missing.html')
+    assert e.value.status_code == 404
+    assert container.lists == 1
+
+
+def test_warmup(container):
+    loader = TemplateAzure(container=container)
+    loader.warmup()
+    assert container.downloads == 1
+    loader.render('notice.html', name='x')
+    assert container.downloads == 1
+
+
+def test_get_template_content_error(container):
+    loader = TemplateAzure(container=container)
+    assert loader.get_template_content('missing.html', name='x') == "error"
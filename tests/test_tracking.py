@@ -0,0 +1,174 @@
+import asyncio
+import time
+import pytest
+
+pytest.importorskip('loguru')
+
+from message_push.dispatch.queue import SQLiteQueue
+from message_push.dispatch.tracking import (DeliveryEvent, DeliveryLog, RedisDeliveryLogStore, SQLiteDeliveryLogStore,
+                                            summarize)
+from message_push.dispatch.worker import Worker
+from message_push.resilience import DeliveryError
+
+
+@pytest.fixture(params=['sqlite', 'redis'])
+def store(request, tmp_path):
+    if request.param == 'sqlite':
+        return SQLiteDeliveryLogStore(str(tmp_path / 'dispatch.db'))
+    fakeredis = pytest.importorskip('fakeredis')
+    return RedisDeliveryLogStore(fakeredis.FakeStrictRedis())
+
+
+def test_store_events_and_listing(store):
+    now = time.time()
+    events = [DeliveryEvent(f'm{i}', 'sms' if i % 2 else 'email', 'queued', ['a', 'b'], ts=now + i * 0.001)
+              for i in range(5)]
+    store.append(events + [DeliveryEvent('m1', 'sms', 'delivered', ['a'], ts=now + 0.01)])
+    assert [e.status for e in store.events('m1')] == ['queued', 'delivered']
+    assert store.events('unknown') == []
+
+    page, cursor = store.messages(now, now + 1, limit=2)
+    assert [e.message_id for e in page] == ['m0', 'm1']
+    page, cursor = store.messages(now, now + 1, limit=2, cursor=cursor)
+    assert [e.message_id for e in page] == ['m2', 'm3']
+    page, cursor = store.messages(now, now + 1, limit=2, cursor=cursor)
+    assert [e.message_id for e in page] == ['m4']
+    assert cursor is None
+
+    page, _ = store.messages(now, now + 1, limit=10, channel='sms')
+    assert [e.message_id for e in page] == ['m1', 'm3']
+    page, _ = store.messages(now + 0.0015, now + 0.0035, limit=10)
+    assert [e.message_id for e in page] == ['m2', 'm3']
+
+
+def test_scheduled_messages_listed(store):
+    now = time.time()
+    store.append([DeliveryEvent('m0', 'sms', 'queued', ['a'], ts=now),
+                  DeliveryEvent('m1', 'sms', 'scheduled', ['a'], 'send at 2030-01-01T09:00:00+0800', ts=now + 0.001),
+                  DeliveryEvent('m1', 'sms', 'sending', ['a'], ts=now + 0.002)])
+    page, _ = store.messages(now, now + 1, limit=10)
+    assert [(e.message_id, e.status) for e in page] == [('m0', 'queued'), ('m1', 'scheduled')]
+    assert summarize(store.events('m1')[:1])['status'] == 'scheduled'
+
+
+def test_summarize():
+    events = [DeliveryEvent('m', 'sms', 'queued', ['a', 'b'], ts=1),
+              DeliveryEvent('m', 'sms', 'sending', ['a', 'b'], ts=2),
+              DeliveryEvent('m', 'sms', 'delivered', ['a'], ts=3),
+              DeliveryEvent('m', 'sms', 'failed', ['b'], 'ProviderError(400)', ts=3)]
+    message = summarize(events)
+    assert message['status'] == 'partial'
+    assert message['recipients']['b'] == {'status': 'failed', 'detail': 'ProviderError(400)', 'updated_at': 3}
+    assert summarize(events[:2])['status'] == 'sending'
+    assert summarize(events[:3])['status'] == 'sending'
+    assert summarize(events + [DeliveryEvent('m', 'sms', 'delivered', ['b'], ts=4)])['status'] == 'delivered'
+
+
+def test_delivery_log_batches_writes(tmp_path):
+    class CountingStore(SQLiteDeliveryLogStore):
+        batches = []
+
+        def append(self, events):
+            self.batches.append(len(events))
+            super(CountingStore, self).append(events)
+
+    log = DeliveryLog(CountingStore(str(tmp_path / 'dispatch.db')), batch_size=100, flush_interval=10)
+    start = time.perf_counter()
+    for i in range(1000):
+        log.record(f'm{i}', 'sms', 'queued', ['15000000000'])
+    # 记录只写入缓冲区，不访问存储
+    assert (time.perf_counter() - start) / 1000 < 0.0005
+    log.close()
+    assert sum(CountingStore.batches) == 1000
+    assert max(CountingStore.batches) == 100
+    assert log.get('m999')['status'] == 'queued'
+    assert log.get('unknown') is None
+
+
+def test_worker_records_recipient_states(tmp_path):
+    queue = SQLiteQueue(str(tmp_path / 'dispatch.db'))
+    log = DeliveryLog(SQLiteDeliveryLogStore(str(tmp_path / 'dispatch.db')), flush_interval=0.01)
+    calls = []
+
+    async def handler(payload):
+        calls.append(payload['to_users'])
+        if len(calls) == 1:
+            result = {'succeeded': ['a'], 'failed': ['b'], 'errors': {'ProviderError(503)': ['b'],
+                                                                      'openid not found': ['c']}}
+            raise DeliveryError('partial failure', recipients=['b'], result=result)
+        return {'succeeded': payload['to_users'], 'failed': [], 'errors': {}}
+
+    async def run():
+        worker = Worker(queue, 'wechat', handler, delivery_log=log)
+        task = asyncio.ensure_future(worker.run(block=0.05))
+        while queue.depth('wechat'):
+            await asyncio.sleep(0.05)
+        worker.stop()
+        await task
+
+    job_id = queue.enqueue('wechat', {'to_users': ['a', 'b', 'c']})
+    log.record(job_id, 'wechat', 'queued', ['a', 'b', 'c'])
+    asyncio.run(run())
+    message = log.get(job_id)
+    log.close()
+    assert calls == [['a', 'b', 'c'], ['b']]
+    assert message['status'] == 'partial'
+    assert {user: state['status'] for user, state in message['recipients'].items()} == \
+        {'a': 'delivered', 'b': 'delivered', 'c': 'failed'}
+    assert message['recipients']['c']['detail'] == 'openid not found'
+    assert [(e['status'], e['recipients']) for e in message['events']] == \
+        [('queued', 3), ('sending', 3), ('delivered', 1), ('failed', 1), ('failed', 1), ('sending', 1),
+         ('delivered', 1)]
+
+
+@pytest.fixture()
+def client(tmp_path, monkeypatch):
+    pytest.importorskip('httpx')
+    from fastapi.testclient import TestClient
+    from message_push import main
+    from message_push.authorize import has_access
+
+    queue = SQLiteQueue(str(tmp_path / 'dispatch.db'))
+    log = DeliveryLog(SQLiteDeliveryLogStore(str(tmp_path / 'dispatch.db')))
+    monkeypatch.setattr(main, 'get_queue', lambda: queue)
+    monkeypatch.setattr(main, 'get_delivery_log', lambda: log)
+    main.app.dependency_overrides[has_access] = lambda: True
+    try:
+        yield TestClient(main.app)
+    finally:
+        main.app.dependency_overrides.clear()
+        log.close()
+
+
+def test_message_status_api(client):
+    body = {"template_name": "notice", "to_users": ["15000000000", "15000000001"], "message": {"name": "x"}}
+    resp = client.post("/api/v1/services/sms/messages", json=body)
+    assert resp.json() == "success"
+    message_id = resp.headers['X-Message-Id']
+
+    message = client.get(f"/api/v1/messages/{message_id}").json()
+    assert message['status'] == 'queued'
+    assert sorted(message['recipients']) == body['to_users']
+    assert client.get("/api/v1/messages/unknown").status_code == 404
+
+    second = client.post("/api/v1/services/sms/messages", json=body).headers['X-Message-Id']
+    page = client.get("/api/v1/messages", params={"limit": 1}).json()
+    assert [m['id'] for m in page['messages']] == [message_id]
+    assert page['messages'][0]['recipients'] == 2
+    page = client.get("/api/v1/messages", params={"limit": 1, "cursor": page['next_cursor']}).json()
+    assert [m['id'] for m in page['messages']] == [second]
+    assert page['next_cursor'] is None
+    assert client.get("/api/v1/messages", params={"channel": "email"}).json()['messages'] == []
+
+
+def test_delivery_log_restarts_after_fork(tmp_path):
+    log = DeliveryLog(SQLiteDeliveryLogStore(str(tmp_path / 'dispatch.db')), flush_interval=10)
+    log.record('parent', 'sms', 'queued', ['a'])
+    thread = log._thread
+    # 模拟 fork 之后的子进程：后台线程不存在，继承的缓冲区由父进程写入
+    log._pid = -1
+    log.record('child', 'sms', 'queued', ['a'])
+    assert log._thread is not thread and log._thread.is_alive()
+    log.close()
+    assert log.get('parent') is None
+    assert log.get('child')['status'] == 'queued'
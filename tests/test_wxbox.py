@@ -0,0 +1,142 @@
+import asyncio
+import pytest
+
+pytest.importorskip('loguru')
+
+from message_push.wechat.wxbox import WXBox, WXTemplate
+from tests.mocks import MockWechatServer, StaticAzureAuthorization, DictOpenIDCache
+
+
+@pytest.fixture()
+def wechat_server():
+    with MockWechatServer() as server:
+        yield server
+
+
+def new_wxbox(server, users: dict):
+    wx_box = WXBox(azure_authz=StaticAzureAuthorization(), wx_openid_cache=DictOpenIDCache(users))
+    wx_box.wx_token_url = server.token_url
+    wx_box.wx_api_url = server.api_url
+    wx_box.http2 = False
+    return wx_box
+
+
+def test_async_send(wechat_server):
+    users = {f'union{i}': f'open{i}' for i in range(20)}
+    wx_box = new_wxbox(wechat_server, users)
+    wx_box.concurrency = 4
+    msg = WXTemplate(message={"keyword1": {"value": "Company"}, "remark": {"value": "remark", "color": "#ff0000"}},
+                     miniprogram={"appid": "wxid", "pagepath": "page/xx"})
+
+    async def send():
+        await wx_box.async_send(list(users) + ['unknown'], 'template', msg)
+        await wx_box.aclose()
+
+    asyncio.run(send())
+    sent = [body for method, path, query, body in wechat_server.requests if path.endswith('/send')]
+    assert sorted(body['touser'] for body in sent) == sorted(users.values())
+    assert sent[0]['data']['keyword1']['color'] == '#0c74da'
+    assert sent[0]['data']['remark']['color'] == '#ff0000'
+    assert sent[0]['miniprogram'] == {"appid": "wxid", "pagepath": "page/xx"}
+
+
+def token_requests(server):
+    return [path for method, path, query, body in server.requests if path == '/token']
+
+
+def test_token_cached_across_sends(wechat_server):
+    users = {'union0': 'open0'}
+    wx_box = new_wxbox(wechat_server, users)
+    msg = WXTemplate(message={"keyword1": {"value": "Company"}})
+
+    async def send():
+        for _ in range(3):
+            await wx_box.async_send(list(users), 'template', msg)
+        await wx_box.aclose()
+
+    asyncio.run(send())
+    wx_box.send(list(users), 'template', msg)
+    assert len(token_requests(wechat_server)) == 1
+
+
+def test_token_refresh_single_flight(wechat_server):
+    wx_box = new_wxbox(wechat_server, {})
+    wechat_server.latency = 0.05
+
+    async def get_tokens():
+        return await asyncio.gather(*[wx_box.token_manager.get_token() for _ in range(20)])
+
+    assert asyncio.run(get_tokens()) == [wechat_server.access_token] * 20
+    assert len(token_requests(wechat_server)) == 1
+
+
+def test_invalid_token_refreshed_and_retried(wechat_server):
+    users = {f'union{i}': f'open{i}' for i in range(10)}
+    wx_box = new_wxbox(wechat_server, users)
+    msg = WXTemplate(message={"keyword1": {"value": "Company"}})
+
+    async def send():
+        await wx_box.token_manager.get_token()
+        # 中控服务器刷新了 token，缓存的 token 失效
+        wechat_server.access_token = 'rotated-token'
+        await wx_box.async_send(list(users), 'template', msg)
+        await wx_box.aclose()
+
+    asyncio.run(send())
+    accepted = [query['access_token'] for method, path, query, body in wechat_server.requests
+                if path.endswith('/send') and query['access_token'] == 'rotated-token']
+    assert len(accepted) == len(users)
+    assert len(token_requests(wechat_server)) == 2
+
+
+def test_async_send_reads_openids_without_blocking(wechat_server, monkeypatch):
+    fakeredis = pytest.importorskip('fakeredis')
+    from message_push.caches import AsyncWxOpenIDCache, LocalCache
+
+    wx_box = new_wxbox(wechat_server, {})
+
+    def blocking_lookup(to_users):
+        raise AssertionError('sync redis used in async_send')
+    monkeypatch.setattr(wx_box, '_get_wx_openids', blocking_lookup)
+
+    async def send():
+        client = fakeredis.aioredis.FakeRedis()
+        await client.mset({'union0': 'open0', 'union1': 'open1'})
+        wx_box.async_openid_cache = AsyncWxOpenIDCache(client=client, local_cache=LocalCache())
+        result = await wx_box.async_send(['union0', 'union1', 'unknown'], 'template',
+                                         WXTemplate(message={"keyword1": {"value": "x"}}))
+        await wx_box.aclose()
+        await client.aclose()
+        return result
+
+    result = asyncio.run(send())
+    assert sorted(result['succeeded']) == ['union0', 'union1']
+    sent = [body['touser'] for method, path, query, body in wechat_server.requests if path.endswith('/send')]
+    assert sorted(sent) == ['open0', 'open1']
+
+
+def test_token_shared_between_processes(wechat_server):
+    fakeredis = pytest.importorskip('fakeredis')
+    from message_push.caches import SharedValue
+    from message_push.wechat.token import WXTokenManager
+
+    server = fakeredis.FakeServer()
+
+    def new_manager():
+        shared = SharedValue('wx_token', client=fakeredis.FakeStrictRedis(server=server),
+                             async_client=fakeredis.aioredis.FakeRedis(server=server))
+        return WXTokenManager(StaticAzureAuthorization(), wechat_server.token_url, shared=shared)
+
+    first, second, third = new_manager(), new_manager(), new_manager()
+
+    async def get_tokens():
+        token = await first.get_token()
+        assert await second.get_token() == token
+        # 微信返回 token 失效后，不再使用共享的同一个 token
+        wechat_server.access_token = 'rotated-token'
+        second.invalidate(token)
+        assert await second.get_token() == 'rotated-token'
+
+    asyncio.run(get_tokens())
+    assert third.get_token_sync() == 'rotated-token'
+    assert len(token_requests(wechat_server)) == 2